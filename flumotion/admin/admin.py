@@ -159,6 +159,107 @@ class AdminClientFactory(fpb.ReconnectingFPBClientFactory):
 # objects and real interfaces for the views a model communicates with
 
 
+class StateSubscription(log.Loggable):
+    """
+    I am a subscription of an admin client to some keys of some component
+    states of the manager, as made by L{AdminModel.subscribe}.
+
+    I keep a copy of the keys subscribed to, and tell my listeners about
+    their changes.
+
+    @ivar id:         the id of the subscription in the manager
+    @type id:         int
+    @ivar components: the keys subscribed to and their value, by avatarId
+                      of the matching components
+    @type components: dict of str -> dict
+    """
+
+    logCategory = 'subscription'
+
+    def __init__(self, model, subscriptionId, components):
+        self.model = model
+        self.id = subscriptionId
+        self.components = components
+        self._listeners = {}
+
+    def get(self, avatarId, key, otherwise=None):
+        """
+        Get the value of a key of a component subscribed to.
+
+        Return otherwise when the component or the key are not subscribed
+        to, or the value is None.
+        """
+        v = self.components.get(avatarId, {}).get(key)
+        if v is None:
+            return otherwise
+        return v
+
+    def addListener(self, listener, set_=None, append=None, remove=None,
+                    setitem=None, delitem=None, added=None, removed=None):
+        """
+        Add a listener to the changes of the keys subscribed to.
+
+        The procedures are called like those given to
+        L{flumotion.twisted.flavors.StateRemoteCache.addListener}, with
+        the avatarId of the component instead of its state. The added and
+        removed procedures are called with the avatarId of the components
+        matching the subscription that are added or removed.
+
+        Always call this method using keyword arguments for the functions.
+        """
+        if listener in self._listeners:
+            raise KeyError(
+                "%r is already a listener of %r" % (listener, self))
+        self._listeners[listener] = {'set': set_, 'append': append,
+                                     'remove': remove, 'setitem': setitem,
+                                     'delitem': delitem, 'added': added,
+                                     'removed': removed}
+
+    def removeListener(self, listener):
+        del self._listeners[listener]
+
+    def cancel(self):
+        """
+        Cancel the subscription.
+
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+        return self.model.unsubscribe(self)
+
+    def eventReceived(self, avatarId, event, args):
+        if event == 'added':
+            self.components[avatarId] = args[0]
+        elif event == 'removed':
+            self.components.pop(avatarId, None)
+        elif avatarId not in self.components:
+            self.warning('%s event for unknown component %s',
+                         event, avatarId)
+            return
+        else:
+            state = self.components[avatarId]
+            if event == 'set':
+                state[args[0]] = args[1]
+            elif event == 'append':
+                state.setdefault(args[0], []).append(args[1])
+            elif event == 'remove':
+                if args[1] in state.get(args[0], []):
+                    state[args[0]].remove(args[1])
+            elif event == 'setitem':
+                state.setdefault(args[0], {})[args[1]] = args[2]
+            elif event == 'delitem':
+                state.get(args[0], {}).pop(args[1], None)
+
+        for procs in self._listeners.values():
+            proc = procs.get(event)
+            if proc:
+                try:
+                    proc(avatarId, *args)
+                except Exception, e:
+                    # These are all programming errors
+                    self.warning('Exception in subscription listener: %s',
+                                 log.getExceptionMessage(e))
+
+
 class AdminModel(medium.PingingMedium, signals.SignalMixin):
     """
     I live in the admin client.
@@ -195,6 +296,8 @@ class AdminModel(medium.PingingMedium, signals.SignalMixin):
         self._components = {} # dict of components
         self.planet = None
         self._workerHeavenState = None
+        self._fullState = True
+        self._subscriptions = {} # subscription id -> StateSubscription
 
     def disconnectFromManager(self):
         """
@@ -212,7 +315,7 @@ class AdminModel(medium.PingingMedium, signals.SignalMixin):
             self.clientFactory = None
 
     def connectToManager(self, connectionInfo, keepTrying=False,
-                         writeConnection=True):
+                         writeConnection=True, fullState=True):
         """
         Connects to the specified manager.
 
@@ -224,6 +327,10 @@ class AdminModel(medium.PingingMedium, signals.SignalMixin):
         @param writeConnection: when this is L{True} the connection is saved
                                 for future uses on cache
         @type  writeConnection: bool
+        @param fullState:       when this is L{False} the planet and worker
+                                heaven states are not retrieved, for clients
+                                only using L{subscribe}
+        @type  fullState:       bool
 
         @rtype: L{twisted.internet.defer.Deferred}
         """
@@ -231,6 +338,7 @@ class AdminModel(medium.PingingMedium, signals.SignalMixin):
 
         self.connectionInfo = connectionInfo
         self._writeConnection = writeConnection
+        self._fullState = fullState
 
         # give the admin an id unique to the manager -- if a program is
         # adminning multiple managers, this id should tell them apart
@@ -443,6 +551,12 @@ class AdminModel(medium.PingingMedium, signals.SignalMixin):
 
         self.remote.notifyOnDisconnect(self._remoteDisconnected)
 
+        if not self._fullState:
+            self.debug('Connected to manager, not retrieving its state')
+            self.connected = True
+            self.emit('connected')
+            return defer.succeed(None)
+
         d = self.callRemote('getPlanetState')
         d.addCallback(gotPlanetState)
         d.addCallback(gotWorkerHeavenState)
@@ -560,7 +674,51 @@ class AdminModel(medium.PingingMedium, signals.SignalMixin):
     def getWorkerHeavenState(self):
         return self._workerHeavenState
 
+    def subscribe(self, flows=None, components=None, keys=None):
+        """
+        Subscribe to some keys of some component states, filtered in the
+        manager, instead of observing the whole planet state.
+
+        Each of flows, components and keys is a list of shell-style
+        patterns, matching the names of the flows, the avatarIds of the
+        components and the keys of their states, or None to match
+        everything.
+
+        @rtype: L{twisted.internet.defer.Deferred} firing a
+                L{StateSubscription}
+        """
+
+        def subscribed((subscriptionId, snapshot)):
+            subscription = StateSubscription(self, subscriptionId, snapshot)
+            self._subscriptions[subscriptionId] = subscription
+            return subscription
+        d = self.callRemote('subscribe', flows, components, keys)
+        d.addCallback(subscribed)
+        return d
+
+    def unsubscribe(self, subscription):
+        """
+        Cancel a subscription made with L{subscribe}.
+
+        @type subscription: L{StateSubscription}
+
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+        self._subscriptions.pop(subscription.id, None)
+        return self.callRemote('unsubscribe', subscription.id)
+
+    def remote_subscriptionEvent(self, subscriptionId, avatarId, event,
+                                 args):
+        subscription = self._subscriptions.get(subscriptionId)
+        if subscription is None:
+            self.debug('event for cancelled subscription %d',
+                       subscriptionId)
+            return
+        subscription.eventReceived(avatarId, event, args)
+
     def _remoteDisconnected(self, remoteReference):
+        # the subscriptions are gone with the avatar
+        self._subscriptions = {}
         self.debug("emitting disconnected")
         self.connected = False
         self.emit('disconnected')
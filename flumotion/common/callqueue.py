@@ -0,0 +1,95 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_common_callqueue -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""batched hand-off of calls from a thread to the reactor
+"""
+
+from collections import deque
+
+from twisted.internet import reactor
+
+from flumotion.common import log, poller
+
+__version__ = "$Rev$"
+
+
+class ThreadedCallQueue(object, log.Loggable):
+    """A queue of calls made from a single thread, like a GStreamer
+    streaming thread, to be run in the reactor thread.
+
+    Unlike reactor.callFromThread, queuing a call doesn't wake up the
+    reactor. The queued calls are run in order, in batches, either
+    periodically or as soon as the number of queued calls reaches a
+    threshold. As deque's append and popleft are atomic, no lock is
+    needed between the producing thread and the reactor.
+    """
+
+    logCategory = 'callqueue'
+
+    def __init__(self, interval, threshold):
+        """
+        @param interval:  float number of seconds between periodic runs
+        @param threshold: number of queued calls triggering a run
+        """
+        self.interval = interval
+        self.threshold = threshold
+
+        # number of times the queue woke up the reactor from a thread
+        self.wakeups = 0
+        # number of calls run from the queue
+        self.calls = 0
+
+        self._calls = deque()
+        self._wakeupPending = False
+        self._poller = poller.Poller(self.run, interval, start=False)
+
+    def start(self):
+        """Start running the queued calls periodically.
+        """
+        self._poller.start()
+
+    def stop(self):
+        """Stop running the queued calls periodically, and run the calls
+        that are still queued.
+        """
+        self._poller.stop()
+        self.run()
+
+    def callFromThread(self, f, *args):
+        """Queue a call to be run in the reactor thread.
+
+        Can be called from any thread, but only from a single one.
+        """
+        self._calls.append((f, args))
+        if len(self._calls) >= self.threshold and not self._wakeupPending:
+            self._wakeupPending = True
+            self.wakeups += 1
+            reactor.callFromThread(self.run)
+
+    def run(self):
+        """Run all the queued calls. Must be called in the reactor thread.
+        """
+        self._wakeupPending = False
+        calls = self._calls
+        while calls:
+            f, args = calls.popleft()
+            self.calls += 1
+            try:
+                f(*args)
+            except Exception, e:
+                self.warning("Queued call to %r failed: %s", f,
+                             log.getExceptionMessage(e))
@@ -99,9 +99,7 @@ class DAG(log.Loggable):
 
         @rtype: Boolean
         """
-        if (object, type) in self._nodes.keys():
-            return True
-        return False
+        return (object, type) in self._nodes
 
     def removeNode(self, object, type=0):
         """
@@ -116,11 +114,9 @@ class DAG(log.Loggable):
                 object, type))
         node = self._getNode(object, type)
         self.debug("Removing node (%r, %r)" % (object, type))
-        # go through all the nodes and remove edges that end in this node
-        for somenodeobj, somenodetype in self._nodes:
-            somenode = self._nodes[(somenodeobj, somenodetype)]
-            if node in somenode.children:
-                self.removeEdge(somenodeobj, object, somenodetype, type)
+        # remove edges that end in this node
+        for parent in node.parents[:]:
+            self.removeEdge(parent.object, object, parent.type, type)
 
         del self._nodes[(object, type)]
 
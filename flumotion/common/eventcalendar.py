@@ -15,6 +15,7 @@
 #
 # Headers in this file shall remain intact.
 
+import bisect
 import datetime
 
 HAS_ICALENDAR = False
@@ -47,6 +48,11 @@ and HAS_DATEUTIL properties and if any of them is False, they should
 withhold from further using the module.
 """
 
+# how far ahead of the time asked for recurrences get expanded
+EXPANSION_WINDOW = datetime.timedelta(days=1)
+# number of past occurrences of a recurrence kept before forgetting them
+PRUNE_THRESHOLD = 1024
+
 
 def _toDateTime(d):
     """
@@ -219,6 +225,120 @@ class Event(log.Loggable):
         return not self.__eq__(other)
 
 
+class Timeline(log.Loggable):
+    """
+    I hold the start times of the occurrences of a recurring event, in
+    order, expanding them from its recurrence rule as later times are
+    asked for.
+
+    Occurrences that no query from the last time asked for on needs are
+    eventually forgotten, so my size doesn't grow with the age of the
+    recurrence. Asking for an earlier time expands the rule from the
+    beginning again.
+
+    @type event:    L{Event}
+    @type duration: L{datetime.timedelta}
+    """
+
+    def __init__(self, event, excluded):
+        """
+        @param event:    the recurring event
+        @type  event:    L{Event}
+        @param excluded: start times of the occurrences not to return,
+                         because of exception dates or overriding events
+        @type  excluded: dict of L{datetime.datetime} -> True
+        """
+        self.event = event
+        self.duration = event.end - event.start
+        self._excluded = excluded
+        self._reset()
+
+    def _reset(self):
+        # FIXME: support multiple RRULE; see 4.8.5.4 Recurrence Rule
+        self._rule = iter(rrule.rrulestr(self.event.rrules[0],
+                                         dtstart=self.event.start))
+        self._starts = []
+        self._next = self._advance()
+        # occurrences starting before this may have been forgotten
+        self._prunedUntil = None
+
+    def _advance(self):
+        try:
+            return self._rule.next()
+        except StopIteration:
+            return None
+
+    def _expand(self, lowest, until):
+        # expand the occurrences starting before until and a window more,
+        # keeping only the last one of those starting before lowest
+        if self._next is None or self._next >= until:
+            return
+        until += EXPANSION_WINDOW
+        starts = self._starts
+        next = self._next
+        while next is not None and next < until:
+            if len(starts) == 1 and next < lowest:
+                starts[0] = next
+                self._prunedUntil = next
+            else:
+                starts.append(next)
+            next = self._advance()
+        self._next = next
+
+    def _prune(self, lowest):
+        # forget the occurrences starting before lowest, but the last one
+        i = bisect.bisect_left(self._starts, lowest) - 1
+        if i > PRUNE_THRESHOLD:
+            del self._starts[:i]
+            self._prunedUntil = self._starts[0]
+
+    def getStarts(self, start, end):
+        """
+        Get the start times of the occurrences ending at or after start,
+        and starting before end.
+
+        @type  start: L{datetime.datetime}
+        @type  end:   L{datetime.datetime}
+
+        @rtype: list of L{datetime.datetime}
+        """
+        lowest = start - self.duration
+        if self._prunedUntil is not None and lowest < self._prunedUntil:
+            self._reset()
+        self._expand(lowest, end)
+        self._prune(lowest)
+
+        starts = self._starts
+        lo = bisect.bisect_left(starts, lowest)
+        hi = bisect.bisect_left(starts, end)
+        excluded = self._excluded
+        return [s for s in starts[lo:hi] if s not in excluded]
+
+    def getLastStart(self, dt):
+        """
+        Get the start time of the last occurrence starting before dt,
+        unless it is excluded.
+
+        @type  dt: L{datetime.datetime}
+
+        @rtype: L{datetime.datetime} or None
+        """
+        if self._prunedUntil is not None and dt <= self._prunedUntil:
+            self._reset()
+        self._expand(dt - self.duration, dt)
+        self._prune(dt - self.duration)
+
+        i = bisect.bisect_left(self._starts, dt)
+        if not i:
+            return None
+        dtstart = self._starts[i - 1]
+        if dtstart in self._excluded:
+            self.log('occurrence of %r at %r is excluded',
+                     self.event, dtstart)
+            return None
+        return dtstart
+
+
 class EventSet(log.Loggable):
     """
     I represent a set of VEVENT entries in a calendar sharing the same uid.
@@ -235,6 +355,8 @@ class EventSet(log.Loggable):
         """
         self.uid = uid
         self._events = []
+        self._timeline = None
+        self._timelineStale = True
 
     def __repr__(self):
         return "<EventSet for uid %r >" % (
@@ -253,6 +375,7 @@ class EventSet(log.Loggable):
             event, self._events)
 
         self._events.append(event)
+        self._timelineStale = True
 
     def removeEvent(self, event):
         """
@@ -264,6 +387,7 @@ class EventSet(log.Loggable):
         assert self.uid == event.uid, \
             "my uid %s does not match Event uid %s" % (self.uid, event.uid)
         self._events.remove(event)
+        self._timelineStale = True
 
     def getPoints(self, start=None, delta=None, clip=True):
         """
@@ -288,13 +412,14 @@ class EventSet(log.Loggable):
             delta = datetime.timedelta(seconds=0)
 
         points = []
+        end = start + delta
 
-        eventInstances = self._getEventInstances(start, start + delta, clip)
+        eventInstances = self._getEventInstances(start, end, clip)
         for i in eventInstances:
             for p in i.getPoints():
-                if p.dt >= start and p.dt <= start + delta:
+                if p.dt >= start and p.dt <= end:
                     points.append(p)
-        points.sort()
+        points.sort(key=lambda p: (p.dt, p.which))
 
         return points
 
@@ -316,6 +441,25 @@ class EventSet(log.Loggable):
 
         return recurring
 
+    def _getTimeline(self):
+        # the timeline of the recurring event, if any, rebuilt after the
+        # events of the set changed
+        if self._timelineStale:
+            self._timeline = None
+            recurring = self._getRecurringEvent()
+            if recurring:
+                # an event that has a recurrence id overrides the instance
+                # of the recurrence with a start time matching it
+                excluded = {}
+                for event in self._events:
+                    if event.recurrenceid:
+                        excluded[event.recurrenceid] = True
+                for exdate in recurring.exdates or []:
+                    excluded[exdate] = True
+                self._timeline = Timeline(recurring, excluded)
+            self._timelineStale = False
+        return self._timeline
+
     def _getEventInstances(self, start, end, clip):
         # get all instances whose start and/or end fall between the given
         # datetimes
@@ -324,29 +468,22 @@ class EventSet(log.Loggable):
         # to dateutil's solution
 
         eventInstances = []
-
-        recurring = self._getRecurringEvent()
+        recurring = None
 
         # find all instances between the two given times
-        if recurring:
-            eventInstances = self._getEventInstancesRecur(
-                recurring, start, end)
+        timeline = self._getTimeline()
+        if timeline:
+            recurring = timeline.event
+            delta = timeline.duration
+            for startTime in timeline.getStarts(start, end):
+                eventInstances.append(
+                    EventInstance(recurring, startTime, startTime + delta))
 
-        # an event that has a recurrence id overrides the instance of the
-        # recurrence with a start time matching the recurrence id, so
-        # throw it out
         for event in self._events:
             # skip the main event
             if event is recurring:
                 continue
 
-            if event.recurrenceid:
-                # Remove recurrent instance(s) that start at this recurrenceid
-                for i in eventInstances[:]:
-                    if i.start == event.recurrenceid:
-                        eventInstances.remove(i)
-                        break
-
             i = self._getEventInstanceSingle(event, start, end)
             if i:
                 eventInstances.append(i)
@@ -373,51 +510,6 @@ class EventSet(log.Loggable):
 
         return EventInstance(event, event.start, event.end)
 
-    def _getEventInstancesRecur(self, event, start, end):
-        # get all event instances for this recurring event that start before
-        # the given end time and end after the given start time.
-        # The UNTIL value applies to the start of a recurring event,
-        # not to the end.  So if you would calculate based on the end for the
-        # recurrence rule, and there is a recurring instance that starts before
-        # UNTIL but ends after UNTIL, it would not be taken into account.
-
-        ret = []
-
-        # don't calculate endPoint based on end recurrence rule, because
-        # if the next one after a start point is past UNTIL then the rrule
-        # returns None
-        delta = event.end - event.start
-
-        # FIXME: support multiple RRULE; see 4.8.5.4 Recurrence Rule
-        r = None
-        if event.rrules:
-            r = event.rrules[0]
-        startRecurRule = rrule.rrulestr(r, dtstart=event.start)
-
-        for startTime in startRecurRule:
-            # ignore everything stopping before our start time
-            if startTime + delta < start:
-                continue
-
-            # stop looping if it's past the requested end time
-            if startTime >= end:
-                break
-
-            # skip if it's on our list of exceptions
-            if event.exdates:
-                if startTime in event.exdates:
-                    self.debug("startTime %r is listed as EXDATE, skipping",
-                        startTime)
-                    continue
-
-            endTime = startTime + delta
-
-            i = EventInstance(event, startTime, endTime)
-
-            ret.append(i)
-
-        return ret
-
     def getActiveEventInstances(self, dt=None):
         """
         Get all event instances active at the given dt.
@@ -432,36 +524,16 @@ class EventSet(log.Loggable):
         result = []
 
         # handle recurrence events first
-        recurring = self._getRecurringEvent()
-        if recurring:
-            # FIXME: support multiple RRULE; see 4.8.5.4 Recurrence Rule
-            startRecurRule = rrule.rrulestr(recurring.rrules[0],
-                dtstart=recurring.start)
-            dtstart = startRecurRule.before(dt)
-
+        recurring = None
+        timeline = self._getTimeline()
+        if timeline:
+            recurring = timeline.event
+            dtstart = timeline.getLastStart(dt)
             if dtstart:
-                skip = False
-                # ignore if we have another event with this recurrence-id
-                for event in self._events:
-                    if event.recurrenceid:
-                        if event.recurrenceid == dtstart:
-                            self.log(
-                                'event %r, recurrenceid %r matches dtstart %r',
-                                    event, event.recurrenceid, dtstart)
-                            skip = True
-
-                # add if it's not on our list of exceptions
-                if recurring.exdates and dtstart in recurring.exdates:
-                    self.log('recurring event %r has exdate for %r',
-                        recurring, dtstart)
-                    skip = True
-
-                if not skip:
-                    delta = recurring.end - recurring.start
-                    dtend = dtstart + delta
-                    if dtend >= dt:
-                        # starts before our dt, and ends after, so add
-                        result.append(EventInstance(recurring, dtstart, dtend))
+                dtend = dtstart + timeline.duration
+                if dtend >= dt:
+                    # starts before our dt, and ends after, so add
+                    result.append(EventInstance(recurring, dtstart, dtend))
 
         # handle all other events
         for event in self._events:
@@ -508,6 +580,28 @@ class Calendar(log.Loggable):
             self._eventSets[uid] = EventSet(uid)
         self._eventSets[uid].addEvent(event)
 
+    def reuseEventSets(self, calendar):
+        """
+        Take over the event sets of the given calendar whose events did not
+        change, along with the recurrences they already expanded.
+
+        @param calendar: the calendar this one replaces
+        @type  calendar: L{Calendar}
+        """
+        def key(eventSet):
+            # an event's tuple does not hold its RECURRENCE-ID, but an
+            # override moved to another instance excludes another one
+            return [e.toTuple() + (e.recurrenceid, )
+                    for e in eventSet.getEvents()]
+
+        reused = 0
+        for uid, eventSet in self._eventSets.items():
+            other = calendar._eventSets.get(uid)
+            if other and key(other) == key(eventSet):
+                self._eventSets[uid] = other
+                reused += 1
+        self.debug('reused %d of %d event sets', reused, len(self._eventSets))
+
     def getPoints(self, start=None, delta=None):
         """
         Get all points from the given start time within the given delta.
@@ -0,0 +1,306 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_common_heartbeat -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""liveness checking of PB connections, with one timer for all of them
+"""
+
+import math
+import weakref
+
+from twisted.spread import pb
+
+from flumotion.common import errors, log
+from flumotion.twisted.compat import reactor
+
+__version__ = "$Rev$"
+
+# seconds between two slots of the timer wheel
+RESOLUTION = 1.0
+# seconds after which the round trip time of a busy connection is
+# measured again
+RTT_INTERVAL = 60.0
+# weight of a new round trip time in the moving average
+RTT_WEIGHT = 0.25
+
+_schedulers = weakref.WeakKeyDictionary() # clock -> HeartbeatScheduler
+
+
+def getScheduler(clock=reactor):
+    """
+    Get the heartbeat scheduler shared by all the connections of the
+    process using the given clock.
+
+    @rtype: L{HeartbeatScheduler}
+    """
+    if clock not in _schedulers:
+        _schedulers[clock] = HeartbeatScheduler(clock)
+    return _schedulers[clock]
+
+
+class Heartbeat(object):
+    """
+    I follow the liveness of one PB connection.
+
+    Anything received on the connection counts as a heartbeat, and should
+    be reported by calling L{seen}. The other side is only pinged when
+    nothing was received for L{interval} seconds, or to measure the round
+    trip time again when it was not for RTT_INTERVAL seconds. The
+    connection is disconnected when nothing was received for L{timeout}
+    seconds.
+
+    @ivar rtt:        the last round trip time measured, in seconds
+    @type rtt:        float or None
+    @ivar rttAverage: the moving average of the round trip times
+    @type rttAverage: float or None
+    @ivar rttMin:     the shortest round trip time measured
+    @type rttMin:     float or None
+    @ivar rttMax:     the longest round trip time measured
+    @type rttMax:     float or None
+    @ivar rttCount:   the number of round trip times measured
+    @type rttCount:   int
+    """
+
+    def __init__(self, scheduler, ping, disconnect, interval, timeout):
+        self.scheduler = scheduler
+        self.ping = ping
+        self.disconnect = disconnect
+        self.interval = interval
+        self.timeout = timeout
+        self.lastSeen = scheduler.seconds()
+
+        self.rtt = None
+        self.rttAverage = None
+        self.rttMin = None
+        self.rttMax = None
+        self.rttCount = 0
+
+        self._lastMeasured = None
+        self._pingSent = None # time the unanswered ping was sent
+        self._slot = None # tick of the slot of the timer wheel I'm in
+
+    def seen(self):
+        """
+        Tell me something was received on the connection.
+        """
+        self.lastSeen = self.scheduler.seconds()
+
+    def sendPing(self):
+        """
+        Ping the other side now, unless a ping is not answered yet.
+        """
+        if self.ping and self._pingSent is None:
+            self._sendPing(self.scheduler.seconds())
+
+    def stop(self):
+        """
+        Stop following the connection.
+        """
+        self.scheduler.remove(self)
+
+    def getStats(self):
+        """
+        @returns: the round trip time statistics of the connection, and
+                  the seconds since something was last received on it
+        @rtype:   dict
+        """
+        return {'rtt': self.rtt,
+                'rtt-average': self.rttAverage,
+                'rtt-min': self.rttMin,
+                'rtt-max': self.rttMax,
+                'rtt-count': self.rttCount,
+                'idle': self.scheduler.seconds() - self.lastSeen}
+
+    def _sendPing(self, now):
+        self._pingSent = now
+        d = self.ping()
+        d.addCallbacks(self._pingAnswered, self._pingFailed)
+
+    def _pingAnswered(self, result):
+        now = self.scheduler.seconds()
+        self.lastSeen = now
+        if self._pingSent is not None:
+            self._addRTT(now - self._pingSent)
+            self._pingSent = None
+
+    def _pingFailed(self, failure):
+        if failure.check(pb.PBConnectionLost, pb.DeadReferenceError,
+                         errors.NotConnectedError):
+            # ignoring the connection failures so they don't end up in
+            # the logs - we'll notice the lack of heartbeats eventually
+            self._pingSent = None
+            return
+        # the other side answered, even if only with an error
+        self._pingAnswered(None)
+
+    def _addRTT(self, rtt):
+        self.rtt = rtt
+        self.rttCount += 1
+        self._lastMeasured = self.lastSeen
+        if self.rttAverage is None:
+            self.rttAverage = self.rttMin = self.rttMax = rtt
+        else:
+            self.rttAverage += RTT_WEIGHT * (rtt - self.rttAverage)
+            self.rttMin = min(self.rttMin, rtt)
+            self.rttMax = max(self.rttMax, rtt)
+
+    def _check(self, now):
+        # returns when to check again, or None after disconnecting
+        idle = now - self.lastSeen
+        if idle > self.timeout:
+            self.scheduler.info('nothing received in %f seconds, closing '
+                                'connection', self.timeout)
+            self.disconnect()
+            return None
+
+        due = self.lastSeen + self.interval
+        if self.ping:
+            if self._lastMeasured is None:
+                # not measured yet
+                due = now
+            else:
+                due = min(due, self._lastMeasured + RTT_INTERVAL)
+        if self.ping and self._pingSent is None and due <= now:
+            self._sendPing(now)
+        if due <= now:
+            due = now + self.interval
+        return due
+
+
+class HeartbeatScheduler(log.Loggable):
+    """
+    I check the liveness of PB connections, and ping them when they are
+    idle.
+
+    Instead of two timers per connection, I keep the connections in the
+    slots of a timer wheel, one slot for each RESOLUTION seconds, and have
+    a single timer for the next slot that isn't empty. Traffic on a
+    connection only updates the time it was last seen; the connection is
+    looked at again when its slot comes.
+    """
+
+    logCategory = 'heartbeat'
+
+    def __init__(self, clock=reactor, resolution=RESOLUTION):
+        self._clock = clock
+        self.resolution = resolution
+        self._wheel = {} # tick -> dict of Heartbeat -> True
+        self._tick = int(clock.seconds() // resolution) # last tick checked
+        self._call = None
+        self._callTick = None
+
+    def seconds(self):
+        return self._clock.seconds()
+
+    def add(self, ping, disconnect, interval, timeout):
+        """
+        Start following the liveness of a connection.
+
+        @param ping:       procedure pinging the other side, returning a
+                           deferred firing when it answers, or None to
+                           only check the connection
+        @type  ping:       callable
+        @param disconnect: procedure to call when nothing was received
+                           for timeout seconds
+        @type  disconnect: callable
+        @param interval:   seconds without receiving anything after which
+                           the other side is pinged
+        @type  interval:   float
+        @param timeout:    seconds without receiving anything after which
+                           the connection is disconnected
+        @type  timeout:    float
+
+        @rtype: L{Heartbeat}
+        """
+        heartbeat = Heartbeat(self, ping, disconnect, interval, timeout)
+        now = self.seconds()
+        if ping:
+            # the round trip time is measured in the next slot, not from
+            # here, which is often the middle of setting the connection up
+            self._schedule(heartbeat, now)
+        else:
+            self._schedule(heartbeat, now + interval)
+        return heartbeat
+
+    def remove(self, heartbeat):
+        """
+        Stop following the liveness of a connection.
+
+        @type heartbeat: L{Heartbeat}
+        """
+        tick = heartbeat._slot
+        heartbeat._slot = None
+        # the slot is not in the wheel anymore while it is being checked
+        slot = self._wheel.get(tick)
+        if not slot or heartbeat not in slot:
+            return
+        del slot[heartbeat]
+        if not slot:
+            del self._wheel[tick]
+            if not self._wheel and self._call:
+                self._call.cancel()
+                self._call = None
+                self._callTick = None
+
+    def getCount(self):
+        """
+        @returns: the number of connections followed
+        @rtype:   int
+        """
+        return sum([len(slot) for slot in self._wheel.values()])
+
+    def _schedule(self, heartbeat, when):
+        tick = max(int(math.ceil(when / self.resolution)), self._tick + 1)
+        heartbeat._slot = tick
+        self._wheel.setdefault(tick, {})[heartbeat] = True
+        if self._callTick is None or tick < self._callTick:
+            self._setTimer(tick)
+
+    def _setTimer(self, tick):
+        if self._call:
+            self._call.cancel()
+        delay = max(tick * self.resolution - self.seconds(), 0)
+        self._callTick = tick
+        self._call = self._clock.callLater(delay, self._timeout)
+
+    def _timeout(self):
+        self._call = None
+        self._callTick = None
+        now = self.seconds()
+        current = int(now // self.resolution)
+        if current - self._tick > len(self._wheel):
+            ticks = [tick for tick in self._wheel.keys() if tick <= current]
+            ticks.sort()
+        else:
+            ticks = range(self._tick + 1, current + 1)
+        self._tick = current
+
+        for tick in ticks:
+            slot = self._wheel.pop(tick, None)
+            if not slot:
+                continue
+            for heartbeat in slot:
+                if heartbeat._slot != tick:
+                    # removed while checking the slot
+                    continue
+                heartbeat._slot = None
+                due = heartbeat._check(now)
+                # it can be removed when disconnected
+                if due is not None and heartbeat._slot is None:
+                    self._schedule(heartbeat, due)
+
+        if self._wheel and self._call is None:
+            self._setTimer(min(self._wheel.keys()))
@@ -18,11 +18,11 @@
 """base classes for PB client-side mediums.
 """
 
-from twisted.spread import pb
 from twisted.internet import defer
 from zope.interface import implements
 
 from flumotion.common import log, interfaces, bundleclient, errors, netutils
+from flumotion.common import heartbeat
 from flumotion.configure import configure
 from flumotion.twisted import pb as fpb
 from flumotion.twisted.compat import reactor
@@ -234,7 +234,7 @@ class PingingMedium(BaseMedium):
     _pingInterval = configure.heartbeatInterval
     _pingCheckInterval = (configure.heartbeatInterval *
                           configure.pingTimeoutMultiplier)
-    _pingDC = None
+    _heartbeat = None
     _clock = reactor
 
     def startPinging(self, disconnect):
@@ -243,38 +243,23 @@ class PingingMedium(BaseMedium):
         @type  disconnect: callable
         """
         self.debug('startPinging')
-        self._lastPingback = self._clock.seconds()
-        if self._pingDC:
+        if self._heartbeat:
             self.debug("Cannot start pinging, already pinging")
             return
-        self._pingDisconnect = disconnect
-        self._ping()
-        self._pingCheck()
+        scheduler = heartbeat.getScheduler(self._clock)
+        self._heartbeat = scheduler.add(self._ping, disconnect,
+                                        self._pingInterval,
+                                        self._pingCheckInterval)
+        # we ping as soon as connected, as we always did
+        self._heartbeat.sendPing()
 
     def _ping(self):
-
-        def pingback(result):
-            self._lastPingback = self._clock.seconds()
-            self.log('pinged, pingback at %r' % self._lastPingback)
-
-        def pingFailed(failure):
-            # ignoring the connection failures so they don't end up in
-            # the logs - we'll notice the lack of pingback eventually
-            failure.trap(pb.PBConnectionLost)
-            self.log('ping failed: %s' % log.getFailureMessage(failure))
-
-        if self.remote:
-            self.log('pinging')
-            d = self.callRemoteLogging(log.LOG, 0, 'ping')
-            d.addCallbacks(pingback, pingFailed)
-        else:
-            self.info('tried to ping, but disconnected yo')
-
-        self._pingDC = self._clock.callLater(self._pingInterval,
-                                             self._ping)
+        self.log('pinging')
+        return self.callRemoteLogging(log.LOG, 0, 'ping')
 
     def remoteMessageReceived(self, broker, message, args, kw):
-        self._lastPingback = self._clock.seconds()
+        if self._heartbeat:
+            self._heartbeat.seen()
         return BaseMedium.remoteMessageReceived(
             self, broker, message, args, kw)
 
@@ -283,31 +268,26 @@ class PingingMedium(BaseMedium):
             self, level, stackDepth, name, *args, **kwargs)
 
         def cb(result):
-            self._lastPingback = self._clock.seconds()
+            if self._heartbeat:
+                self._heartbeat.seen()
             return result
         d.addCallback(cb)
         return d
 
-    def _pingCheck(self):
-        self._pingCheckDC = None
-        if (self.remote and
-            ((self._clock.seconds() - self._lastPingback) >
-             self._pingCheckInterval)):
-            self.info('no pingback in %f seconds, closing connection',
-                      self._pingCheckInterval)
-            self._pingDisconnect()
-        else:
-            self._pingCheckDC = self._clock.callLater(self._pingCheckInterval,
-                                                      self._pingCheck)
-
     def stopPinging(self):
-        if self._pingCheckDC:
-            self._pingCheckDC.cancel()
-        self._pingCheckDC = None
+        if self._heartbeat:
+            self._heartbeat.stop()
+        self._heartbeat = None
 
-        if self._pingDC:
-            self._pingDC.cancel()
-        self._pingDC = None
+    def getHeartbeatStats(self):
+        """
+        @returns: the round trip time statistics of the connection, as
+                  returned by L{heartbeat.Heartbeat.getStats}, or None
+                  when not connected
+        @rtype:   dict or None
+        """
+        if self._heartbeat:
+            return self._heartbeat.getStats()
 
     def _disconnect(self):
         if self.remote:
@@ -325,6 +305,9 @@ class PingingMedium(BaseMedium):
 
         self.startPinging(self._disconnect)
 
+    def remote_ping(self):
+        return True
+
     def remote_writeFluDebugMarker(self, level, marker):
         """
         Sets a marker that will be prefixed to the log strings. Setting this
@@ -19,6 +19,7 @@
 """
 
 import array
+import bisect
 import errno
 import platform
 import re
@@ -27,8 +28,6 @@ import struct
 
 from twisted.internet import address
 
-from flumotion.common import avltree
-
 __version__ = "$Rev$"
 
 
@@ -144,7 +143,196 @@ def countTrailingZeroes32(n):
     return tz
 
 
+def parseAddress(s):
+    """
+    Parse an IPv4 or IPv6 address. IPv4-mapped IPv6 addresses, as
+    reported by dual-stack sockets, are parsed as IPv4 addresses.
+
+    @type  s: str
+    @returns: the address family and the address as an integer
+    @rtype:   tuple of (int, long)
+    """
+    if ':' in s:
+        try:
+            high, low = struct.unpack('!QQ',
+                                      socket.inet_pton(socket.AF_INET6, s))
+        except (socket.error, ValueError):
+            raise ValueError(s)
+        n = (high << 64) | low
+        if n >> 32 == 0xffff:
+            return socket.AF_INET, int(n & 0xffffffff)
+        return socket.AF_INET6, n
+    try:
+        return socket.AF_INET, struct.unpack('!I',
+            socket.inet_pton(socket.AF_INET, s))[0]
+    except (socket.error, ValueError):
+        return socket.AF_INET, ipv4StringToInt(s)
+
+
+def formatAddress(family, n):
+    """
+    The reverse of L{parseAddress}.
+    """
+    if family == socket.AF_INET:
+        return ipv4IntToString(n)
+    return socket.inet_ntop(socket.AF_INET6,
+                            struct.pack('!QQ', n >> 64, n & (2 ** 64 - 1)))
+
+
+ADDRESS_BITS = {socket.AF_INET: 32,
+                socket.AF_INET6: 128}
+
+
+class _Routes(list):
+    # the routes of a subnet added more than once, in order of preference
+    pass
+
+
+class _Prefixes(object):
+    """
+    I hold the subnets of one address family, and a flattened view of
+    them for longest prefix lookups.
+
+    The subnets are kept in a dict per prefix length. The flattened view
+    is a sorted array of the first addresses of the ranges in which the
+    preferred route does not change, with the route of each range; it is
+    rebuilt on the first lookup after the subnets changed, and searched
+    with bisect.
+    """
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.nets = {} # prefix length -> {network: route or _Routes}
+        self.lengths = [] # prefix lengths in use, longest first
+        self.count = 0
+        self._starts = None
+        self._routes = None
+
+    def add(self, maskBits, net, route):
+        nets = self.nets.get(maskBits)
+        if nets is None:
+            nets = self.nets[maskBits] = {}
+            self.lengths.append(maskBits)
+            self.lengths.sort(reverse=True)
+        if net not in nets:
+            nets[net] = route
+        else:
+            routes = nets[net]
+            if not isinstance(routes, _Routes):
+                routes = _Routes([routes])
+            if route in routes:
+                raise ValueError('subnet already has route %r' % (route, ))
+            routes.append(route)
+            routes.sort(reverse=True)
+            nets[net] = routes
+        self.count += 1
+        self._starts = None
+
+    def remove(self, maskBits, net, route):
+        nets = self.nets.get(maskBits, {})
+        routes = nets.get(net, _Routes())
+        if not isinstance(routes, _Routes):
+            routes = _Routes([routes])
+        if route not in routes:
+            raise ValueError('subnet has no route %r' % (route, ))
+        routes.remove(route)
+        if len(routes) > 1:
+            nets[net] = routes
+        elif routes:
+            nets[net] = routes[0]
+        else:
+            del nets[net]
+            if not nets:
+                del self.nets[maskBits]
+                self.lengths.remove(maskBits)
+        self.count -= 1
+        self._starts = None
+
+    def iterRoutes(self, maskBits, net):
+        routes = self.nets[maskBits][net]
+        if isinstance(routes, _Routes):
+            return iter(routes)
+        return iter((routes, ))
+
+    def __iter__(self):
+        # (prefix length, network, route), most specific first
+        for maskBits in self.lengths:
+            nets = self.nets[maskBits]
+            for net in sorted(nets, reverse=True):
+                for route in self.iterRoutes(maskBits, net):
+                    yield maskBits, net, route
+
+    def route(self, ip):
+        if self._starts is None:
+            self._compile()
+        i = bisect.bisect_right(self._starts, ip) - 1
+        if i < 0:
+            return None
+        return self._routes[i]
+
+    def iterMatches(self, ip):
+        for maskBits in self.lengths:
+            net = ip & ~((1 << (self.bits - maskBits)) - 1)
+            if net in self.nets[maskBits]:
+                for route in self.iterRoutes(maskBits, net):
+                    yield route
+
+    def _compile(self):
+        # the subnets sorted by first address, the enclosing ones first;
+        # subnets are either disjoint or nested, so a stack of the ones
+        # enclosing the current address gives its preferred route
+        subnets = []
+        for maskBits, nets in self.nets.items():
+            size = 1 << (self.bits - maskBits)
+            for net, routes in nets.iteritems():
+                if isinstance(routes, _Routes):
+                    routes = routes[0]
+                subnets.append((net, -size, routes))
+        subnets.sort()
+
+        if self.bits == 32:
+            starts = array.array('L')
+        else:
+            starts = []
+        routes = []
+
+        def emit(start, route):
+            if not routes or routes[-1] != route:
+                starts.append(start)
+                routes.append(route)
+
+        stack = [] # (last address, route)
+        pos = 0
+        for net, size, route in subnets:
+            while stack and stack[-1][0] < net:
+                last, r = stack.pop()
+                if pos <= last:
+                    emit(pos, r)
+                    pos = last + 1
+            if pos < net:
+                if stack:
+                    emit(pos, stack[-1][1])
+                else:
+                    emit(pos, None)
+                pos = net
+            stack.append((net - size - 1, route))
+        while stack:
+            last, r = stack.pop()
+            if pos <= last:
+                emit(pos, r)
+                pos = last + 1
+        if pos < 1 << self.bits:
+            emit(pos, None)
+
+        self._starts = starts
+        self._routes = routes
+
+
 class RoutingTable(object):
+    """
+    I map IPv4 and IPv6 subnets to routes, and find the route of the most
+    specific subnet an address is in.
+    """
 
     def fromFile(klass, f, requireNames=True, defaultRouteName='*default*'):
         """
@@ -154,6 +342,7 @@ class RoutingTable(object):
         The entries are expected to have the form:
         IP-ADDRESS/MASK-BITS ROUTE-NAME
 
+        where IP-ADDRESS is an IPv4 or IPv6 address.
         The `#' character denotes a comment. Empty lines are allowed.
 
         @param f: file from whence to read a routing table
@@ -168,11 +357,13 @@ class RoutingTable(object):
         comment = re.compile(r'^\s*#')
         empty = re.compile(r'^\s*$')
         entry = re.compile(r'^\s*'
-                           r'(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'
+                           r'(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}'
+                           r'|[0-9a-fA-F]*:[0-9a-fA-F:.]*)'
                            r'/'
-                           r'(\d{1,2})'
+                           r'(\d{1,3})'
                            r'(\s+([^\s](.*[^\s])?))?\s*$')
         ret = klass()
+        names = {}
         n = 0
         for line in f:
             n += 1
@@ -191,72 +382,83 @@ class RoutingTable(object):
                 else:
                     route = defaultRouteName
             ret.addSubnet(route, m.group(1), int(m.group(2)))
-            if route not in ret.routeNames:
+            if route not in names:
+                names[route] = True
                 ret.routeNames.append(route)
 
         return ret
     fromFile = classmethod(fromFile)
 
     def __init__(self):
-        self.avltree = avltree.AVLTree()
+        self._prefixes = {socket.AF_INET: _Prefixes(32),
+                          socket.AF_INET6: _Prefixes(128)}
         self.routeNames = []
 
     def getRouteNames(self):
         return self.routeNames
 
-    def _parseSubnet(self, ipv4String, maskBits):
-        return (ipv4StringToInt(ipv4String),
-                ~((1 << (32 - maskBits)) - 1))
-
-    def addSubnet(self, route, ipv4String, maskBits=32):
-        ipv4Int, mask = self._parseSubnet(ipv4String, maskBits)
-        if not ipv4Int & mask == ipv4Int:
+    def _parseSubnet(self, ipString, maskBits):
+        family, ipInt = parseAddress(ipString)
+        bits = ADDRESS_BITS[family]
+        if maskBits is None:
+            maskBits = bits
+        if not 0 <= maskBits <= bits:
+            raise ValueError('Invalid mask bits %d for %s'
+                             % (maskBits, ipString))
+        return family, ipInt, maskBits
+
+    def addSubnet(self, route, ipString, maskBits=None):
+        family, ipInt, maskBits = self._parseSubnet(ipString, maskBits)
+        if ipInt & ((1 << (ADDRESS_BITS[family] - maskBits)) - 1):
             raise ValueError('Net %s too specific for mask with %d bits'
-                             % (ipv4String, maskBits))
-        self.avltree.insert((mask, ipv4Int, route))
+                             % (ipString, maskBits))
+        self._prefixes[family].add(maskBits, ipInt, route)
 
-    def removeSubnet(self, route, ipv4String, maskBits=32):
-        ipv4Int, mask = self._parseSubnet(ipv4String, maskBits)
-        self.avltree.delete((mask, ipv4Int, route))
+    def removeSubnet(self, route, ipString, maskBits=None):
+        family, ipInt, maskBits = self._parseSubnet(ipString, maskBits)
+        self._prefixes[family].remove(maskBits, ipInt, route)
 
     def __iter__(self):
-        return self.avltree.iterreversed()
+        for family in (socket.AF_INET, socket.AF_INET6):
+            bits = ADDRESS_BITS[family]
+            for maskBits, net, route in self._prefixes[family]:
+                yield ~((1 << (bits - maskBits)) - 1), net, route
 
     def iterHumanReadable(self):
-        for mask, net, route in self:
-            yield route, ipv4IntToString(net), 32-countTrailingZeroes32(mask)
+        for family in (socket.AF_INET, socket.AF_INET6):
+            for maskBits, net, route in self._prefixes[family]:
+                yield route, formatAddress(family, net), maskBits
 
     def __len__(self):
-        return len(self.avltree)
+        return sum([p.count for p in self._prefixes.values()])
+
+    def _parseIP(self, ip):
+        if isinstance(ip, (int, long)):
+            return socket.AF_INET, ip
+        return parseAddress(ip)
 
     def route(self, ip):
         """
         Return the preferred route for this IP.
 
         @param ip: The IP to use for routing decisions.
-        @type  ip: An integer or string representing an IPv4 address
+        @type  ip: An integer representing an IPv4 address, or a string
+                   representing an IPv4 or IPv6 address
         """
-        if isinstance(ip, str):
-            ip = ipv4StringToInt(ip)
-
-        for netmask, net, route in self:
-            if ip & netmask == net:
-                return route
-
-        return None
+        family, ip = self._parseIP(ip)
+        return self._prefixes[family].route(ip)
 
     def route_iter(self, ip):
         """
         Return an iterator yielding routes in order of preference.
 
         @param ip: The IP to use for routing decisions.
-        @type  ip: An integer or string representing an IPv4 address
+        @type  ip: An integer representing an IPv4 address, or a string
+                   representing an IPv4 or IPv6 address
         """
-        if isinstance(ip, str):
-            ip = ipv4StringToInt(ip)
-        for mask, net, route in self:
-            if ip & mask == net:
-                yield route
+        family, ip = self._parseIP(ip)
+        for route in self._prefixes[family].iterMatches(ip):
+            yield route
         # Yield the default route
         yield None
 
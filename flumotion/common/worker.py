@@ -222,14 +222,17 @@ class ManagerWorkerState(flavors.StateCacheable):
     """
     I represent the state of a worker in the manager.
 
-     - name: name of the worker
-     - host: the IP address of the worker as seen by the manager
+     - name:   name of the worker
+     - host:   the IP address of the worker as seen by the manager
+     - checks: dict, statistics of the check result cache of the worker,
+               see L{flumotion.worker.checkcache.CheckCache.getStats}
     """
 
     def __init__(self, **kwargs):
         flavors.StateCacheable.__init__(self)
         self.addKey('name')
         self.addKey('host')
+        self.addKey('checks')
         for k, v in kwargs.items():
             self.set(k, v)
 
@@ -15,15 +15,13 @@
 #
 # Headers in this file shall remain intact.
 
-import struct
-import socket
 
 from twisted.web import http
 from twisted.internet import reactor, defer
 from twisted.python import failure
 
 from flumotion.configure import configure
-from flumotion.common import errors
+from flumotion.common import errors, netutils
 from flumotion.twisted.credentials import cryptChallenge
 
 from flumotion.common import log, keycards
@@ -217,6 +215,9 @@ class HTTPAuthentication(log.Loggable):
     def clientDone(self, fd):
         return self.component.remove_client(fd)
 
+    def clientsDone(self, fds):
+        return self.component.remove_clients(fds)
+
     def doCleanupKeycard(self, bouncerName, keycard):
         # cleanup this one keycard, and take the opportunity to retry
         # previous failed cleanups
@@ -287,15 +288,21 @@ class HTTPAuthentication(log.Loggable):
         """
         Expire client's connections associated with the keycard Ids.
         """
-        expired = 0
+        fds = []
+        unknown = 0
         for keycardId in keycardIds:
-            try:
-                self.expireKeycard(keycardId)
-                expired += 1
-            except KeyError, e:
-                self.warn("Failed to expire keycard %r: %s",
-                          keycardId, log.getExceptionMessage(e))
-        return expired
+            keycard = self._idToKeycard.get(keycardId)
+            if keycard is None:
+                unknown += 1
+                continue
+            fds.append(keycard._fd)
+            self._removeKeycard(keycard._fd)
+        if unknown:
+            self.warning("Failed to expire %d unknown keycards", unknown)
+
+        self.debug('asking streamer to remove %d expired clients', len(fds))
+        self.clientsDone(fds)
+        return len(fds)
 
     ### resource.Resource methods
 
@@ -384,7 +391,7 @@ class HTTPAuthentication(log.Loggable):
 class LogFilter:
 
     def __init__(self):
-        self.filters = [] # list of (network, mask)
+        self.filters = netutils.RoutingTable()
 
     def addIPFilter(self, filter):
         """
@@ -397,31 +404,35 @@ class LogFilter:
             prefixlen = int(prefixlen)
         elif len(definition) == 1:
             net = definition[0]
-            prefixlen = 32
+            prefixlen = None
         else:
             raise errors.ConfigError(
                 "Cannot parse filter definition %s" % filter)
 
-        if prefixlen < 0 or prefixlen > 32:
-            raise errors.ConfigError("Invalid prefix length")
-
-        mask = ~((1 << (32 - prefixlen)) - 1)
         try:
-            net = struct.unpack(">I", socket.inet_pton(socket.AF_INET, net))[0]
-        except socket.error:
+            family, net = netutils.parseAddress(net)
+        except ValueError:
             raise errors.ConfigError(
                 "Failed to parse network address %s" % net)
+
+        bits = netutils.ADDRESS_BITS[family]
+        if prefixlen is None:
+            prefixlen = bits
+        if prefixlen < 0 or prefixlen > bits:
+            raise errors.ConfigError("Invalid prefix length")
+
+        mask = ~((1 << (bits - prefixlen)) - 1)
         net = net & mask # just in case
 
-        self.filters.append((net, mask))
+        try:
+            self.filters.addSubnet(True, netutils.formatAddress(family, net),
+                                   prefixlen)
+        except ValueError:
+            # already filtered
+            pass
 
     def isInRange(self, ip):
         """
         Return true if ip is in any of the defined network(s) for this filter
         """
-        # Handles IPv4 only.
-        realip = struct.unpack(">I", socket.inet_pton(socket.AF_INET, ip))[0]
-        for f in self.filters:
-            if (realip & f[1]) == f[0]:
-                return True
-        return False
+        return self.filters.route(ip) is not None
@@ -101,6 +101,8 @@ class Scheduler(log.Loggable):
         # we do comparison of instances by content, since, while the timing
         # information may have changed, if the content is still the same,
         # then the event is still considered 'active'
+        if self._calendar:
+            calendar.reuseEventSets(self._calendar)
         self._calendar = calendar
         for instance in oldInstances:
             if instance.event.content not in newInstancesContent:
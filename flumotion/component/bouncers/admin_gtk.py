@@ -18,6 +18,7 @@
 import os
 
 import gettext
+import gobject
 import gtk
 
 from twisted.internet import defer
@@ -43,7 +44,7 @@ class KeycardsNode(BaseAdminGtkNode):
 
     def render(self):
         self._iters = {} # iter -> data dict mapping
-        self.model = gtk.ListStore(str, str, str)
+        self.model = gtk.ListStore(gobject.TYPE_UINT64, str, str)
 
         gladeFile = os.path.join('flumotion', 'component', 'bouncers',
             'bouncer.glade')
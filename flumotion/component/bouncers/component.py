@@ -84,7 +84,7 @@ import time
 
 from twisted.internet import defer, reactor
 
-from flumotion.common import keycards, errors, python, poller
+from flumotion.common import keycards, errors, log, python, poller
 from flumotion.common.componentui import WorkerComponentUIState
 
 from flumotion.component import component
@@ -94,7 +94,9 @@ __all__ = ['Bouncer']
 __version__ = "$Rev$"
 
 # How many keycards to expire in a single synchronous deferred expiration call.
-EXPIRE_BLOCK_SIZE = 100
+EXPIRE_BLOCK_SIZE = 1000
+# How many blocks can be waiting for their expiration at the same time.
+EXPIRE_WINDOW = 4
 
 
 class BouncerMedium(component.BaseComponentMedium):
@@ -149,6 +151,70 @@ class BouncerMedium(component.BaseComponentMedium):
         return self.comp.getEnabled()
 
 
+class _KeycardExpiry(object):
+    """
+    I expire a list of keycards of a bouncer on their requesters.
+
+    We can't expire all keycards in a single blocking call because there
+    might be so many that the component goes lost, but waiting for every
+    block to be expired before sending the next one makes expiring many
+    keycards take long. I keep a window of blocks in flight instead,
+    removing and sending a new block every time one is answered.
+    """
+
+    def __init__(self, bouncer, keycardIds):
+        self.bouncer = bouncer
+        self.expired = 0
+        self._keycardIds = keycardIds
+        self._position = 0
+        self._pending = 0 # blocks waiting for their answers
+        self._sending = False
+        self._finished = defer.Deferred()
+
+    def start(self):
+        self._send()
+        return self._finished
+
+    def _send(self):
+        # blocks can be answered while we send, and should not make us
+        # send recursively
+        if self._sending:
+            return
+        self._sending = True
+        medium = self.bouncer.medium
+        while (self._pending < EXPIRE_WINDOW
+               and self._position < len(self._keycardIds)):
+            block = self._keycardIds[self._position:
+                                     self._position + EXPIRE_BLOCK_SIZE]
+            self._position += EXPIRE_BLOCK_SIZE
+            idByReq = self.bouncer._removeKeycardBlock(block)
+            if not (idByReq and medium):
+                continue
+            defs = []
+            for requesterId, ids in idByReq.items():
+                d = medium.callRemote('expireKeycards', requesterId, ids)
+                d.addErrback(self._expireErrback, requesterId)
+                defs.append(d)
+            self._pending += 1
+            dl = defer.DeferredList(defs)
+            dl.addCallback(self._blockExpired)
+        self._sending = False
+
+        if not self._pending and self._position >= len(self._keycardIds):
+            if not self._finished.called:
+                self._finished.callback(self.expired)
+
+    def _expireErrback(self, failure, requesterId):
+        self.bouncer.warning('failed to expire keycards of %s: %s',
+                             requesterId, log.getFailureMessage(failure))
+        return 0
+
+    def _blockExpired(self, results):
+        self._pending -= 1
+        self.expired += sum([v for s, v in results if s and v])
+        self._send()
+
+
 class Bouncer(component.BaseComponent):
     """
     I am the base class for all bouncer components.
@@ -165,8 +231,9 @@ class Bouncer(component.BaseComponent):
     KEYCARD_EXPIRE_INTERVAL = 2 * 60 # expire every 2 minutes
 
     def init(self):
-        self._idCounter = 0
-        self._idFormat = time.strftime('%Y%m%d%H%M%S-%%d')
+        # keycard ids are integers; starting from the time we started
+        # makes them unique across restarts of the bouncer
+        self._idCounter = int(time.time()) << 32
         self._keycards = {} # keycard id -> Keycard
 
         self._expirer = poller.Poller(self._expire,
@@ -240,11 +307,14 @@ class Bouncer(component.BaseComponent):
                   the expirer poller MAY be stopped.
         @rtype: bool
         """
+        expired = []
         for k in self._keycards.values():
             if hasattr(k, 'ttl'):
                 k.ttl -= elapsed
                 if k.ttl <= 0:
-                    self.expireKeycardId(k.id)
+                    expired.append(k.id)
+        if expired:
+            self.expireKeycardIds(expired)
         return len(self._keycards) > 0
 
     def do_validate(self, keycard):
@@ -309,8 +379,7 @@ class Bouncer(component.BaseComponent):
 
     def generateKeycardId(self):
         # FIXME: what if it already had one ?
-        # FIXME: deal with wraparound ?
-        keycardId = self._idFormat % self._idCounter
+        keycardId = self._idCounter
         self._idCounter += 1
         return keycardId
 
@@ -346,10 +415,10 @@ class Bouncer(component.BaseComponent):
         del self._keycards[keycard.id]
         self.on_keycardRemoved(keycard)
 
-        self.info("removed keycard with id %s" % keycard.id)
+        self.info("removed keycard with id %s", keycard.id)
 
     def removeKeycardId(self, keycardId):
-        self.debug("removing keycard with id %s" % keycardId)
+        self.debug("removing keycard with id %s", keycardId)
         if not keycardId in self._keycards:
             raise KeyError
 
@@ -379,44 +448,29 @@ class Bouncer(component.BaseComponent):
             return defer.succeed(None)
 
     def expireKeycardIds(self, keycardIds):
-        self.log("expiring keycards with id %r", keycardIds)
-        d = defer.Deferred()
-        self._expireNextKeycardBlock(0, keycardIds, d)
-        return d
+        """
+        Expire keycards, in blocks of EXPIRE_BLOCK_SIZE keycards, with up
+        to EXPIRE_WINDOW blocks waiting for their requesters to answer at
+        the same time.
 
-    def _expireNextKeycardBlock(self, total, keycardIds, finished):
-        # We can't expire all keycards in a single blocking call because
-        # there might be so many that the component goes lost.
-        # This call will trigger expiring all keycards by chunking them
-        # across separate deferreds.
+        @returns: a deferred firing with the number of keycards expired
+                  by their requesters
+        """
+        self.log("expiring %d keycards", len(keycardIds))
+        expiry = _KeycardExpiry(self, keycardIds)
+        return expiry.start()
 
-        keycardBlock = keycardIds[:EXPIRE_BLOCK_SIZE]
-        keycardIds = keycardIds[EXPIRE_BLOCK_SIZE:]
+    def _removeKeycardBlock(self, keycardIds):
+        # remove the keycards, and return the ids of those we still had
+        # by requester
         idByReq = {}
-
-        for keycardId in keycardBlock:
+        for keycardId in keycardIds:
             if keycardId in self._keycards:
                 keycard = self._keycards[keycardId]
                 requesterId = keycard.requesterId
                 idByReq.setdefault(requesterId, []).append(keycardId)
                 self.removeKeycardId(keycardId)
-
-        if not (idByReq and self.medium):
-            # instead of serializing each block by chaining deferreds, which
-            # can trigger maximum recursion depth, we just callback once
-            # on the passed-in deferred
-            finished.callback(total)
-            return
-
-        defs = [self.medium.callRemote('expireKeycards', rid, ids)
-                for rid, ids in idByReq.items()]
-        dl = defer.DeferredList(defs, consumeErrors=True)
-
-        def countExpirations(results, total):
-            return sum([v for s, v in results if s and v]) + total
-
-        dl.addCallback(countExpirations, total)
-        dl.addCallback(self._expireNextKeycardBlock, keycardIds, finished)
+        return idByReq
 
     def _addKeycard(self, keycard):
         """
@@ -30,8 +30,9 @@ class BouncerPlug(base.ComponentPlug):
     logCategory = 'bouncer-plug'
 
     def start(self, component):
-        self._idCounter = 0
-        self._idFormat = time.strftime('%Y%m%d%H%M%S-%%d')
+        # keycard ids are integers; starting from the time we started
+        # makes them unique across restarts of the component
+        self._idCounter = int(time.time()) << 32
         self._keycards = {} # keycard id -> Keycard
         return base.ComponentPlug.start(self, component)
 
@@ -43,8 +44,7 @@ class BouncerPlug(base.ComponentPlug):
 
     def generateKeycardId(self):
         # FIXME: what if it already had one ?
-        # FIXME: deal with wraparound ?
-        keycardId = self._idFormat % self._idCounter
+        keycardId = self._idCounter
         self._idCounter += 1
         return keycardId
 
@@ -89,10 +89,10 @@ class BouncerPlug(base.ComponentPlug):
     def removeKeycard(self, keycard):
         del self._keycards[keycard.id]
         self.on_keycardRemoved(keycard)
-        self.info("removed keycard with id %s" % keycard.id)
+        self.info("removed keycard with id %s", keycard.id)
 
     def removeKeycardId(self, keycardId):
-        self.debug("removing keycard with id %s" % keycardId)
+        self.debug("removing keycard with id %s", keycardId)
         keycard = self._keycards[keycardId]
         self.removeKeycard(keycard)
 
@@ -0,0 +1,171 @@
+# -*- test-case-name: flumotion.test.test_component_streamer_burstcache -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""keyframe bookkeeping for bursting data to joining clients
+"""
+
+import threading
+import time
+from collections import deque
+
+__version__ = "$Rev$"
+
+
+class BurstCache(object):
+    """
+    I keep track of the keyframes in the data queued by a multifdsink.
+
+    I don't hold any data myself: I only remember the byte position and
+    the timestamp of every keyframe still within the byte or time budget
+    of the sink, so the burst to give to a joining client can be computed
+    exactly, instead of letting the sink guess from buffer counts.
+
+    Buffers are added from the streaming thread, while bursts are computed
+    in the reactor thread.
+    """
+
+    def __init__(self, maxBytes=None, maxTime=None):
+        """
+        @param maxBytes: the number of bytes the sink keeps, or None
+        @type  maxBytes: int
+        @param maxTime:  the number of seconds the sink keeps, or None
+        @type  maxTime:  float
+        """
+        self.maxBytes = maxBytes
+        self.maxTime = maxTime
+
+        self._lock = threading.Lock()
+        self._keyframes = deque() # (byte position, timestamp)
+        self._bytes = 0L # total number of bytes queued so far
+        self._timestamp = None # timestamp of the last buffer
+        self._waiting = [] # join times of clients waiting for a keyframe
+
+        # seconds the joining clients waited for a keyframe
+        self.waitCount = 0
+        self.waitTotal = 0.0
+        self.waitMax = 0.0
+
+    ### called from the streaming thread
+
+    def addBuffer(self, size, timestamp, keyframe, now=None):
+        """
+        Add a buffer queued by the sink.
+
+        @param size:      the size of the buffer in bytes
+        @param timestamp: the timestamp of the buffer in seconds, or None
+        @param keyframe:  whether the buffer can be decoded on its own
+        """
+        self._lock.acquire()
+        try:
+            if timestamp is None:
+                timestamp = self._timestamp
+            if keyframe:
+                self._keyframes.append((self._bytes, timestamp))
+                if self._waiting:
+                    self._keyframeArrived(now or time.time())
+            self._bytes += size
+            self._timestamp = timestamp
+            self._expire()
+        finally:
+            self._lock.release()
+
+    ### called from the reactor thread
+
+    def getBurst(self, burstSize=0, burstTime=0.0, now=None):
+        """
+        Compute the burst to give to a joining client: all the data since
+        the latest keyframe that is at least burstSize bytes or burstTime
+        seconds old, or since the oldest keyframe still queued if none is.
+
+        When no keyframe is queued, the client is accounted as waiting
+        for the next one.
+
+        @return: the number of bytes to burst, or None if there is no
+                 keyframe to start from
+        @rtype:  long
+        """
+        self._lock.acquire()
+        try:
+            if not self._keyframes:
+                self._waiting.append(now or time.time())
+                return None
+            self._addWait(0.0)
+            position = self._keyframes[0][0]
+            for keyframePosition, timestamp in reversed(self._keyframes):
+                if burstTime and timestamp is not None \
+                        and self._timestamp - timestamp >= burstTime:
+                    position = keyframePosition
+                    break
+                if not burstTime and \
+                        self._bytes - keyframePosition >= burstSize:
+                    position = keyframePosition
+                    break
+            return self._bytes - position
+        finally:
+            self._lock.release()
+
+    def getCachedBytes(self):
+        """
+        @return: the number of bytes queued since the oldest keyframe
+        @rtype:  long
+        """
+        self._lock.acquire()
+        try:
+            if not self._keyframes:
+                return 0L
+            return self._bytes - self._keyframes[0][0]
+        finally:
+            self._lock.release()
+
+    def getKeyframeCount(self):
+        return len(self._keyframes)
+
+    def getAverageWait(self):
+        """
+        @return: the average time in seconds joining clients waited for
+                 a keyframe to start from
+        @rtype:  float
+        """
+        if not self.waitCount:
+            return 0.0
+        return self.waitTotal / self.waitCount
+
+    ### private methods, called with the lock held
+
+    def _keyframeArrived(self, now):
+        for joined in self._waiting:
+            self._addWait(max(now - joined, 0.0))
+        self._waiting = []
+
+    def _addWait(self, wait):
+        self.waitCount += 1
+        self.waitTotal += wait
+        self.waitMax = max(self.waitMax, wait)
+
+    def _expire(self):
+        # the sink drops the data beyond its limits, and so the keyframes
+        keyframes = self._keyframes
+        while keyframes:
+            position, timestamp = keyframes[0]
+            if self.maxBytes is not None \
+                    and self._bytes - position > self.maxBytes:
+                keyframes.popleft()
+            elif self.maxTime is not None and timestamp is not None \
+                    and self._timestamp - timestamp > self.maxTime:
+                keyframes.popleft()
+            else:
+                break
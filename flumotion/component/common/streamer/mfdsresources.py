@@ -30,6 +30,28 @@ from flumotion.common import log
 from flumotion.component.common.streamer import resources
 
 
+class ClientStats(object):
+    """
+    I hold the statistics of a client removed from multifdsink that are
+    needed once it is gone, so the stats array can be dropped right away.
+    """
+
+    __slots__ = ('bytesSent', 'timeConnected')
+
+    def __init__(self, bytesSent, timeConnected):
+        self.bytesSent = bytesSent
+        self.timeConnected = timeConnected
+
+    def fromArray(cls, stats):
+        """
+        @param stats: the statistics returned by the get-stats signal
+        @type  stats: GValueArray
+        """
+        # bytes sent, connect time, disconnect time, time connected, ...
+        return cls(stats[0], int(stats[3] / gst.SECOND))
+    fromArray = classmethod(fromArray)
+
+
 class MultiFdSinkStreamingResource(resources.HTTPStreamingResource,
                                    log.Loggable):
 
@@ -53,8 +75,8 @@ class MultiFdSinkStreamingResource(resources.HTTPStreamingResource,
 
     def _logWrite(self, request, stats):
         if stats:
-            bytes_sent = stats[0]
-            time_connected = int(stats[3] / gst.SECOND)
+            bytes_sent = stats.bytesSent
+            time_connected = stats.timeConnected
         else:
             bytes_sent = -1
             time_connected = -1
@@ -71,7 +93,7 @@ class MultiFdSinkStreamingResource(resources.HTTPStreamingResource,
         @param fd: the file descriptor for the client being removed
         @type fd: L{int}
         @param stats: the statistics for the removed client
-        @type stats: GValueArray
+        @type stats: L{ClientStats}
         """
         # PROBE: finishing request; see httpserver.httpserver
         self.debug('[fd %5d] (ts %f) finishing request %r',
@@ -15,16 +15,21 @@
 #
 # Headers in this file shall remain intact.
 
+from collections import deque
+
 import gst
 
 from twisted.internet import reactor
 
+from flumotion.common import errors
+from flumotion.common import format as formatting
 from flumotion.common import gstreamer
 from flumotion.common import messages
 from flumotion.component.base import http
+from flumotion.component.common.streamer import burstcache
 from flumotion.component.common.streamer import streamer
 from flumotion.component.common.streamer.mfdsresources import \
-    MultiFdSinkStreamingResource, HTTPRoot
+    MultiFdSinkStreamingResource, HTTPRoot, ClientStats
 
 from flumotion.common.i18n import N_, gettexter
 
@@ -33,6 +38,11 @@ __version__ = "$Rev$"
 
 T_ = gettexter()
 
+# kB of data kept beyond the burst size when no burst cache size is given
+DEFAULT_BURST_CACHE_MARGIN = 2048
+# maximum number of removed clients processed in a reactor iteration
+REMOVAL_BATCH_SIZE = 100
+
 
 ### the actual component is a streamer using multifdsink
 
@@ -53,6 +63,27 @@ class Stats(streamer.Stats):
         return max(map(
                 lambda sink: sink.get_property('bytes-to-serve'), self.sinks))
 
+    def getBurstCaches(self):
+        return [sink.burstCache for sink in self.sinks if sink.burstCache]
+
+    def updateState(self, set):
+        streamer.Stats.updateState(self, set)
+
+        set('clients-removal-backlog', self.getRemovalBacklog())
+
+        caches = self.getBurstCaches()
+        if not caches:
+            return
+        cached = sum([cache.getCachedBytes() for cache in caches])
+        waitCount = sum([cache.waitCount for cache in caches])
+        waitTotal = sum([cache.waitTotal for cache in caches])
+        set('burst-cache-size', formatting.formatStorage(cached) + 'Byte')
+        set('burst-cache-size-raw', cached)
+        if waitCount:
+            set('clients-keyframe-wait', waitTotal / waitCount)
+        set('clients-keyframe-wait-max',
+            max([cache.waitMax for cache in caches]))
+
 
 class MultifdSinkStreamer(streamer.Streamer, Stats):
     pipe_template = 'multifdsink name=sink ' + \
@@ -60,15 +91,30 @@ class MultifdSinkStreamer(streamer.Streamer, Stats):
                                 'recover-policy=3'
     defaultSyncMethod = 0
 
+    def init(self):
+        streamer.Streamer.init(self)
+
+        # removed clients waiting to be processed in the reactor thread
+        self._removals = deque()
+        self._removalsScheduled = False
+
+        for i in ('clients-removal-backlog',
+                  'burst-cache-size', 'burst-cache-size-raw',
+                  'clients-keyframe-wait', 'clients-keyframe-wait-max'):
+            self.uiState.addKey(i, None)
+
     def setup_burst_mode(self, sink):
+        sink.burstCache = None
         if self.burst_on_connect:
             if self.burst_time and \
                     gstreamer.element_factory_has_property('multifdsink',
                                                            'units-max'):
                 self.debug("Configuring burst mode for %f second burst",
                     self.burst_time)
-                # Set a burst for configurable minimum time, plus extra to
-                # start from a keyframe if needed.
+                # Bursts start from the keyframe found by our burst cache
+                # when adding the client; the sink only falls back on a
+                # burst for configurable minimum time, plus extra to start
+                # from a keyframe if needed, when no keyframe is known.
                 sink.set_property('sync-method', 4) # burst-keyframe
                 sink.set_property('burst-unit', 2) # time
                 sink.set_property('burst-value',
@@ -76,15 +122,20 @@ class MultifdSinkStreamer(streamer.Streamer, Stats):
 
                 # We also want to ensure that we have sufficient data available
                 # to satisfy this burst; and an appropriate maximum, all
-                # specified in units of time.
+                # specified in units of time unless we have a byte budget.
                 sink.set_property('time-min',
                     long((self.burst_time + 5) * gst.SECOND))
 
-                sink.set_property('unit-type', 2) # time
-                sink.set_property('units-soft-max',
-                    long((self.burst_time + 8) * gst.SECOND))
-                sink.set_property('units-max',
-                    long((self.burst_time + 10) * gst.SECOND))
+                if self.burst_cache_size:
+                    self._set_byte_limits(sink, 0)
+                else:
+                    sink.set_property('unit-type', 2) # time
+                    sink.set_property('units-soft-max',
+                        long((self.burst_time + 8) * gst.SECOND))
+                    sink.set_property('units-max',
+                        long((self.burst_time + 10) * gst.SECOND))
+                    sink.burstCache = burstcache.BurstCache(
+                        maxTime=self.burst_time + 10)
             elif self.burst_size:
                 self.debug("Configuring burst mode for %d kB burst",
                     self.burst_size)
@@ -102,24 +153,22 @@ class MultifdSinkStreamer(streamer.Streamer, Stats):
                 # the burst amount so that we should have a keyframe available
                 sink.set_property('bytes-min', (self.burst_size + 512) * 1024)
 
-                # And then we need a maximum still further above that - the
-                # exact value doesn't matter too much, but we want it
-                # reasonably small to limit memory usage. multifdsink doesn't
-                # give us much control here, we can only specify the max
-                # values in buffers. We assume each buffer is close enough
-                # to 4kB - true for asf and ogg, at least
-                sink.set_property('buffers-soft-max',
-                    (self.burst_size + 1024) / 4)
-                sink.set_property('buffers-max',
-                    (self.burst_size + 2048) / 4)
-
+                # And then we need a maximum still further above that, to
+                # limit memory usage; it's given in bytes, by default 2 MB
+                # above the burst amount.
+                self._set_byte_limits(sink, self.burst_size * 1024)
             else:
                 # Old behaviour; simple burst-from-latest-keyframe
                 self.debug("simple burst-on-connect, setting sync-method 2")
                 sink.set_property('sync-method', 2)
 
-                sink.set_property('buffers-soft-max', 250)
-                sink.set_property('buffers-max', 500)
+                # The sink finds the latest keyframe on its own; we only
+                # track keyframes when given a byte budget to enforce
+                if self.burst_cache_size:
+                    self._set_byte_limits(sink, 0)
+                else:
+                    sink.set_property('buffers-soft-max', 250)
+                    sink.set_property('buffers-max', 500)
         else:
             self.debug("no burst-on-connect, setting sync-method 0")
             sink.set_property('sync-method', self.defaultSyncMethod)
@@ -127,11 +176,23 @@ class MultifdSinkStreamer(streamer.Streamer, Stats):
             sink.set_property('buffers-soft-max', 250)
             sink.set_property('buffers-max', 500)
 
+    def _set_byte_limits(self, sink, burstBytes):
+        # Bound the data queued by the sink to the burst cache size; slow
+        # clients are recovered half way between the burst and that limit
+        maxBytes = (self.burst_cache_size or
+                    self.burst_size + DEFAULT_BURST_CACHE_MARGIN) * 1024
+        self.debug("Limiting queued data to %d bytes", maxBytes)
+        sink.set_property('unit-type', 3) # bytes
+        sink.set_property('units-soft-max', (burstBytes + maxBytes) / 2)
+        sink.set_property('units-max', maxBytes)
+        sink.burstCache = burstcache.BurstCache(maxBytes=maxBytes)
+
     def parseExtraProperties(self, properties):
         # check how to set client sync mode
         self.burst_on_connect = properties.get('burst-on-connect', False)
         self.burst_size = properties.get('burst-size', 0)
         self.burst_time = properties.get('burst-time', 0.0)
+        self.burst_cache_size = properties.get('burst-cache-size', 0)
 
     def _configure_sink(self, sink):
         self.setup_burst_mode(sink)
@@ -147,6 +208,10 @@ class MultifdSinkStreamer(streamer.Streamer, Stats):
 
         sink.connect('deep-notify::caps', self._notify_caps_cb)
 
+        if sink.burstCache:
+            sink.get_pad('sink').add_buffer_probe(self._burst_buffer_probe,
+                                                  sink.burstCache)
+
         # these are made threadsafe using idle_add in the handler
         sink.connect('client-added', self._client_added_handler)
 
@@ -170,6 +235,11 @@ class MultifdSinkStreamer(streamer.Streamer, Stats):
                 'gst-plugins-base', '0.10.10'))
             addMessage(m)
 
+        cacheSize = props.get('burst-cache-size', None)
+        if cacheSize is not None and cacheSize <= props.get('burst-size', 0):
+            raise errors.ConfigError('burst-cache-size must be larger than '
+                                     'burst-size')
+
     def configure_auth_and_resource(self):
         self.httpauth = http.HTTPAuthentication(self)
         self.resource = MultiFdSinkStreamingResource(self, self.httpauth)
@@ -206,13 +276,32 @@ class MultifdSinkStreamer(streamer.Streamer, Stats):
         return mime
 
     def add_client(self, fd, request):
-        sink = self.get_element('sink')
-        sink.emit('add', fd)
+        self._add_client_to_sink(self.get_element('sink'), fd)
+
+    def _add_client_to_sink(self, sink, fd):
+        burst = None
+        if sink.burstCache:
+            burst = sink.burstCache.getBurst(self.burst_size * 1024,
+                                             self.burst_time)
+        if burst is None:
+            sink.emit('add', fd)
+            return
+        # Burst everything since the keyframe found in the cache; the sink
+        # looks for it from the minimum, and the maximum makes sure it can
+        # still start from a keyframe if more data arrived in the meantime
+        self.log('[fd %5d] bursting %d bytes', fd, burst)
+        maxBytes = sink.burstCache.maxBytes or -1
+        sink.emit('add-full', fd, 4, 3, burst, 3, maxBytes) # burst-keyframe
 
     def remove_client(self, fd):
         sink = self.get_element('sink')
         sink.emit('remove', fd)
 
+    def remove_clients(self, fds):
+        sink = self.get_element('sink')
+        for fd in fds:
+            sink.emit('remove', fd)
+
     def remove_all_clients(self):
         """Remove all the clients.
 
@@ -228,6 +317,9 @@ class MultifdSinkStreamer(streamer.Streamer, Stats):
         Stats.clientAdded(self)
         self.update_ui_state()
 
+    def getRemovalBacklog(self):
+        return len(self._removals)
+
     def _client_removed_handler(self, sink, fd, reason, stats):
         self.log('[fd %5d] client_removed_handler, reason %s', fd, reason)
         if reason.value_name == 'GST_CLIENT_STATUS_ERROR':
@@ -235,6 +327,20 @@ class MultifdSinkStreamer(streamer.Streamer, Stats):
 
         self.resource.clientRemoved(sink, fd, reason, stats)
         Stats.clientRemoved(self)
+
+    def _process_removals(self):
+        # Removed clients are processed in bounded batches, giving the
+        # reactor a chance to serve other events in between, so mass
+        # disconnections don't block the component
+        self._removalsScheduled = False
+        removals = self._removals
+        for i in range(min(len(removals), REMOVAL_BATCH_SIZE)):
+            self._client_removed_handler(*removals.popleft())
+        if removals:
+            self.log('%d removed clients left to process', len(removals))
+            if not self._removalsScheduled:
+                self._removalsScheduled = True
+                reactor.callLater(0, self._process_removals)
         self.update_ui_state()
 
     ### START OF THREAD-AWARE CODE (called from non-reactor threads)
@@ -257,6 +363,17 @@ class MultifdSinkStreamer(streamer.Streamer, Stats):
 
         reactor.callFromThread(self.update_ui_state)
 
+    def _burst_buffer_probe(self, pad, buffer, cache):
+        # Headers are not queued by the sink, they are sent to every client
+        if buffer.flag_is_set(gst.BUFFER_FLAG_IN_CAPS):
+            return True
+        timestamp = None
+        if buffer.timestamp != gst.CLOCK_TIME_NONE:
+            timestamp = float(buffer.timestamp) / gst.SECOND
+        cache.addBuffer(buffer.size, timestamp,
+                        not buffer.flag_is_set(gst.BUFFER_FLAG_DELTA_UNIT))
+        return True
+
     # We now use both client-removed and client-fd-removed. We call get-stats
     # from the first callback ('client-removed'), but don't actually start
     # removing the client until we get 'client-fd-removed'. This ensures that
@@ -266,6 +383,8 @@ class MultifdSinkStreamer(streamer.Streamer, Stats):
 
     def _client_removed_cb(self, sink, fd, reason):
         stats = sink.emit('get-stats', fd)
+        if stats:
+            stats = ClientStats.fromArray(stats)
         self._pending_removals[fd] = (stats, reason)
 
     # this can be called from both application and streaming thread !
@@ -273,7 +392,11 @@ class MultifdSinkStreamer(streamer.Streamer, Stats):
     def _client_fd_removed_cb(self, sink, fd):
         (stats, reason) = self._pending_removals.pop(fd)
 
-        reactor.callFromThread(self._client_removed_handler, sink, fd,
-            reason, stats)
+        # Only wake up the reactor if it's not already going to process
+        # the queued removals
+        self._removals.append((sink, fd, reason, stats))
+        if not self._removalsScheduled:
+            self._removalsScheduled = True
+            reactor.callFromThread(self._process_removals)
 
     ### END OF THREAD-AWARE CODE
@@ -581,6 +581,15 @@ class Streamer(feedcomponent.ParseLaunchComponent, Stats):
             self))
         return d
 
+    def remove_clients(self, fds):
+        """
+        Remove the clients with the given file descriptors.
+
+        Used by keycard expiry.
+        """
+        for fd in fds:
+            self.remove_client(fd)
+
     def remove_all_clients(self):
         """ Remove all the the clients
 
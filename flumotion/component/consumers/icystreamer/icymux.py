@@ -99,6 +99,7 @@ class IcyMux(gst.Element):
         self._shouldOutputMetadata = False
         self._lastTitle = None
         self._lastTitleTimestamp = -1
+        self._titleMetadata = None
 
     def _broadcast_title_handler(self, object):
         self.debug("Will broadcast title.")
@@ -110,6 +111,7 @@ class IcyMux(gst.Element):
             struc = event.get_structure()
             if 'title' in struc.keys():
                 self._lastTitle = struc['title']
+                self._titleMetadata = None
                 self._lastTitleTimestamp = int(time.time())
                 self.debug("Stored title: %r on timestamp %r" %\
                         (self._lastTitle, self._lastTitleTimestamp))
@@ -119,6 +121,9 @@ class IcyMux(gst.Element):
     def _recountMetaint(self):
         self._icyMetaint = self._frameSize * self._numFrames
         self.debug("Metaint recount: %d" % self._icyMetaint)
+        # the caps only change with the metaint, don't parse them per frame
+        self._caps = gst.caps_from_string("application/x-icy, " +\
+               "metadata-interval=%d" % self._icyMetaint)
 
     def do_get_property(self, property):
         if property.name == "frame-size":
@@ -154,24 +159,53 @@ class IcyMux(gst.Element):
         return gst.Element.do_change_state(self, transition)
 
     def chainfunc(self, pad, buffer):
-        self.adapter.push(buffer)
-        while self.adapter.available() >= self._frameSize:
-            frame = self.adapter.take_buffer(self._frameSize)
-            self._setCapsAndFlags(frame)
-            if self._frameCount == 0:
-                #mark as key frame
-                frame.flag_unset(gst.BUFFER_FLAG_DELTA_UNIT)
-                self.log('marked as keyframe')
-
-            self.srcpad.push(frame)
-            self.log('Pushed frame of size %d' % frame.size)
-            self._frameCount += 1
-
-            if self._frameCount == self._numFrames:
-                self.outputMetadata()
-                self._frameCount = 0
+        # Frames are pushed as sub-buffers of the incoming buffers; only
+        # the frames spanning several incoming buffers go through the
+        # adapter, which has to copy them
+        frameSize = self._frameSize
+        offset = 0
+        available = self.adapter.available()
+        if available:
+            needed = max(frameSize - available, 0)
+            if needed > buffer.size:
+                self.adapter.push(buffer)
+                return gst.FLOW_OK
+            if needed:
+                self.adapter.push(buffer.create_sub(0, needed))
+                offset = needed
+            while self.adapter.available() >= frameSize:
+                self._pushFrame(self.adapter.take_buffer(frameSize))
+            if self.adapter.available():
+                # the frame size shrank, keep the data in order
+                if offset < buffer.size:
+                    self.adapter.push(
+                        buffer.create_sub(offset, buffer.size - offset))
+                while self.adapter.available() >= frameSize:
+                    self._pushFrame(self.adapter.take_buffer(frameSize))
+                return gst.FLOW_OK
+
+        while buffer.size - offset >= frameSize:
+            self._pushFrame(buffer.create_sub(offset, frameSize))
+            offset += frameSize
+        if offset < buffer.size:
+            self.adapter.push(buffer.create_sub(offset, buffer.size - offset))
         return gst.FLOW_OK
 
+    def _pushFrame(self, frame):
+        self._setCapsAndFlags(frame)
+        if self._frameCount == 0:
+            #mark as key frame
+            frame.flag_unset(gst.BUFFER_FLAG_DELTA_UNIT)
+            self.log('marked as keyframe')
+
+        self.srcpad.push(frame)
+        self.log('Pushed frame of size %d' % frame.size)
+        self._frameCount += 1
+
+        if self._frameCount == self._numFrames:
+            self.outputMetadata()
+            self._frameCount = 0
+
     def _getTitleForMetadata(self):
         if self._shouldOutputMetadata:
             self.info("Will output title: %r" % self._lastTitle)
@@ -181,30 +215,40 @@ class IcyMux(gst.Element):
             return None
 
     def outputMetadata(self):
-        buf = MetadataBuffer(title=self._getTitleForMetadata())
+        title = self._getTitleForMetadata()
+        if title:
+            # encode the title only once, it's resent on every broadcast
+            if self._titleMetadata is None:
+                self._titleMetadata = encodeMetadata(title)
+            buf = gst.Buffer(self._titleMetadata)
+        else:
+            buf = gst.Buffer(EMPTY_METADATA)
         self._setCapsAndFlags(buf)
         self.srcpad.push(buf)
         self.log('Pushed metadata')
 
     def _setCapsAndFlags(self, buf):
-        buf.set_caps(gst.caps_from_string("application/x-icy, " +\
-               "metadata-interval=%d" % self._icyMetaint))
+        buf.set_caps(self._caps)
         buf.flag_set(gst.BUFFER_FLAG_DELTA_UNIT)
 
 
 gst.element_register(IcyMux, "icymux")
 
 
-class MetadataBuffer(gst.Buffer):
+def encodeMetadata(title=None):
+    """
+    Encode a metadata block: its length in 16 bytes units followed by
+    the title, padded to a multiple of 16 bytes.
 
-    def __init__(self, title=None):
-        self.title = title
+    @rtype: str
+    """
+    payload = ""
+    if title:
+        title = title.encode("utf-8", "replace")
+        payload = "StreamTitle='%s';" % title
+        if not (len(payload) % 16 == 0):
+            toAdd = 16 - (len(payload) % 16)
+            payload = payload + "\0" * toAdd
+    return chr(len(payload) / 16) + payload
 
-        payload = ""
-        if title:
-            title = title.encode("utf-8", "replace")
-            payload = "StreamTitle='%s';" % title
-            if not (len(payload) % 16 == 0):
-                toAdd = 16 - (len(payload) % 16)
-                payload = payload + "\0" * toAdd
-        gst.Buffer.__init__(self, chr(len(payload) / 16) + payload)
+EMPTY_METADATA = encodeMetadata()
@@ -162,13 +162,18 @@ class ICYStreamer(MultifdSinkStreamer):
             # We should sent it only to the newly comming in client, but this
             # requires patching multifdsink
             self.muxer.emit('broadcast-title')
-        sink.emit('add', fd)
+        self._add_client_to_sink(sink, fd)
 
     def remove_client(self, fd):
         sink = self.sinkConnections[fd]
         sink.emit('remove', fd)
         del self.sinkConnections[fd]
 
+    def remove_clients(self, fds):
+        for fd in fds:
+            if fd in self.sinkConnections:
+                self.remove_client(fd)
+
     def get_icy_headers(self):
         self.debug("Icy headers: %r", self.icyHeaders)
         return self.icyHeaders
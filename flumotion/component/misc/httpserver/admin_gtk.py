@@ -227,6 +227,7 @@ class CacheStatsAdminGtkNode(StatisticsAdminGtkNode):
         self._regReqStat('current-copy-count')
         self._regReqStat('finished-copy-count')
         self._regReqStat('cancelled-copy-count')
+        self._regReqStat('cache-shards', _formatShards)
         return statistics
 
 
@@ -255,6 +256,22 @@ def _formatClientCount(value):
     return template % value
 
 
+def _formatShards(value):
+    if not value:
+        return ""
+    lines = []
+    for shard in value:
+        if shard['available']:
+            status = _("%d hits, %d misses") % (shard['hit-count'],
+                                                shard['miss-count'])
+        else:
+            status = _("failed")
+        lines.append("%s: %s / %s (%s)" % (
+            shard['path'], _formatBytes(shard['usage']),
+            _formatBytes(shard['size']), status))
+    return "\n".join(lines)
+
+
 def _formatTimeStamp(value):
     return time.strftime("%c", time.localtime(value))
 
@@ -19,14 +19,15 @@ import errno
 import os
 import stat
 import tempfile
-import threading
 import time
 
-from twisted.internet import defer, reactor, threads, abstract
+from twisted.internet import defer, abstract
+from twisted.python import failure
 
 from flumotion.common import log, common
 from flumotion.component.misc.httpserver import cachestats
 from flumotion.component.misc.httpserver import cachemanager
+from flumotion.component.misc.httpserver import diskio
 from flumotion.component.misc.httpserver import fileprovider
 from flumotion.component.misc.httpserver import localpath
 from flumotion.component.misc.httpserver.fileprovider import FileClosedError
@@ -37,6 +38,10 @@ from flumotion.component.misc.httpserver.fileprovider import NotFoundError
 SEEK_SET = 0 # os.SEEK_SET is not defined in python 2.4
 FILE_COPY_BUFFER_SIZE = abstract.FileDescriptor.bufferSize
 MAX_LOGNAME_SIZE = 30 # maximum number of characters to use for logging a path
+# Seconds the status of a source file is kept, to save network file system
+# requests when the same file is asked for again and again
+DEFAULT_SOURCE_INFO_TTL = 2
+MAX_SOURCE_INFOS = 10000
 
 
 LOG_CATEGORY = "fileprovider-localcached"
@@ -47,6 +52,17 @@ errnoLookup = {errno.ENOENT: fileprovider.NotFoundError,
                errno.EACCES: fileprovider.AccessError}
 
 
+def stat_file(path):
+    """
+    @rtype: statinfo
+    """
+    try:
+        return os.stat(path)
+    except OSError, e:
+        cls = errnoLookup.get(e.errno, fileprovider.FileError)
+        raise cls("Failed to stat file '%s': %s" % (path, str(e)))
+
+
 def open_stat(path, mode='rb'):
     """
     @rtype: (file, statinfo)
@@ -66,6 +82,55 @@ def open_stat(path, mode='rb'):
     return handle, info
 
 
+def create_temp(path, size):
+    """
+    Creates the temporary file a file of the given size is copied to,
+    opened for writing and for reading.
+
+    @rtype: (file, file, statinfo)
+    """
+    # Created with another name and renamed, so the file is never
+    # seen with a wrong size
+    fd, transientPath = tempfile.mkstemp(".tmp", LOG_CATEGORY,
+                                         os.path.dirname(path))
+    wfile = os.fdopen(fd, "wb")
+    rfile = None
+    try:
+        rfile = open(transientPath, "rb")
+        wfile.truncate(size)
+        os.rename(transientPath, path)
+    except:
+        wfile.close()
+        if rfile is not None:
+            rfile.close()
+        os.remove(transientPath)
+        raise
+    return wfile, rfile, os.fstat(rfile.fileno())
+
+
+def copy_block(source, dest, offset):
+    """
+    Copies a block of a file at the same offset of another one.
+
+    @returns: the number of bytes copied
+    @rtype:   int
+    """
+    source.seek(offset)
+    dest.seek(offset)
+    data = source.read(FILE_COPY_BUFFER_SIZE)
+    dest.write(data)
+    dest.flush()
+    return len(data)
+
+
+def file_key(info):
+    """
+    @returns: the key identifying a file in the disk I/O queues;
+              it's the same for all the handles of the file
+    """
+    return info[stat.ST_DEV], info[stat.ST_INO]
+
+
 class FileProviderLocalCachedPlug(fileprovider.FileProviderPlug,
                                   log.Loggable):
     """
@@ -81,13 +146,19 @@ class FileProviderLocalCachedPlug(fileprovider.FileProviderPlug,
     the cache usage changed and keep an estimation
     of the cache usage for statistics.
 
-    I'm creating a unique thread to do the file copying block by block,
-    for all files to be copied to the cache.
-    Using a thread instead of a reactor.callLater 'loop' allow for
-    higher copy throughput and do not slow down the mail loop when
-    lots of files are copied at the same time.
-    Simulations with real request logs show that using a thread
-    gives better results than the equivalent asynchronous implementation.
+    All the disk operations, opening and reading the files and copying
+    them block by block to the cache, are run in the threads of a
+    L{diskio.DiskIOExecutor}, so a slow network file system never blocks
+    the main loop. The operations on a file are queued in order, so a
+    copy and the reads of the parts not yet copied never use the source
+    file at the same time, and the clients streaming the same file share
+    their reads.
+
+    The status of the source files is kept for a few seconds, and the
+    clients asking for a file while its status is retrieved or while it's
+    opened to be copied wait for the result instead of doing it again;
+    this way a newly published file asked for by lots of clients
+    at the same time is looked up and opened only once.
     """
 
     logCategory = LOG_CATEGORY
@@ -104,9 +175,15 @@ class FileProviderLocalCachedPlug(fileprovider.FileProviderPlug,
         cleanupEnabled = props.get('cleanup-enabled')
         cleanupHighWatermark = props.get('cleanup-high-watermark')
         cleanupLowWatermark = props.get('cleanup-low-watermark')
+        threads = props.get('disk-io-threads', diskio.DEFAULT_THREADS)
+        self.sourceInfoTTL = props.get('source-info-ttl',
+                                       DEFAULT_SOURCE_INFO_TTL)
 
-        self._sessions = {} # {CopySession: None}
         self._index = {} # {path: CopySession}
+        self._sourceInfos = {} # {path: (statinfo, expiry time)}
+        # Deferreds waiting for the operations running for a path
+        self._statting = {} # {path: [Deferred]}
+        self._opening = {} # {path: [Deferred]}
 
         self.stats = cachestats.CacheStatistics()
 
@@ -118,34 +195,35 @@ class FileProviderLocalCachedPlug(fileprovider.FileProviderPlug,
 
         common.ensureDir(self._sourceDir, "source")
 
-        # Startup copy thread
-        self._thread = CopyThread(self)
+        self.executor = diskio.DiskIOExecutor(threads)
 
     def start(self, component):
         self.debug('Starting cachedprovider plug for component %r', component)
         d = self.cache.setUp()
-        d.addCallback(lambda x: self._thread.start())
+        d.addCallback(lambda x: self.executor.start())
         return d
 
     def stop(self, component):
         self.debug('Stopping cachedprovider plug for component %r', component)
-        self._thread.stop()
         dl = []
         for s in self._index.values():
             d = s.close()
             if d:
                 dl.append(d)
-        if len(dl) != 0:
-            return defer.DeferredList(dl)
+        d = defer.DeferredList(dl)
+        d.addCallback(lambda _: self.executor.stop())
+        return d
 
     def startStatsUpdates(self, updater):
         #FIXME: This is temporary. Should be done with plug UI.
         # Used for the UI to know which plug is used
         updater.update("provider-name", "fileprovider-localcached")
         self.stats.startUpdates(updater)
+        self.executor.startUpdates(updater)
 
     def stopStatsUpdates(self):
         self.stats.stopUpdates()
+        self.executor.stopUpdates()
 
     def getRootPath(self):
         if self._sourceDir is None:
@@ -171,6 +249,37 @@ class FileProviderLocalCachedPlug(fileprovider.FileProviderPlug,
             basename = basename[:prefixMaxLen-1] + "*"
         return basename + postfix
 
+    def getSourceInfo(self, path):
+        """
+        @return: a deferred fired with the status of a source file,
+                 which can be a few seconds old
+        @rtype:  L{defer.Deferred}
+        """
+        entry = self._sourceInfos.get(path, None)
+        if entry is not None:
+            info, expiry = entry
+            if expiry > time.time():
+                self.stats.onSourceInfoHit()
+                return defer.succeed(info)
+            del self._sourceInfos[path]
+        return self._coalesce(self._statting, path, self._statSource, path)
+
+    def forgetSourceInfo(self, path):
+        self._sourceInfos.pop(path, None)
+
+    def isOpeningSource(self, path):
+        return path in self._opening
+
+    def openCopySession(self, path):
+        """
+        Opens a source file and starts copying it to the cache;
+        when it's already being opened, waits for the same copy session.
+
+        @return: a deferred fired with the L{CopySession}
+        @rtype:  L{defer.Deferred}
+        """
+        return self._coalesce(self._opening, path, self._openSource, path)
+
     def getCopySession(self, path):
         return self._index.get(path, None)
 
@@ -189,31 +298,59 @@ class FileProviderLocalCachedPlug(fileprovider.FileProviderPlug,
 
     def removeCopySession(self, session):
         path = session.sourcePath
-        if path in self._index:
+        if self._index.get(path) is session:
             del self._index[path]
-        self.disableSession(session)
 
-    def activateSession(self, session):
-        self.debug("Starting Copy Session '%s' (%d)",
-                   session.logName, len(self._sessions))
-        if session in self._sessions:
-            return
-        self._sessions[session] = None
-        self._activateCopyLoop()
 
-    def disableSession(self, session):
-        self.debug("Stopping Copy Session '%s' (%d)",
-                   session.logName, len(self._sessions))
-        if session in self._sessions:
-            del self._sessions[session]
-        if not self._sessions:
-            self._disableCopyLoop()
+    ## Private Methods ##
+
+    def _coalesce(self, table, path, func, *args):
+        # Single flight: only one operation runs for a path at a time
+        waiting = table.get(path, None)
+        if waiting is not None:
+            self.stats.onRequestCoalesced()
+            d = defer.Deferred()
+            waiting.append(d)
+            return d
+        table[path] = []
+        d = func(*args)
+        d.addBoth(self._coalescedDone, table, path)
+        return d
+
+    def _coalescedDone(self, result, table, path):
+        for d in table.pop(path, []):
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        return result
+
+    def _statSource(self, path):
+        d = self.executor.call(path, stat_file, path)
+        d.addCallback(self._storeSourceInfo, path)
+        return d
+
+    def _openSource(self, path):
+        d = self.executor.call(path, open_stat, path)
+        d.addCallback(self._sourceOpened, path)
+        return d
 
-    def _activateCopyLoop(self):
-        self._thread.wakeup()
+    def _sourceOpened(self, (sourceFile, sourceInfo), path):
+        self._storeSourceInfo(sourceInfo, path)
+        return self.createCopySession(path, sourceFile, sourceInfo)
 
-    def _disableCopyLoop(self):
-        self._thread.sleep()
+    def _storeSourceInfo(self, info, path):
+        if self.sourceInfoTTL <= 0:
+            return info
+        now = time.time()
+        if len(self._sourceInfos) >= MAX_SOURCE_INFOS:
+            for p, (i, expiry) in self._sourceInfos.items():
+                if expiry <= now:
+                    del self._sourceInfos[p]
+        if len(self._sourceInfos) >= MAX_SOURCE_INFOS:
+            self._sourceInfos.clear()
+        self._sourceInfos[path] = (info, now + self.sourceInfoTTL)
+        return info
 
 
 class LocalPath(localpath.LocalPath, log.Loggable):
@@ -234,56 +371,6 @@ class LocalPath(localpath.LocalPath, log.Loggable):
         return f.open()
 
 
-    ## Private Methods ##
-
-    def _removeCachedFile(self, sourcePath):
-        cachePath = self.plug.cache.getCachePath(sourcePath)
-        try:
-            os.remove(cachePath)
-            self.debug("Deleted cached file '%s'", cachePath)
-        except OSError, e:
-            if e.errno != errno.ENOENT:
-                self.warning("Error deleting file: %s", str(e))
-
-
-class CopyThread(threading.Thread, log.Loggable):
-
-    logCategory = LOG_CATEGORY
-
-    def __init__(self, plug):
-        threading.Thread.__init__(self)
-        self.plug = plug
-        self._running = True
-        self._event = threading.Event()
-
-    def stop(self):
-        self._running = False
-        self._event.set()
-        self.join()
-
-    def wakeup(self):
-        self._event.set()
-
-    def sleep(self):
-        self._event.clear()
-
-    def run(self):
-        while self._running:
-            sessions = self.plug._sessions.keys()
-            for session in sessions:
-                try:
-                    session.doServe()
-                except Exception, e:
-                    log.warning("Error during async file serving: %s",
-                                log.getExceptionMessage(e))
-                try:
-                    session.doCopy()
-                except Exception, e:
-                    log.warning("Error during file copy: %s",
-                                log.getExceptionMessage(e))
-            self._event.wait()
-
-
 class CopySessionCancelled(Exception):
     pass
 
@@ -292,9 +379,10 @@ class CopySession(log.Loggable):
     """
     I'm serving a file at the same time I'm copying it
     from the network file system to the cache.
-    If the client ask for data not yet copied, the source file
-    read operation is delegated the the copy thread as an asynchronous
-    operation because file seeking/reading is not thread safe.
+    The copy is done block by block by the disk I/O executor.
+    If the client ask for data not yet copied, it's read from the source
+    file in the same executor queue as the copy, so the source file
+    is never used by two threads at the same time.
 
     The copy session have to open two times the temporary file,
     one for read-only and one for write only,
@@ -323,14 +411,18 @@ class CopySession(log.Loggable):
         # The size and modification time is not supposed to change over time
         self.mtime = sourceInfo[stat.ST_MTIME]
         self.size = sourceInfo[stat.ST_SIZE]
+        self._executor = plug.executor
+        self._cache = plug.cache
+        self._stats = plug.stats
         self._sourceFile = sourceFile
+        self._sourceKey = file_key(sourceInfo)
+        self._tempKey = None
         self._cancelled = False # True when a session has been outdated
+        self._completing = False # True while the copy is renamed
         self._wTempFile = None
         self._rTempFile = None
         self._allocTag = None # Tag used to identify cache allocations
         self._waitCancel = None
-        # List of the pending read from source file
-        self._pending = [] # [(position, size, defer),]
         self._refCount = 0
         self._copied = 0 # None when the file is fully copied
         self._correction = 0 # Used to take into account copies data for stats
@@ -342,58 +434,16 @@ class CopySession(log.Loggable):
 
     def read(self, position, size, stats):
         # If the temporary file is open for reading
-        if self._rTempFile:
-            # And the needed data is already downloaded
-            # Safe to read because it's not used by the copy thread
-            if (self._copied is None) or ((position + size) <= self._copied):
-                try:
-                    self._rTempFile.seek(position)
-                    data = self._rTempFile.read(size)
-                    # Adjust the cache/source values to take copy into account
-                    size = len(data)
-                    # It's safe to use and modify self._correction even if
-                    # it's used by the copy thread because the copy thread
-                    # only add and the main thread only subtract.
-                    # The only thing that could append it's a less accurate
-                    # correction...
-                    diff = min(self._correction, size)
-                    self._correction -= diff
-                    stats.onBytesRead(0, size, diff)
-                    return data
-                except Exception, e:
-                    self.warning("Failed to read from temporary file: %s",
-                                 log.getExceptionMessage(e))
-                    self._cancelSession()
-        # If the source file is not open anymore, we can't continue
-        if self._sourceFile is None:
-            raise FileError("File caching error, cannot proceed")
-        # Otherwise read the data directly from the source
-        try:
-            # It's safe to not use Lock, because simple type operations
-            # are thread safe, and even if the copying state change
-            # from True to False, _onCopyFinished will be called
-            # later in the same thread and will process pending reads.
-            if self.copying:
-                # If we are currently copying the source file,
-                # we defer the file read to the copying thread
-                # because we can't read a file from two threads.
-                d = defer.Deferred()
-
-                def updateStats(data):
-                    stats.onBytesRead(len(data), 0, 0)
-                    return data
-
-                d.addCallback(updateStats)
-                self._pending.append((position, size, d))
-                return d
-            # Not copying, it's safe to read directly
-            self._sourceFile.seek(position)
-            data = self._sourceFile.read(size)
-            stats.onBytesRead(len(data), 0, 0)
-            return data
-        except IOError, e:
-            cls = errnoLookup.get(e.errno, FileError)
-            raise cls("Failed to read source file: %s" % str(e))
+        # and the needed data is already copied
+        if self._rTempFile and ((self._copied is None)
+                                or ((position + size) <= self._copied)):
+            d = self._executor.read(self._tempKey, self._rTempFile,
+                                    position, size)
+            d.addCallbacks(self._readFromTemp, self._tempReadFailed,
+                           callbackArgs=(stats, ),
+                           errbackArgs=(position, size, stats))
+            return d
+        return self._readSource(position, size, stats)
 
     def incRef(self):
         self._refCount += 1
@@ -406,7 +456,8 @@ class CopySession(log.Loggable):
             # Cancel the copy and close the writing temporary file.
             self._cancelCopy(False, True)
         # We close if the copy is finished (if _copied is None)
-        if (self._refCount == 0) and (self._copied is None):
+        if (self._refCount == 0) and (self._copied is None) \
+                and not self._completing:
             self.close()
 
     def _close(self):
@@ -424,71 +475,52 @@ class CopySession(log.Loggable):
             d.addCallback(lambda _: self._close())
             return d
 
-    def doServe(self):
-        if not (self.copying and self._pending):
-            # Nothing to do anymore.
-            return False
-        # We have pending source file read operations
-        position, size, d = self._pending.pop(0)
-        self._sourceFile.seek(position)
-        data = self._sourceFile.read(size)
-        # Call the deferred in the main thread
-        reactor.callFromThread(d.callback, data)
-        return len(self._pending) > 0
-
-    def doCopy(self):
-        # Called in the copy thread context.
-        if not self.copying:
-            # Nothing to do anymore.
-            return False
-        # Copy a buffer from the source file to the temporary writing file
-        cont = True
-        try:
-            # It's safe to use self._copied, because it's only set
-            # by the copy thread during copy.
-            self._sourceFile.seek(self._copied)
-            self._wTempFile.seek(self._copied)
-            data = self._sourceFile.read(FILE_COPY_BUFFER_SIZE)
-            self._wTempFile.write(data)
-            self._wTempFile.flush()
-        except IOError, e:
-            self.warning("Failed to copy source file: %s",
-                         log.getExceptionMessage(e))
-            # Abort copy and cancel the session
-            self.copying = False
-            reactor.callFromThread(self.plug.disableSession, self)
-            reactor.callFromThread(self._cancelSession)
-            # Do not continue
-            cont = False
-        else:
-            size = len(data)
-            self._copied += size
-            self._correction += size
-            if  size < FILE_COPY_BUFFER_SIZE:
-                # Stop copying
-                self.copying = False
-                reactor.callFromThread(self.plug.disableSession, self)
-                reactor.callFromThread(self._onCopyFinished)
-                cont = False
-        # Check for cancellation
-        if self._waitCancel and self.copying:
-            # Copy has been cancelled
-            self.copying = False
-            reactor.callFromThread(self.plug.disableSession, self)
-            reactor.callFromThread(self._onCopyCancelled, *self._waitCancel)
-            return False
-        return cont
-
 
     ## Private Methods ##
 
+    def _readSource(self, position, size, stats):
+        # If the source file is not open anymore, we can't continue
+        if self._sourceFile is None:
+            raise FileError("File caching error, cannot proceed")
+        # Queued with the copy of the source file
+        d = self._executor.read(self._sourceKey, self._sourceFile,
+                                position, size)
+        d.addCallbacks(self._readFromSource, self._sourceReadFailed,
+                       callbackArgs=(stats, ))
+        return d
+
+    def _readFromTemp(self, data, stats):
+        # Adjust the cache/source values to take copy into account
+        size = len(data)
+        diff = min(self._correction, size)
+        self._correction -= diff
+        stats.onBytesRead(0, size, diff)
+        return data
+
+    def _tempReadFailed(self, failure, position, size, stats):
+        failure.trap(IOError)
+        self.warning("Failed to read from temporary file: %s",
+                     log.getFailureMessage(failure))
+        self._cancelSession()
+        return self._readSource(position, size, stats)
+
+    def _readFromSource(self, data, stats):
+        stats.onBytesRead(len(data), 0, 0)
+        return data
+
+    def _sourceReadFailed(self, failure):
+        failure.trap(IOError)
+        e = failure.value
+        cls = errnoLookup.get(e.errno, FileError)
+        raise cls("Failed to read source file: %s" % str(e))
+
     def _allocCacheSpace(self):
         # Retrieve a cache allocation tag, used to track the cache free space
-        return self.plug.cache.allocateCacheSpace(self.size)
+        return self._cache.allocateCacheSpace(self.size, self.sourcePath)
 
     def _releaseCacheSpace(self):
         if not (self._cancelled or self._allocTag is None):
-            self.plug.cache.releaseCacheSpace(self._allocTag)
+            self._cache.releaseCacheSpace(self._allocTag)
         self._allocTag = None
 
     def _cancelSession(self):#
@@ -509,54 +541,75 @@ class CopySession(log.Loggable):
             # No free space, proxying source file directly
             self._cancelSession()
             return
-        self.plug.stats.onCopyStarted()
-        # Then open a transient temporary files
-        try:
-            fd, transientPath = tempfile.mkstemp(".tmp", LOG_CATEGORY)
-            self.log("Created transient file '%s'", transientPath)
-            self._wTempFile = os.fdopen(fd, "wb")
-            self.log("Opened temporary file for writing [fd %d]",
-                     self._wTempFile.fileno())
-            self._rTempFile = file(transientPath, "rb")
-            self.log("Opened temporary file for reading [fd %d]",
-                     self._rTempFile.fileno())
-        except IOError, e:
-            self.warning("Failed to open temporary file: %s",
-                         log.getExceptionMessage(e))
-            self._cancelSession()
-            return
-        # Truncate it to the source size
-        try:
-            self.log("Truncating temporary file to size %d", self.size)
-            self._wTempFile.truncate(self.size)
-        except IOError, e:
-            self.warning("Failed to truncate temporary file: %s",
-                         log.getExceptionMessage(e))
-            self._cancelSession()
+        self._stats.onCopyStarted()
+        # Then create the temporary file, truncated to the source size
+        d = self._executor.call(self.tempPath, create_temp,
+                                self.tempPath, self.size)
+        d.addCallbacks(self._gotTempFile, self._tempFileFailed)
+        return d
+
+    def _gotTempFile(self, (wTempFile, rTempFile, tempInfo)):
+        self._wTempFile = wTempFile
+        self._rTempFile = rTempFile
+        self._tempKey = file_key(tempInfo)
+        self.log("Created temporary file '%s' [fd %d for writing, "
+                 "fd %d for reading]", self.tempPath,
+                 wTempFile.fileno(), rTempFile.fileno())
+        if self._cancelled and self._refCount <= 1:
+            # Outdated while creating the temporary file
+            self._closeWriteTempFile()
             return
-        # And move it to the real temporary file path
-        try:
-            self.log("Renaming transient file to '%s'", self.tempPath)
-            os.rename(transientPath, self.tempPath)
-        except IOError, e:
-            self.warning("Failed to rename transient temporary file: %s",
-                         log.getExceptionMessage(e))
         # And start copying
         self.debug("Start caching '%s' [fd %d]",
                    self.sourcePath, self._sourceFile.fileno())
-        # Activate the copy
         self.copying = True
-        self.plug.activateSession(self)
+        self._copyBlock()
+
+    def _tempFileFailed(self, failure):
+        self.warning("Failed to create temporary file: %s",
+                     log.getFailureMessage(failure))
+        self._cancelSession()
 
     def _startCopying(self):
         self.log("Start copy session")
         # First ensure there is not already a temporary file
-        self._removeTempFile()
+        d = self._removeTempFile()
         # Reserve cache space, may trigger a cache cleanup
-        d = self._allocCacheSpace()
+        d.addCallback(lambda _: self._allocCacheSpace())
         d.addCallback(self._gotCacheSpace)
         return d
 
+    def _copyBlock(self):
+        d = self._executor.call(self._sourceKey, copy_block,
+                                self._sourceFile, self._wTempFile,
+                                self._copied)
+        d.addCallbacks(self._blockCopied, self._copyFailed)
+
+    def _blockCopied(self, size):
+        self._copied += size
+        self._correction += size
+        if size < FILE_COPY_BUFFER_SIZE:
+            # Stop copying
+            self.copying = False
+            self._onCopyFinished()
+            return
+        # Check for cancellation
+        if self._waitCancel:
+            # Copy has been cancelled
+            self.copying = False
+            self._onCopyCancelled(*self._waitCancel)
+            return
+        self._copyBlock()
+
+    def _copyFailed(self, failure):
+        self.warning("Failed to copy source file: %s",
+                     log.getFailureMessage(failure))
+        # Abort copy, remove the partial copy and cancel the session
+        self.copying = False
+        closeSource = self._waitCancel and self._waitCancel[0]
+        self._onCopyCancelled(closeSource, True)
+        self._cancelSession()
+
     def _cancelCopy(self, closeSource, closeTempWrite):
         if self.copying:
             self.log("Canceling file copy")
@@ -566,7 +619,7 @@ class CopySession(log.Loggable):
             self.debug("Cancel caching '%s' [fd %d]",
                        self.sourcePath, self._sourceFile.fileno())
             # Disable the copy, we do not modify copying directly
-            # to let the copying thread terminate current operations.
+            # to let the block being copied finish.
             # The file close operation are deferred.
             self._waitCancel = (closeSource, closeTempWrite)
             return
@@ -578,24 +631,11 @@ class CopySession(log.Loggable):
 
     def _onCopyCancelled(self, closeSource, closeTempWrite):
         self.log("Copy session cancelled")
-        # Called when the copy thread really stopped to read/write
+        # Called when the last block has been copied
         self._waitCancel = None
-        self.plug.stats.onCopyCancelled(self.size, self._copied)
-        # Resolve all pending source read operations
-        for position, size, d in self._pending:
-            if self._sourceFile is None:
-                d.errback(CopySessionCancelled())
-            else:
-                try:
-                    self._sourceFile.seek(position)
-                    data = self._sourceFile.read(size)
-                    d.callback(data)
-                except Exception, e:
-                    self.warning("Failed to read from source file: %s",
-                                 log.getExceptionMessage(e))
-                    d.errback(e)
-        self._pending = []
-        # then we can safely close files
+        self._stats.onCopyCancelled(self.size, self._copied)
+        # The reads of the source file already queued are done
+        # before closing it
         if closeSource:
             self._closeSourceFile()
         if closeTempWrite:
@@ -604,111 +644,103 @@ class CopySession(log.Loggable):
     def _onCopyFinished(self):
         if self._sourceFile is None:
             return
-        # Called when the copy thread really stopped to read/write
+        # Called when the last block has been copied
         self.debug("Finished caching '%s' [fd %d]",
                    self.sourcePath, self._sourceFile.fileno())
-        self.plug.stats.onCopyFinished(self.size)
+        self._stats.onCopyFinished(self.size)
         # Set the copy as finished to prevent the temporary file
         # to be deleted when closed
         self._copied = None
         # Closing source and write files
         self._closeSourceFile()
         self._closeWriteTempFile()
-        # Setting the modification time on the temporary file
-        try:
-            mtime = self.mtime
-            atime = int(time.time())
-            self.log("Setting temporary file modification time to %d", mtime)
-            # FIXME: Should use futimes, but it's not wrapped by python
-            os.utime(self.tempPath, (atime, mtime))
-        except OSError, e:
-            if e.errno == errno.ENOENT:
-                # The file may have been deleted by another process
-                self._releaseCacheSpace()
-            else:
-                self.warning("Failed to update modification time of temporary "
-                             "file: %s", log.getExceptionMessage(e))
-            self._cancelSession()
-        try:
-            self.log("Renaming temporary file to '%s'", self.cachePath)
-            os.rename(self.tempPath, self.cachePath)
-        except OSError, e:
-            if e.errno == errno.ENOENT:
-                self._releaseCacheSpace()
-            else:
-                self.warning("Failed to rename temporary file: %s",
-                             log.getExceptionMessage(e))
-            self._cancelSession()
-        # Complete all pending source read operations with the temporary file.
-        for position, size, d in self._pending:
-            try:
-                self._rTempFile.seek(position)
-                data = self._rTempFile.read(size)
-                d.callback(data)
-            except Exception, e:
-                self.warning("Failed to read from temporary file: %s",
-                             log.getExceptionMessage(e))
-                d.errback(e)
-        self._pending = []
+        # Setting the modification time on the temporary file,
+        # then renaming it; the session is kept until it's done
+        self._completing = True
+        mtime = self.mtime
+        atime = int(time.time())
+        self.log("Setting temporary file modification time to %d", mtime)
+        # FIXME: Should use futimes, but it's not wrapped by python
+        d = self._executor.call(self.tempPath, os.utime,
+                                self.tempPath, (atime, mtime))
+        d.addErrback(self._completeFailed,
+                     "update modification time of temporary file")
+        d.addCallback(self._renameTempFile)
+        d.addCallback(self._onCopyCompleted)
+
+    def _renameTempFile(self, _):
+        self.log("Renaming temporary file to '%s'", self.cachePath)
+        d = self._executor.call(self.tempPath, os.rename,
+                                self.tempPath, self.cachePath)
+        d.addErrback(self._completeFailed, "rename temporary file")
+        return d
+
+    def _completeFailed(self, failure, action):
+        failure.trap(OSError)
+        if failure.value.errno == errno.ENOENT:
+            # The file may have been deleted by another process
+            self._releaseCacheSpace()
+        else:
+            self.warning("Failed to %s: %s", action,
+                         log.getFailureMessage(failure))
+        self._cancelSession()
+
+    def _onCopyCompleted(self, _):
+        self._completing = False
         if self._refCount == 0:
             # We were waiting for the file to be copied to close it.
             self.close()
 
     def _removeTempFile(self):
-        try:
-            os.remove(self.tempPath)
-            self.log("Deleted temporary file '%s'", self.tempPath)
-            # Inform the plug that cache space has been released
-            self._releaseCacheSpace()
-        except OSError, e:
-            if e.errno == errno.ENOENT:
-                if self._wTempFile is not None:
-                    # Already deleted but inform the plug anyway
-                    self._releaseCacheSpace()
-            else:
-                self.warning("Error deleting temporary file: %s",
-                             log.getExceptionMessage(e))
+        d = self._executor.call(self.tempPath, os.remove, self.tempPath)
+        d.addCallbacks(self._tempFileRemoved, self._tempFileRemoveFailed,
+                       errbackArgs=(self._wTempFile is not None, ))
+        return d
+
+    def _tempFileRemoved(self, _):
+        self.log("Deleted temporary file '%s'", self.tempPath)
+        # Inform the plug that cache space has been released
+        self._releaseCacheSpace()
+
+    def _tempFileRemoveFailed(self, failure, opened):
+        failure.trap(OSError)
+        if failure.value.errno == errno.ENOENT:
+            if opened:
+                # Already deleted but inform the plug anyway
+                self._releaseCacheSpace()
+        else:
+            self.warning("Error deleting temporary file: %s",
+                         log.getFailureMessage(failure))
+
+    def _closeFile(self, key, handle, description):
+        self.log("Closing %s [fd %d]", description, handle.fileno())
+        d = self._executor.call(key, handle.close)
+        d.addErrback(self._closeFailed, description)
+
+    def _closeFailed(self, failure, description):
+        self.warning("Failed to close %s: %s", description,
+                     log.getFailureMessage(failure))
 
     def _closeSourceFile(self):
         if self._sourceFile is not None:
-            self.log("Closing source file [fd %d]", self._sourceFile.fileno())
-            try:
-                try:
-                    self._sourceFile.close()
-                finally:
-                    self._sourceFile = None
-            except IOError, e:
-                self.warning("Failed to close source file: %s",
-                             log.getExceptionMessage(e))
+            self._closeFile(self._sourceKey, self._sourceFile, "source file")
+            self._sourceFile = None
 
     def _closeReadTempFile(self):
         if self._rTempFile is not None:
-            self.log("Closing temporary file for reading [fd %d]",
-                     self._rTempFile.fileno())
-            try:
-                try:
-                    self._rTempFile.close()
-                finally:
-                    self._rTempFile = None
-            except IOError, e:
-                self.warning("Failed to close temporary file for reading: %s",
-                             log.getExceptionMessage(e))
+            self._closeFile(self._tempKey, self._rTempFile,
+                            "temporary file for reading")
+            self._rTempFile = None
 
     def _closeWriteTempFile(self):
         if self._wTempFile is not None:
             # If the copy is not finished, remove the temporary file
             if not self._cancelled and self._copied is not None:
                 self._removeTempFile()
-            self.log("Closing temporary file for writing [fd %d]",
-                     self._wTempFile.fileno())
-            try:
-                try:
-                    self._wTempFile.close()
-                finally:
-                    self._wTempFile = None
-            except Exception, e:
-                self.warning("Failed to close temporary file for writing: %s",
-                             log.getExceptionMessage(e))
+            # After the blocks copied from the source file
+            self._closeFile(self._sourceKey, self._wTempFile,
+                            "temporary file for writing")
+            self._wTempFile = None
 
 
 class TempFileDelegate(log.Loggable):
@@ -733,10 +765,8 @@ class TempFileDelegate(log.Loggable):
     def read(self, size, stats):
         assert not self._reading, "Simultaneous read not supported"
         d = self._session.read(self._position, size, stats)
-        if isinstance(d, defer.Deferred):
-            self._reading = True
-            return d.addCallback(self._cbGotData)
-        self._position += len(d)
+        self._reading = True
+        d.addBoth(self._readDone)
         return d
 
     def close(self):
@@ -747,10 +777,11 @@ class TempFileDelegate(log.Loggable):
 
     ## Private Methods ##
 
-    def _cbGotData(self, data):
+    def _readDone(self, result):
         self._reading = False
-        self._position += len(data)
-        return data
+        if isinstance(result, str):
+            self._position += len(result)
+        return result
 
 
 class DirectFileDelegate(log.Loggable):
@@ -762,50 +793,58 @@ class DirectFileDelegate(log.Loggable):
 
     def __init__(self, plug, path, file, info):
         self.logName = plug.getLogName(path, file.fileno())
+        self._executor = plug.executor
         self._file = file
+        self._key = file_key(info)
+        self._position = 0
         # The size and modification time is not supposed to change over time
         self.mtime = info[stat.ST_MTIME]
         self.size = info[stat.ST_SIZE]
 
     def tell(self):
-        try:
-            return self._file.tell()
-        except IOError, e:
-            cls = errnoLookup.get(e.errno, FileError)
-            raise cls("Failed to tell position in file: %s" % str(e))
+        return self._position
 
     def seek(self, offset):
-        try:
-            self._file.seek(offset, SEEK_SET)
-        except IOError, e:
-            cls = errnoLookup.get(e.errno, FileError)
-            raise cls("Failed to seek in cached file: %s" % str(e))
+        self._position = offset
 
     def read(self, size):
-        try:
-            return self._file.read(size)
-        except IOError, e:
-            cls = errnoLookup.get(e.errno, FileError)
-            raise cls("Failed to read data from file: %s" % str(e))
+        offset = self._position
+        d = self._executor.read(self._key, self._file, offset, size)
+        d.addCallbacks(self._gotData, self._readFailed,
+                       callbackArgs=(offset, ))
+        return d
 
     def close(self):
         if self._file is not None:
-            try:
-                try:
-                    self._file.close()
-                finally:
-                    self._file = None
-            except IOError, e:
-                cls = errnoLookup.get(e.errno, FileError)
-                raise cls("Failed to close file: %s" % str(e))
+            # After the reads still queued for the file
+            d = self._executor.call(self._key, self._file.close)
+            d.addErrback(self._closeFailed)
+            self._file = None
+
+
+    ## Private Methods ##
+
+    def _gotData(self, data, offset):
+        self._position = offset + len(data)
+        return data
+
+    def _readFailed(self, failure):
+        failure.trap(IOError)
+        e = failure.value
+        cls = errnoLookup.get(e.errno, FileError)
+        raise cls("Failed to read data from file: %s" % str(e))
+
+    def _closeFailed(self, failure):
+        self.warning("Failed to close file: %s",
+                     log.getFailureMessage(failure))
 
 
 class CachedFileDelegate(DirectFileDelegate):
 
     def read(self, size, stats):
-        data = DirectFileDelegate.read(self, size)
-        stats.onBytesRead(0, len(data), 0)
-        return data
+        d = DirectFileDelegate.read(self, size)
+        d.addCallback(self._countBytes, stats)
+        return d
 
     def close(self):
         if self._file is not None:
@@ -813,6 +852,13 @@ class CachedFileDelegate(DirectFileDelegate):
             DirectFileDelegate.close(self)
 
 
+    ## Private Methods ##
+
+    def _countBytes(self, data, stats):
+        stats.onBytesRead(0, len(data), 0)
+        return data
+
+
 class CachedFile(fileprovider.File, log.Loggable):
 
     logCategory = LOG_CATEGORY
@@ -832,9 +878,10 @@ class CachedFile(fileprovider.File, log.Loggable):
         self._delegate = None
 
     def open(self):
-        # Opening source file in a separate thread, as it usually involves
-        # accessing a network filesystem (which would block the reactor)
-        d = threads.deferToThread(open_stat, self._path)
+        # Looking up the source file in the disk I/O threads, as it usually
+        # involves accessing a network filesystem (which would block
+        # the reactor)
+        d = self.plug.getSourceInfo(self._path)
         d.addCallbacks(self._selectDelegate, self._sourceOpenFailed)
 
         def _setDelegate(delegate):
@@ -846,10 +893,12 @@ class CachedFile(fileprovider.File, log.Loggable):
     def _sourceOpenFailed(self, failure):
         failure.trap(NotFoundError)
         self.debug("Source file %r not found", self._path)
+        self.plug.forgetSourceInfo(self._path)
         self.plug.outdateCopySession(self._path)
         cachedPath = self.plug.cache.getCachePath(self._path)
-        self._removeCachedFile(cachedPath)
-        raise failure
+        d = self._removeCachedFile(cachedPath)
+        d.addCallback(lambda _: failure)
+        return d
 
     def __str__(self):
         return "<CachedFile '%s'>" % self._path
@@ -878,13 +927,7 @@ class CachedFile(fileprovider.File, log.Loggable):
         if self._delegate is None:
             raise FileClosedError("File closed")
         try:
-            d = self._delegate.read(size, self.stats)
-            if isinstance(d, defer.Deferred):
-                return d
-            return defer.succeed(d)
-        except IOError, e:
-            cls = errnoLookup.get(e.errno, FileError)
-            return defer.fail(cls("Failed to read cached data: %s", str(e)))
+            return self._delegate.read(size, self.stats)
         except:
             return defer.fail()
 
@@ -903,32 +946,43 @@ class CachedFile(fileprovider.File, log.Loggable):
 
     ## Private Methods ##
 
-    def _closeSourceFile(self, sourceFile):
-        self.log("Closing source file [fd %d]", sourceFile.fileno())
-        try:
-            sourceFile.close()
-        except Exception, e:
-            self.warning("Failed to close source file: %s",
-                         log.getExceptionMessage(e))
+    def _closeFile(self, handle, description):
+        self.log("Closing %s [fd %d]", description, handle.fileno())
+        d = self.plug.executor.call(self._path, handle.close)
+        d.addErrback(self._closeFailed, description)
+
+    def _closeFailed(self, failure, description):
+        self.warning("Failed to close %s: %s", description,
+                     log.getFailureMessage(failure))
 
-    def _selectDelegate(self, (sourceFile, sourceInfo)):
+    def _selectDelegate(self, sourceInfo):
         sourcePath = self._path
-        self.log("Selecting delegate for source file %r [fd %d]",
-                 sourcePath, sourceFile.fileno())
-        # Update the log name
-        self.logName = self.plug.getLogName(self._path, sourceFile.fileno())
+        self.log("Selecting delegate for source file %r", sourcePath)
+        if stat.S_ISDIR(sourceInfo[stat.ST_MODE]):
+            raise fileprovider.CannotOpenError("'%s' is a directory"
+                                               % sourcePath)
         # Opening cached file
         cachedPath = self.plug.cache.getCachePath(sourcePath)
-        try:
-            cachedFile, cachedInfo = open_stat(cachedPath)
-            self.log("Opened cached file [fd %d]", cachedFile.fileno())
-        except NotFoundError:
+        d = self.plug.executor.call(cachedPath, open_stat, cachedPath)
+        d.addCallbacks(self._gotCachedFile, self._cachedOpenFailed,
+                       callbackArgs=(sourceInfo, cachedPath),
+                       errbackArgs=(sourceInfo, cachedPath))
+        return d
+
+    def _cachedOpenFailed(self, failure, sourceInfo, cachedPath):
+        failure.trap(FileError)
+        if failure.check(NotFoundError):
             self.debug("Did not find cached file '%s'", cachedPath)
-            return self._tryTempFile(sourcePath, sourceFile, sourceInfo)
-        except FileError, e:
-            self.debug("Failed to open cached file: %s", str(e))
-            self._removeCachedFile(cachedPath)
-            return self._tryTempFile(sourcePath, sourceFile, sourceInfo)
+            return self._tryTempFile(sourceInfo)
+        self.debug("Failed to open cached file: %s",
+                   log.getFailureMessage(failure))
+        d = self._removeCachedFile(cachedPath)
+        d.addCallback(lambda _: self._tryTempFile(sourceInfo))
+        return d
+
+    def _gotCachedFile(self, (cachedFile, cachedInfo), sourceInfo,
+                       cachedPath):
+        self.log("Opened cached file [fd %d]", cachedFile.fileno())
         # Found a cached file, now check the modification time
         self.debug("Found cached file '%s'", cachedPath)
         sourceTime = sourceInfo[stat.ST_MTIME]
@@ -938,10 +992,11 @@ class CachedFile(fileprovider.File, log.Loggable):
             self.debug("Cached file out-of-date (%d != %d)",
                        sourceTime, cacheTime)
             self.stats.onCacheOutdated()
-            self.plug.outdateCopySession(sourcePath)
-            self._removeCachedFile(cachedPath)
-            return self._cacheFile(sourcePath, sourceFile, sourceInfo)
-        self._closeSourceFile(sourceFile)
+            self.plug.outdateCopySession(self._path)
+            self._closeFile(cachedFile, "out-of-date cached file")
+            d = self._removeCachedFile(cachedPath)
+            d.addCallback(lambda _: self._cacheFile())
+            return d
         # We have a valid cached file, just delegate to it.
         self.debug("Serving cached file '%s'", cachedPath)
         delegate = CachedFileDelegate(self.plug, cachedPath,
@@ -950,36 +1005,50 @@ class CachedFile(fileprovider.File, log.Loggable):
         return delegate
 
     def _removeCachedFile(self, cachePath):
-        try:
-            os.remove(cachePath)
-            self.debug("Deleted cached file '%s'", cachePath)
-        except OSError, e:
-            if e.errno != errno.ENOENT:
-                self.warning("Error deleting cached file: %s", str(e))
-
-    def _tryTempFile(self, sourcePath, sourceFile, sourceInfo):
-        session = self.plug.getCopySession(sourcePath)
+        d = self.plug.executor.call(cachePath, os.remove, cachePath)
+        d.addCallbacks(self._cachedFileRemoved, self._cachedFileRemoveFailed,
+                       callbackArgs=(cachePath, ))
+        return d
+
+    def _cachedFileRemoved(self, _, cachePath):
+        self.debug("Deleted cached file '%s'", cachePath)
+
+    def _cachedFileRemoveFailed(self, failure):
+        failure.trap(OSError)
+        if failure.value.errno != errno.ENOENT:
+            self.warning("Error deleting cached file: %s",
+                         log.getFailureMessage(failure))
+
+    def _tryTempFile(self, sourceInfo):
+        session = self.plug.getCopySession(self._path)
         if session is None:
             self.debug("No copy sessions found")
-            return self._cacheFile(sourcePath, sourceFile, sourceInfo)
+            return self._cacheFile()
         self.debug("Copy session found")
         if sourceInfo[stat.ST_MTIME] != session.mtime:
             self.debug("Copy session out-of-date (%d != %d)",
                        sourceInfo[stat.ST_MTIME], session.mtime)
             self.stats.onCacheOutdated()
             session.outdate()
-            return self._cacheFile(sourcePath, sourceFile, sourceInfo)
-        self._closeSourceFile(sourceFile)
+            return self._cacheFile()
         # We have a valid session, just delegate to it.
-        self.debug("Serving temporary file '%s'", session.tempPath)
-        delegate = TempFileDelegate(self.plug, session)
-        self.stats.onStarted(delegate.size, cachestats.TEMP_HIT)
-        return delegate
+        return self._delegateToSession(session, cachestats.TEMP_HIT)
+
+    def _cacheFile(self):
+        status = cachestats.CACHE_MISS
+        if self.plug.isOpeningSource(self._path):
+            # Another client is opening the source file to copy it,
+            # we will be served by the same copy session
+            self.debug("Waiting for the source file to be opened")
+            status = cachestats.TEMP_HIT
+        d = self.plug.openCopySession(self._path)
+        d.addCallback(self._delegateToSession, status)
+        return d
 
-    def _cacheFile(self, sourcePath, sourceFile, sourceInfo):
-        session = self.plug.createCopySession(sourcePath, sourceFile,
-                                              sourceInfo)
+    def _delegateToSession(self, session, status):
+        # Update the log name
+        self.logName = session.logName
         self.debug("Serving temporary file '%s'", session.tempPath)
         delegate = TempFileDelegate(self.plug, session)
-        self.stats.onStarted(delegate.size, cachestats.CACHE_MISS)
+        self.stats.onStarted(delegate.size, status)
         return delegate
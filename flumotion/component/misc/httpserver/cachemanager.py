@@ -15,13 +15,14 @@
 #
 # Headers in this file shall remain intact.
 
+import bisect
 import errno
 import os
 import tempfile
 import time
 import stat
 
-from twisted.internet import defer, threads, reactor, utils
+from twisted.internet import defer, threads, reactor
 
 from flumotion.common import log, common, python, errors
 from flumotion.common import format as formatting
@@ -35,9 +36,70 @@ DEFAULT_CLEANUP_HIGH_WATERMARK = 1.0
 DEFAULT_CLEANUP_LOW_WATERMARK = 0.6
 ID_CACHE_MAX_SIZE = 1024
 TEMP_FILE_POSTFIX = ".tmp"
+# Points of each shard on the consistent hashing ring
+SHARD_VIRTUAL_NODES = 64
+# Seconds a failed shard is not used
+SHARD_RETRY_PERIOD = 60
+# Maximum age in seconds of the shards usage estimation
+CACHE_USAGE_UPDATE_PERIOD = 60
+# Errors meaning a shard disk is failing
+DISK_ERRORS = (errno.EIO, errno.EROFS, errno.ENODEV, errno.ENXIO,
+               errno.ENOTDIR)
+
+
+class CacheShard(object):
+    """
+    One of the cache directories, usually on its own disk, with its own
+    usage accounting and cleanup.
+
+    A shard failing because of disk errors is not used for
+    SHARD_RETRY_PERIOD seconds, its files going to the other shards.
+    """
+
+    def __init__(self, cacheDir, cacheSize, highWatermark, lowWatermark):
+        self.cacheDir = cacheDir
+        self.cacheSize = cacheSize # in bytes
+
+        self.cacheUsage = None
+        self.cacheUsageLastUpdate = None
+        self.lastCacheTime = None
+
+        self.cacheMaxUsage = cacheSize * highWatermark # in bytes
+        self.cacheMinUsage = cacheSize * lowWatermark # in bytes
+
+        self.hitCount = 0
+        self.missCount = 0
+        self.failureCount = 0
+        self.failureTime = None
+
+    def isAvailable(self):
+        return (self.failureTime is None
+                or self.failureTime + SHARD_RETRY_PERIOD <= time.time())
+
+    def getDirectory(self, ident):
+        return os.path.join(self.cacheDir, ident[:2], ident[2:4])
+
+    def getStatistics(self):
+        return {"path": self.cacheDir,
+                "size": self.cacheSize,
+                "usage": self.cacheUsage or 0,
+                "hit-count": self.hitCount,
+                "miss-count": self.missCount,
+                "failure-count": self.failureCount,
+                "available": self.isAvailable()}
 
 
 class CacheManager(object, log.Loggable):
+    """
+    Manages the cached files, spread over one or more cache directories
+    called shards. The identifiers are distributed between the shards
+    using consistent hashing, so a failing shard only moves its own
+    files to the others. Inside a shard, the files are stored in a two
+    levels directory fan-out to keep the directories small.
+
+    Each shard has a share of the cache size, and its own usage
+    accounting and cleanup.
+    """
 
     logCategory = LOG_CATEGORY
 
@@ -48,6 +110,10 @@ class CacheManager(object, log.Loggable):
                  cleanupHighWatermark = None,
                  cleanupLowWatermark = None,
                  cacheRealm = None):
+        """
+        @param cacheDir: the cache directory, or a list of them
+        @type  cacheDir: str or list of str
+        """
 
         if cacheDir is None:
             cacheDir = DEFAULT_CACHE_DIR
@@ -60,8 +126,12 @@ class CacheManager(object, log.Loggable):
         if cleanupLowWatermark is None:
             cleanupLowWatermark = DEFAULT_CLEANUP_LOW_WATERMARK
 
+        if isinstance(cacheDir, basestring):
+            cacheDirs = [cacheDir]
+        else:
+            cacheDirs = list(cacheDir)
+
         self.stats = stats
-        self._cacheDir = cacheDir
         self._cacheSize = cacheSize # in bytes
         self._cleanupEnabled = cleanupEnabled
         highWatermark = max(0.0, min(1.0, float(cleanupHighWatermark)))
@@ -72,18 +142,34 @@ class CacheManager(object, log.Loggable):
         self._identifiers = {} # {path: identifier}
 
         self.info("Cache Manager initialized")
-        self.debug("Cache directory: '%s'", self._cacheDir)
+        self.debug("Cache directories: %s", ", ".join(cacheDirs))
         self.debug("Cache size: %d bytes", self._cacheSize)
         self.debug("Cache cleanup enabled: %s", self._cleanupEnabled)
 
-        common.ensureDir(self._cacheDir, "cache")
-
-        self._cacheUsage = None
-        self._cacheUsageLastUpdate = None
-        self._lastCacheTime = None
+        shardSize = cacheSize / len(cacheDirs)
+        self._shards = [CacheShard(d, shardSize, highWatermark, lowWatermark)
+                        for d in cacheDirs]
 
-        self._cacheMaxUsage = self._cacheSize * highWatermark # in bytes
-        self._cacheMinUsage = self._cacheSize * lowWatermark # in bytes
+        for shard in self._shards:
+            try:
+                common.ensureDir(shard.cacheDir, "cache")
+            except errors.FatalError, e:
+                if len(self._shards) == 1:
+                    raise
+                self._shardFailed(shard, e)
+        if not [s for s in self._shards if s.failureTime is None]:
+            raise errors.FatalError("none of the cache directories %s "
+                                    "can be used" % ", ".join(cacheDirs))
+
+        # Consistent hashing ring of (POSITION, SHARD)
+        self._ring = []
+        for shard in self._shards:
+            for i in range(SHARD_VIRTUAL_NODES):
+                sha1Hash = python.sha1()
+                sha1Hash.update("%s#%d" % (shard.cacheDir, i))
+                self._ring.append((sha1Hash.digest()[:4], shard))
+        self._ring.sort()
+        self._positions = [p for p, s in self._ring]
 
     def setUp(self):
         """
@@ -115,55 +201,150 @@ class CacheManager(object, log.Loggable):
             self._identifiers[path] = ident
         return ident
 
+    def getShard(self, path):
+        """
+        @return: the shard where the file for a path is cached,
+                 the first available one following it in the ring
+                 if it failed, or itself if they all failed.
+        @rtype:  L{CacheShard}
+        """
+        position = self.getIdentifier(path).decode("hex")[:4]
+        index = bisect.bisect(self._positions, position)
+        count = len(self._ring)
+        for i in range(count):
+            shard = self._ring[(index + i) % count][1]
+            if shard.isAvailable():
+                return shard
+        return self._ring[index % count][1]
+
+    def getShards(self):
+        return list(self._shards)
+
     def getCachePath(self, path):
         """
         @return: the cached file path for a path.
         """
         ident = self.getIdentifier(path)
-        return os.path.join(self._cacheDir, ident)
+        shard = self.getShard(path)
+        return os.path.join(shard.getDirectory(ident), ident)
 
     def getTempPath(self, path):
         """
-        @return: a temporary file path for a path.
+        @return: a temporary file path for a path,
+                 in the directory of the cached file which is created.
 
         Don't use this function, it's provided for compatibility.
         Use newTempFile() instead.
         """
+        directory = self.makeCacheDirectory(path)
+        return os.path.join(directory,
+                            self.getIdentifier(path) + TEMP_FILE_POSTFIX)
+
+    def makeCacheDirectory(self, path):
+        """
+        Creates the directory of the cached file for a path if needed.
+
+        @return: the directory path
+        @raise: OSError
+        """
         ident = self.getIdentifier(path)
-        return os.path.join(self._cacheDir, ident + TEMP_FILE_POSTFIX)
+        shard = self.getShard(path)
+        directory = shard.getDirectory(ident)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    self._checkError(shard, e)
+                    raise
+        return directory
 
-    def updateCacheUsageStatistics(self):
-        self.stats.onEstimateCacheUsage(self._cacheUsage, self._cacheSize)
+    def getCacheUsage(self):
+        """
+        @return: the estimated usage of all the shards in bytes.
+        """
+        return sum([s.cacheUsage or 0 for s in self._shards])
+
+    def getShardStatistics(self):
+        return [s.getStatistics() for s in self._shards]
 
-    def _updateCacheUsage(self, usage):
-        self.log('Disk usage for path %r is %d bytes', self._cacheDir, usage)
-        self._cacheUsageLastUpdate = time.time()
-        self._cacheUsage = usage
+    def updateCacheUsageStatistics(self):
+        self.stats.onEstimateCacheUsage(self.getCacheUsage(),
+                                        self._cacheSize)
+        self.stats.onShardStatistics(self.getShardStatistics())
+
+    def _updateCacheUsage(self, usage, shard):
+        self.log('Disk usage for path %r is %d bytes', shard.cacheDir, usage)
+        shard.cacheUsageLastUpdate = time.time()
+        shard.cacheUsage = usage
         self.updateCacheUsageStatistics()
         return usage
 
     def updateCacheUsage(self):
         """
+        Updates the usage of the available shards, the failing ones
+        are not used anymore until SHARD_RETRY_PERIOD elapsed.
+
         @return: a defered with the cache usage in bytes.
-        @raise: OSError or FlumotionError
+        @raise: OSError or FlumotionError if all the shards failed
         """
+        dl = [self._updateShardUsage(s)
+              for s in self._shards if s.isAvailable()]
+        d = defer.DeferredList(dl, consumeErrors=True)
+        d.addCallback(self._cacheUsageUpdated)
+        return d
 
+    def _cacheUsageUpdated(self, results):
+        failures = [r for ok, r in results if not ok]
+        if failures and (len(failures) == len(results)):
+            return failures[0]
+        return self.getCacheUsage()
+
+    def _updateShardUsage(self, shard):
         # Only calculate cache usage if the cache directory
-        # modification time changed since the last time we looked at it.
+        # modification time changed since the last time we looked at it,
+        # or if it's too old as files are created in subdirectories.
         try:
-            cacheTime = os.path.getmtime(self._cacheDir)
+            cacheTime = os.path.getmtime(shard.cacheDir)
         except OSError, e:
+            self._shardFailed(shard, e)
             return defer.fail(e)
 
-        if ((self._cacheUsage is None) or (self._lastCacheTime < cacheTime)):
-            self._lastCacheTime = cacheTime
-            self.log('Getting disk usage for path %r', self._cacheDir)
-            d = utils.getProcessOutput('du', ['-bs', self._cacheDir])
-            d.addCallback(lambda o: int(o.split('\t', 1)[0]))
-            d.addCallback(self._updateCacheUsage)
+        if ((shard.cacheUsage is None) or (shard.lastCacheTime < cacheTime)
+            or (shard.cacheUsageLastUpdate + CACHE_USAGE_UPDATE_PERIOD
+                < time.time())):
+            shard.lastCacheTime = cacheTime
+            self.log('Getting disk usage for path %r', shard.cacheDir)
+            # Only the files are counted, like when cleaning up,
+            # the fan-out directories can't be freed
+            d = threads.deferToThread(_getFilesSize, shard.cacheDir)
+            d.addCallback(self._updateCacheUsage, shard)
+            d.addErrback(self._shardUsageFailed, shard)
             return d
         else:
-            return defer.succeed(self._cacheUsage)
+            return defer.succeed(shard.cacheUsage)
+
+    def _shardUsageFailed(self, failure, shard):
+        self._shardFailed(shard, failure.getErrorMessage())
+        return failure
+
+    def _shardFailed(self, shard, error):
+        """
+        Stops using a shard for SHARD_RETRY_PERIOD seconds.
+        """
+        shard.failureCount += 1
+        shard.failureTime = time.time()
+        self.warning("Cache directory %r failed, not using it for %d "
+                     "seconds: %s", shard.cacheDir, SHARD_RETRY_PERIOD,
+                     str(error))
+        self.updateCacheUsageStatistics()
+
+    def _checkError(self, shard, error):
+        """
+        Checks if an error accessing a shard comes from a disk failure.
+        """
+        if getattr(error, "errno", None) in DISK_ERRORS:
+            self._shardFailed(shard, error)
 
     def _rmfiles(self, files):
         try:
@@ -174,33 +355,28 @@ class CacheManager(object, log.Loggable):
                 # TODO: is warning() thread safe?
                 self.warning("Error cleaning cached file: %s", str(e))
 
-    def _setCacheUsage(self, _, usage):
+    def _setCacheUsage(self, _, shard, usage):
         # Update the cache usage
-        self._cacheUsage = usage
-        self._cacheUsageLastUpdate = time.time()
+        shard.cacheUsage = usage
+        shard.cacheUsageLastUpdate = time.time()
         return usage
 
-    def _cleanUp(self):
+    def _cleanUp(self, shard):
         # Update cleanup statistics
         self.stats.onCleanup()
-        # List the cached files with file state
-        try:
-            listdir = os.listdir(self._cacheDir)
-        except OSError, e:
-            return defer.fail(e)
+        # List the cached files with file state, from the fan-out
+        # directories and the top one, in a thread like the disk usage
+        d = threads.deferToThread(_listFiles, shard.cacheDir)
+        d.addCallbacks(self._removeOldestFiles, self._listingFailed,
+                       callbackArgs=(shard, ), errbackArgs=(shard, ))
+        return d
 
-        files = []
-        for f in listdir:
-            f = os.path.join(self._cacheDir, f)
-            # There's a possibility of getting an error on os.stat here.
-            try:
-                files.append((f, os.stat(f)))
-            except OSError, e:
-                if e.errno == errno.ENOENT:
-                    pass
-                else:
-                    return defer.fail(e)
+    def _listingFailed(self, failure, shard):
+        failure.trap(OSError)
+        self._checkError(shard, failure.value)
+        return failure
 
+    def _removeOldestFiles(self, files, shard):
         # Calculate the cached file total size
         usage = sum([d[1].st_size for d in files])
         # Delete the cached file starting by the oldest accessed ones
@@ -209,37 +385,38 @@ class CacheManager(object, log.Loggable):
         for path, info in files:
             usage -= info.st_size
             rmlist.append(path)
-            if usage <= self._cacheMinUsage:
+            if usage <= shard.cacheMinUsage:
                 # We reach the cleanup limit
-                self.debug('cleaned up, cache use is now %sbytes',
-                    formatting.formatStorage(usage))
+                self.debug('cleaned up %r, cache use is now %sbytes',
+                    shard.cacheDir, formatting.formatStorage(usage))
                 break
         d = threads.deferToThread(self._rmfiles, rmlist)
-        d.addBoth(self._setCacheUsage, usage)
+        d.addBoth(self._setCacheUsage, shard, usage)
         return d
 
-    def _allocateCacheSpaceAfterCleanUp(self, usage, size):
-        if (self._cacheUsage + size) >= self._cacheSize:
+    def _allocateCacheSpaceAfterCleanUp(self, usage, shard, size):
+        if (shard.cacheUsage + size) >= shard.cacheSize:
             # There is not enough space, allocation failed
             self.updateCacheUsageStatistics()
-            self.debug('not enough space in cache, '
+            self.debug('not enough space in cache %r, '
                        'cannot cache %d > %d' %
-                       (self._cacheUsage + size, self._cacheSize))
+                       (shard.cacheDir, shard.cacheUsage + size,
+                        shard.cacheSize))
             return None
 
         # There is enough space to allocate, allocation succeed
-        self._cacheUsage += size
+        shard.cacheUsage += size
         self.updateCacheUsageStatistics()
-        return (self._cacheUsageLastUpdate, size)
+        return (shard, shard.cacheUsageLastUpdate, size)
 
-    def _allocateCacheSpace(self, usage, size):
-        if usage + size < self._cacheMaxUsage:
-            self._cacheUsage += size
+    def _allocateCacheSpace(self, usage, shard, size):
+        if usage + size < shard.cacheMaxUsage:
+            shard.cacheUsage += size
             self.updateCacheUsageStatistics()
-            return defer.succeed((self._cacheUsageLastUpdate, size))
+            return defer.succeed((shard, shard.cacheUsageLastUpdate, size))
 
-        self.debug('cache usage will be %sbytes, need more cache',
-            formatting.formatStorage(usage + size))
+        self.debug('cache usage of %r will be %sbytes, need more cache',
+            shard.cacheDir, formatting.formatStorage(usage + size))
 
         if not self._cleanupEnabled:
             # No space available and cleanup disabled: allocation failed.
@@ -247,11 +424,17 @@ class CacheManager(object, log.Loggable):
                        'so cannot cache %d' % size)
             return defer.succeed(None)
 
-        d = self._cleanUp()
-        d.addCallback(self._allocateCacheSpaceAfterCleanUp, size)
+        d = self._cleanUp(shard)
+        d.addCallback(self._allocateCacheSpaceAfterCleanUp, shard, size)
         return d
 
-    def allocateCacheSpace(self, size):
+    def _allocationFailed(self, failure, shard):
+        failure.trap(OSError, IOError)
+        self.debug("Cannot allocate cache space in %r: %s",
+                   shard.cacheDir, failure.getErrorMessage())
+        return None
+
+    def allocateCacheSpace(self, size, path=None):
         """
         Try to reserve cache space.
 
@@ -269,31 +452,53 @@ class CacheManager(object, log.Loggable):
 
         @param size: size to reserve, in bytes
         @type  size: int
+        @param path: path of the file the space is for, used to select
+                     the shard; if not specified the least used is used
+        @type  path: str
 
         @return: an allocation tag or None if the allocation failed.
         @rtype:   defer to tuple
         """
-        d = self.updateCacheUsage()
-        d.addCallback(self._allocateCacheSpace, size)
+        if path is not None:
+            shard = self.getShard(path)
+        else:
+            shards = [(s.cacheUsage, s) for s in self._shards
+                      if s.isAvailable()] or [(0, self._shards[0])]
+            shard = min(shards)[1]
+        if not shard.isAvailable():
+            return defer.succeed(None)
+        d = self._updateShardUsage(shard)
+        d.addCallback(self._allocateCacheSpace, shard, size)
+        d.addErrback(self._allocationFailed, shard)
         return d
 
     def releaseCacheSpace(self, tag):
         """
         Low-level function to release reserved cache space.
         """
-        lastUpdate, size = tag
-        if lastUpdate == self._cacheUsageLastUpdate:
-            self._cacheUsage -= size
+        shard, lastUpdate, size = tag
+        if lastUpdate == shard.cacheUsageLastUpdate:
+            shard.cacheUsage -= size
             self.updateCacheUsageStatistics()
 
     def openCacheFile(self, path):
         """
         @return: a defer to a CacheFile instance or None
         """
+        shard = self.getShard(path)
+        if not shard.isAvailable():
+            return defer.succeed(None)
         try:
-            return defer.succeed(CachedFile(self, path))
+            cachedFile = CachedFile(self, path)
+        except (OSError, IOError), e:
+            shard.missCount += 1
+            self._checkError(shard, e)
+            return defer.succeed(None)
         except:
+            shard.missCount += 1
             return defer.succeed(None)
+        shard.hitCount += 1
+        return defer.succeed(cachedFile)
 
     def _newTempFile(self, tag, path, size, mtime=None):
         # if allocation fails
@@ -302,18 +507,48 @@ class CacheManager(object, log.Loggable):
 
         try:
             return TempFile(self, path, tag, size, mtime)
-        except OSError:
+        except OSError, e:
+            self.releaseCacheSpace(tag)
+            self._checkError(tag[0], e)
             return None
 
     def newTempFile(self, path, size, mtime=None):
         """
         @return: a defer to a TempFile instance or None
         """
-        d = self.allocateCacheSpace(size)
+        d = self.allocateCacheSpace(size, path)
         d.addCallback(self._newTempFile, path, size, mtime)
         return d
 
 
+def _raise(error):
+    raise error
+
+
+def _listFiles(directory):
+    """
+    @return: the paths and stats of the files in a directory
+             and its subdirectories
+    @rtype:  list of (str, stat_result)
+    @raise: OSError
+    """
+    files = []
+    for dirpath, dirnames, filenames in os.walk(directory, onerror=_raise):
+        for f in filenames:
+            f = os.path.join(dirpath, f)
+            # There's a possibility of getting an error on os.stat here.
+            try:
+                files.append((f, os.stat(f)))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+    return files
+
+
+def _getFilesSize(directory):
+    return sum([s.st_size for f, s in _listFiles(directory)])
+
+
 class CachedFile:
     """
     Read only.
@@ -366,13 +601,15 @@ class TempFile:
         self.tag = tag
         self.cachemgr = cachemgr
         self._completed = False
-        self._finishPath = cachemgr.getCachePath(resPath)
+        directory = cachemgr.makeCacheDirectory(resPath)
+        self._finishPath = os.path.join(directory,
+                                        cachemgr.getIdentifier(resPath))
         self.mtime = mtime
         self.file = None
         self.size = size
 
         fd, tempPath = tempfile.mkstemp(TEMP_FILE_POSTFIX,
-                                        LOG_CATEGORY, cachemgr._cacheDir)
+                                        LOG_CATEGORY, directory)
         cachemgr.log("Created temporary file '%s' [fd %d]",
                      tempPath, fd)
         self.file = os.fdopen(fd, "w+b")
@@ -456,7 +693,7 @@ class TempFile:
             return
         self._completed = True
 
-        _, size = self.tag
+        size = self.tag[-1]
         if (self.tell() != size and checkSize):
             raise IOError("Did not reach end of file")
 
@@ -511,6 +748,9 @@ def main(argv=None):
             #    + "k / " + str(size / (1024)) + "k"
             pass
 
+        def onShardStatistics(self, shards):
+            pass
+
         def onCleanup(self):
             self.oncleanup += 1
             print "OnCleanup"
@@ -539,8 +779,8 @@ def main(argv=None):
         m.releaseCacheSpace(tag)
 
     def checkUsage(usage, m, check):
-        if (not check(m._cacheUsage)):
-            print "Cache overrun!!! %d/%d" % (m._cacheUsage, m._cacheSize)
+        if (not check(m.getCacheUsage())):
+            print "Cache overrun!!! %d/%d" % (m.getCacheUsage(), m._cacheSize)
 
     def openCacheAndClose(_, m, name):
         d = m.openCacheFile(name)
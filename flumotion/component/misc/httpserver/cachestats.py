@@ -121,6 +121,9 @@ class CacheStatistics(object):
         self.cacheMissCount = 0
         self.cacheOutdateCount = 0
         self.cleanupCount = 0
+        # For source file lookups
+        self.sourceInfoHitCount = 0
+        self.coalescedRequestCount = 0
         # For real file reading statistics
         self.bytesReadFromSource = 0L
         self.bytesReadFromCache = 0L
@@ -131,6 +134,12 @@ class CacheStatistics(object):
         self.cancelledCopyCount = 0
         self.bytesCopied = 0L
         self._copyRatios = 0.0
+        # Origin server connection statistics
+        self.poolHitCount = 0
+        self.poolMissCount = 0
+        self.currentConnectionCount = 0
+        self.closedConnectionCount = 0
+        self._closedConnectionRequests = 0
 
     def startUpdates(self, updater):
         self._updater = updater
@@ -171,12 +180,42 @@ class CacheStatistics(object):
         return self._copyRatios / self.finishedCopyCount
     meanCopyRatio = property(getMeanCopyRatio)
 
+    def getPoolHitRatio(self):
+        total = self.poolHitCount + self.poolMissCount
+        if total == 0:
+            return 0.0
+        return float(self.poolHitCount) / total
+    poolHitRatio = property(getPoolHitRatio)
+
+    def getMeanConnectionRequests(self):
+        if self.closedConnectionCount == 0:
+            return 0
+        return (float(self._closedConnectionRequests)
+                / self.closedConnectionCount)
+    meanConnectionRequests = property(getMeanConnectionRequests)
+
     def onEstimateCacheUsage(self, usage, max):
         self._cacheUsage = usage
         self._cacheUsageRatio = float(usage) / max
         self._set("cache-usage-estimation", self._cacheUsage)
         self._set("cache-usage-ratio-estimation", self._cacheUsageRatio)
 
+    def onShardStatistics(self, shards):
+        """
+        @param shards: the path, size, usage, hit, miss and failure counts
+                       and availability of each cache directory
+        @type  shards: list of dict
+        """
+        self._set("cache-shards", shards)
+
+    def onSourceInfoHit(self):
+        self.sourceInfoHitCount += 1
+        self._set("source-info-hit-count", self.sourceInfoHitCount)
+
+    def onRequestCoalesced(self):
+        self.coalescedRequestCount += 1
+        self._set("coalesced-request-count", self.coalescedRequestCount)
+
     def onCleanup(self):
         self.cleanupCount += 1
         self._set("cleanup-count", self.cleanupCount)
@@ -209,6 +248,27 @@ class CacheStatistics(object):
         self._set("mean-copy-ratio", self.meanCopyRatio)
         self._set("mean-bytes-copied", self.meanBytesCopied)
 
+    def onPoolHit(self):
+        self.poolHitCount += 1
+        self._set("pool-hit-count", self.poolHitCount)
+        self._set("pool-hit-ratio", self.poolHitRatio)
+
+    def onPoolMiss(self):
+        self.poolMissCount += 1
+        self._set("pool-miss-count", self.poolMissCount)
+        self._set("pool-hit-ratio", self.poolHitRatio)
+
+    def onConnectionOpened(self):
+        self.currentConnectionCount += 1
+        self._set("current-connection-count", self.currentConnectionCount)
+
+    def onConnectionClosed(self, requests):
+        self.currentConnectionCount -= 1
+        self.closedConnectionCount += 1
+        self._closedConnectionRequests += requests
+        self._set("current-connection-count", self.currentConnectionCount)
+        self._set("mean-connection-requests", self.meanConnectionRequests)
+
     def _set(self, key, value):
         if self._updater is not None:
             self._updater.update(key, value)
@@ -234,15 +294,27 @@ class CacheStatistics(object):
             PAC: coPy cAncellation Count
             MCS: Mean Copy Size
             MCR: Mean Copy Ratio
+            PHC: Pool Hit Count, requests sent through reused connections
+            PMC: Pool Miss Count, connections opened to the servers
+            PHR: Pool Hit Ratio
+            OCC: Origin Connection Count
+            MRC: Mean Requests by Connection
+            SIH: Source Info Hits, source lookups saved by the status kept
+            CRQ: Coalesced ReQuests, waiting for the same lookup or open
         """
         log.debug("stats-local-cache",
                   "CRR: %.4f; CMC: %d; CHC: %d; THC: %d; COC: %d; "
                   "CCC: %d; CCU: %d; CUR: %.5f; "
-                  "PTC: %d; PCC: %d; PAC: %d; MCS: %d; MCR: %.4f",
+                  "PTC: %d; PCC: %d; PAC: %d; MCS: %d; MCR: %.4f; "
+                  "PHC: %d; PMC: %d; PHR: %.4f; OCC: %d; MRC: %.2f; "
+                  "SIH: %d; CRQ: %d",
                   self.cacheReadRatio, self.cacheMissCount,
                   self.cacheHitCount, self.tempHitCount,
                   self.cacheOutdateCount, self.cleanupCount,
                   self._cacheUsage, self._cacheUsageRatio,
                   self.totalCopyCount, self.currentCopyCount,
                   self.cancelledCopyCount, self.meanBytesCopied,
-                  self.meanCopyRatio)
+                  self.meanCopyRatio, self.poolHitCount, self.poolMissCount,
+                  self.poolHitRatio, self.currentConnectionCount,
+                  self.meanConnectionRequests, self.sourceInfoHitCount,
+                  self.coalescedRequestCount)
@@ -0,0 +1,372 @@
+# -*- test-case-name: flumotion.test.test_component_httpserver_diskio -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""
+thread pool running the disk operations of the file providers
+"""
+
+import time
+
+from twisted.internet import defer, reactor
+from twisted.python import failure, threadpool
+
+from flumotion.common import log
+
+__version__ = "$Rev$"
+
+LOG_CATEGORY = "disk-io"
+
+DEFAULT_THREADS = 8
+# Maximum size of a read merging the reads of several clients
+MAX_MERGED_READ_SIZE = 1024 * 1024
+# Weight of a new time in the moving averages
+TIME_WEIGHT = 0.1
+# Statistics update period
+STATS_UPDATE_PERIOD = 10
+
+
+class DiskIOStopped(Exception):
+    """
+    I am raised for the operations still queued when the executor stops.
+    """
+
+
+class Operation(object):
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.queued = time.time()
+        self.started = None
+        self.finished = None
+        self.dispatched = False
+        self.deferreds = []
+
+    def run(self):
+        return self.func(*self.args, **self.kwargs)
+
+    def succeeded(self, result):
+        for d in self.deferreds:
+            d.callback(result)
+
+    def failed(self, fail):
+        for d in self.deferreds:
+            d.errback(fail)
+
+
+class ReadOperation(Operation):
+    """
+    I read a range of a file with the first handle I was given,
+    and give to each of the clients merged in me the part they asked for.
+    """
+
+    def __init__(self, handle, offset, size):
+        Operation.__init__(self, None, (), {})
+        self.handle = handle
+        self.offset = offset
+        self.size = size
+        self.readers = [] # [(offset, size, deferred)]
+
+    def covers(self, offset, size):
+        return (self.offset <= offset
+                and offset + size <= self.offset + self.size)
+
+    def canExtend(self, offset, size):
+        start = min(self.offset, offset)
+        end = max(self.offset + self.size, offset + size)
+        # Only overlapping or contiguous ranges are merged
+        return ((offset <= self.offset + self.size)
+                and (self.offset <= offset + size)
+                and (end - start <= MAX_MERGED_READ_SIZE))
+
+    def extend(self, offset, size):
+        end = max(self.offset + self.size, offset + size)
+        self.offset = min(self.offset, offset)
+        self.size = end - self.offset
+
+    def addReader(self, offset, size):
+        d = defer.Deferred()
+        self.readers.append((offset, size, d))
+        return d
+
+    def run(self):
+        self.handle.seek(self.offset)
+        return self.handle.read(self.size)
+
+    def succeeded(self, data):
+        for offset, size, d in self.readers:
+            start = offset - self.offset
+            d.callback(data[start:start + size])
+
+    def failed(self, fail):
+        for offset, size, d in self.readers:
+            d.errback(fail)
+
+
+class DiskIOExecutor(log.Loggable):
+    """
+    I run blocking disk operations in a bounded pool of threads,
+    so a slow disk or network file system never blocks the reactor.
+
+    The operations are queued by file: the operations on the same file
+    run one after the other in the order they were asked for, so a file
+    handle is never used by two threads at the same time and a close
+    never overtakes a read. Operations on different files run in parallel.
+
+    Reads of the same file asked for while another one is queued are
+    merged with it when their ranges overlap or touch, and reads covered
+    by a queued or running read wait for it instead of reading again;
+    this way clients streaming the same file share the disk reads.
+
+    I start my threads the first time I'm used.
+    """
+
+    logCategory = LOG_CATEGORY
+
+    _updater = None
+    _callId = None
+
+    def __init__(self, maxThreads=DEFAULT_THREADS):
+        self.maxThreads = maxThreads
+        self._pool = None
+        self._shutdownTrigger = None
+        self._queues = {} # {key: [Operation]}, the first one is dispatched
+
+        self.operationCount = 0
+        self.mergedReadCount = 0
+        self.failureCount = 0
+        self.queueDepth = 0
+        self.queueDepthMax = 0
+        self.waitTimeAverage = None
+        self.waitTimeMax = None
+        self.serviceTimeAverage = None
+        self.serviceTimeMax = None
+
+    ### public API
+
+    def start(self):
+        if self._pool is not None:
+            return
+        self.debug("Starting %d disk I/O threads", self.maxThreads)
+        self._pool = threadpool.ThreadPool(0, self.maxThreads,
+                                           LOG_CATEGORY)
+        self._pool.start()
+        self._shutdownTrigger = reactor.addSystemEventTrigger(
+            'during', 'shutdown', self.stop)
+
+    def stop(self):
+        """
+        Wait for the running operations and fail the queued ones
+        with L{DiskIOStopped}.
+        """
+        if self._pool is None:
+            return
+        self.debug("Stopping disk I/O threads")
+        pool, self._pool = self._pool, None
+        if self._shutdownTrigger is not None:
+            try:
+                reactor.removeSystemEventTrigger(self._shutdownTrigger)
+            except ValueError:
+                pass
+            self._shutdownTrigger = None
+        pool.stop()
+        queues, self._queues = self._queues, {}
+        for queue in queues.values():
+            for op in queue:
+                if op.dispatched:
+                    # Its result is waiting to be delivered by the reactor
+                    continue
+                self.queueDepth -= 1
+                op.failed(failure.Failure(DiskIOStopped()))
+
+    def call(self, key, func, *args, **kwargs):
+        """
+        Call a function in a thread after the operations queued for a file.
+
+        @param key: the key identifying the file the function works with
+        @param func: the function, which can block
+
+        @rtype: L{defer.Deferred} fired with the result of the function
+        """
+        op = Operation(func, args, kwargs)
+        d = defer.Deferred()
+        op.deferreds.append(d)
+        self._enqueue(key, op)
+        return d
+
+    def read(self, key, handle, offset, size):
+        """
+        Read a range of a file in a thread.
+
+        @param key:    the key identifying the file; handles with the
+                       same key must give the same data
+        @param handle: the handle to read the file with if the read
+                       is not merged with another one
+        @type  handle: file
+        @param offset: the offset to read from
+        @type  offset: long
+        @param size:   the amount of bytes to read
+        @type  size:   int
+
+        @rtype: L{defer.Deferred} fired with the data read, smaller than
+                size when the end of the file is reached
+        """
+        queue = self._queues.get(key, [])
+        for op in queue:
+            if not isinstance(op, ReadOperation):
+                continue
+            if op.covers(offset, size):
+                self.mergedReadCount += 1
+                return op.addReader(offset, size)
+            if not op.dispatched and op.canExtend(offset, size):
+                self.mergedReadCount += 1
+                op.extend(offset, size)
+                return op.addReader(offset, size)
+        op = ReadOperation(handle, offset, size)
+        d = op.addReader(offset, size)
+        self._enqueue(key, op)
+        return d
+
+    def getQueueLength(self, key):
+        """
+        @returns: the number of operations queued or running for a file
+        @rtype:   int
+        """
+        return len(self._queues.get(key, []))
+
+    def getStats(self):
+        """
+        @returns: the number of threads, the operations queued or running,
+                  and their maximum, the operations finished, failed and
+                  the reads merged with others, and the moving average and
+                  maximum of the seconds operations waited in the queues
+                  and took to run
+        @rtype:   dict
+        """
+        return {'threads': self.maxThreads,
+                'queue-depth': self.queueDepth,
+                'queue-depth-max': self.queueDepthMax,
+                'operations': self.operationCount,
+                'failures': self.failureCount,
+                'merged-reads': self.mergedReadCount,
+                'wait-time-average': self.waitTimeAverage,
+                'wait-time-max': self.waitTimeMax,
+                'service-time-average': self.serviceTimeAverage,
+                'service-time-max': self.serviceTimeMax}
+
+    def startUpdates(self, updater):
+        self._updater = updater
+        if updater and (self._callId is None):
+            self._update()
+
+    def stopUpdates(self):
+        self._updater = None
+        if self._callId is not None:
+            self._callId.cancel()
+            self._callId = None
+
+    ### private methods
+
+    def _enqueue(self, key, op):
+        self.queueDepth += 1
+        self.queueDepthMax = max(self.queueDepthMax, self.queueDepth)
+        queue = self._queues.setdefault(key, [])
+        queue.append(op)
+        if len(queue) == 1:
+            self._dispatch(key, op)
+
+    def _dispatch(self, key, op):
+        self.start()
+        op.dispatched = True
+        self._pool.callInThread(self._run, key, op)
+
+    def _run(self, key, op):
+        # Called in a pool thread
+        op.started = time.time()
+        try:
+            result = op.run()
+            succeeded = True
+        except:
+            result = failure.Failure()
+            succeeded = False
+        op.finished = time.time()
+        reactor.callFromThread(self._done, key, op, succeeded, result)
+
+    def _done(self, key, op, succeeded, result):
+        self.queueDepth -= 1
+        self.operationCount += 1
+        self._updateTimes(op.started - op.queued, op.finished - op.started)
+        queue = self._queues.get(key)
+        if queue and queue[0] is op:
+            del queue[0]
+            if queue:
+                self._dispatch(key, queue[0])
+            else:
+                del self._queues[key]
+        if succeeded:
+            op.succeeded(result)
+        else:
+            self.failureCount += 1
+            self.log("Disk operation failed: %s",
+                     log.getFailureMessage(result))
+            op.failed(result)
+
+    def _updateTimes(self, wait, service):
+        if self.waitTimeAverage is None:
+            self.waitTimeAverage = self.waitTimeMax = wait
+            self.serviceTimeAverage = self.serviceTimeMax = service
+            return
+        self.waitTimeAverage += TIME_WEIGHT * (wait - self.waitTimeAverage)
+        self.waitTimeMax = max(self.waitTimeMax, wait)
+        self.serviceTimeAverage += TIME_WEIGHT * (service
+                                                  - self.serviceTimeAverage)
+        self.serviceTimeMax = max(self.serviceTimeMax, service)
+
+    def _set(self, key, value):
+        if self._updater is not None:
+            self._updater.update(key, value)
+
+    def _update(self):
+        self._set("disk-io-threads", self.maxThreads)
+        self._set("disk-io-queue-depth", self.queueDepth)
+        self._set("disk-io-queue-depth-max", self.queueDepthMax)
+        self._set("disk-io-merged-reads", self.mergedReadCount)
+        self._set("disk-io-wait-time", self.waitTimeAverage)
+        self._set("disk-io-service-time", self.serviceTimeAverage)
+        self._logStatsLine()
+        self._callId = reactor.callLater(STATS_UPDATE_PERIOD, self._update)
+
+    def _logStatsLine(self):
+        """
+        Statistic fields names:
+            IOT: I/O Threads
+            IQD: I/O Queue Depth, operations queued or running
+            IQM: I/O Queue depth Maximum
+            IOC: I/O Operation Count
+            IFC: I/O Failure Count
+            IMR: I/O Merged Reads
+            IWT: I/O mean Wait Time in the queues, in milliseconds
+            IST: I/O mean Service Time, in milliseconds
+        """
+        log.debug("stats-disk-io",
+                  "IOT: %d; IQD: %d; IQM: %d; IOC: %d; IFC: %d; IMR: %d; "
+                  "IWT: %.2f; IST: %.2f",
+                  self.maxThreads, self.queueDepth, self.queueDepthMax,
+                  self.operationCount, self.failureCount,
+                  self.mergedReadCount, (self.waitTimeAverage or 0) * 1000,
+                  (self.serviceTimeAverage or 0) * 1000)
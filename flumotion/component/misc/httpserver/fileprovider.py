@@ -174,6 +174,40 @@ class File(object):
         """
 
 
+class TimeIndexedFile(File):
+    """
+    I am an asynchronous interface to a file with a keyframe index
+    giving the wall-clock time of each keyframe.
+    I can be positioned at a time instead of a byte offset,
+    and I can follow the file while it is still being written.
+    """
+
+    def getHeaders(self):
+        """
+        @return: a deferred fired with the stream headers that must prefix
+                 the data read after seeking to a keyframe; can be empty.
+        @rtype:  L{defer.Deferred}
+        """
+
+    def seekTime(self, start, stop):
+        """
+        Moves the reading position to the keyframe at or before start
+        and limits the reading to the keyframe at or after stop.
+
+        @param start: the UNIX time to start from, or None for the first
+                      indexed keyframe
+        @type  start: float
+        @param stop:  the UNIX time to stop at, or None to follow the file
+                      until it stops growing
+        @type  stop:  float
+
+        @return: the first and last byte offsets that will be read, the
+                 last one being None if not yet known because the file is
+                 followed; None if the times are outside the index.
+        @rtype:  (long, long) or None
+        """
+
+
 class FileProviderPlug(plugbase.ComponentPlug):
     """
     I am a plug that provide a root FilePath instance
@@ -0,0 +1,521 @@
+# -*- test-case-name: flumotion.test.test_component_httpserver_flvindex -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""
+keyframe index of FLV files, to seek in them
+"""
+
+import bisect
+import marshal
+import os
+import struct
+import tempfile
+
+from twisted.internet import defer, reactor, threads
+
+from flumotion.common import log, python
+
+__version__ = "$Rev$"
+
+LOG_CATEGORY = "flv-index"
+
+# Size of the reads when scanning a file
+SCAN_CHUNK_SIZE = 1024 * 1024
+# Maximum number of indexes kept in memory
+MAX_INDEXES = 1000
+# Minimum time between two indexed tags of files without video
+AUDIO_SEEK_PERIOD = 1.0
+# Version of the index files, changed when their format changes
+INDEX_FILE_VERSION = 1
+INDEX_FILE_SUFFIX = ".flvidx"
+
+TAG_AUDIO = 8
+TAG_VIDEO = 9
+TAG_SCRIPT = 18
+TAG_HEADER_SIZE = 11
+VIDEO_KEYFRAME = 1
+
+# AMF0 types used in FLV script tags
+AMF_NUMBER = 0x00
+AMF_BOOLEAN = 0x01
+AMF_STRING = 0x02
+AMF_OBJECT = 0x03
+AMF_NULL = 0x05
+AMF_UNDEFINED = 0x06
+AMF_ECMA_ARRAY = 0x08
+AMF_OBJECT_END = 0x09
+AMF_STRICT_ARRAY = 0x0a
+AMF_DATE = 0x0b
+AMF_LONG_STRING = 0x0c
+
+
+class FLVError(Exception):
+    """
+    I am raised when a file can't be indexed.
+    """
+
+
+### AMF0 script data
+
+def decodeScriptData(data):
+    """
+    Decode the data of a script tag.
+
+    @return: the name of the script and its value
+    @rtype:  tuple of (str, object)
+    """
+    try:
+        name, pos = _decodeValue(data, 0)
+        value, pos = _decodeValue(data, pos)
+    except (struct.error, IndexError):
+        raise FLVError("Truncated script data")
+    return name, value
+
+
+def encodeScriptData(name, value):
+    """
+    Encode the data of a script tag.
+    Dictionaries are encoded as ECMA arrays, lists as strict arrays.
+    """
+    return _encodeValue(name) + _encodeValue(value)
+
+
+def _decodeValue(data, pos):
+    kind = ord(data[pos])
+    pos += 1
+    if kind == AMF_NUMBER:
+        return struct.unpack(">d", data[pos:pos + 8])[0], pos + 8
+    if kind == AMF_BOOLEAN:
+        return ord(data[pos]) != 0, pos + 1
+    if kind == AMF_STRING:
+        return _decodeString(data, pos)
+    if kind in (AMF_NULL, AMF_UNDEFINED):
+        return None, pos
+    if kind == AMF_OBJECT:
+        return _decodeProperties(data, pos)
+    if kind == AMF_ECMA_ARRAY:
+        # The count is only a hint, the end marker is what counts
+        return _decodeProperties(data, pos + 4)
+    if kind == AMF_STRICT_ARRAY:
+        count = struct.unpack(">L", data[pos:pos + 4])[0]
+        pos += 4
+        values = []
+        for i in xrange(count):
+            value, pos = _decodeValue(data, pos)
+            values.append(value)
+        return values, pos
+    if kind == AMF_DATE:
+        # Milliseconds since the epoch and an unused time zone
+        return struct.unpack(">d", data[pos:pos + 8])[0], pos + 10
+    if kind == AMF_LONG_STRING:
+        size = struct.unpack(">L", data[pos:pos + 4])[0]
+        return data[pos + 4:pos + 4 + size], pos + 4 + size
+    raise FLVError("Unsupported script data type %d" % kind)
+
+
+def _decodeString(data, pos):
+    size = struct.unpack(">H", data[pos:pos + 2])[0]
+    return data[pos + 2:pos + 2 + size], pos + 2 + size
+
+
+def _decodeProperties(data, pos):
+    properties = {}
+    while True:
+        key, pos = _decodeString(data, pos)
+        if not key and ord(data[pos]) == AMF_OBJECT_END:
+            return properties, pos + 1
+        properties[key], pos = _decodeValue(data, pos)
+
+
+def _encodeString(value):
+    return struct.pack(">H", len(value)) + value
+
+
+def _encodeValue(value):
+    if value is None:
+        return chr(AMF_NULL)
+    if isinstance(value, bool):
+        return chr(AMF_BOOLEAN) + chr(int(value))
+    if isinstance(value, (int, long, float)):
+        return chr(AMF_NUMBER) + struct.pack(">d", value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    if isinstance(value, str):
+        if len(value) > 0xffff:
+            return chr(AMF_LONG_STRING) + struct.pack(">L", len(value)) + value
+        return chr(AMF_STRING) + _encodeString(value)
+    if isinstance(value, (list, tuple)):
+        return (chr(AMF_STRICT_ARRAY) + struct.pack(">L", len(value))
+                + "".join([_encodeValue(v) for v in value]))
+    if isinstance(value, dict):
+        keys = value.keys()
+        keys.sort()
+        return (chr(AMF_ECMA_ARRAY) + struct.pack(">L", len(keys))
+                + "".join([_encodeString(k) + _encodeValue(value[k])
+                           for k in keys])
+                + _encodeString("") + chr(AMF_OBJECT_END))
+    raise FLVError("Can't encode %r as script data" % (value, ))
+
+
+### index
+
+class FLVIndex(object):
+    """
+    I am the index of the tags of an FLV file a client can start playing
+    from: the video keyframes, or for files without video, an audio tag
+    every L{AUDIO_SEEK_PERIOD} seconds.
+
+    @ivar header:      the FLV header and the first previous tag size
+    @ivar metadata:    the value of the onMetaData script tag of the file,
+                       or None if it has none
+    @ivar bodyOffset:  the offset of the first tag following the header
+                       and the onMetaData tag
+    @ivar duration:    the timestamp of the last tag, in seconds
+    @ivar times:       the timestamps of the indexed tags, in seconds
+    @ivar offsets:     the offsets of the indexed tags in the file
+    """
+
+    def __init__(self, header, metadata, bodyOffset, duration,
+                 times, offsets):
+        self.header = header
+        self.metadata = metadata
+        self.bodyOffset = bodyOffset
+        self.duration = duration
+        self.times = times
+        self.offsets = offsets
+
+    def hasKeyframesMetadata(self):
+        """
+        @return: whether the onMetaData tag of the file contains
+                 the keyframes table players need to seek
+        """
+        keyframes = (self.metadata or {}).get('keyframes', None)
+        return isinstance(keyframes, dict) and 'filepositions' in keyframes
+
+    def findTime(self, time):
+        """
+        @return: the offset of the last indexed tag starting at or before
+                 the given time in seconds, or of the first one
+        @rtype:  long or None if there are no indexed tags
+        """
+        return self._find(self.times, time)
+
+    def findOffset(self, offset):
+        """
+        @return: the offset of the last indexed tag starting at or before
+                 the given offset, or of the first one
+        @rtype:  long or None if there are no indexed tags
+        """
+        return self._find(self.offsets, offset)
+
+    def getMetadataTag(self):
+        """
+        @return: an onMetaData script tag with the metadata of the file and
+                 the keyframes table, followed by its previous tag size;
+                 the file positions are the offsets in the original file
+        @rtype:  str
+        """
+        metadata = dict(self.metadata or {})
+        metadata['hasKeyframes'] = bool(self.times)
+        metadata['keyframes'] = {'times': self.times,
+                                 'filepositions': self.offsets}
+        metadata.setdefault('duration', self.duration)
+        data = encodeScriptData('onMetaData', metadata)
+        size = len(data)
+        # Type, data size, timestamp and its extension, and stream id
+        tag = struct.pack(">BBH", TAG_SCRIPT, size >> 16, size & 0xffff)
+        tag += "\x00" * 7 + data
+        return tag + struct.pack(">L", TAG_HEADER_SIZE + size)
+
+    def toData(self):
+        return (INDEX_FILE_VERSION, self.header, self.metadata,
+                self.bodyOffset, self.duration, self.times, self.offsets)
+
+    def fromData(cls, data):
+        if data[0] != INDEX_FILE_VERSION:
+            raise FLVError("Unsupported index file version %r" % data[0])
+        return cls(*data[1:])
+    fromData = classmethod(fromData)
+
+    def _find(self, keys, key):
+        if not self.offsets:
+            return None
+        i = max(bisect.bisect_right(keys, key) - 1, 0)
+        return self.offsets[i]
+
+
+class _ChunkReader(object):
+
+    def __init__(self, read, size):
+        self._read = read
+        self._size = size
+        self._offset = 0
+        self._data = ""
+
+    def get(self, offset, length):
+        end = offset + length
+        if not (self._offset <= offset
+                and end <= self._offset + len(self._data)):
+            self._offset = offset
+            self._data = self._read(offset, max(length, SCAN_CHUNK_SIZE))
+        start = offset - self._offset
+        data = self._data[start:start + length]
+        if len(data) < length:
+            raise FLVError("Truncated file at offset %d" % offset)
+        return data
+
+
+def scan(read, size):
+    """
+    Build the index of an FLV file reading it once from the beginning,
+    skipping the data of the audio and video tags.
+    This blocks, so it should be called in a thread.
+
+    @param read: function returning the data of the file at an offset
+    @type  read: callable(offset, length) -> str
+    @param size: the size of the file
+
+    @rtype: L{FLVIndex}
+    """
+    reader = _ChunkReader(read, size)
+    header = reader.get(0, 9)
+    if header[:3] != 'FLV':
+        raise FLVError("Not an FLV file")
+    bodyOffset = struct.unpack(">L", header[5:9])[0] + 4
+    header = reader.get(0, bodyOffset)
+
+    metadata = None
+    duration = 0
+    times, offsets = [], []
+    audioTimes, audioOffsets = [], []
+    mediaFound = False
+    offset = bodyOffset
+    while offset + TAG_HEADER_SIZE <= size:
+        tag = reader.get(offset, TAG_HEADER_SIZE)
+        kind = ord(tag[0]) & 0x1f
+        dataSize, = struct.unpack(">L", "\x00" + tag[1:4])
+        stamp, = struct.unpack(">L", tag[7] + tag[4:7])
+        end = offset + TAG_HEADER_SIZE + dataSize + 4
+        if end > size:
+            # The last tag is truncated, never start playing there
+            break
+        time = stamp / 1000.0
+        duration = max(duration, time)
+        if kind == TAG_VIDEO and dataSize:
+            mediaFound = True
+            flags = ord(reader.get(offset + TAG_HEADER_SIZE, 1))
+            if flags >> 4 == VIDEO_KEYFRAME:
+                times.append(time)
+                offsets.append(offset)
+        elif kind == TAG_AUDIO:
+            mediaFound = True
+            if not audioTimes or time >= audioTimes[-1] + AUDIO_SEEK_PERIOD:
+                audioTimes.append(time)
+                audioOffsets.append(offset)
+        elif kind == TAG_SCRIPT and metadata is None and not mediaFound:
+            data = reader.get(offset + TAG_HEADER_SIZE, dataSize)
+            name, value = decodeScriptData(data)
+            if name == 'onMetaData' and isinstance(value, dict):
+                metadata = value
+                if offset == bodyOffset:
+                    bodyOffset = end
+        offset = end
+
+    if not times:
+        times, offsets = audioTimes, audioOffsets
+    return FLVIndex(header, metadata, bodyOffset, duration, times, offsets)
+
+
+### cache
+
+class FLVIndexCache(log.Loggable):
+    """
+    I build the indexes of the FLV files in threads, and keep the most
+    recently used ones in memory and, if I have a directory, on disk.
+
+    The files are identified by a key containing their modification time
+    and size, so a modified file is indexed again. Files that can't be
+    indexed are remembered too, so they are not scanned for every request.
+    """
+
+    logCategory = LOG_CATEGORY
+
+    def __init__(self, directory=None, maxIndexes=MAX_INDEXES):
+        self.directory = directory
+        self.maxIndexes = maxIndexes
+        self.scanCount = 0
+        self.loadCount = 0
+        self._indexes = {} # {KEY: FLVIndex or None}
+        self._lru = [] # Keys, the most recently used last
+        self._building = {} # {KEY: [DEFERRED]}
+        self._stopped = False
+
+    def hasIndex(self, key):
+        """
+        @return: whether the file has been indexed or failed to be
+        """
+        return key in self._indexes
+
+    def getIndex(self, key):
+        """
+        @return: the index of the file if it has been built,
+                 None otherwise
+        @rtype:  L{FLVIndex}
+        """
+        index = self._indexes.get(key, None)
+        if index is not None:
+            self._lru.remove(key)
+            self._lru.append(key)
+        return index
+
+    def buildIndex(self, key, path):
+        """
+        Get the index of a file, loading it from the disk or scanning
+        the file if needed. Requests for a file being indexed wait for it.
+
+        @param key:  the key identifying the version of the file
+        @param path: the path to open the file with
+        @type  path: L{fileprovider.FilePath}
+
+        @rtype: L{defer.Deferred} fired with the L{FLVIndex},
+                or None if the file can't be indexed
+        """
+        if key in self._indexes:
+            return defer.succeed(self.getIndex(key))
+        d = defer.Deferred()
+        if key in self._building:
+            self._building[key].append(d)
+            return d
+        self._building[key] = [d]
+        build = self._load(key)
+        build.addCallback(self._loaded, key, path)
+        build.addErrback(self._buildFailed, key)
+        build.addCallback(self._built, key)
+        return d
+
+    def stop(self):
+        """
+        Abort the scans in progress.
+
+        @rtype: L{defer.Deferred} fired when they are aborted
+        """
+        self._stopped = True
+        l = []
+        for waiters in self._building.values():
+            d = defer.Deferred()
+            waiters.append(d)
+            l.append(d)
+        return defer.DeferredList(l)
+
+    ### private methods
+
+    def _getIndexPath(self, key):
+        sha1Hash = python.sha1()
+        sha1Hash.update(repr(key))
+        name = sha1Hash.digest().encode("hex") + INDEX_FILE_SUFFIX
+        return os.path.join(self.directory, name)
+
+    def _load(self, key):
+        if not self.directory:
+            return defer.succeed(None)
+        d = threads.deferToThread(_loadIndex, self._getIndexPath(key))
+
+        def loadFailed(failure):
+            self.debug("Failed to load the index of %s: %s",
+                       key[0], log.getFailureMessage(failure))
+        d.addErrback(loadFailed)
+        return d
+
+    def _loaded(self, index, key, path):
+        if index is not None:
+            self.loadCount += 1
+            return index
+        self.debug("Indexing %s", key[0])
+        d = defer.maybeDeferred(path.open)
+        d.addCallback(self._scan, key)
+        return d
+
+    def _scan(self, provider, key):
+        self.scanCount += 1
+        d = threads.deferToThread(scan, self._readInThread(provider),
+                                  provider.getsize())
+        d.addBoth(self._scanned, provider, key)
+        return d
+
+    def _readInThread(self, provider):
+
+        def read(offset, length):
+            # Called in a thread, the provider is used in the reactor one
+            if self._stopped:
+                raise FLVError("Indexing stopped")
+            return threads.blockingCallFromThread(reactor, readAt,
+                                                  offset, length)
+
+        def readAt(offset, length):
+            provider.seek(offset)
+            return provider.read(length)
+        return read
+
+    def _scanned(self, result, provider, key):
+        provider.close()
+        if isinstance(result, FLVIndex) and self.directory:
+            d = threads.deferToThread(_saveIndex, self._getIndexPath(key),
+                                      result)
+
+            def saveFailed(failure):
+                self.warning("Failed to save the index of %s: %s",
+                             key[0], log.getFailureMessage(failure))
+            d.addErrback(saveFailed)
+            d.addCallback(lambda _: result)
+            return d
+        return result
+
+    def _buildFailed(self, failure, key):
+        self.debug("Failed to index %s: %s",
+                   key[0], log.getFailureMessage(failure))
+        return None
+
+    def _built(self, index, key):
+        if not self._stopped:
+            self._indexes[key] = index
+            self._lru.append(key)
+            while len(self._lru) > self.maxIndexes:
+                del self._indexes[self._lru.pop(0)]
+        for d in self._building.pop(key, []):
+            d.callback(index)
+
+
+def _loadIndex(path):
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        return FLVIndex.fromData(marshal.load(f))
+    finally:
+        f.close()
+
+
+def _saveIndex(path, index):
+    fd, tempPath = tempfile.mkstemp(INDEX_FILE_SUFFIX,
+                                    dir=os.path.dirname(path))
+    f = os.fdopen(fd, 'wb')
+    try:
+        marshal.dump(index.toData(), f)
+    finally:
+        f.close()
+    os.rename(tempPath, path)
@@ -0,0 +1,483 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+from twisted.internet import defer, protocol, reactor
+from twisted.web import http
+
+from flumotion.common import log
+from flumotion.component.misc.httpserver import cachestats
+from flumotion.component.misc.httpserver.httpcached import common
+
+
+LOG_CATEGORY = "connection-pool"
+
+# Maximum connections opened to the same server address and port
+DEFAULT_MAX_CONNECTIONS = 16
+# Seconds an unused connection is kept open
+DEFAULT_IDLE_TIMEOUT = 30
+# Requests sent through the same connection before closing it
+DEFAULT_MAX_REQUESTS = 1000
+# Seconds to wait for a connection to be established
+DEFAULT_CONN_TIMEOUT = 30
+# Bytes of an unwanted response body read to keep the connection
+DRAIN_MAX_SIZE = 64 * 1024
+# Seconds given to read an unwanted response
+DRAIN_TIMEOUT = 5
+
+# Responses that never have a body
+BODYLESS_STATUSES = (http.NO_CONTENT, http.NOT_MODIFIED)
+
+
+class PoolTimeoutError(Exception):
+    """
+    No connection to the server became available in time.
+    """
+
+
+class PooledConnection(http.HTTPClient, log.Loggable):
+    """
+    A persistent HTTP/1.1 connection to a server, sending one request
+    at a time for the handler given to L{request}.
+
+    The handler is called with the same methods as an HTTPClient:
+    handleStatus, handleHeader, handleEndHeaders and handleResponsePart,
+    then handleResponseEnd when the whole response has been received,
+    or connectionLost if the connection is lost before.
+
+    After the response the connection goes back to the pool if it can
+    be reused, that is when the response had a known length and the
+    server didn't ask to close the connection. If the handler detaches
+    before the end of the response, the rest of a small response is read
+    and discarded; the connection is closed if the response is bigger.
+    """
+
+    logCategory = LOG_CATEGORY
+
+    def __init__(self, pool, key):
+        self.pool = pool
+        self.key = key
+        self.handler = None
+        self.requestCount = 0
+        # Seconds the server keeps the connection, from Keep-Alive headers
+        self.serverTimeout = None
+
+        self._persistent = False
+        self._bodyless = False
+        self._draining = False
+        self._drainCall = None
+        self._idleCall = None
+        self._closed = False
+
+        self.logName = common.log_id(self) # To be able to track the instance
+
+    def __repr__(self):
+        return "<%s: %s:%s>" % (type(self).__name__, self.key[0], self.key[1])
+
+    ### Public Methods ###
+
+    def request(self, handler, method, location, headers):
+        """
+        Send a request through the connection, which has to be idle.
+
+        @param handler: the object the response is given to
+        @param headers: the request headers
+        @type  headers: list of (str, str)
+        """
+        assert self.isIdle(), "Connection busy"
+        self._cancelIdleCall()
+        if self.requestCount:
+            self.pool._onReused(self)
+        self.requestCount += 1
+        self.handler = handler
+        self._resetParser()
+
+        self.sendCommand(method, location)
+        for name, value in headers:
+            self.sendHeader(name, value)
+        self.sendHeader('Connection', 'keep-alive')
+        self.endHeaders()
+
+    def detach(self, handler):
+        """
+        Called by the handler of the current request when it's not
+        interested in the rest of the response anymore.
+        """
+        if self.handler is not handler:
+            return
+        self.handler = None
+        if self.paused:
+            self.resumeProducing()
+        if self._closed:
+            return
+        if not self.line_mode:
+            # Receiving the body
+            if (not self._persistent or self.length is None
+                or self.length > DRAIN_MAX_SIZE):
+                self.close()
+                return
+        # The size of the response is checked after the headers
+        self.log("Discarding the rest of the response")
+        self._draining = True
+        self._drainCall = reactor.callLater(DRAIN_TIMEOUT, self.close)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._cancelIdleCall()
+        self._cancelDrainCall()
+        if self.transport is not None:
+            self.transport.loseConnection()
+
+    def isIdle(self):
+        return (self.handler is None and not self._draining
+                and not self._closed)
+
+    ### Overridden Methods ###
+
+    def connectionMade(self):
+        self.log("Connected to %s:%s", self.key[0], self.key[1])
+        self.pool._onConnected(self)
+
+    def connectionLost(self, reason):
+        self.log("Connection to %s:%s lost after %d requests",
+                 self.key[0], self.key[1], self.requestCount)
+        self._closed = True
+        self._cancelIdleCall()
+        self._cancelDrainCall()
+        handler, self.handler = self.handler, None
+        self.pool._onLost(self)
+        if handler is not None:
+            handler.connectionLost(reason)
+
+    def sendCommand(self, command, path):
+        self.transport.write('%s %s HTTP/1.1\r\n' % (command, path))
+
+    def lineReceived(self, line):
+        http.HTTPClient.lineReceived(self, line)
+        if not self.line_mode and self._bodyless:
+            # The headers are the whole response,
+            # what follows is the next one.
+            self.setLineMode()
+            self.handleResponseEnd()
+
+    def handleStatus(self, version, status, message):
+        self._persistent = version == 'HTTP/1.1'
+        self._bodyless = status.isdigit() and int(status) in BODYLESS_STATUSES
+        if self.handler is not None:
+            self.handler.handleStatus(version, status, message)
+
+    def handleHeader(self, key, value):
+        name = key.lower()
+        if name == 'connection':
+            tokens = [t.strip().lower() for t in value.split(',')]
+            if 'close' in tokens:
+                self._persistent = False
+            elif 'keep-alive' in tokens:
+                self._persistent = True
+        elif name == 'keep-alive':
+            for param in value.split(','):
+                if '=' not in param:
+                    continue
+                k, v = [s.strip() for s in param.split('=', 1)]
+                if k.lower() == 'timeout' and v.isdigit():
+                    self.serverTimeout = int(v)
+        elif name == 'transfer-encoding':
+            # Chunked bodies are not supported
+            self._persistent = False
+        if self.handler is not None:
+            self.handler.handleHeader(key, value)
+
+    def handleEndHeaders(self):
+        if self.length == 0:
+            self._bodyless = True
+        if self.length is None and not self._bodyless:
+            # The end of the body is the end of the connection
+            self._persistent = False
+        if self._draining:
+            if not self._persistent or not (self._bodyless
+                                            or self.length <= DRAIN_MAX_SIZE):
+                self.close()
+            return
+        if self.handler is not None:
+            self.handler.handleEndHeaders()
+
+    def handleResponsePart(self, data):
+        if self.handler is not None:
+            self.handler.handleResponsePart(data)
+
+    def handleResponseEnd(self):
+        if self._closed or self.firstLine:
+            return
+        if not (self._bodyless or self.length == 0):
+            return
+        handler, self.handler = self.handler, None
+        persistent = self._persistent
+        self._draining = False
+        self._cancelDrainCall()
+        self._resetParser()
+        if persistent:
+            self.pool._release(self)
+        else:
+            self.close()
+        if handler is not None:
+            handler.handleResponseEnd()
+
+    ### Private Methods ###
+
+    def _resetParser(self):
+        self.firstLine = True
+        self.length = None
+        self._header = ""
+        self._HTTPClient__buffer = None
+        self._persistent = False
+        self._bodyless = False
+
+    def _startIdleCall(self, timeout):
+        self._cancelIdleCall()
+        self._idleCall = reactor.callLater(timeout, self._onIdleTimeout)
+
+    def _cancelIdleCall(self):
+        if self._idleCall is not None:
+            self._idleCall.cancel()
+            self._idleCall = None
+
+    def _cancelDrainCall(self):
+        if self._drainCall is not None:
+            self._drainCall.cancel()
+            self._drainCall = None
+
+    def _onIdleTimeout(self):
+        self._idleCall = None
+        self.log("Closing idle connection")
+        self.close()
+
+
+class ConnectionFactory(protocol.ClientFactory):
+
+    protocol = PooledConnection
+
+    def __init__(self, pool, key):
+        self.pool = pool
+        self.key = key
+
+    def buildProtocol(self, addr):
+        return self.protocol(self.pool, self.key)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.pool._onConnectionFailed(self.key, reason)
+
+
+class ConnectionPool(log.Loggable):
+    """
+    Keeps HTTP connections open to be reused by the next requests
+    to the same server address and port.
+
+    At most maxConnections connections are opened to the same server;
+    requests wait for one of them to be released when they are all busy,
+    for connTimeout seconds at most.
+    Idle connections are closed after idleTimeout seconds, or before
+    the server closes them when it tells for how long it keeps them.
+    The connection released last is reused first, being the least likely
+    to have been closed by the server meanwhile.
+
+    The requests sent through reused and new connections, and the number
+    of requests sent through each connection, are given to the
+    CacheStatistics.
+    """
+
+    logCategory = LOG_CATEGORY
+
+    connectionFactory = ConnectionFactory
+
+    def __init__(self, stats=None, maxConnections=DEFAULT_MAX_CONNECTIONS,
+                 idleTimeout=DEFAULT_IDLE_TIMEOUT,
+                 connTimeout=DEFAULT_CONN_TIMEOUT,
+                 maxRequests=DEFAULT_MAX_REQUESTS):
+        if stats is None:
+            stats = cachestats.CacheStatistics()
+        self.stats = stats
+        self.maxConnections = maxConnections
+        self.idleTimeout = idleTimeout
+        self.connTimeout = connTimeout
+        self.maxRequests = maxRequests
+
+        self._idle = {} # (host, port) -> list of PooledConnection
+        self._counts = {} # (host, port) -> connections opened or opening
+        self._connecting = {} # (host, port) -> connections opening
+        self._waiting = {} # (host, port) -> list of Deferred
+        self._connections = [] # all the connections opened
+        self._closed = False
+
+    ### Public Methods ###
+
+    def acquire(self, host, port, fresh=False):
+        """
+        Get an idle connection to a server, opening a new one if needed.
+
+        @param fresh: if True, don't reuse an idle connection
+        @returns: a deferred fired with a connected L{PooledConnection},
+                  that can be cancelled while waiting, and failing with
+                  L{PoolTimeoutError} if none is available after
+                  connTimeout seconds
+        @rtype:   L{twisted.internet.defer.Deferred}
+        """
+        key = (host, port)
+        idle = self._idle.get(key)
+        if idle and not fresh:
+            connection = idle.pop()
+            if not idle:
+                del self._idle[key]
+            self.log("Reusing connection %s", connection.logName)
+            return defer.succeed(connection)
+
+        d = defer.Deferred(lambda d: self._cancelWait(key, d))
+        self._waiting.setdefault(key, []).append(d)
+        if self.connTimeout:
+            call = reactor.callLater(self.connTimeout,
+                                     self._onWaitTimeout, key, d)
+            d.addBoth(self._waitDone, call)
+        if idle and self._counts[key] >= self.maxConnections:
+            # Make room for a new connection
+            idle[0].close()
+        self._maybeConnect(key)
+        return d
+
+    def getIdleCount(self, host, port):
+        return len(self._idle.get((host, port), []))
+
+    def getConnectionCount(self, host, port):
+        return self._counts.get((host, port), 0)
+
+    def close(self):
+        """
+        Close all the connections not used by a request, and the others
+        when their request is done.
+        """
+        self._closed = True
+        for connection in self._connections[:]:
+            if connection.handler is None:
+                connection.close()
+
+    ### Protected Methods, used by PooledConnection ###
+
+    def _release(self, connection):
+        if self._closed:
+            connection.close()
+            return
+        if connection.requestCount >= self.maxRequests:
+            self.log("Closing connection %s after %d requests",
+                     connection.logName, connection.requestCount)
+            connection.close()
+            return
+        if self._giveToWaiting(connection):
+            return
+        timeout = self.idleTimeout
+        if connection.serverTimeout is not None:
+            # Close it before the server does
+            timeout = min(timeout, connection.serverTimeout - 1)
+        if timeout <= 0:
+            connection.close()
+            return
+        self._idle.setdefault(connection.key, []).append(connection)
+        connection._startIdleCall(timeout)
+
+    def _onConnected(self, connection):
+        self._connecting[connection.key] -= 1
+        self._connections.append(connection)
+        self.stats.onConnectionOpened()
+        self.log("New connection %s", connection.logName)
+        self._release(connection)
+
+    def _onConnectionFailed(self, key, reason):
+        self._connecting[key] -= 1
+        self._decrementCount(key)
+        # Don't make the others wait for a server we can't connect to
+        waiting = self._waiting.pop(key, [])
+        self.log("Connection to %s:%s failed, failing %d requests: %s",
+                 key[0], key[1], len(waiting), reason.getErrorMessage())
+        for d in waiting:
+            d.errback(reason)
+
+    def _onLost(self, connection):
+        key = connection.key
+        self._decrementCount(key)
+        if connection in self._connections:
+            self._connections.remove(connection)
+        idle = self._idle.get(key)
+        if idle and connection in idle:
+            idle.remove(connection)
+            if not idle:
+                del self._idle[key]
+        self.stats.onConnectionClosed(connection.requestCount)
+        self._maybeConnect(key)
+
+    def _onReused(self, connection):
+        self.stats.onPoolHit()
+
+    ### Private Methods ###
+
+    def _maybeConnect(self, key):
+        waiting = len(self._waiting.get(key, []))
+        if waiting <= self._connecting.get(key, 0):
+            return
+        if self._counts.get(key, 0) >= self.maxConnections:
+            self.log("All the %d connections to %s:%s are busy, "
+                     "%d requests waiting", self.maxConnections,
+                     key[0], key[1], waiting)
+            return
+        self._counts[key] = self._counts.get(key, 0) + 1
+        self._connecting[key] = self._connecting.get(key, 0) + 1
+        self.stats.onPoolMiss()
+        factory = self.connectionFactory(self, key)
+        reactor.connectTCP(key[0], key[1], factory, self.connTimeout)
+
+    def _decrementCount(self, key):
+        self._counts[key] -= 1
+        if not self._counts[key]:
+            del self._counts[key]
+            del self._connecting[key]
+
+    def _giveToWaiting(self, connection):
+        waiting = self._waiting.get(connection.key)
+        if not waiting:
+            return False
+        d = waiting.pop(0)
+        if not waiting:
+            del self._waiting[connection.key]
+        d.callback(connection)
+        return True
+
+    def _waitDone(self, result, call):
+        if call.active():
+            call.cancel()
+        return result
+
+    def _onWaitTimeout(self, key, d):
+        self._cancelWait(key, d)
+        self.log("No connection to %s:%s available in %s seconds",
+                 key[0], key[1], self.connTimeout)
+        d.errback(PoolTimeoutError("No connection to %s:%s available "
+                                   "in %s seconds" % (key[0], key[1],
+                                                      self.connTimeout)))
+
+    def _cancelWait(self, key, d):
+        waiting = self._waiting.get(key)
+        if waiting and d in waiting:
+            waiting.remove(d)
+            if not waiting:
+                del self._waiting[key]
@@ -21,6 +21,7 @@ from flumotion.common import log
 from flumotion.component.misc.httpserver import cachemanager
 from flumotion.component.misc.httpserver import cachestats
 from flumotion.component.misc.httpserver import localpath
+from flumotion.component.misc.httpserver.httpcached import connection_pool
 from flumotion.component.misc.httpserver.httpcached import http_client
 from flumotion.component.misc.httpserver.httpcached import http_utils
 from flumotion.component.misc.httpserver.httpcached import request_manager
@@ -32,6 +33,7 @@ from flumotion.component.misc.httpserver.httpcached import strategy_basic
 LOG_CATEGORY = "filereader-httpcached"
 
 DEFAULT_CACHE_TTL = 5*60
+DEFAULT_STALE_TTL = 60
 DEFAULT_DNS_REFRESH = 60
 DEFAULT_VIRTUAL_PORT = 80
 DEFAULT_VIRTUAL_PATH = ""
@@ -39,6 +41,10 @@ DEFAULT_SERVER_PORT = 3128
 DEFAULT_PROXY_PRIORITY = 1
 DEFAULT_CONN_TIMEOUT = 2
 DEFAULT_IDLE_TIMEOUT = 5
+DEFAULT_MAX_SERVER_CONNECTIONS = connection_pool.DEFAULT_MAX_CONNECTIONS
+DEFAULT_KEEPALIVE_TIMEOUT = connection_pool.DEFAULT_IDLE_TIMEOUT
+DEFAULT_READ_AHEAD_BLOCKS = 4
+DEFAULT_READ_AHEAD_BLOCK_SIZE = 256 # KiB
 
 
 class FileReaderHTTPCachedPlug(log.Loggable):
@@ -49,6 +55,7 @@ class FileReaderHTTPCachedPlug(log.Loggable):
      - Load-balanced HTTP servers with priority level (fall-back).
      - More than one IP by server hostname with periodic DNS refresh.
      - Connection resuming if HTTP connection got disconnected.
+     - Persistent HTTP connections reused between requests.
     """
 
     logCategory = LOG_CATEGORY
@@ -115,14 +122,27 @@ class FileReaderHTTPCachedPlug(log.Loggable):
         connTimeout = props.get('connection-timeout', DEFAULT_CONN_TIMEOUT)
         idleTimeout = props.get('idle-timeout', DEFAULT_IDLE_TIMEOUT)
 
-        client = http_client.StreamRequester(connTimeout, idleTimeout)
+        maxConnections = props.get('max-server-connections',
+                                   DEFAULT_MAX_SERVER_CONNECTIONS)
+        keepAliveTimeout = props.get('keepalive-timeout',
+                                     DEFAULT_KEEPALIVE_TIMEOUT)
+
+        pool = connection_pool.ConnectionPool(self.stats, maxConnections,
+                                              keepAliveTimeout, connTimeout)
+        client = http_client.StreamRequester(connTimeout, idleTimeout, pool)
 
         reqmgr = request_manager.RequestManager(selector, client)
 
         cacheTTL = props.get('cache-ttl', DEFAULT_CACHE_TTL)
+        staleTTL = props.get('stale-ttl', DEFAULT_STALE_TTL)
+        readAhead = props.get('read-ahead-blocks', DEFAULT_READ_AHEAD_BLOCKS)
+        blockSize = props.get('read-ahead-block-size',
+                              DEFAULT_READ_AHEAD_BLOCK_SIZE) * 1024
 
         self.strategy = strategy_basic.CachingStrategy(self.cachemgr,
-                                                       reqmgr, cacheTTL)
+                                                       reqmgr, cacheTTL,
+                                                       readAhead, blockSize,
+                                                       staleTTL)
 
         self.resmgr = resource_manager.ResourceManager(self.strategy,
                                                        self.stats)
@@ -18,13 +18,14 @@
 import datetime
 import cgi
 
-from twisted.internet import defer, protocol, reactor
+from twisted.internet import defer, reactor
 from twisted.python.util import InsensitiveDict
 from twisted.web import http
 
 from flumotion.common import log
 from flumotion.common import errors
 from flumotion.component.misc.httpserver.httpcached import common
+from flumotion.component.misc.httpserver.httpcached import connection_pool
 from flumotion.component.misc.httpserver.httpcached import http_utils
 
 
@@ -94,14 +95,20 @@ class StreamInfo(object):
 
 class StreamRequester(log.Loggable):
     """
-    Allows retrieval of data streams using HTTP 1.0.
+    Allows retrieval of data streams using HTTP 1.1,
+    through persistent connections kept in a ConnectionPool.
     """
 
     logCategory = LOG_CATEGORY
 
-    def __init__(self, connTimeout=0, idleTimeout=0):
+    def __init__(self, connTimeout=0, idleTimeout=0, pool=None):
         self.connTimeout = connTimeout
         self.idleTimeout = idleTimeout
+        if pool is None:
+            if not connTimeout:
+                connTimeout = connection_pool.DEFAULT_CONN_TIMEOUT
+            pool = connection_pool.ConnectionPool(connTimeout=connTimeout)
+        self.pool = pool
 
     def retrieve(self, consumer, url, proxyAddress=None, proxyPort=None,
                  ifModifiedSince=None, ifUnmodifiedSince=None,
@@ -118,18 +125,22 @@ class StreamRequester(log.Loggable):
 
         getter = StreamGetter(consumer, url,
                               ifModifiedSince, ifUnmodifiedSince,
-                              start, size, self.idleTimeout)
-        getter.connect(proxyAddress, proxyPort, self.connTimeout)
+                              start, size, self.idleTimeout, self.pool)
+        getter.connect(proxyAddress, proxyPort)
         return getter
 
+    def cleanup(self):
+        self.pool.close()
 
-class StreamGetter(protocol.ClientFactory, http.HTTPClient, log.Loggable):
+
+class StreamGetter(log.Loggable):
     """
-    Retrieves a stream using HTTP 1.0.
+    Retrieves a stream using HTTP 1.1.
 
-    This class is at the same time a Factory and a Protocol,
-    this can be done because it's a client and in twisted
-    client factories only create on protocol.
+    The request is sent through a connection from a ConnectionPool;
+    I'm given the response by the connection as if I were its protocol.
+    If a reused connection is closed by the server before answering,
+    the request is sent again once through a new connection.
 
     The outcome, the stream info and stream data is forwarded
     to a common.StreamConsumer instance given at creating time.
@@ -147,7 +158,7 @@ class StreamGetter(protocol.ClientFactory, http.HTTPClient, log.Loggable):
 
     def __init__(self, consumer, url,
                  ifModifiedSince=None, ifUnmodifiedSince=None,
-                 start=None, size=None, timeout=0):
+                 start=None, size=None, timeout=0, pool=None):
         self.consumer = consumer
         self.url = url
 
@@ -157,6 +168,7 @@ class StreamGetter(protocol.ClientFactory, http.HTTPClient, log.Loggable):
         self.start = start
         self.size = size
         self.timeout = timeout
+        self.pool = pool
 
         self.headers = {}
         self.peer = None
@@ -167,6 +179,10 @@ class StreamGetter(protocol.ClientFactory, http.HTTPClient, log.Loggable):
         self._canceled = False
         self._remaining = None
         self._idlecheck = None
+        self._acquiring = None
+        self._connection = None
+        self._reused = False
+        self._retried = False
 
         self.logName = common.log_id(self) # To be able to track the instance
 
@@ -175,7 +191,7 @@ class StreamGetter(protocol.ClientFactory, http.HTTPClient, log.Loggable):
 
     ### Public Methods ###
 
-    def connect(self, proxyAddress=None, proxyPort=None, timeout=0):
+    def connect(self, proxyAddress=None, proxyPort=None):
         assert not self._connected, "Already connected"
         self._connected = True
         url = self.url
@@ -187,62 +203,41 @@ class StreamGetter(protocol.ClientFactory, http.HTTPClient, log.Loggable):
         else:
             self.log("Connecting to %s:%s for %s",
                      self.host, self.port, self.url)
-            reactor.connectTCP(self.host, self.port, self, timeout)
+            self._acquire()
 
     def pause(self):
-        if not self.paused and self.transport is not None:
-            self.pauseProducing()
+        connection = self._connection
+        if connection is not None and not connection.paused:
+            connection.pauseProducing()
             self.log("Request paused for %s", self.url)
 
     def resume(self):
-        if self.paused and self.transport is not None:
-            self.resumeProducing()
+        connection = self._connection
+        if connection is not None and connection.paused:
+            connection.resumeProducing()
             self.log("Request resumed for %s", self.url)
 
     def cancel(self):
-        if self._connected and self.transport is not None:
-            self.transport.loseConnection()
+        self._canceled = True
+        self._release()
         self._cancelIdleCheck()
         self.log("Request canceled for %s", self.url)
-        self._canceled = True
-
-    ### Overridden Methods ###
-
-    def buildProtocol(self, addr):
-        assert self.peer is None, "Protocol already built"
-        self.peer = addr
-        return self
-
-    def clientConnectionFailed(self, connector, reason):
-        self._serverError(common.SERVER_UNAVAILABLE, reason.getErrorMessage())
 
-    def connectionMade(self):
-        self.log("Connection made for %s", self.url)
-        self.sendCommand(self.HTTP_METHOD, self.url.location)
-        self.sendHeader('Host', self.url.host)
-        self.sendHeader('User-Agent', USER_AGENT)
-        self.sendHeader('Connection', "close") # Pipeline not yet supported
-
-        if self.ifModifiedSince:
-            datestr = http.datetimeToString(self.ifModifiedSince)
-            self.sendHeader('If-Modified-Since', datestr)
-
-        if self.ifUnmodifiedSince:
-            datestr = http.datetimeToString(self.ifUnmodifiedSince)
-            self.sendHeader('If-Unmodified-Since', datestr)
-
-        if self.start or self.size:
-            start = self.start or 0
-            end = (self.size and (start + self.size - 1)) or None
-            rangeSpecs = "bytes=%s-%s" % (start, end or "")
-            self.sendHeader('Range', rangeSpecs)
-
-        self.endHeaders()
-
-        self._resetIdleCheck()
+    ### Connection Handler Methods ###
 
     def connectionLost(self, reason):
         self.log("Connection lost for %s", self.url)
+        self._connection = None
+        if self._reused and self.status is None and not self._canceled \
+                and not self._retried:
+            # The server closed the idle connection
+            # at the same time the request was sent
+            self.log("Reused connection closed before any response, "
+                     "retrying with a new connection")
+            self._retried = True
+            self._cancelIdleCheck()
+            self._acquire(fresh=True)
+            return
         self.handleResponseEnd()
         if not self._canceled:
             self._serverError(common.SERVER_DISCONNECTED,
@@ -318,6 +313,7 @@ class StreamGetter(protocol.ClientFactory, http.HTTPClient, log.Loggable):
             self._onData(data)
 
     def handleResponseEnd(self):
+        self._connection = None
         if self.info is not None:
             if self._remaining == 0:
                 self.log("Request done, got %d bytes starting at %d from %s, "
@@ -333,12 +329,62 @@ class StreamGetter(protocol.ClientFactory, http.HTTPClient, log.Loggable):
         else:
             self.log("Incomplete request %s", self.url.toString())
 
-    def sendCommand(self, command, path):
-        # We want HTTP/1.1 for conditional GET and range requests
-        self.transport.write('%s %s HTTP/1.1\r\n' % (command, path))
-
     ### Private Methods ###
 
+    def _acquire(self, fresh=False):
+        d = self.pool.acquire(self.host, self.port, fresh)
+        self._acquiring = d
+        d.addCallbacks(self._gotConnection, self._acquireFailed)
+
+    def _gotConnection(self, connection):
+        self._acquiring = None
+        self._connection = connection
+        self._reused = connection.requestCount > 0
+        self.peer = connection.transport.getPeer()
+        self.log("Sending request for %s through %s",
+                 self.url, connection.logName)
+        connection.request(self, self.HTTP_METHOD, self.url.location,
+                           self._getRequestHeaders())
+        self._resetIdleCheck()
+
+    def _acquireFailed(self, failure):
+        self._acquiring = None
+        if failure.check(defer.CancelledError):
+            return
+        if failure.check(connection_pool.PoolTimeoutError):
+            self._serverError(common.SERVER_TIMEOUT,
+                              failure.getErrorMessage())
+            return
+        self._serverError(common.SERVER_UNAVAILABLE,
+                          failure.getErrorMessage())
+
+    def _getRequestHeaders(self):
+        headers = [('Host', self.url.host),
+                   ('User-Agent', USER_AGENT)]
+
+        if self.ifModifiedSince:
+            datestr = http.datetimeToString(self.ifModifiedSince)
+            headers.append(('If-Modified-Since', datestr))
+
+        if self.ifUnmodifiedSince:
+            datestr = http.datetimeToString(self.ifUnmodifiedSince)
+            headers.append(('If-Unmodified-Since', datestr))
+
+        if self.start or self.size:
+            start = self.start or 0
+            end = (self.size and (start + self.size - 1)) or None
+            rangeSpecs = "bytes=%s-%s" % (start, end or "")
+            headers.append(('Range', rangeSpecs))
+
+        return headers
+
+    def _release(self):
+        if self._acquiring is not None:
+            self._acquiring.cancel()
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            connection.detach(self)
+
     def _keepActive(self):
         self._updateCount += 1
 
@@ -366,8 +412,7 @@ class StreamGetter(protocol.ClientFactory, http.HTTPClient, log.Loggable):
     def _cancel(self):
         self._cancelIdleCheck()
         if self.consumer:
-            if self.transport:
-                self.transport.loseConnection()
+            self._release()
             self.consumer = None
 
     def _serverError(self, code, message):
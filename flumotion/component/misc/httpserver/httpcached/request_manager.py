@@ -16,6 +16,8 @@
 # Headers in this file shall remain intact.
 
 
+import time
+
 from flumotion.common import log
 from flumotion.component.misc.httpserver.httpcached import common
 from flumotion.component.misc.httpserver.httpcached import http_utils
@@ -58,6 +60,7 @@ class RequestManager(log.Loggable):
         return self.selector.setup()
 
     def cleanup(self):
+        self.client.cleanup()
         return self.selector.cleanup()
 
 
@@ -79,6 +82,8 @@ class ConsumerManager(common.StreamConsumer, log.Loggable):
         self.current_request = None
         self.last_error = None
         self.last_message = None
+        self._requestTime = None
+        self._answered = False
 
         self.logName = common.log_id(self) # To be able to track the instance
 
@@ -108,6 +113,9 @@ class ConsumerManager(common.StreamConsumer, log.Loggable):
                            self.current_server.port)
             proxy_address = s.ip
             proxy_port = s.port
+            s.onRequestStarted()
+            self._requestTime = time.time()
+            self._answered = False
             self.current_request =\
                 self.client.retrieve(self, self.url,
                                      proxyAddress=proxy_address,
@@ -135,19 +143,23 @@ class ConsumerManager(common.StreamConsumer, log.Loggable):
         self.debug("Canceling request %s", self.url)
         self.current_request.cancel()
         self.current_request = None
+        self._requestFinished()
 
     def serverError(self, getter, code, message):
         self.debug("Server Error %s (%s) for %s using %s:%s",
                    message, code, self.url, getter.host, getter.port)
         self.last_error = code
         self.last_message = message
-        if code in (common.SERVER_DISCONNECTED,
-                    common.SERVER_TIMEOUT):
+        startTime = self._requestTime
+        self._requestFinished()
+        self.current_server.reportError(code, startTime)
+        if (code == common.SERVER_DISCONNECTED
+            or (code == common.SERVER_TIMEOUT and self._answered)):
             # The connection was established
             # and data may have already been received.
             self.consumer.serverError(self, code, message)
             return
-        self.current_server.reportError(code)
+        # Nothing was received from this server, try the next one
         self.retrieve()
 
     def conditionFail(self, getter, code, message):
@@ -155,17 +167,22 @@ class ConsumerManager(common.StreamConsumer, log.Loggable):
             return
         self.log("Condition Error %s (%s) for %s",
                  message, code, self.url)
+        self._serverAnswered()
+        self._requestFinished()
         self.consumer.conditionFail(self, code, message)
 
     def streamNotAvailable(self, getter, code, message):
         if self.current_request is None:
             return
         self.log("Stream not available \"%s\" for %s", message, self.url)
+        self._serverAnswered()
+        self._requestFinished()
         self.consumer.streamNotAvailable(self, code, message)
 
     def onInfo(self, getter, info):
         if self.current_request is None:
             return
+        self._serverAnswered()
         self.consumer.onInfo(self, info)
 
     def onData(self, getter, data):
@@ -176,4 +193,16 @@ class ConsumerManager(common.StreamConsumer, log.Loggable):
     def streamDone(self, getter):
         if self.current_request is None:
             return
+        self._requestFinished()
         self.consumer.streamDone(self)
+
+    def _serverAnswered(self):
+        if not self._answered and self._requestTime is not None:
+            self._answered = True
+            self.current_server.reportSuccess(time.time() - self._requestTime)
+
+    def _requestFinished(self):
+        # Only once by server tried
+        if self._requestTime is not None:
+            self._requestTime = None
+            self.current_server.onRequestFinished()
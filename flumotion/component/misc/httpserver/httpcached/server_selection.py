@@ -19,14 +19,35 @@
 import operator
 import random
 import socket
+import time
 
 from twisted.internet import base, defer, threads, reactor
 from twisted.python import threadpool
 from flumotion.common import log
+from flumotion.component.misc.httpserver.httpcached import common
 
 DEFAULT_PRIORITY = 1.0
 DEFAULT_REFRESH_TIMEOUT = 300
 
+# Weight of a new sample in the latency and error rate moving averages
+STATS_WEIGHT = 0.2
+# Latency in seconds assumed for a server before its first response
+DEFAULT_LATENCY = 0.1
+# How much the error rate makes a server look slower
+ERROR_PENALTY = 10.0
+# Consecutive errors after which a server is not used anymore
+CIRCUIT_MAX_FAILURES = 3
+# Seconds before trying again a server not used anymore,
+# doubled each time the new try fails
+CIRCUIT_MIN_DELAY = 5
+CIRCUIT_MAX_DELAY = 120
+# Seconds the statistics of a server no longer resolved are kept
+KNOWN_SERVER_TIMEOUT = 3600
+
+# Errors telling something about the health of the server
+HEALTH_ERRORS = (common.SERVER_UNAVAILABLE, common.SERVER_DISCONNECTED,
+                 common.SERVER_TIMEOUT, common.INTERNAL_ERROR)
+
 LOG_CATEGORY = "server-selector"
 
 
@@ -60,6 +81,9 @@ class ServerSelector(log.Loggable):
     def __init__(self, timeout=DEFAULT_REFRESH_TIMEOUT, sk=socket):
         self.servers = {}
         self.hostnames = {}
+        # (ip, port, priority) -> Server, to keep their statistics
+        # when DNS refreshes remove and add them again
+        self._known = {}
         self.timeout = timeout
         self.socket = socket
 
@@ -69,11 +93,11 @@ class ServerSelector(log.Loggable):
     def _addCallback(self, h, hostname, port, priority):
         ip_list = h[2]
         for ip in ip_list:
-            s = Server(ip, port, priority)
+            s = self._getServer(ip, port, priority)
             if s not in self.servers[priority]:
                 self.servers[priority].append(s)
 
-        self.hostnames[hostname] = (ip_list, priority, port)
+        self.hostnames[hostname] = (list(ip_list), priority, port)
 
     def _addErrback(self, err):
         self.warning("Could not resolve host %s",
@@ -101,32 +125,76 @@ class ServerSelector(log.Loggable):
         """
         Order the looked up servers by priority, and return them.
 
+        Within a priority, the servers are ordered by the power of two
+        choices: of two random servers, the one with the least cost
+        comes first. The servers that failed too many times come after
+        all the others, in case no other server answers.
+
         @return a generator of Server
         """
+        now = time.time()
+        unavailable = []
         priorities = self.servers.keys()
         priorities.sort()
         for p in priorities:
-            servers = self.servers[p]
-            random.shuffle(servers)
-            for s in servers:
+            available = []
+            for s in self.servers[p]:
+                if s.isAvailable(now):
+                    available.append(s)
+                else:
+                    unavailable.append(s)
+            for s in self._orderByLoad(available):
                 yield s
+        unavailable.sort(key=operator.attrgetter('retryTime'))
+        for s in unavailable:
+            yield s
+
+    def _orderByLoad(self, servers):
+        servers = list(servers)
+        ordered = []
+        while len(servers) > 1:
+            a, b = random.sample(servers, 2)
+            if b.getCost() < a.getCost():
+                a = b
+            servers.remove(a)
+            ordered.append(a)
+        ordered.extend(servers)
+        return ordered
+
+    def _getServer(self, ip, port, priority):
+        key = (ip, port, priority)
+        if key not in self._known:
+            self._known[key] = Server(ip, port, priority)
+        server = self._known[key]
+        server.lastSeen = time.time()
+        return server
+
+    def _pruneKnown(self, _=None):
+        # Forget the servers not resolved for a while
+        limit = time.time() - KNOWN_SERVER_TIMEOUT
+        used = []
+        for servers in self.servers.values():
+            used.extend(servers)
+        for key, server in self._known.items():
+            if server not in used and server.lastSeen < limit:
+                del self._known[key]
 
     def _refreshCallback(self, host, hostname):
-        # FIXME: improve me, avoid data duplication, Server info loss..
         new_ips = host[2]
         old_ips, priority, port = self.hostnames[hostname]
         to_be_added = [ip for ip in new_ips if ip not in old_ips]
         to_be_removed = [ip for ip in old_ips if ip not in new_ips]
         servers = self.servers[priority]
         for ip in to_be_added:
-            servers.append(Server(ip, port, priority))
-            self.hostnames[hostname][0].append(ip)
+            s = self._getServer(ip, port, priority)
+            if s not in servers:
+                servers.append(s)
+            old_ips.append(ip)
         for ip in to_be_removed:
-            for s in servers:
-                if s.ip == ip:
+            for s in servers[:]:
+                if s.ip == ip and s.port == port:
                     servers.remove(s)
-                    self.hostnames[hostname][0].remove(ip)
-        self.servers[priority] = servers
+            old_ips.remove(ip)
 
     def refreshServers(self):
         dl = []
@@ -137,6 +205,7 @@ class ServerSelector(log.Loggable):
             dl.append(d)
         self._resetRefresh()
         d = defer.DeferredList(dl)
+        d.addCallback(self._pruneKnown)
         d.addCallback(lambda _: self)
         return d
 
@@ -157,17 +226,108 @@ class ServerSelector(log.Loggable):
 
 
 class Server(object):
+    """
+    An address of an HTTP server, with statistics about the requests
+    sent to it: the moving averages of its latency and error rate, and
+    the number of requests in progress.
+
+    After CIRCUIT_MAX_FAILURES consecutive errors the server is not
+    available until retryTime. Then one request at a time is sent to it;
+    if it fails the server is unavailable for twice as long, and if
+    it succeeds the server is used again, less than the others until
+    its error rate gets lower. The failures of the requests started
+    before the server stopped being used tell nothing new, and are
+    ignored.
+    """
 
     def __init__(self, ip, port, priority):
         self.ip = ip
         self.port = port
         self.priority = priority
 
-    def reportError(self, code):
-        pass
+        self.outstanding = 0
+        self.latency = None
+        self.errorRate = 0.0
+        self.requestCount = 0
+        self.errorCount = 0
+        self.failures = 0
+        self.retryTime = None
+        self.retryDelay = CIRCUIT_MIN_DELAY
+        self.lastSeen = time.time()
+
+    def isAvailable(self, now=None):
+        if self.retryTime is None:
+            return True
+        if now is None:
+            now = time.time()
+        # Only one request at a time to see if it's back
+        return now >= self.retryTime and self.outstanding == 0
+
+    def getCost(self):
+        """
+        @returns: the expected time for a new request, given the requests
+                  in progress, the latency and the error rate
+        """
+        latency = self.latency or DEFAULT_LATENCY
+        return ((self.outstanding + 1) * latency
+                * (1.0 + ERROR_PENALTY * self.errorRate))
+
+    def onRequestStarted(self):
+        self.outstanding += 1
+        self.requestCount += 1
+
+    def onRequestFinished(self):
+        self.outstanding = max(self.outstanding - 1, 0)
+
+    def reportSuccess(self, latency):
+        """
+        Called when the server answered a request.
+
+        @param latency: the seconds it took to answer
+        """
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += STATS_WEIGHT * (latency - self.latency)
+        self.errorRate -= STATS_WEIGHT * self.errorRate
+        self.failures = 0
+        if self.retryTime is not None:
+            log.info(LOG_CATEGORY, "Server %s:%d is back", self.ip, self.port)
+            self.retryTime = None
+            self.retryDelay = max(self.retryDelay / 2, CIRCUIT_MIN_DELAY)
+
+    def reportError(self, code, startTime=None):
+        """
+        Called when a request to the server failed.
+
+        @param code:      the error code
+        @param startTime: when the request was sent, or None if unknown
+        """
+        if code not in HEALTH_ERRORS:
+            return
+        if self.retryTime is not None and startTime is not None \
+                and startTime < self.retryTime:
+            # Already in progress when the server stopped being used
+            return
+        self.errorCount += 1
+        self.errorRate += STATS_WEIGHT * (1.0 - self.errorRate)
+        self.failures += 1
+        if self.retryTime is not None:
+            # The request trying the server again failed
+            self.retryDelay = min(self.retryDelay * 2, CIRCUIT_MAX_DELAY)
+        elif self.failures < CIRCUIT_MAX_FAILURES:
+            return
+        log.info(LOG_CATEGORY, "Server %s:%d failed %d times, "
+                 "not using it for %d seconds", self.ip, self.port,
+                 self.failures, self.retryDelay)
+        self.retryTime = time.time() + self.retryDelay
 
     def __repr__(self):
         return "<%s: %s:%d>" % (type(self).__name__, self.ip, self.port)
 
     def __eq__(self, other):
-        return self.__dict__ == other.__dict__
+        return ((self.ip, self.port, self.priority)
+                == (other.ip, other.port, other.priority))
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
@@ -15,6 +15,7 @@
 #
 # Headers in this file shall remain intact.
 
+import heapq
 import stat
 from cStringIO import StringIO
 import time
@@ -36,6 +37,11 @@ MAX_RESUME_COUNT = 20
 # produce faster than 6.25 Mibit/s (6.55 Mbit/s)
 PRODUCING_PERIOD = 0.08
 
+# Size of the blocks fetched ahead of the readers
+READAHEAD_BLOCK_SIZE = 256 * 1024
+# Minimum number of blocks kept for the readers of a resource
+MIN_CACHED_BLOCKS = 8
+
 
 class ConditionError(Exception):
     """
@@ -61,13 +67,29 @@ class CachingStrategy(log.Loggable):
 
     logCategory = "base-caching"
 
-    def __init__(self, cachemgr, reqmgr, ttl):
+    def __init__(self, cachemgr, reqmgr, ttl, readAhead=0,
+                 blockSize=READAHEAD_BLOCK_SIZE, staleTTL=0):
+        """
+        @param readAhead: number of blocks fetched ahead of the readers
+                          of resources not cached yet, 0 to disable
+        @param blockSize: size of these blocks
+        @param staleTTL:  time in seconds an expired cached file is still
+                          served right away while being checked for
+                          expiration in the background, 0 to disable
+        """
         self.cachemgr = cachemgr
         self.reqmgr = reqmgr
         self.ttl = ttl
+        self.readAhead = readAhead
+        self.blockSize = blockSize
+        self.staleTTL = staleTTL
 
         self._identifiers = {} # {IDENTIFIER: CachingSession}
         self._etimes = {} # {IDENTIFIER: EXPIRATION_TIME}
+        # Heap of (EXPIRATION_TIME, IDENTIFIER), entries for identifiers
+        # kept alive again are only removed when they expire
+        self._expirations = []
+        self._blockCaches = {} # {(IDENTIFIER, MTIME): BlockCache}
 
         self._cleanupCall = None
 
@@ -80,6 +102,9 @@ class CachingStrategy(log.Loggable):
         self.reqmgr.cleanup()
         for session in self._identifiers.values():
             session.cancel()
+        for cache in self._blockCaches.values():
+            cache.close()
+        self._blockCaches = {}
         return self
 
     def getSourceFor(self, url, stats):
@@ -120,8 +145,36 @@ class CachingStrategy(log.Loggable):
     def getSessions(self):
         return self._identifiers.values()
 
+    def getBlockCache(self, source):
+        """
+        Get the block cache shared by the readers of the same version
+        of a resource. It has to be released with L{releaseBlockCache}.
+
+        @param source: the data source or caching session of the resource
+        @rtype: L{BlockCache}
+        """
+        key = (source.identifier, source.mtime)
+        cache = self._blockCaches.get(key, None)
+        if cache is None:
+            maxBlocks = max(MIN_CACHED_BLOCKS, self.readAhead * 2)
+            cache = BlockCache(self.reqmgr, source.url, source.size,
+                               source.mtime, self.blockSize, maxBlocks)
+            cache.key = key
+            self._blockCaches[key] = cache
+        cache.addref()
+        return cache
+
+    def releaseBlockCache(self, cache):
+        cache.delref()
+        if not cache.isref():
+            cache.close()
+            if self._blockCaches.get(cache.key, None) is cache:
+                del self._blockCaches[cache.key]
+
     def keepCacheAlive(self, identifier, ttl=None):
-        self._etimes[identifier] = time.time() + (ttl or self.ttl)
+        etime = time.time() + (ttl or self.ttl)
+        self._etimes[identifier] = etime
+        heapq.heappush(self._expirations, (etime, identifier))
 
     ### To Be Overridden ###
 
@@ -131,6 +184,9 @@ class CachingStrategy(log.Loggable):
     def _onCacheOutdated(self, url, identifier, cachedFile, stats):
         raise NotImplementedError()
 
+    def _onCacheStale(self, url, identifier, cachedFile):
+        raise NotImplementedError()
+
     ### Protected Methods ###
 
     def _startCleanupLoop(self):
@@ -149,10 +205,12 @@ class CachingStrategy(log.Loggable):
         self._startCleanupLoop()
 
     def _cleanupExpirationTable(self):
-        now = time.time()
-        expired = [i for i, e in self._etimes.items() if e < now]
-        for ident in expired:
-            del self._etimes[ident]
+        # Expired entries are kept while the cached files can be served stale
+        limit = time.time() - self.staleTTL
+        while self._expirations and self._expirations[0][0] < limit:
+            etime, ident = heapq.heappop(self._expirations)
+            if self._etimes.get(ident, None) == etime:
+                del self._etimes[ident]
 
     def _onNewSession(self, session):
         identifier = session.identifier
@@ -183,11 +241,19 @@ class CachingStrategy(log.Loggable):
             self.log("Opened cached file '%s'", cachedFile.name)
             etime = self._etimes.get(identifier, None)
             session = self._identifiers.get(identifier, None)
-            if (etime and (etime > time.time()) or
+            now = time.time()
+            if (etime and (etime > now) or
                 (session and session.checkModified)):
                 stats.onStarted(cachedFile.stat[stat.ST_SIZE],
                                 cachestats.CACHE_HIT)
                 return CachedSource(identifier, url, cachedFile, stats)
+            if etime and (etime + self.staleTTL > now):
+                self.debug("Cached file expired, serving it while checking "
+                           "for expiration '%s'", cachedFile.name)
+                self._onCacheStale(url, identifier, cachedFile)
+                stats.onStarted(cachedFile.stat[stat.ST_SIZE],
+                                cachestats.CACHE_HIT)
+                return CachedSource(identifier, url, cachedFile, stats)
             self.debug("Cached file may have expired '%s'", cachedFile.name)
             return self._onCacheOutdated(url, identifier, cachedFile, stats)
         self.debug("Resource not cached '%s'", url)
@@ -245,6 +311,7 @@ class BaseRemoteSource(resource_manager.DataSource):
     strategy = None
     session = None
     stats = None
+    readAhead = None
 
     def produce(self, consumer, offset):
         return RemoteProducer(consumer, self.session, offset, self.stats)
@@ -261,11 +328,24 @@ class BaseRemoteSource(resource_manager.DataSource):
             self.session._correction -= diff
             self.stats.onBytesRead(0, size, diff) # from cache
             return data
-        d = self.strategy.requestData(self.url, offset, size, self.mtime)
+        if self.strategy.readAhead:
+            if self.readAhead is None:
+                cache = self.strategy.getBlockCache(self)
+                self.readAhead = ReadAhead(cache, self.strategy.readAhead)
+            d = self.readAhead.read(offset, size)
+            if not isinstance(d, defer.Deferred):
+                return self._requestDataCb(d)
+        else:
+            d = self.strategy.requestData(self.url, offset, size, self.mtime)
         d.addCallback(self._requestDataCb)
         d.addErrback(self._requestDataFailed)
         return d
 
+    def _releaseReadAhead(self):
+        if self.readAhead is not None:
+            self.strategy.releaseBlockCache(self.readAhead.cache)
+            self.readAhead = None
+
     def _requestDataFailed(self, failure):
         if failure.check(fileprovider.FileOutOfDate):
             self.session.cancel()
@@ -296,6 +376,7 @@ class RemoteSource(BaseRemoteSource):
 
     def close(self):
         self.stats.onClosed()
+        self._releaseReadAhead()
         self.session.delref()
         self.session = None
 
@@ -786,6 +867,10 @@ class RemoteProducer(common.StreamConsumer, log.Loggable):
 
     It can recover request failures up to MAX_RESUME_COUNT times.
 
+    If the strategy reads ahead, the data not cached by the session
+    is produced by block from the strategy block cache instead,
+    prefetching the next blocks while not paused.
+
     It's not used yet in the context of http-server.
     Until now, the simulations show that using a producer with
     long-lived HTTP requests instead of short lived block request
@@ -800,12 +885,15 @@ class RemoteProducer(common.StreamConsumer, log.Loggable):
         self.offset = offset
         self.session = session
         self.stats = stats
+        self.strategy = session.strategy
         self.reqmgr = session.strategy.reqmgr
 
         self.logName = common.log_id(self) # To be able to track the instance
 
         self._pipelining = False
         self._paused = False
+        self._readAhead = None
+        self._reading = False
         self._request = None
         self._produced = 0
         self._resumes = MAX_RESUME_COUNT
@@ -837,8 +925,11 @@ class RemoteProducer(common.StreamConsumer, log.Loggable):
                 # Start a new one
                 self._pipeline()
         else:
-            # Producing from session
-            self._produce()
+            if self._readAhead is not None:
+                self._readAhead.resume()
+            if not self._reading:
+                # Producing from session
+                self._produce()
 
     def pauseProducing(self):
         if self.consumer is None:
@@ -852,6 +943,8 @@ class RemoteProducer(common.StreamConsumer, log.Loggable):
             if self._request:
                 self._request.pause()
         else:
+            if self._readAhead is not None:
+                self._readAhead.pause()
             # Producing from session
             self._stop()
 
@@ -931,6 +1024,10 @@ class RemoteProducer(common.StreamConsumer, log.Loggable):
                                  abstract.FileDescriptor.bufferSize)
 
         if data is None:
+            if self.strategy.readAhead:
+                # The session can't serve the data, read it by block
+                self._produceAhead()
+                return
             # The session can't serve the data, start pipelining
             self._pipeline()
             return
@@ -945,6 +1042,40 @@ class RemoteProducer(common.StreamConsumer, log.Loggable):
 
         self._call = reactor.callLater(PRODUCING_PERIOD, self._produce)
 
+    def _produceAhead(self):
+        if self._readAhead is None:
+            cache = self.strategy.getBlockCache(self.session)
+            self._readAhead = ReadAhead(cache, self.strategy.readAhead)
+        offset = self.offset + self._produced
+        d = self._readAhead.read(offset, self.strategy.blockSize)
+        if not isinstance(d, defer.Deferred):
+            self._gotBlock(d)
+            return
+        self._reading = True
+        d.addCallbacks(self._gotBlock, self._blockFailed)
+
+    def _gotBlock(self, data):
+        self._reading = False
+        if self.consumer is None:
+            # Already terminated
+            return
+        if data == "":
+            self.log("All data produced by block")
+            self._terminate()
+            return
+        self._write(data)
+        if not self._paused:
+            self._call = reactor.callLater(0, self._produce)
+
+    def _blockFailed(self, failure):
+        self._reading = False
+        if self.consumer is None:
+            # Already terminated
+            return
+        self.warning("Failed to read block of %s: %s",
+                     self.session.url, failure.getErrorMessage())
+        self._terminate()
+
     def _write(self, data):
         size = len(data)
         self._produced += size
@@ -992,6 +1123,10 @@ class RemoteProducer(common.StreamConsumer, log.Loggable):
 
         self._stop() # Stopping producing from session
 
+        if self._readAhead is not None:
+            self.strategy.releaseBlockCache(self._readAhead.cache)
+            self._readAhead = None
+
         expected = self.session.size - self.offset
         if self._produced != expected:
             self.warning("Only produced %s of the %s bytes "
@@ -1030,6 +1165,7 @@ class BlockRequester(common.StreamConsumer, log.Loggable):
         self._mtime = mtime
         self._data = None
         self._deferred = None
+        self._request = None
         self._offset = None
         self._size = None
         self._resumes = MAX_RESUME_COUNT
@@ -1048,6 +1184,15 @@ class BlockRequester(common.StreamConsumer, log.Loggable):
 
         return self._deferred
 
+    def cancel(self):
+        """
+        Cancels the retrieval, the deferred returned by the retrieve
+        method will never be fired.
+        """
+        if self._request is not None:
+            self._request.cancel()
+        self._cleanup()
+
     def serverError(self, getter, code, message):
         assert self._deferred is not None, "Not retrieving anything"
         if code == common.RANGE_NOT_SATISFIABLE:
@@ -1093,9 +1238,196 @@ class BlockRequester(common.StreamConsumer, log.Loggable):
         self._cleanup()
 
     def _retrieve(self):
-        self.reqmgr.retrieve(self, self._url, start=self._offset,
-                             size=self._size, ifUnmodifiedSince=self._mtime)
+        request = self.reqmgr.retrieve(self, self._url, start=self._offset,
+                                       size=self._size,
+                                       ifUnmodifiedSince=self._mtime)
+        if self._deferred is not None:
+            # Not already finished
+            self._request = request
 
     def _cleanup(self):
         self._deferred = None
+        self._request = None
         self._data = None
+
+
+class BlockCache(log.Loggable):
+    """
+    Keeps the last blocks of a resource retrieved using range requests,
+    shared by all the readers of the same version of the resource.
+
+    A block is never requested twice at the same time; readers asking
+    for a block being retrieved wait for the pending request.
+    """
+
+    logCategory = "block-cache"
+
+    def __init__(self, reqmgr, url, size, mtime, blockSize, maxBlocks):
+        self.reqmgr = reqmgr
+        self.url = url
+        self.size = size
+        self.mtime = mtime
+        self.blockSize = blockSize
+        self.maxBlocks = maxBlocks
+        self.key = None
+
+        self.logName = common.log_id(self) # To be able to track the instance
+
+        self._blocks = {} # {INDEX: DATA}
+        self._lru = [] # Block indexes, the most recently used last
+        self._pending = {} # {INDEX: (BlockRequester, [DEFERRED])}
+        self._refcount = 0
+        self._closed = False
+
+    def getBlockCount(self):
+        return (self.size + self.blockSize - 1) // self.blockSize
+
+    def getBlock(self, index):
+        """
+        @return: the data of the block if cached, None otherwise
+        """
+        data = self._blocks.get(index, None)
+        if data is not None:
+            self._lru.remove(index)
+            self._lru.append(index)
+        return data
+
+    def fetch(self, index):
+        """
+        @return: a deferred fired with the data of the block
+        """
+        data = self.getBlock(index)
+        if data is not None:
+            return defer.succeed(data)
+        if self._closed:
+            return defer.fail(fileprovider.FileClosedError("Cache closed"))
+        d = defer.Deferred()
+        if index in self._pending:
+            self._pending[index][1].append(d)
+        else:
+            self._retrieve(index, [d])
+        return d
+
+    def prefetch(self, index):
+        """
+        Starts retrieving a block if it is not cached or pending.
+        """
+        if (self._closed or index >= self.getBlockCount()
+            or index in self._blocks or index in self._pending):
+            return
+        self._retrieve(index, [])
+
+    def close(self):
+        self._closed = True
+        pending = self._pending
+        self._pending = {}
+        for requester, waiters in pending.values():
+            requester.cancel()
+            for d in waiters:
+                d.errback(fileprovider.FileClosedError("Cache closed"))
+        self._blocks = {}
+        self._lru = []
+
+    def addref(self):
+        self._refcount += 1
+
+    def delref(self):
+        self._refcount -= 1
+
+    def isref(self):
+        return self._refcount > 0
+
+    def _retrieve(self, index, waiters):
+        offset = index * self.blockSize
+        size = min(self.blockSize, self.size - offset)
+        self.log("Retrieving block %d (%d bytes at %d) of %s",
+                 index, size, offset, self.url)
+        requester = BlockRequester(self.reqmgr, self.url, self.mtime)
+        self._pending[index] = (requester, waiters)
+        d = requester.retrieve(offset, size)
+        d.addCallbacks(self._blockRetrieved, self._blockFailed,
+                       callbackArgs=(index, ), errbackArgs=(index, ))
+
+    def _blockRetrieved(self, data, index):
+        requester, waiters = self._pending.pop(index, (None, []))
+        if not self._closed:
+            self._blocks[index] = data
+            self._lru.append(index)
+            while len(self._lru) > self.maxBlocks:
+                del self._blocks[self._lru.pop(0)]
+        for d in waiters:
+            d.callback(data)
+
+    def _blockFailed(self, failure, index):
+        requester, waiters = self._pending.pop(index, (None, []))
+        if not waiters:
+            self.debug("Failed to prefetch block %d of %s: %s",
+                       index, self.url, failure.getErrorMessage())
+        for d in waiters:
+            d.errback(failure)
+
+
+class ReadAhead(object):
+    """
+    Sliding read-ahead window of a reader over a L{BlockCache}.
+
+    Reading retrieves the blocks containing the requested data and
+    starts retrieving the next blocks, unless paused, so they are
+    already there when the reader asks for them.
+    Counts the reads that had to wait for data to be retrieved.
+    """
+
+    def __init__(self, cache, blocks):
+        self.cache = cache
+        self.blocks = blocks
+        self.readCount = 0
+        self.stallCount = 0
+
+        self._position = 0 # Index of the block following the last read
+        self._paused = False
+
+    def read(self, offset, size):
+        """
+        @return: the data if all its blocks are cached,
+                 a deferred fired with the data otherwise
+        """
+        end = min(offset + size, self.cache.size)
+        if offset >= end:
+            return ""
+        self.readCount += 1
+        first = offset // self.cache.blockSize
+        last = (end - 1) // self.cache.blockSize
+        self._position = last + 1
+        indexes = range(first, last + 1)
+        blocks = [self.cache.getBlock(i) for i in indexes]
+        if None not in blocks:
+            self._prefetch()
+            return self._extract(blocks, first, offset, end)
+        self.stallCount += 1
+        d = defer.gatherResults([self.cache.fetch(i) for i in indexes],
+                                consumeErrors=True)
+        self._prefetch()
+        d.addCallback(self._extract, first, offset, end)
+        d.addErrback(self._unwrapError)
+        return d
+
+    def pause(self):
+        self._paused = True
+
+    def resume(self):
+        self._paused = False
+        self._prefetch()
+
+    def _prefetch(self):
+        if self._paused:
+            return
+        for index in range(self._position, self._position + self.blocks):
+            self.cache.prefetch(index)
+
+    def _extract(self, blocks, first, offset, end):
+        start = offset - first * self.cache.blockSize
+        return "".join(blocks)[start:start + end - offset]
+
+    def _unwrapError(self, failure):
+        failure.trap(defer.FirstError)
+        return failure.value.subFailure
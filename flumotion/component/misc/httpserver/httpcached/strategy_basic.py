@@ -43,13 +43,21 @@ class CachingStrategy(strategy_base.CachingStrategy):
     and keep alive, if it succeed the cached file is deleted
     and a new caching session is created and started.
 
+    If the cached file expired less than staleTTL seconds ago,
+    it is served right away and the session checking for modifications
+    is started in the background. Only one check is done at a time for
+    a resource, and the cached file is kept if the servers fail.
+
     Updates the caching statistics.
     """
 
     logCategory = LOG_CATEGORY
 
-    def __init__(self, cachemgr, reqmgr, ttl):
-        strategy_base.CachingStrategy.__init__(self, cachemgr, reqmgr, ttl)
+    def __init__(self, cachemgr, reqmgr, ttl, readAhead=0,
+                 blockSize=strategy_base.READAHEAD_BLOCK_SIZE, staleTTL=0):
+        strategy_base.CachingStrategy.__init__(self, cachemgr, reqmgr, ttl,
+                                               readAhead, blockSize,
+                                               staleTTL)
 
     def _onCacheMiss(self, url, stats):
         session = strategy_base.CachingSession(self, url, self.cachemgr.stats)
@@ -113,6 +121,50 @@ class CachingStrategy(strategy_base.CachingStrategy):
         cachedFile.close()
         return failure
 
+    def _onCacheStale(self, url, identifier, cachedFile):
+        self.log("Checking in the background if resource is outdated '%s'",
+                 url)
+        mtime = cachedFile.stat.st_mtime
+        sess = strategy_base.CachingSession(self, url,
+            self.cachemgr.stats, ifModifiedSince=mtime)
+        sess.cache()
+        sess.checkModified = True
+        d = sess.waitStarted()
+        args = (url, identifier, cachedFile)
+        d.addCallbacks(self._staleOutdated, self._staleNotOutdated,
+                       callbackArgs=args, errbackArgs=args)
+
+    def _staleOutdated(self, session, url, identifier, cachedFile):
+        self.debug("Stale resource outdated, caching the new one for '%s'",
+                   url)
+        # New requests will use the session until the resource is cached,
+        # the cached file is closed by the source serving it
+        session.checkModified = False
+        cachedFile.unlink()
+
+    def _staleNotOutdated(self, failure, url, identifier, cachedFile):
+        if failure.check(strategy_base.ConditionError):
+            self.log("Stale resource not outdated, keep using "
+                     "the cached one for '%s'", url)
+            self.keepCacheAlive(identifier)
+            return
+
+        if failure.check(fileprovider.NotFoundError, fileprovider.AccessError):
+            self.debug("Stale resource deleted or forbidden, "
+                       "removing cached file")
+            cachedFile.unlink()
+            return
+
+        if failure.check(fileprovider.FileError):
+            self.warning("Stale cached file expiration check fail, "
+                         "using cached file anyway: %s",
+                         failure.getErrorMessage())
+            self.keepCacheAlive(identifier, EXPIRE_CHECK_TTL)
+            return
+
+        self.warning("Stale cached file expiration check fail: %s",
+                     log.getFailureMessage(failure))
+
     def _filterErrors(self, failure):
         if failure.check(strategy_base.ConditionError):
             raise fileprovider.FileError(failure.getErrorMessage())
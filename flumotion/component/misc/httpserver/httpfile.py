@@ -35,6 +35,7 @@ from flumotion.configure import configure
 from flumotion.common import log
 from flumotion.component.component import moods
 from flumotion.component.misc.httpserver import fileprovider
+from flumotion.component.misc.httpserver import flvindex
 
 # register serializables
 from flumotion.common import messages
@@ -43,6 +44,11 @@ __version__ = "$Rev$"
 
 LOG_CATEGORY = "httpserver"
 
+# Maximum amount of MP4 table data kept by the MP4 index cache
+MP4_INDEX_CACHE_SIZE = 64 * 1024 * 1024
+# Maximum number of start times kept for each MP4 file
+MP4_INDEX_MAX_SPLITS = 32
+
 try:
     resource.ErrorPage
     errorpage = resource
@@ -144,12 +150,9 @@ class File(resource.Resource, log.Loggable):
         self.debug('[fd %5d] (ts %f) incoming request %r',
                    request.transport.fileno(), time.time(), request)
         # Different headers not normally set in static.File...
-        # Specify that we will close the connection after this request, and
-        # that the client must not issue further requests.
-        # We do this because future requests on this server might actually need
-        # to go to a different process (because of the porter)
+        # Whether the connection is kept open for further requests is
+        # decided by the channel
         request.setHeader('Server', 'Flumotion/%s' % configure.version)
-        request.setHeader('Connection', 'close')
 
         d = self._httpauth.startAuthentication(request)
         d.addCallbacks(self._requestAuthenticated, self._authenticationFailed,
@@ -241,12 +244,9 @@ class File(resource.Resource, log.Loggable):
         self.debug("Rendering file %s", self._path)
 
         # Different headers not normally set in static.File...
-        # Specify that we will close the connection after this request, and
-        # that the client must not issue further requests.
-        # We do this because future requests on this server might actually need
-        # to go to a different process (because of the porter)
+        # Whether the connection is kept open for further requests is
+        # decided by the channel
         request.setHeader('Server', 'Flumotion/%s' % configure.version)
-        request.setHeader('Connection', 'close')
         # We can do range requests, in bytes.
         # UGLY HACK FIXME: if pdf, then do not accept range requests
         # because Adobe Reader plugin messes up
@@ -262,6 +262,12 @@ class File(resource.Resource, log.Loggable):
             self.debug('File content type: %r' % contentType)
             request.setHeader('content-type', contentType)
 
+        # range request takes precedence over time seeking
+        if isinstance(provider, fileprovider.TimeIndexedFile) \
+                and request.getHeader('range') is None \
+                and ('start' in request.args or 'end' in request.args):
+            return self._prepareTimeSeek(request, provider)
+
         fileSize = provider.getsize()
         # first and last byte offset we will write
         first = 0
@@ -337,6 +343,44 @@ class File(resource.Resource, log.Loggable):
 
         return d
 
+    def _prepareTimeSeek(self, request, provider):
+        # 'start' and 'end' are UNIX times; without 'end' the file is
+        # followed while it grows, so we can't tell the content length
+        try:
+            start = self._getTimeArgument(request, 'start')
+            stop = self._getTimeArgument(request, 'end')
+        except ValueError:
+            return self.badRequest.render(request)
+        if start is not None and stop is not None and stop <= start:
+            return self.badRequest.render(request)
+
+        d = provider.getHeaders()
+
+        def seekAndSetContentLength(header):
+            byteRange = provider.seekTime(start, stop)
+            if byteRange is None:
+                self.debug("Time range %s-%s not in %s",
+                           start, stop, provider)
+                request.setResponseCode(http.REQUESTED_RANGE_NOT_SATISFIABLE)
+                return ''
+            first, last = byteRange
+            if last is not None:
+                request.setHeader('Content-Length',
+                                  str(len(header) + last - first + 1))
+            request.setResponseRange(first, last, provider.getsize())
+            if request.method == 'HEAD':
+                return ''
+            return self._startRequest(request, header, provider, first, last)
+
+        d.addCallback(seekAndSetContentLength)
+        return d
+
+    def _getTimeArgument(self, request, name):
+        value = request.args.get(name, [None])[0]
+        if value is None:
+            return None
+        return float(value)
+
     def _startRequest(self, request, header, provider, first, last):
         # Call request modifiers
         for modifier in self._requestModifiers:
@@ -389,7 +433,11 @@ class File(resource.Resource, log.Loggable):
             # Set the provider first, because for very small file
             # the transfer could terminate right away.
             request._provider = provider
-            transfer = FileTransfer(provider, last + 1, consumer)
+            # Without a last byte, transfer until the provider's end of file
+            size = None
+            if last is not None:
+                size = last + 1
+            transfer = FileTransfer(provider, size, consumer)
             request._transfer = transfer
 
             # The important NOT_DONE_YET was already returned by the render()
@@ -419,6 +467,10 @@ class File(resource.Resource, log.Loggable):
         request.setHeader("Content-Length", str(last - first + 1))
         return ''
 
+    def _getCacheKey(self, provider):
+        # Providers do not all identify their files when printed, paths do
+        return (str(self._path), provider.getmtime(), provider.getsize())
+
 
 class MimedFileFactory(log.Loggable):
     """
@@ -459,34 +511,170 @@ class FLVFile(File):
     """
     I am a File resource for FLV files.
     I can handle requests with a 'start' GET parameter.
-    This parameter represents the byte offset from where to start.
+    This parameter represents the byte offset from where to start, or the
+    time in seconds if my startUnit is 'seconds'.
     If it is non-zero, I will output an FLV header so the result is
     playable.
+
+    The files are indexed by an L{flvindex.FLVIndexCache} shared by all
+    the FLV files. Once a file is indexed, I start from the keyframe at
+    or before the requested position, and follow the FLV header with an
+    onMetaData tag having the keyframes table, so players can seek again.
+    Until then, byte offsets are used as they are, while time offsets wait
+    for the index. Whole files and ranges are always served as they are,
+    so they agree with each other and with HEAD requests.
     """
     header = 'FLV\x01\x01\000\000\000\x09\000\000\000\x09'
 
+    indexCache = flvindex.FLVIndexCache()
+    startUnit = 'bytes'
+
     def do_prepareBody(self, request, provider, first, last):
         self.log('do_prepareBody for FLV')
-        length = last - first + 1
-        ret = ''
 
-        # if there is a non-zero start get parameter, prefix the body with
-        # our FLV header
+        # range request takes precedence over our start parsing
+        if request.getHeader('range') is not None:
+            request.setHeader("Content-Length", str(last - first + 1))
+            return ''
+
+        start = self._getStart(request)
+        cache = self.indexCache
+        key = self._getCacheKey(provider)
+        if cache.hasIndex(key):
+            return self._prepareStart(request, provider, last, start,
+                                      cache.getIndex(key))
+        d = cache.buildIndex(key, self._path)
+        if start and self.startUnit == 'seconds':
+            self.debug('Waiting for the index of %s', provider)
+            d.addCallback(lambda index: self._prepareStart(
+                request, provider, last, start, index))
+            return d
+        return self._prepareStart(request, provider, last, start, None)
+
+    def _getStart(self, request):
         # each value is a list
+        value = request.args.get('start', ['0'])[0]
         try:
-            start = int(request.args.get('start', ['0'])[0])
+            if self.startUnit == 'seconds':
+                return float(value)
+            return int(value)
         except ValueError:
-            start = 0
-        # range request takes precedence over our start parsing
-        if request.getHeader('range') is None and start:
-            self.debug('Start %d passed, seeking', start)
-            provider.seek(start)
-            length = last - start + 1 + len(self.header)
-            ret = self.header
+            return 0
+
+    def _prepareStart(self, request, provider, last, start, index):
+        offset = None
+        if start:
+            self.debug('Start %r passed, seeking', start)
+            header = self.header
+            if index is not None:
+                if self.startUnit == 'seconds':
+                    offset = index.findTime(start)
+                else:
+                    offset = index.findOffset(start)
+                header += index.getMetadataTag()
+            elif self.startUnit != 'seconds':
+                offset = start
+
+        if offset is None:
+            request.setHeader("Content-Length", str(last + 1))
+            return ''
 
+        provider.seek(offset)
+        length = last - offset + 1 + len(header)
         request.setHeader("Content-Length", str(length))
+        return header
+
+
+class MP4IndexCache(log.Loggable):
+    """
+    I keep, for the MP4 files recently seeked in, the data read to parse
+    their tables and the headers rebuilt for their most requested start
+    times, so seeking again in a popular file doesn't read and parse its
+    tables again.
+
+    The files are identified by a key containing their modification time
+    and size, so a modified file never gets the data of its previous
+    version. I forget the least recently used files first.
+    """
+
+    logCategory = LOG_CATEGORY
 
-        return ret
+    def __init__(self, maxSize=MP4_INDEX_CACHE_SIZE,
+                 maxSplits=MP4_INDEX_MAX_SPLITS):
+        self.maxSize = maxSize
+        self.maxSplits = maxSplits
+        self.size = 0
+        self.readHitCount = 0
+        self.splitHitCount = 0
+        self._entries = {} # {KEY: (READS, SPLITS, [START])}
+        self._lru = [] # Keys, the most recently used last
+
+    def getRead(self, key, offset, size):
+        """
+        @return: the data read at the given offset if cached, None otherwise
+        """
+        entry = self._touch(key)
+        if entry is None:
+            return None
+        data = entry[0].get((offset, size))
+        if data is not None:
+            self.readHitCount += 1
+        return data
+
+    def addRead(self, key, offset, size, data):
+        reads, splits, starts = self._getEntry(key)
+        if (offset, size) not in reads:
+            reads[(offset, size)] = data
+            self._grow(len(data))
+
+    def getSplit(self, key, start):
+        """
+        @return: the rebuilt header and the offset to continue from
+                 for the given start time if cached, None otherwise
+        """
+        entry = self._touch(key)
+        if entry is None:
+            return None
+        split = entry[1].get(start)
+        if split is not None:
+            self.splitHitCount += 1
+            entry[2].remove(start)
+            entry[2].append(start)
+        return split
+
+    def addSplit(self, key, start, header, offset):
+        reads, splits, starts = self._getEntry(key)
+        if start in splits:
+            return
+        splits[start] = (header, offset)
+        starts.append(start)
+        self._grow(len(header))
+        while len(starts) > self.maxSplits:
+            self.size -= len(splits.pop(starts.pop(0))[0])
+
+    def _touch(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._lru.remove(key)
+            self._lru.append(key)
+        return entry
+
+    def _getEntry(self, key):
+        entry = self._touch(key)
+        if entry is None:
+            entry = ({}, {}, [])
+            self._entries[key] = entry
+            self._lru.append(key)
+        return entry
+
+    def _grow(self, size):
+        self.size += size
+        while self.size > self.maxSize and self._lru:
+            key = self._lru.pop(0)
+            reads, splits, starts = self._entries.pop(key)
+            self.debug("Forgetting MP4 tables of %s", key[0])
+            self.size -= sum([len(d) for d in reads.values()])
+            self.size -= sum([len(h) for h, o in splits.values()])
 
 
 class MP4File(File):
@@ -499,8 +687,12 @@ class MP4File(File):
     seconds.  If it is non-zero, I will seek inside the file to the sample with
     that time, and prepend the content with rebuilt MP4 tables, to make the
     output playable.
+    The data read to rebuild the tables and the rebuilt tables are kept in
+    an L{MP4IndexCache} shared by all the MP4 files.
     """
 
+    indexCache = MP4IndexCache()
+
     def do_prepareBody(self, request, provider, first, last):
         self.log('do_prepareBody for MP4')
         length = last - first + 1
@@ -520,13 +712,10 @@ class MP4File(File):
 
             def seekAndSetContentLength(header_and_offset):
                 header, offset = header_and_offset
-                # the header is a file-like object with the file pointer at the
-                # end, the offset is a number
-                length = last - offset + 1 + header.tell()
+                length = last - offset + 1 + len(header)
                 provider.seek(offset)
                 request.setHeader("Content-Length", str(length))
-                header.seek(0)
-                return header.read()
+                return header
 
             def seekingFailed(failure):
                 # swallow the failure and serve the file from the beginning
@@ -544,16 +733,40 @@ class MP4File(File):
             return defer.succeed(ret)
 
     def _split_file(self, provider, start):
+        cache = self.indexCache
+        key = self._getCacheKey(provider)
+        split = cache.getSplit(key, start)
+        if split is not None:
+            self.debug('Using cached MP4 header for start %f', start)
+            return defer.succeed(split)
+
         d = defer.Deferred()
 
         def read_some_data(how_much, from_where):
             if how_much:
+                data = cache.getRead(key, from_where, how_much)
+                if data is not None:
+                    try:
+                        splitter.feed(data)
+                    except:
+                        d.errback(Failure())
+                    return
                 provider.seek(from_where)
                 read_d = provider.read(how_much)
-                read_d.addCallback(splitter.feed)
+                read_d.addCallback(data_read, how_much, from_where)
                 read_d.addErrback(d.errback)
             else:
-                d.callback(splitter.result())
+                # the header is a file-like object with the file pointer at
+                # the end, the offset is a number
+                header, offset = splitter.result()
+                header.seek(0)
+                header = header.read()
+                cache.addSplit(key, start, header, offset)
+                d.callback((header, offset))
+
+        def data_read(data, how_much, from_where):
+            cache.addRead(key, from_where, how_much, data)
+            splitter.feed(data)
 
         splitter = mp4seek.async.Splitter(start)
         splitter.start(read_some_data)
@@ -574,7 +787,8 @@ class FileTransfer(log.Loggable):
         """
         @param provider: an asynchronous file provider
         @type  provider: L{fileprovider.File}
-        @param size: file position to which file should be read
+        @param size: file position to which file should be read,
+                     or None to read until the end of file
         @type  size: int
         @param consumer: consumer to receive the data
         @type  consumer: L{twisted.internet.interfaces.IFinishableConsumer}
@@ -599,7 +813,7 @@ class FileTransfer(log.Loggable):
         pass
 
     def stopProducing(self):
-        self.debug('Stop producing from %s at %d/%d bytes',
+        self.debug('Stop producing from %s at %d/%s bytes',
                    self.provider, self.provider.tell(), self.size)
         # even though it's the consumer stopping us, from looking at
         # twisted code it looks like we still are required to
@@ -612,8 +826,10 @@ class FileTransfer(log.Loggable):
             self._again = True
             return
         self._again = False
-        d = self.provider.read(min(abstract.FileDescriptor.bufferSize,
-                                   self.size - self.written))
+        size = abstract.FileDescriptor.bufferSize
+        if self.size is not None:
+            size = min(size, self.size - self.written)
+        d = self.provider.read(size)
         self._pending = d
         d.addCallbacks(self._cbGotData, self._ebReadFailed)
 
@@ -647,11 +863,18 @@ class FileTransfer(log.Loggable):
         if self._finished:
             return
 
-        if self.provider.tell() == self.size:
+        if self.size is None:
+            if not data:
+                self.debug('Written %d bytes until the end of %s',
+                           self.bytesWritten, self.provider)
+                self._terminate()
+                return
+        elif self.provider.tell() == self.size:
             self.debug('Written entire file of %d bytes from %s',
                        self.size, self.provider)
             self._terminate()
-        elif self._again:
+            return
+        if self._again:
             # Continue producing
             self._produce()
 
@@ -673,7 +896,7 @@ class FileTransfer(log.Loggable):
         self.consumer.write(data)
 
     def _terminate(self):
-        if self.size != self.bytesWritten:
+        if self.size is not None and self.size != self.bytesWritten:
             self.warning("Terminated before writing the full %s bytes, "
                          "only %s byte written", self.size, self.bytesWritten)
         try:
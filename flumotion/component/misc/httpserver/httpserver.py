@@ -31,7 +31,7 @@ from flumotion.component import component
 from flumotion.component.base import http as httpbase
 from flumotion.component.component import moods
 from flumotion.component.misc.httpserver import httpfile, \
-        localprovider, localpath
+        localprovider, localpath, flvindex
 from flumotion.component.misc.httpserver import serverstats
 from flumotion.component.misc.porter import porterclient
 from flumotion.twisted import fdserver
@@ -40,6 +40,10 @@ __version__ = "$Rev$"
 T_ = gettexter()
 
 UPTIME_UPDATE_INTERVAL = 5
+# Seconds an idle persistent connection is kept open
+DEFAULT_KEEP_ALIVE_TIMEOUT = 15
+# Requests served on a persistent connection before closing it
+DEFAULT_KEEP_ALIVE_MAX_REQUESTS = 100
 
 FILEPROVIDER_SOCKET = 'flumotion.component.misc.httpserver' \
                       '.fileprovider.FileProviderPlug'
@@ -88,9 +92,11 @@ class CancellableRequest(server.Request):
         # it can happen that this method will be called with the
         # transport's fd already closed (if the connection is lost
         # early in the request handling)
+        if not self._isResponseComplete():
+            # The client can't find the end of the response, so the
+            # connection can't be used for another request
+            self.channel.persistent = False
         server.Request.finish(self)
-        # We sent Connection: close, so we must close the connection
-        self.transport.loseConnection()
         self.requestCompleted(self.fd)
 
     def connectionLost(self, reason):
@@ -108,6 +114,12 @@ class CancellableRequest(server.Request):
             self._component.requestFinished(self, self.stats.bytesSent,
                                             duration, fd)
 
+    def _isResponseComplete(self):
+        length = self.responseHeaders.getRawHeaders('content-length')
+        if (length is None) or (self.method == 'HEAD'):
+            return True
+        return int(length[0]) == self._bytesWritten
+
     def getLogFields(self):
         headers = self.getAllHeaders()
         duration = (self._completionTime or time.time()) - self._startTime
@@ -132,13 +144,110 @@ class CancellableRequest(server.Request):
         return requestFields
 
 
+class HTTPChannel(http.HTTPChannel):
+    """
+    I am a persistent HTTP connection.
+
+    I serve the requests one after the other: a pipelined request is only
+    parsed once the response to the previous one is finished, so there is
+    never more than one request in progress for a file descriptor.
+    I close the connection after the maximum number of requests of my site.
+    Connections handed over by a porter are kept open too, but as the
+    requests following the first one don't go through the porter any more,
+    I close the connection instead of serving a request for a path my
+    component doesn't handle; clients then retry it with a new connection.
+    """
+
+    def __init__(self):
+        http.HTTPChannel.__init__(self)
+        self.requestCount = 0
+        self.stats = None
+        self._resumeCall = None
+
+    def connectionMade(self):
+        http.HTTPChannel.connectionMade(self)
+        self.factory.channelOpened(self)
+
+    def allHeadersReceived(self):
+        self.requestCount += 1
+        if self.stats is not None:
+            self.stats.onRequestStarted()
+        http.HTTPChannel.allHeadersReceived(self)
+
+    def checkPersistence(self, request, version):
+        persistent = http.HTTPChannel.checkPersistence(self, request,
+                                                       version)
+        if persistent and self.requestCount >= self.factory.maxRequests:
+            request.setHeader('Connection', 'close')
+            return False
+        return persistent
+
+    def allContentReceived(self):
+        if self.requestCount > 1 \
+                and not self.factory.component.servesPath(self._path):
+            self.transport.loseConnection()
+            return
+        # Wait for this request to be finished to parse the next one
+        self.paused = True
+        http.HTTPChannel.allContentReceived(self)
+
+    def requestDone(self, request):
+        http.HTTPChannel.requestDone(self, request)
+        if self.persistent and self._resumeCall is None:
+            # Let the request be completed before starting the next one
+            self._resumeCall = reactor.callLater(0, self._resume)
+
+    def connectionLost(self, reason):
+        if self._resumeCall is not None:
+            self._resumeCall.cancel()
+            self._resumeCall = None
+        http.HTTPChannel.connectionLost(self, reason)
+        self.factory.channelClosed(self)
+
+    def _resume(self):
+        self._resumeCall = None
+        self.paused = False
+        # Parse the requests already received
+        self.dataReceived('')
+
+
 class Site(server.Site):
     requestFactory = CancellableRequest
+    protocol = HTTPChannel
 
-    def __init__(self, resource, component):
-        server.Site.__init__(self, resource)
+    def __init__(self, resource, component,
+                 timeout=DEFAULT_KEEP_ALIVE_TIMEOUT,
+                 maxRequests=DEFAULT_KEEP_ALIVE_MAX_REQUESTS):
+        """
+        @param timeout:     seconds an idle connection is kept open
+        @param maxRequests: the maximum number of requests served
+                            on a connection
+        """
+        server.Site.__init__(self, resource, timeout=timeout)
 
         self.component = component
+        self.maxRequests = maxRequests
+        self._channels = {} # {HTTPChannel: None}
+
+    def channelOpened(self, channel):
+        self._channels[channel] = None
+        if self.component.stats is not None:
+            channel.stats = serverstats.ConnectionStatistics(
+                self.component.stats)
+
+    def channelClosed(self, channel):
+        if channel in self._channels:
+            del self._channels[channel]
+            if channel.stats is not None:
+                channel.stats.onClosed()
+
+    def getConnectionCount(self):
+        return len(self._channels)
+
+    def closeIdleConnections(self):
+        for channel in self._channels.keys():
+            if not channel.requests:
+                channel.transport.loseConnection()
 
 
 class StatisticsUpdater(object):
@@ -228,6 +337,9 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
         self._startTime = time.time()
         self._uptimeCallId = None
         self._allowBrowsing = False
+        self._keepAliveTimeout = DEFAULT_KEEP_ALIVE_TIMEOUT
+        self._keepAliveMaxRequests = DEFAULT_KEEP_ALIVE_MAX_REQUESTS
+        self._site = None
 
         self._description = 'On-Demand Flumotion Stream'
 
@@ -278,6 +390,17 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
                 #            " in conjunction with a file provider plug.")))
                 #self.addMessage(msg)
 
+        unit = props.get('flv-start-unit', 'bytes')
+        if unit not in ('bytes', 'seconds'):
+            msg = "'flv-start-unit' must be 'bytes' or 'seconds', not %r" \
+                % unit
+            return defer.fail(errors.ConfigError(msg))
+        indexDir = props.get('flv-index-dir', None)
+        if indexDir and not os.path.isdir(indexDir):
+            msg = "the directory specified in 'flv-index-dir': %s does " \
+                "not exist" % indexDir
+            return defer.fail(errors.ConfigError(msg))
+
         if props.get('type', 'master') == 'slave':
             for k in 'socket-path', 'username', 'password':
                 if not 'porter-' + k in props:
@@ -311,6 +434,14 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
         self.type = props.get('type', 'master')
         self.port = props.get('port', 8801)
         self._allowBrowsing = props.get('allow-browsing', False)
+        self._keepAliveTimeout = props.get('keep-alive-timeout',
+                                           DEFAULT_KEEP_ALIVE_TIMEOUT)
+        self._keepAliveMaxRequests = props.get(
+            'keep-alive-max-requests', DEFAULT_KEEP_ALIVE_MAX_REQUESTS)
+        # The FLV files share the index cache and start unit
+        httpfile.FLVFile.indexCache = flvindex.FLVIndexCache(
+            props.get('flv-index-dir', None))
+        httpfile.FLVFile.startUnit = props.get('flv-start-unit', 'bytes')
         if self.type == 'slave':
             # already checked for these in do_check
             self._porterPath = props['porter-socket-path']
@@ -381,7 +512,9 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
             raise errors.WrongStateError(
                 "a resource or path property must be set")
 
-        site = Site(root, self)
+        site = Site(root, self, self._keepAliveTimeout,
+                    self._keepAliveMaxRequests)
+        self._site = site
         self._timeoutRequestsCallLater = reactor.callLater(
             self.REQUEST_TIMEOUT, self._timeoutRequests)
 
@@ -458,7 +591,7 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
         if self._twistedPort:
             self._twistedPort.stopListening()
 
-        l = [self.remove_all_clients()]
+        l = [self.remove_all_clients(), httpfile.FLVFile.indexCache.stop()]
         if self.type == 'slave' and self._pbclient:
             if self._singleFile:
                 l.append(self._pbclient.deregisterPath(self.mountPoint))
@@ -573,6 +706,15 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
         else:
             self.debug("No client with fd %d found", fd)
 
+    def remove_clients(self, fds):
+        """
+        Remove the clients with the given file descriptors.
+
+        Used by keycard expiry.
+        """
+        for fd in fds:
+            self.remove_client(fd)
+
     def remove_all_clients(self):
         l = []
         for fd in self._connected_clients:
@@ -583,6 +725,8 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
             request = self._connected_clients[fd]
             request.unregisterProducer()
             request.channel.transport.loseConnection()
+        if self._site is not None:
+            self._site.closeIdleConnections()
 
         self.debug("Waiting for %d clients to finish", len(l))
         return defer.DeferredList(l)
@@ -665,6 +809,26 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
         """
         return len(self._connected_clients)
 
+    def getConnections(self):
+        """
+        Return the number of open connections, idle ones included
+        """
+        if self._site is None:
+            return 0
+        return self._site.getConnectionCount()
+
+    def servesPath(self, path):
+        """
+        Return whether a request for the given path is for this component,
+        and not for another one behind the same porter
+        """
+        if self.type != 'slave':
+            return True
+        path = path.split('?', 1)[0]
+        if self._singleFile:
+            return path == self.mountPoint
+        return path.startswith(self.mountPoint)
+
     def getBytesSent(self):
         """
         Current Bandwidth
@@ -22,6 +22,7 @@ import errno
 from twisted.internet import defer
 
 from flumotion.common import log
+from flumotion.component.misc.httpserver import diskio
 from flumotion.component.misc.httpserver import fileprovider, localpath
 from flumotion.component.misc.httpserver.fileprovider import FileError
 from flumotion.component.misc.httpserver.fileprovider import FileClosedError
@@ -31,11 +32,36 @@ SEEK_SET = 0
 
 LOG_CATEGORY = "fileprovider-local"
 
+errnoLookup = {errno.ENOENT: fileprovider.NotFoundError,
+               errno.ENOTDIR: fileprovider.NotFoundError,
+               errno.EISDIR: fileprovider.CannotOpenError,
+               errno.EACCES: fileprovider.AccessError}
+
+
+def openFile(path):
+    """
+    Open a file for reading and get its status.
+
+    @rtype: (file, statinfo)
+    """
+    try:
+        handle = open(path, 'rb')
+    except IOError, e:
+        cls = errnoLookup.get(e[0], FileError)
+        raise cls("Failed to open file '%s': %s" % (path, str(e)))
+    try:
+        info = os.fstat(handle.fileno())
+    except OSError, e:
+        handle.close()
+        cls = errnoLookup.get(e[0], FileError)
+        raise cls("Failed to stat file '%s': %s" % (path, str(e)))
+    return handle, info
+
 
 class FileProviderLocalPlug(fileprovider.FileProviderPlug, log.Loggable):
     """
-    I am a plug that provide local files directly,
-    faking the file access is asynchronous.
+    I am a plug that provide local files,
+    opening and reading them in a pool of threads.
     """
 
     logcategory = LOG_CATEGORY
@@ -43,39 +69,56 @@ class FileProviderLocalPlug(fileprovider.FileProviderPlug, log.Loggable):
     def __init__(self, args):
         props = args['properties']
         self._path = props.get('path', None)
+        threads = props.get('disk-io-threads', diskio.DEFAULT_THREADS)
+        self._executor = diskio.DiskIOExecutor(threads)
+
+    def stop(self, component):
+        self._executor.stop()
 
     def startStatsUpdates(self, updater):
-        # No statistics for local file provider
-        pass
+        self._executor.startUpdates(updater)
 
     def stopStatsUpdates(self):
-        pass
+        self._executor.stopUpdates()
 
     def getRootPath(self):
         if self._path is None:
             return None
-        return LocalPath(self._path)
+        return LocalPath(self._path, self._executor)
 
 
 class LocalPath(localpath.LocalPath):
 
+    def __init__(self, path, executor=None):
+        localpath.LocalPath.__init__(self, path)
+        self._executor = executor
+
+    def child(self, name):
+        childpath = self._getChildPath(name)
+        return type(self)(childpath, self._executor)
+
     def open(self):
-        return LocalFile(self._path, self.mimeType)
+        if self._executor is None:
+            return LocalFile(self._path, self.mimeType)
+        d = self._executor.call(self._path, openFile, self._path)
+        d.addCallback(lambda opened: LocalFile(self._path, self.mimeType,
+                                               self._executor, opened))
+        return d
 
 
 class LocalFile(fileprovider.File, log.Loggable):
     """
-    I offer a fake asynchronous wrapper around a synchronous file.
-    I'm not thread-safe, I should only be used to read small blocks
-    from a local file system and I don't support cloning.
+    I offer an asynchronous wrapper around a local file.
+    With a L{diskio.DiskIOExecutor} the file is read in its threads,
+    merging the reads of the clients streaming the same file;
+    without one the file is read synchronously, so it should only be used
+    to read small blocks from a local file system.
+    I don't support cloning.
     """
 
     logCategory = LOG_CATEGORY
 
-    _errorLookup = {errno.ENOENT: fileprovider.NotFoundError,
-                    errno.ENOTDIR: fileprovider.NotFoundError,
-                    errno.EISDIR: fileprovider.CannotOpenError,
-                    errno.EACCES: fileprovider.AccessError}
+    _errorLookup = errnoLookup
 
     # Overriding parent class properties to become attribute
     mimeType = None
@@ -84,20 +127,25 @@ class LocalFile(fileprovider.File, log.Loggable):
     _file = None
     _info = None
 
-    def __init__(self, path, mimeType):
+    def __init__(self, path, mimeType, executor=None, opened=None):
+        """
+        @param executor: the executor doing the disk operations, or None
+                         to do them synchronously
+        @type  executor: L{diskio.DiskIOExecutor}
+        @param opened:   the file handle and status already got with
+                         L{openFile}, or None to open the file now
+        @type  opened:   (file, statinfo)
+        """
         self._path = path
         self.mimeType = mimeType
-        try:
-            self._file = open(path, 'rb')
-            self.debug("%s opened [fd %5d]", self, self._file.fileno())
-        except IOError, e:
-            cls = self._errorLookup.get(e[0], FileError)
-            raise cls("Failed to open file '%s': %s" % (path, str(e)))
-        try:
-            self._info = os.fstat(self._file.fileno())
-        except OSError, e:
-            cls = self._errorLookup.get(e[0], FileError)
-            raise cls("Failed to stat file '%s': %s" % (path, str(e)))
+        self._executor = executor
+        self._position = 0
+        if opened is None:
+            opened = openFile(path)
+        self._file, self._info = opened
+        # The handles of a file share their reads
+        self._key = (self._info[stat.ST_DEV], self._info[stat.ST_INO])
+        self.debug("%s opened [fd %5d]", self, self._file.fileno())
 
     def __str__(self):
         return "<LocalFile '%s'>" % self._path
@@ -117,44 +165,45 @@ class LocalFile(fileprovider.File, log.Loggable):
     def tell(self):
         if self._file is None:
             raise FileClosedError("File closed")
-        try:
-            return self._file.tell()
-        except IOError, e:
-            cls = self._errorLookup.get(e[0], FileError)
-            raise cls("Failed to tell position in file '%s': %s"
-                      % (self._path, str(e)))
+        return self._position
 
     def seek(self, offset):
         if self._file is None:
             raise FileClosedError("File closed")
-        try:
-            self._file.seek(offset, SEEK_SET)
-        except IOError, e:
-            cls = self._errorLookup.get(e[0], FileError)
-            raise cls("Failed to seek in file '%s': %s"
-                      % (self._path, str(e)))
+        self._position = offset
 
     def read(self, size):
         if self._file is None:
             raise FileClosedError("File closed")
+        offset = self._position
+        if self._executor is not None:
+            d = self._executor.read(self._key, self._file, offset, size)
+            d.addCallbacks(self._gotData, self._readFailed,
+                           callbackArgs=(offset, ))
+            return d
         try:
+            self._file.seek(offset, SEEK_SET)
             data = self._file.read(size)
-            return defer.succeed(data)
         except IOError, e:
             cls = self._errorLookup.get(e[0], FileError)
             return defer.fail(cls("Failed to read data from %s: %s"
                                   % (self._path, str(e))))
         except:
             return defer.fail()
+        return defer.succeed(self._gotData(data, offset))
 
     def close(self):
         if self._file is not None:
+            handle = self._file
+            self._file = None
+            self._info = None
+            if self._executor is not None:
+                # After the reads still queued for the handle
+                d = self._executor.call(self._key, handle.close)
+                d.addErrback(self._closeFailed)
+                return
             try:
-                try:
-                    self._file.close()
-                finally:
-                    self._file = None
-                    self._info = None
+                handle.close()
             except IOError, e:
                 cls = self._errorLookup.get(e[0], FileError)
                 raise cls("Failed to close file '%s': %s"
@@ -165,3 +214,19 @@ class LocalFile(fileprovider.File, log.Loggable):
 
     def getLogFields(self):
         return {}
+
+    ## Private Methods ##
+
+    def _gotData(self, data, offset):
+        self._position = offset + len(data)
+        return data
+
+    def _readFailed(self, failure):
+        failure.trap(IOError)
+        e = failure.value
+        cls = self._errorLookup.get(e[0], FileError)
+        raise cls("Failed to read data from %s: %s" % (self._path, str(e)))
+
+    def _closeFailed(self, failure):
+        self.warning("Failed to close file '%s': %s",
+                     self._path, log.getFailureMessage(failure))
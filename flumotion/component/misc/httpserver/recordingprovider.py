@@ -0,0 +1,372 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_component_providers -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+import bisect
+import os
+import stat
+import time
+
+from twisted.internet import defer, reactor
+
+from flumotion.common import log
+from flumotion.component.consumers.disker.index import Index
+from flumotion.component.misc.httpserver import fileprovider, localpath
+from flumotion.component.misc.httpserver import localprovider
+from flumotion.component.misc.httpserver.fileprovider import FileError
+from flumotion.component.misc.httpserver.fileprovider import FileClosedError
+
+LOG_CATEGORY = "fileprovider-recording"
+
+# Interval between two checks for new data when following a recording
+FOLLOW_INTERVAL = 0.5
+# A followed recording is considered finished when it didn't grow
+# for this amount of seconds
+DEFAULT_FOLLOW_TIMEOUT = 10
+
+
+class FileProviderRecordingPlug(fileprovider.FileProviderPlug, log.Loggable):
+    """
+    I am a plug that provides the recordings written by a disker.
+
+    When a recording has a disker index next to it, I allow requesting it
+    by wall-clock time: the times are mapped to byte offsets of keyframes
+    with a binary search in the index, so seeking doesn't need to parse
+    the recording. Recordings still being written are followed while they
+    grow. Files without an index are provided like the local provider does.
+    """
+
+    logCategory = LOG_CATEGORY
+
+    def __init__(self, args):
+        props = args['properties']
+        self._path = props.get('path', None)
+        self._followTimeout = props.get('follow-timeout',
+                                        DEFAULT_FOLLOW_TIMEOUT)
+        self._indexes = {} # {index location: RecordingIndex}
+
+    def startStatsUpdates(self, updater):
+        # No statistics for recording file provider
+        pass
+
+    def stopStatsUpdates(self):
+        pass
+
+    def getRootPath(self):
+        if self._path is None:
+            return None
+        return RecordingPath(self._path, self)
+
+    def getIndex(self, location):
+        """
+        @return: the up to date index stored in location,
+                 or None if there is no valid index there
+        @rtype:  L{RecordingIndex}
+        """
+        index = self._indexes.get(location, None)
+        if index is None:
+            if not os.path.exists(location):
+                return None
+            index = RecordingIndex(location)
+            self._indexes[location] = index
+        if not index.refresh():
+            del self._indexes[location]
+            return None
+        return index
+
+    def getFollowTimeout(self):
+        return self._followTimeout
+
+
+class RecordingPath(localpath.LocalPath):
+
+    def __init__(self, path, plug):
+        localpath.LocalPath.__init__(self, path)
+        self._plug = plug
+
+    def child(self, name):
+        childpath = self._getChildPath(name)
+        return type(self)(childpath, self._plug)
+
+    def open(self):
+        location = '.'.join([self._path, Index.INDEX_EXTENSION])
+        index = self._plug.getIndex(location)
+        if index is None:
+            return localprovider.LocalFile(self._path, self.mimeType)
+        return RecordingFile(self._path, self.mimeType, index,
+                             self._plug.getFollowTimeout())
+
+
+class RecordingIndex(log.Loggable):
+    """
+    I keep the keyframe index of a recording loaded in memory,
+    reading only the entries appended since the last refresh.
+    """
+
+    logCategory = LOG_CATEGORY
+
+    def __init__(self, location):
+        self.location = location
+        self._index = Index()
+        self._tdts = []
+        self._offsets = []
+        self._inode = None
+        self._position = 0
+
+    def refresh(self):
+        """
+        Loads the entries appended to the index file since the last call.
+
+        @return: False if the index file is not valid anymore
+        @rtype:  bool
+        """
+        try:
+            info = os.stat(self.location)
+        except OSError, e:
+            self.debug("Failed to stat index %s: %s", self.location,
+                       log.getExceptionMessage(e))
+            return False
+        if info[stat.ST_INO] != self._inode \
+                or info[stat.ST_SIZE] < self._position:
+            # The disker rewrote the index, start over
+            if self._inode is not None:
+                self.debug("Index %s has been rewritten, reloading",
+                           self.location)
+            self._index.clear()
+            self._tdts = []
+            self._offsets = []
+            self._inode = info[stat.ST_INO]
+            self._position = 0
+        if info[stat.ST_SIZE] == self._position:
+            return True
+
+        try:
+            handle = open(self.location, 'r')
+            try:
+                handle.seek(self._position)
+                data = handle.read()
+            finally:
+                handle.close()
+        except IOError, e:
+            self.warning("Failed to read index %s: %s", self.location,
+                         log.getExceptionMessage(e))
+            return False
+
+        # Only parse complete lines, the disker may be writing the last one
+        end = data.rfind('\n') + 1
+        lines = data[:end].splitlines()
+        if self._position == 0:
+            if len(lines) < 2:
+                # Headers not fully written yet
+                return True
+            if not lines[0].startswith('FLUIDX1 #') \
+                    or lines[1] != ' '.join(Index.INDEX_KEYS):
+                self.warning("%s is not a valid index", self.location)
+                return False
+            lines = lines[2:]
+        self._position += end
+
+        count = len(self._index)
+        if not self._index.loadEntries(lines):
+            return False
+        for entry in self._index.getEntries(count):
+            self._tdts.append(entry['tdt'])
+            self._offsets.append(entry['offset'])
+        self.log("Loaded %d new entries from index %s",
+                 len(self._tdts) - count, self.location)
+        return True
+
+    def getHeaders(self):
+        """
+        @return: the index entry of the stream headers, or None
+        @rtype:  dict
+        """
+        return self._index.getHeaders()
+
+    def getByteRange(self, start, stop):
+        """
+        Maps UNIX times to byte offsets of keyframes, using a binary search.
+
+        @return: the offset of the keyframe at or before start and the
+                 offset of the byte preceding the keyframe at or after stop,
+                 this last one being None if stop is not indexed yet;
+                 None if there is nothing to provide in that range.
+        @rtype:  (long, long) or None
+        """
+        if not self._tdts:
+            return None
+        first = 0
+        if start is not None:
+            first = max(bisect.bisect_right(self._tdts, start) - 1, 0)
+        if stop is None:
+            return self._offsets[first], None
+        last = bisect.bisect_left(self._tdts, stop)
+        if last <= first:
+            return None
+        if last == len(self._tdts):
+            return self._offsets[first], None
+        return self._offsets[first], self._offsets[last] - 1
+
+
+class RecordingFile(localprovider.LocalFile, fileprovider.TimeIndexedFile):
+    """
+    I am a local file with a disker index that can be read from a given
+    time, and I keep providing data while the recording grows.
+    """
+
+    logCategory = LOG_CATEGORY
+
+    def __init__(self, path, mimeType, index, followTimeout):
+        localprovider.LocalFile.__init__(self, path, mimeType)
+        self._index = index
+        self._followTimeout = followTimeout
+        self._following = False
+        self._stop = None # offset at which to stop reading
+        self._stopTime = None # time to resolve the stop offset from
+        self._lastGrowth = time.time()
+        self._pending = None # (deferred, size) waiting for data
+        self._followCall = None
+
+    def __str__(self):
+        return "<RecordingFile '%s'>" % self._path
+
+    def getsize(self):
+        if self._file is None:
+            raise FileClosedError("File closed")
+        # The recording may still be growing
+        try:
+            self._info = os.fstat(self._file.fileno())
+        except OSError, e:
+            cls = self._errorLookup.get(e[0], FileError)
+            raise cls("Failed to stat file '%s': %s" % (self._path, str(e)))
+        return self._info[stat.ST_SIZE]
+
+    def getHeaders(self):
+        if self._file is None:
+            raise FileClosedError("File closed")
+        headers = self._index.getHeaders()
+        if not headers:
+            return defer.succeed('')
+        try:
+            # The reading position is kept by the file, not the handle
+            self._file.seek(headers['offset'], localprovider.SEEK_SET)
+            data = self._file.read(headers['length'])
+        except IOError, e:
+            cls = self._errorLookup.get(e[0], FileError)
+            return defer.fail(cls("Failed to read headers from %s: %s"
+                                  % (self._path, str(e))))
+        return defer.succeed(data)
+
+    def seekTime(self, start, stop):
+        if self._file is None:
+            raise FileClosedError("File closed")
+        self._index.refresh()
+        byteRange = self._index.getByteRange(start, stop)
+        if byteRange is None:
+            return None
+        first, last = byteRange
+        self.debug("Time range %s-%s mapped to bytes %s-%s in %s",
+                   start, stop, first, last, self._path)
+        self.seek(first)
+        if last is None:
+            self._following = True
+            self._stopTime = stop
+        else:
+            self._stop = last + 1
+        return first, last
+
+    def read(self, size):
+        if self._file is None:
+            raise FileClosedError("File closed")
+        size = self._clipReadSize(size)
+        if size <= 0:
+            return defer.succeed('')
+        if not self._following:
+            return localprovider.LocalFile.read(self, size)
+        # Reading seeks first, which clears the end of file condition
+        # of the handle, so we get what has been written since we reached it
+        d = localprovider.LocalFile.read(self, size)
+
+        def checkData(data):
+            if data:
+                self._lastGrowth = time.time()
+                return data
+            # We reached the end of what has been recorded so far
+            pending = defer.Deferred()
+            self._pending = pending, size
+            self._followCall = reactor.callLater(FOLLOW_INTERVAL,
+                                                 self._followRecording)
+            return pending
+        d.addCallback(checkData)
+        return d
+
+    def close(self):
+        if self._followCall is not None:
+            self._followCall.cancel()
+            self._followCall = None
+        self._pending = None
+        localprovider.LocalFile.close(self)
+
+    def getLogFields(self):
+        return {'following': self._following}
+
+    ## Private Methods ##
+
+    def _clipReadSize(self, size):
+        if self._stop is None:
+            return size
+        return min(size, self._stop - self._position)
+
+    def _followRecording(self):
+        self._followCall = None
+        if self._pending is None or self._file is None:
+            return
+        d, size = self._pending
+
+        if self._stop is None and self._stopTime is not None:
+            self._index.refresh()
+            byteRange = self._index.getByteRange(None, self._stopTime)
+            if byteRange and byteRange[1] is not None:
+                self.debug("Stop time %s reached at offset %d in %s",
+                           self._stopTime, byteRange[1], self._path)
+                self._stop = byteRange[1] + 1
+        size = self._clipReadSize(size)
+
+        data = ''
+        if size > 0:
+            try:
+                self._file.seek(self._position, localprovider.SEEK_SET)
+                data = self._file.read(size)
+                self._position += len(data)
+            except IOError, e:
+                self._pending = None
+                cls = self._errorLookup.get(e[0], FileError)
+                d.errback(cls("Failed to read data from %s: %s"
+                              % (self._path, str(e))))
+                return
+
+        now = time.time()
+        if data:
+            self._lastGrowth = now
+        elif size > 0 and now - self._lastGrowth < self._followTimeout:
+            self._followCall = reactor.callLater(FOLLOW_INTERVAL,
+                                                 self._followRecording)
+            return
+        else:
+            self.debug("Stopped following %s at offset %d",
+                       self._path, self._position)
+        self._pending = None
+        d.callback(data)
@@ -43,6 +43,21 @@ class RequestStatistics(object):
         self._stats._onRequestComplete(self, size)
 
 
+class ConnectionStatistics(object):
+
+    def __init__(self, serverStats):
+        self._stats = serverStats
+        self.requestCount = 0
+        self._stats._onConnectionOpen(self)
+
+    def onRequestStarted(self):
+        self.requestCount += 1
+        self._stats._onConnectionRequest(self)
+
+    def onClosed(self):
+        self._stats._onConnectionClose(self)
+
+
 class ServerStatistics(object):
 
     _updater = None
@@ -57,6 +72,12 @@ class ServerStatistics(object):
         self.requestCountPeakTime = now
         self.finishedRequestCount = 0
         self.totalBytesSent = 0L
+        self.currentConnectionCount = 0
+        self.totalConnectionCount = 0
+        self.connectionCountPeak = 0
+        self.connectionCountPeakTime = now
+        self.keepAliveRequestCount = 0
+        self._connectionRequestCount = 0
 
         # Updated by a call to the update method
         self.meanRequestCount = 0
@@ -79,6 +100,7 @@ class ServerStatistics(object):
         self._set("bitrate-peak-time", self.bitratePeakTime)
         self._set("request-rate-peak-time", self.requestRatePeakTime)
         self._set("request-count-peak-time", self.requestCountPeakTime)
+        self._set("connection-count-peak-time", self.connectionCountPeakTime)
         if self._callId is None:
             self._callId = reactor.callLater(STATS_UPDATE_PERIOD, self._update)
 
@@ -94,6 +116,13 @@ class ServerStatistics(object):
         return 0.0
     meanFileReadRatio = property(getMeanFileReadRatio)
 
+    def getMeanRequestsPerConnection(self):
+        if self.totalConnectionCount > 0:
+            return (float(self._connectionRequestCount)
+                    / self.totalConnectionCount)
+        return 0.0
+    meanRequestsPerConnection = property(getMeanRequestsPerConnection)
+
     def _update(self):
         now = time.time()
         updateDelta = now - self._lastUpdateTime
@@ -145,6 +174,8 @@ class ServerStatistics(object):
 
         # Update bytes read statistic key too
         self._set("total-bytes-sent", self.totalBytesSent)
+        self._set("mean-requests-per-connection",
+                  self.meanRequestsPerConnection)
 
         self._lastRequestCount = self.totalRequestCount
         self._lastBytesSent = self.totalBytesSent
@@ -182,6 +213,28 @@ class ServerStatistics(object):
             self._fileReadRatios += float(stats.bytesSent) / size
             self._set("mean-file-read-ratio", self.meanFileReadRatio)
 
+    def _onConnectionOpen(self, stats):
+        self.currentConnectionCount += 1
+        self.totalConnectionCount += 1
+        self._set("current-connection-count", self.currentConnectionCount)
+        self._set("total-connection-count", self.totalConnectionCount)
+        if self.currentConnectionCount > self.connectionCountPeak:
+            now = time.time()
+            self.connectionCountPeak = self.currentConnectionCount
+            self.connectionCountPeakTime = now
+            self._set("connection-count-peak", self.currentConnectionCount)
+            self._set("connection-count-peak-time", now)
+
+    def _onConnectionRequest(self, stats):
+        self._connectionRequestCount += 1
+        if stats.requestCount > 1:
+            self.keepAliveRequestCount += 1
+            self._set("keep-alive-request-count", self.keepAliveRequestCount)
+
+    def _onConnectionClose(self, stats):
+        self.currentConnectionCount -= 1
+        self._set("current-connection-count", self.currentConnectionCount)
+
     def _updateAverage(self, lastTime, newTime, lastValue, newValue):
         lastDelta = lastTime - self.startTime
         newDelta = newTime - lastTime
@@ -202,11 +255,19 @@ class ServerStatistics(object):
             FRR: File Read Ratio
             MBR: Mean Bitrate
             CBR: Current Bitrate
+            TCC: Total Connection Count
+            CCC: Current Connection Count
+            KRC: Keep-alive Request Count, requests following the first
+                 one of a connection
+            RPC: mean Requests Per Connection
         """
         log.debug("stats-http-server",
                   "TRC: %s; CRC: %d; CRR: %.2f; MRR: %.2f; "
-                  "FRR: %.4f; MBR: %d; CBR: %d",
+                  "FRR: %.4f; MBR: %d; CBR: %d; TCC: %d; CCC: %d; "
+                  "KRC: %d; RPC: %.2f",
                   self.totalRequestCount, self.currentRequestCount,
                   self.currentRequestRate, self.meanRequestRate,
                   self.meanFileReadRatio, self.meanBitrate,
-                  self.currentBitrate)
+                  self.currentBitrate, self.totalConnectionCount,
+                  self.currentConnectionCount, self.keepAliveRequestCount,
+                  self.meanRequestsPerConnection)
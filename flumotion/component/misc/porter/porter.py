@@ -435,7 +435,7 @@ class PorterProtocol(protocol.Protocol, log.Loggable):
 
     def dataReceived(self, data):
         self._buffer = self._buffer + data
-        self.log("Got data, buffer now \"%s\"" % self._buffer)
+        self.log("Got data, buffer now \"%s\"", self._buffer)
         # We accept more than just '\r\n' (the true HTTP line end) in the
         # interests of compatibility.
         for delim in self.delimiters:
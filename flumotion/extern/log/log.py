@@ -24,7 +24,17 @@ import fnmatch
 import time
 import types
 import logging
+import threading
 import traceback
+from collections import deque
+
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
 
 # environment variables controlling levels for each category
 _DEBUG = "*:1"
@@ -42,10 +52,16 @@ _log_handlers_limited = []
 
 _initialized = False
 
+# (class, method name) of the no-op log methods installed on Loggable classes
+_shortcuts = []
+
 _stdout = None
 _stderr = None
 _old_hup_handler = None
 
+# the ThreadedLogWriter used instead of stderrHandler, if any
+_writer = None
+
 
 # public log levels
 (ERROR,
@@ -172,6 +188,7 @@ def setLogSettings(state):
 
     for category in categories:
         registerCategory(category)
+    _clearShortcuts()
 
 
 def getLogSettings():
@@ -195,6 +212,46 @@ def _canShortcutLogging(category, level):
         return level > getCategoryLevel(category)
 
 
+def _installShortcut(loggable, name):
+    """
+    Replace the Loggable method of the given name by a no-op on the class
+    of loggable, whose category doesn't log at that level.
+    Calling it only costs a lookup of the category, checked in case a
+    subclass or an instance uses a different one.
+    """
+    if 'logCategory' in getattr(loggable, '__dict__', {}):
+        return
+    klass = loggable.__class__
+    category = loggable.logCategory
+    if getattr(klass.__dict__.get(name, None), 'logShortcut', None) \
+            == category:
+        return
+    method = getattr(getattr(klass, name, None), 'im_func', None)
+    original = Loggable.__dict__[name]
+    if method is not original and not hasattr(method, 'logShortcut'):
+        # the class has its own implementation, leave it alone
+        return
+
+    def shortcut(self, *args):
+        if self.logCategory != category:
+            return original(self, *args)
+    shortcut.logShortcut = category
+    setattr(klass, name, shortcut)
+    _shortcuts.append((klass, name))
+
+
+def _clearShortcuts():
+    """
+    Remove all the no-op log methods, to be installed again according to
+    the new log settings when logging.
+    """
+    global _shortcuts
+    shortcuts, _shortcuts = _shortcuts, []
+    for klass, name in shortcuts:
+        if hasattr(klass.__dict__.get(name, None), 'logShortcut'):
+            delattr(klass, name)
+
+
 def scrubFilename(filename):
     '''
     Scrub the filename to a relative path for all packages in our scrub list.
@@ -446,6 +503,160 @@ def stderrHandler(level, object, category, file, line, message):
     sys.stderr.flush()
 
 
+class ThreadedLogWriter:
+    """
+    A log handler that writes messages from a thread of its own, so
+    logging doesn't block the reactor or streaming threads on I/O.
+
+    Messages are queued as records in a bounded queue, which the writer
+    thread formats and writes in batches. The thread sleeps until a
+    message is queued; while it writes, the next messages queue up for
+    the next batch. When the queue is full, new messages are dropped and
+    counted; the number of dropped messages is written along with the
+    next batch.
+
+    The output is resolved when writing, so reopenOutputFiles keeps
+    working.
+
+    @ivar dropped: the number of messages dropped so far
+    @ivar written: the number of messages written so far
+    """
+
+    def __init__(self, output=None, jsonLines=False, maxRecords=10000):
+        """
+        @param output:     the file to write to, sys.stderr if None
+        @param jsonLines:  whether to write a JSON object per line
+                           instead of text
+        @param maxRecords: the maximum number of messages queued
+        """
+        if jsonLines and json is None:
+            raise ValueError("JSON output needs the json module")
+        self.output = output
+        self.jsonLines = jsonLines
+        self.maxRecords = maxRecords
+
+        self.dropped = 0
+        self.written = 0
+
+        self._records = deque()
+        self._reportedDropped = 0
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+        # set when messages are queued, cleared by the writer thread
+        self._queued = threading.Event()
+
+    def handle(self, level, object, category, file, line, message):
+        """
+        The log handler, queuing a message for the writer thread.
+        """
+        if self._thread and self._pid != os.getpid():
+            # we've been forked, e.g. when daemonizing; the writer thread
+            # only exists in the parent, which writes what it queued
+            self._records.clear()
+            self._reportedDropped = self.dropped
+            # its thread may have been holding the lock of the event
+            self._queued = threading.Event()
+            self._thread = None
+            self.start()
+        if len(self._records) >= self.maxRecords:
+            self.dropped += 1
+            return
+        # deque's append and popleft are atomic, no lock needed
+        self._records.append((time.time(), level, object, category,
+                              file, line, message))
+        # the writer clears the event before writing the queue, so only
+        # the first message of a batch needs to wake it up
+        if not self._queued.isSet():
+            self._queued.set()
+
+    def start(self):
+        if self._thread:
+            return
+        self._stopping = False
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run,
+                                        name='ThreadedLogWriter')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the writer thread, and write the messages still queued.
+        """
+        if self._thread:
+            self._stopping = True
+            self._queued.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def flush(self):
+        """
+        Write all the messages queued.
+        """
+        records = self._records
+        lines = []
+        while records:
+            lines.append(self._format(records.popleft()))
+        written = len(lines)
+        dropped = self.dropped - self._reportedDropped
+        if dropped:
+            self._reportedDropped += dropped
+            lines.append(self._format((time.time(), WARN, None, 'log',
+                                       scrubFilename(__file__), 0,
+                                       '%d log messages dropped' % dropped)))
+        if not lines:
+            return
+        output = self.output or sys.stderr
+        safeprintf(output, ''.join(lines))
+        try:
+            output.flush()
+        except IOError:
+            pass
+        self.written += written
+
+    def _run(self):
+        while not self._stopping:
+            self._queued.wait()
+            self._queued.clear()
+            self.flush()
+
+    def _format(self, record):
+        (when, level, object, category, file, line, message) = record
+        if self.jsonLines:
+            return json.dumps({'time': when,
+                               'level': _LEVEL_NAMES[level - 1],
+                               'pid': os.getpid(),
+                               'object': _toUnicode(object),
+                               'category': category,
+                               'message': _toUnicode(message),
+                               'file': file,
+                               'line': line}) + '\n'
+
+        o = ""
+        if object:
+            o = '"' + _toString(object) + '"'
+        # level   pid     object   cat      time
+        # 5 + 1 + 7 + 1 + 32 + 1 + 17 + 1 + 15 == 80
+        return '%s [%5d] %-32s %-17s %-15s %-4s %s (%s:%d)\n' % (
+            getFormattedLevelName(level), os.getpid(), o, category,
+            time.strftime("%b %d %H:%M:%S", time.localtime(when)),
+            "", _toString(message), file, line)
+
+
+def _toString(s):
+    if isinstance(s, unicode):
+        return s.encode('UTF-8')
+    return s
+
+
+def _toUnicode(s):
+    if isinstance(s, str):
+        return s.decode('UTF-8', 'replace')
+    return s
+
+
 def _preformatLevels(noColorEnvVarName):
     format = '%-5s'
 
@@ -499,6 +710,11 @@ def init(envVarName, enableColorOutput=False):
         setDebug(os.environ[envVarName])
     addLimitedLogHandler(stderrHandler)
 
+    # write from a thread, as text or as JSON lines, if asked to
+    writer = os.environ.get(envVarName + "_ASYNC", None)
+    if writer:
+        startThreadedWriter(jsonLines=(writer == 'json'))
+
     _initialized = True
 
 
@@ -514,6 +730,49 @@ def setDebug(string):
     # reparse all already registered category levels
     for category in _categories:
         registerCategory(category)
+    _clearShortcuts()
+
+
+def startThreadedWriter(jsonLines=False, maxRecords=10000):
+    """
+    Write the log messages from a thread, instead of writing them to stderr
+    from the thread logging them. The messages still queued are written
+    at exit.
+
+    @param jsonLines:  whether to write a JSON object per line instead of
+                       text
+    @param maxRecords: the maximum number of messages waiting to be
+                       written; further messages are dropped
+    @rtype: L{ThreadedLogWriter}
+    """
+    global _writer
+    if _writer:
+        return _writer
+
+    _writer = ThreadedLogWriter(jsonLines=jsonLines, maxRecords=maxRecords)
+    if stderrHandler in _log_handlers_limited:
+        removeLimitedLogHandler(stderrHandler)
+    addLimitedLogHandler(_writer.handle)
+    _writer.start()
+
+    import atexit
+    atexit.register(stopThreadedWriter)
+    return _writer
+
+
+def stopThreadedWriter():
+    """
+    Write the log messages to stderr from the thread logging them again.
+    """
+    global _writer
+    if not _writer:
+        return
+
+    writer, _writer = _writer, None
+    if writer.handle in _log_handlers_limited:
+        removeLimitedLogHandler(writer.handle)
+        addLimitedLogHandler(stderrHandler)
+    writer.stop()
 
 
 def getDebug():
@@ -541,8 +800,11 @@ def reset():
     """
     Resets the logging system, removing all log handlers.
     """
-    global _log_handlers, _log_handlers_limited, _initialized
+    global _log_handlers, _log_handlers_limited, _initialized, _writer
 
+    if _writer:
+        _writer.stop()
+        _writer = None
     _log_handlers = []
     _log_handlers_limited = []
     _initialized = False
@@ -566,6 +828,8 @@ def addLogHandler(func):
 
     if func not in _log_handlers:
         _log_handlers.append(func)
+        # every message has to reach the handler now
+        _clearShortcuts()
 
 
 def addLimitedLogHandler(func):
@@ -764,6 +1028,7 @@ class Loggable:
     def error(self, *args):
         """Log an error.  By default this will also raise an exception."""
         if _canShortcutLogging(self.logCategory, ERROR):
+            _installShortcut(self, 'error')
             return
         errorObject(self.logObjectName(), self.logCategory,
             *self.logFunction(*args))
@@ -771,6 +1036,7 @@ class Loggable:
     def warning(self, *args):
         """Log a warning.  Used for non-fatal problems."""
         if _canShortcutLogging(self.logCategory, WARN):
+            _installShortcut(self, 'warning')
             return
         warningObject(self.logObjectName(), self.logCategory,
             *self.logFunction(*args))
@@ -778,6 +1044,7 @@ class Loggable:
     def info(self, *args):
         """Log an informational message.  Used for normal operation."""
         if _canShortcutLogging(self.logCategory, INFO):
+            _installShortcut(self, 'info')
             return
         infoObject(self.logObjectName(), self.logCategory,
             *self.logFunction(*args))
@@ -785,6 +1052,7 @@ class Loggable:
     def debug(self, *args):
         """Log a debug message.  Used for debugging."""
         if _canShortcutLogging(self.logCategory, DEBUG):
+            _installShortcut(self, 'debug')
             return
         debugObject(self.logObjectName(), self.logCategory,
             *self.logFunction(*args))
@@ -792,6 +1060,7 @@ class Loggable:
     def log(self, *args):
         """Log a log message.  Used for debugging recurring events."""
         if _canShortcutLogging(self.logCategory, LOG):
+            _installShortcut(self, 'log')
             return
         logObject(self.logObjectName(), self.logCategory,
             *self.logFunction(*args))
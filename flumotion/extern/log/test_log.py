@@ -401,3 +401,185 @@ class TestLogUnicode(unittest.TestCase):
 
 if __name__ == '__main__':
     unittest.main()
+
+
+class OtherLogTester(LogTester):
+    logCategory = 'othertestlog'
+
+
+class OwnDebugTester(LogTester):
+
+    def debug(self, *args):
+        self.debugged = args
+        LogTester.debug(self, *args)
+
+
+class TestLogShortcuts(unittest.TestCase):
+
+    def setUp(self):
+        self.category = self.level = self.message = None
+        log.reset()
+        log.setDebug("testlog:3,othertestlog:5")
+        log.addLimitedLogHandler(self.handler)
+
+    def tearDown(self):
+        log._clearShortcuts()
+
+    def handler(self, level, object, category, file, line, message):
+        self.category = category
+        self.message = message
+
+    def testShortcutInstalled(self):
+        tester = LogTester()
+        tester.debug("not visible")
+        self.failUnless('debug' in LogTester.__dict__)
+        self.failIf('info' in LogTester.__dict__)
+        tester.debug("not visible")
+        self.assertEquals(self.message, None)
+
+        tester.info("visible")
+        self.assertEquals(self.message, 'visible')
+
+    def testSetDebugClearsShortcuts(self):
+        tester = LogTester()
+        tester.debug("not visible")
+        self.failUnless('debug' in LogTester.__dict__)
+
+        log.setDebug("testlog:4")
+        self.failIf('debug' in LogTester.__dict__)
+        tester.debug("visible")
+        self.assertEquals(self.message, 'visible')
+
+    def testAddLogHandlerClearsShortcuts(self):
+        tester = LogTester()
+        tester.log("not visible")
+        log.addLogHandler(self.handler)
+        self.failIf('log' in LogTester.__dict__)
+        tester.log("visible")
+        self.assertEquals(self.message, 'visible')
+
+    def testSubclassCategory(self):
+        LogTester().debug("not visible")
+        OtherLogTester().debug("visible")
+        self.assertEquals(self.category, 'othertestlog')
+        self.assertEquals(self.message, 'visible')
+
+    def testInstanceCategory(self):
+        LogTester().debug("not visible")
+        tester = LogTester()
+        tester.logCategory = 'othertestlog'
+        tester.debug("visible")
+        self.assertEquals(self.message, 'visible')
+        self.failIf('debug' in tester.__dict__)
+
+    def testOwnMethodKept(self):
+        tester = OwnDebugTester()
+        tester.debug("own")
+        tester.debug("own again")
+        self.assertEquals(tester.debugged, ("own again", ))
+        self.failIf(hasattr(OwnDebugTester.__dict__['debug'], 'logShortcut'))
+        self.failIf('debug' in LogTester.__dict__)
+
+
+class TestThreadedLogWriter(unittest.TestCase):
+
+    def setUp(self):
+        log.reset()
+        log.setDebug("testlog:5")
+        from StringIO import StringIO
+        self.output = StringIO()
+        self.tester = LogTester()
+
+    def tearDown(self):
+        log.reset()
+
+    def testWrite(self):
+        writer = log.ThreadedLogWriter(self.output)
+        log.addLimitedLogHandler(writer.handle)
+        self.tester.debug("first")
+        self.tester.info("second %d", 2)
+        self.assertEquals(self.output.getvalue(), '')
+
+        writer.flush()
+        lines = self.output.getvalue().splitlines()
+        self.assertEquals(len(lines), 2)
+        self.failUnless('testlog' in lines[0])
+        self.failUnless(lines[0].split('(')[0].rstrip().endswith('first'))
+        self.failUnless('second 2' in lines[1])
+        self.assertEquals(writer.written, 2)
+
+    def testThread(self):
+        writer = log.ThreadedLogWriter(self.output)
+        log.addLimitedLogHandler(writer.handle)
+        writer.start()
+        for i in range(100):
+            self.tester.log("message %d", i)
+        writer.stop()
+        lines = self.output.getvalue().splitlines()
+        self.assertEquals(len(lines), 100)
+        self.failUnless('message 99' in lines[-1])
+
+    def testWakeUp(self):
+        writer = log.ThreadedLogWriter(self.output)
+        log.addLimitedLogHandler(writer.handle)
+        writer.start()
+        self.tester.log("message")
+        # written by the thread without being stopped
+        import time
+        for i in range(500):
+            if writer.written:
+                break
+            time.sleep(0.01)
+        self.assertEquals(writer.written, 1)
+        writer.stop()
+
+    def testForked(self):
+        writer = log.ThreadedLogWriter(self.output)
+        log.addLimitedLogHandler(writer.handle)
+        writer.start()
+        writer.stop()
+        # queued before forking, so the parent writes them
+        writer._records.append((0, log.LOG, None, 'testlog', 'f', 1, 'old'))
+        writer._thread, writer._pid = object(), -1
+        self.tester.log("new")
+        writer.stop()
+        lines = self.output.getvalue().splitlines()
+        self.assertEquals(len(lines), 1)
+        self.failUnless('new' in lines[0])
+
+    def testDropped(self):
+        writer = log.ThreadedLogWriter(self.output, maxRecords=3)
+        log.addLimitedLogHandler(writer.handle)
+        for i in range(5):
+            self.tester.log("message %d", i)
+        self.assertEquals(writer.dropped, 2)
+
+        writer.flush()
+        lines = self.output.getvalue().splitlines()
+        self.assertEquals(len(lines), 4)
+        self.failUnless('message 2' in lines[2])
+        self.failUnless('2 log messages dropped' in lines[3])
+        self.assertEquals(writer.written, 3)
+
+    def testJSONLines(self):
+        if log.json is None:
+            raise unittest.SkipTest("json module not available")
+        writer = log.ThreadedLogWriter(self.output, jsonLines=True)
+        log.addLimitedLogHandler(writer.handle)
+        self.tester.warning(u"caf\xe9")
+        writer.flush()
+        record = log.json.loads(self.output.getvalue())
+        self.assertEquals(record['level'], 'WARN')
+        self.assertEquals(record['category'], 'testlog')
+        self.assertEquals(record['message'], u"caf\xe9")
+
+    def testStartStop(self):
+        log.addLimitedLogHandler(log.stderrHandler)
+        writer = log.startThreadedWriter()
+        self.failUnless(log.startThreadedWriter() is writer)
+        self.failIf(log.stderrHandler in log._log_handlers_limited)
+        self.failUnless(writer.handle in log._log_handlers_limited)
+
+        log.stopThreadedWriter()
+        self.failUnless(log.stderrHandler in log._log_handlers_limited)
+        self.failIf(writer.handle in log._log_handlers_limited)
@@ -55,6 +55,17 @@ class AdminAvatar(base.ManagerAvatar):
     """
     logCategory = 'admin-avatar'
 
+    def __init__(self, heaven, avatarId, remoteIdentity, mind):
+        base.ManagerAvatar.__init__(self, heaven, avatarId, remoteIdentity,
+                                    mind)
+        self._subscriptionIds = []
+
+    def onShutdown(self):
+        for subscriptionId in self._subscriptionIds:
+            self.vishnu.subscriptions.unsubscribe(subscriptionId)
+        self._subscriptionIds = []
+        base.ManagerAvatar.onShutdown(self)
+
     # override pb.Avatar implementation so we can run admin actions
 
     def perspectiveMessageReceived(self, broker, message, args, kwargs):
@@ -80,6 +91,50 @@ class AdminAvatar(base.ManagerAvatar):
         self.debug("returning planet state %r" % self.vishnu.state)
         return self.vishnu.state
 
+    def perspective_subscribe(self, flows=None, components=None, keys=None):
+        """
+        Subscribe to some keys of some component states, instead of
+        observing the whole planet state. The changes are sent to
+        remote_subscriptionEvent on the admin medium.
+
+        See L{flumotion.manager.subscription.SubscriptionHub.subscribe}.
+
+        @param flows:      patterns of the names of the flows to watch
+        @type  flows:      list of str or None
+        @param components: patterns of the avatarIds of the components
+        @type  components: list of str or None
+        @param keys:       patterns of the keys of the component states
+        @type  keys:       list of str or None
+
+        @returns: the id of the subscription, and the matching keys of the
+                  matching components, by avatarId
+        @rtype:   tuple of (int, dict of str -> dict)
+        """
+        subscriptionId, snapshot = self.vishnu.subscriptions.subscribe(
+            self._subscriptionEvent, flows, components, keys)
+        self._subscriptionIds.append(subscriptionId)
+        return subscriptionId, snapshot
+
+    def perspective_unsubscribe(self, subscriptionId):
+        """
+        Cancel a subscription made with L{perspective_subscribe}.
+
+        @type subscriptionId: int
+        """
+        if subscriptionId not in self._subscriptionIds:
+            self.debug('not subscribed with id %r', subscriptionId)
+            return
+        self._subscriptionIds.remove(subscriptionId)
+        self.vishnu.subscriptions.unsubscribe(subscriptionId)
+
+    def _subscriptionEvent(self, subscriptionId, avatarId, event, args):
+        d = self.mindCallRemote('subscriptionEvent', subscriptionId,
+                                avatarId, event, args)
+        # the admin may be gone already
+        d.addErrback(lambda failure: self.debug(
+            'failed to send subscription event: %s',
+            log.getFailureMessage(failure)))
+
     def perspective_getWorkerHeavenState(self):
         """
         Get the worker heaven state.
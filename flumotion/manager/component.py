@@ -440,7 +440,7 @@ class ComponentAvatar(base.ManagerAvatar):
         Remove a keycard managed by this bouncer because the requester
         has gone.
 
-        @type  keycardId: str
+        @type  keycardId: int
         """
         return self.mindCallRemote('removeKeycardId', keycardId)
 
@@ -449,7 +449,7 @@ class ComponentAvatar(base.ManagerAvatar):
         Expire a keycard issued to this component because the bouncer decided
         to.
 
-        @type  keycardId: str
+        @type  keycardId: int
         """
         return self.mindCallRemote('expireKeycard', keycardId)
 
@@ -458,7 +458,7 @@ class ComponentAvatar(base.ManagerAvatar):
         Expire keycards issued to this component because the bouncer
         decided to.
 
-        @type  keycardIds: sequence of str
+        @type  keycardIds: sequence of int
         """
         return self.mindCallRemote('expireKeycards', keycardIds)
 
@@ -515,7 +515,7 @@ class ComponentAvatar(base.ManagerAvatar):
                               requested authentication for the given keycardId
         @type  requesterId: str
         @param keycardId:     id of keycard to expire
-        @type  keycardId:     str
+        @type  keycardId:     int
         """
         # FIXME: we should also be able to expire manager bouncer keycards
         if not self.heaven.hasAvatar(requesterId):
@@ -538,7 +538,7 @@ class ComponentAvatar(base.ManagerAvatar):
                             requested authentication for the given keycardId
         @type  requesterId: str
         @param keycardIds:  sequence of id of keycards to expire
-        @type  keycardIds:  sequence of str
+        @type  keycardIds:  sequence of int
         """
         if not self.heaven.hasAvatar(requesterId):
             self.warning('asked to expire %d keycards for requester %s, '
@@ -563,74 +563,115 @@ class dictlist(dict):
 
 
 class FeedMap(object, log.Loggable):
+    """
+    I map the eaters of the logged in components to the feeders they eat
+    from.
+
+    I am kept up to date as components attach and detach: only the
+    entries of the component and of the eaters of its feeds are updated,
+    so a planet logging in at once doesn't cost quadratic time.
+
+    When more than one component provides a feed, eaters eat from the
+    first one that attached.
+    """
     logName = 'feed-map'
 
     def __init__(self):
-        #FIXME: Use twisted.python.util.OrderedDict instead
         self.avatars = {}
-        self._ordered_avatars = []
-        self._dirty = True
-        self._recalc()
+        # eater full feed id -> (eaterAlias, feederAvatar, feederName)
+        self.feedersForEaters = {}
+        # feeder full feed id -> [(feederName, eaterAvatar, eaterAlias)]
+        self.eatersForFeeders = dictlist()
+        # full feed id -> [(feederAvatar, feederName)], in attach order
+        self.feeds = dictlist()
+        # feederAvatar -> [(eaterAvatar, full feed id)]
+        self.feedDeps = dictlist()
+        # full feed id -> [(eaterAvatar, feedId, eaterAlias, eater full
+        # feed id)], for all the eaters of the logged in components,
+        # eating or not
+        self._eaters = dictlist()
+        # eater full feed id -> feeder full feed id, for the bound eaters
+        self._bound = {}
+        # avatar -> (feeds, eaters) as they were when it attached; its
+        # state is gone by the time it detaches
+        self._attached = {}
 
     def componentAttached(self, avatar):
         assert avatar.avatarId not in self.avatars
         self.avatars[avatar.avatarId] = avatar
-        self._ordered_avatars.append(avatar)
-        self._dirty = True
+        feeds = self._getFeeds(avatar)
+        eaters = self._getEaters(avatar)
+        self._attached[avatar] = (feeds, eaters)
+        for ffid, pair in feeds:
+            self.feeds.add(ffid, pair)
+            if len(self.feeds[ffid]) == 1:
+                # first provider of the feed, so its eaters were waiting
+                for entry in self._eaters.get(ffid, []):
+                    self._bindEater(ffid, *entry)
+        for ffid, feedId, eName, eFfid in eaters:
+            self._eaters.add(ffid, (avatar, feedId, eName, eFfid))
+            self._bindEater(ffid, avatar, feedId, eName, eFfid)
 
     def componentDetached(self, avatar):
         # returns the a list of other components that will need to be
         # reconnected
         del self.avatars[avatar.avatarId]
-        self._ordered_avatars.remove(avatar)
-        self._dirty = True
-        # NB, feedDeps is dirty. Scrub it of avatars that have logged
-        # out
-        return [(a, f) for a, f in self.feedDeps.pop(avatar, [])
-                if a.avatarId in self.avatars]
-
-    def _getFeederAvatar(self, eater, feedId):
-        # FIXME: 'get' part is confusing - this methods _modifies_ structures!
-        flowName = eater.getParentName()
-        compName, feedName = common.parseFeedId(feedId)
-        ffid = common.fullFeedId(flowName, compName, feedName)
-        feeder = None
-        if ffid in self.feeds:
-            feeder, feedName = self.feeds[ffid][0]
-            self.feedDeps.add(feeder, (eater, ffid))
-            if feeder.getFeedId(feedName) != feedId:
-                self.debug('chose %s for feed %s',
-                           feeder.getFeedId(feedName), feedId)
-        return feeder, feedName
-
-    def _recalc(self):
-        if not self._dirty:
-            return
-        self.feedersForEaters = ffe = {}
-        self.eatersForFeeders = eff = dictlist()
-        self.feeds = dictlist()
-        self.feedDeps = dictlist()
+        feeds, eaters = self._attached.pop(avatar)
+        for ffid, feedId, eName, eFfid in eaters:
+            self._eaters.remove(ffid, (avatar, feedId, eName, eFfid))
+            self._unbindEater(ffid, avatar, eFfid)
+        for ffid, pair in feeds:
+            self.feeds.remove(ffid, pair)
+
+        deps = self.feedDeps.get(avatar, [])[:]
+        for ffid in dict.fromkeys([ffid for eater, ffid in deps]):
+            for eater, feedId, eName, eFfid in self._eaters[ffid]:
+                if self._unbindEater(ffid, eater, eFfid):
+                    self._bindEater(ffid, eater, feedId, eName, eFfid)
+        return deps
+
+    def _getFeeds(self, avatar):
+        ret = [(avatar.getFullFeedId(feederName), (avatar, feederName))
+               for feederName in avatar.getFeeders()]
+        ret.extend(avatar.getVirtualFeeds().items())
+        return ret
 
-        for comp in self._ordered_avatars:
-            for feederName in comp.getFeeders():
-                self.feeds.add(comp.getFullFeedId(feederName),
-                               (comp, feederName))
-            for ffid, pair in comp.getVirtualFeeds().items():
-                self.feeds.add(ffid, pair)
-
-        for eater in self.avatars.values():
-            for pairs in eater.getEaters().values():
-                for feedId, eName in pairs:
-                    feeder, fName = self._getFeederAvatar(eater, feedId)
-                    if feeder:
-                        ffe[eater.getFullFeedId(eName)] = (
-                            eName, feeder, fName)
-                        eff.add(feeder.getFullFeedId(fName),
-                                (fName, eater, eName))
-                    else:
-                        self.debug('eater %s waiting for feed %s to log in',
-                                   eater.getFeedId(eName), feedId)
-        self._dirty = False
+    def _getEaters(self, avatar):
+        flowName = avatar.getParentName()
+        ret = []
+        for pairs in avatar.getEaters().values():
+            for feedId, eName in pairs:
+                compName, feedName = common.parseFeedId(feedId)
+                ffid = common.fullFeedId(flowName, compName, feedName)
+                ret.append((ffid, feedId, eName,
+                            avatar.getFullFeedId(eName)))
+        return ret
+
+    def _bindEater(self, ffid, eater, feedId, eName, eFfid):
+        if ffid not in self.feeds:
+            self.debug('eater %s waiting for feed %s to log in',
+                       eFfid, feedId)
+            return
+        feeder, fName = self.feeds[ffid][0]
+        if feeder.getFeedId(fName) != feedId:
+            self.debug('chose %s for feed %s',
+                       feeder.getFeedId(fName), feedId)
+        fFfid = feeder.getFullFeedId(fName)
+        self.feedersForEaters[eFfid] = (eName, feeder, fName)
+        self.eatersForFeeders.add(fFfid, (fName, eater, eName))
+        self.feedDeps.add(feeder, (eater, ffid))
+        self._bound[eFfid] = fFfid
+
+    def _unbindEater(self, ffid, eater, eFfid):
+        # returns whether the eater was eating from a feeder
+        entry = self.feedersForEaters.pop(eFfid, None)
+        if entry is None:
+            return False
+        eName, feeder, fName = entry
+        self.eatersForFeeders.remove(self._bound.pop(eFfid),
+                                     (fName, eater, eName))
+        self.feedDeps.remove(feeder, (eater, ffid))
+        return True
 
     def getFeedersForEaters(self, avatar):
         """Get the set of feeds that this component is eating from,
@@ -639,7 +680,6 @@ class FeedMap(object, log.Loggable):
         @return: a list of (eaterAlias, feederAvatar, feedName) tuples
         @rtype:  list of (str, ComponentAvatar, str)
         """
-        self._recalc()
         ret = []
         for tups in avatar.getEaters().values():
             for feedId, alias in tups:
@@ -659,7 +699,6 @@ class FeedMap(object, log.Loggable):
         @return: a list of (eaterAlias, feederAvatar, feedName) tuples
         @rtype:  list of (str, L{ComponentAvatar}, str)
         """
-        self._recalc()
         ret = []
         for feeder, feedName in self.feeds.get(ffid, []):
             rffid = feeder.getFullFeedId(feedName)
@@ -676,7 +715,6 @@ class FeedMap(object, log.Loggable):
         @return: a list of (feederName, eaterAvatar, eaterAlias) tuples
         @rtype:  list of (str, ComponentAvatar, str)
         """
-        self._recalc()
         ret = []
         for feedName in avatar.getFeeders():
             ffid = avatar.getFullFeedId(feedName)
@@ -370,7 +370,8 @@ class ConfigEntryManager:
     "I represent a <manager> entry in a planet config file"
 
     def __init__(self, name, host, port, transport, certificate, bouncer,
-            fludebug, plugs):
+            fludebug, plugs, startupConcurrency=None,
+            startupWaitForProducers=None):
         self.name = name
         self.host = host
         self.port = port
@@ -379,6 +380,8 @@ class ConfigEntryManager:
         self.bouncer = bouncer
         self.fludebug = fludebug
         self.plugs = plugs
+        self.startupConcurrency = startupConcurrency
+        self.startupWaitForProducers = startupWaitForProducers
 
 
 class ConfigEntryAtmosphere:
@@ -717,7 +720,12 @@ class ManagerConfigParser(FlumotionConfigParser):
                    'certificate': (simpleparse(str), recordval('certificate')),
                    'component': (_ignore, _ignore),
                    'plugs': (_ignore, _ignore),
-                   'debug': (simpleparse(str), recordval('fludebug'))}
+                   'debug': (simpleparse(str), recordval('fludebug')),
+                   'startup-concurrency': (simpleparse(int),
+                                           recordval('startupConcurrency')),
+                   'startup-wait-for-producers': (
+                       simpleparse(common.strToBool),
+                       recordval('startupWaitForProducers'))}
         self.parseFromTable(node, parsers)
         return ret
 
@@ -747,7 +755,9 @@ class ManagerConfigParser(FlumotionConfigParser):
                    'certificate': (_ignore, _ignore),
                    'component': (parsecomponent, gotcomponent),
                    'plugs': (parseplugs, gotplugs),
-                   'debug': (_ignore, _ignore)}
+                   'debug': (_ignore, _ignore),
+                   'startup-concurrency': (_ignore, _ignore),
+                   'startup-wait-for-producers': (_ignore, _ignore)}
         self.parseFromTable(node, parsers)
 
     def parseBouncerAndPlugs(self):
@@ -41,6 +41,7 @@ from flumotion.common.netutils import addressGetHost
 from flumotion.common.planet import moods
 from flumotion.configure import configure
 from flumotion.manager import admin, component, worker, base, config
+from flumotion.manager import startup, subscription
 from flumotion.twisted import portal as fportal
 from flumotion.project import project
 
@@ -178,6 +179,10 @@ class Vishnu(log.Loggable):
     @type componentHeaven: L{component.ComponentHeaven}
     @cvar adminHeaven:     the admin heaven
     @type adminHeaven:     L{admin.AdminHeaven}
+    @cvar startup:         the scheduler creating components on workers
+    @type startup:         L{startup.StartupScheduler}
+    @cvar subscriptions:   the subscriptions of admins to the planet state
+    @type subscriptions:   L{subscription.SubscriptionHub}
     @cvar configDir:       the configuration directory for
                            this Vishnu's manager
     @type configDir:       str
@@ -198,6 +203,7 @@ class Vishnu(log.Loggable):
                                                   component.ComponentHeaven)
         self.adminHeaven = self._createHeaven(interfaces.IAdminMedium,
                                               admin.AdminHeaven)
+        self.startup = startup.StartupScheduler(self._workerCreateComponent)
 
         self.running = True
 
@@ -220,6 +226,7 @@ class Vishnu(log.Loggable):
         self.state = planet.ManagerPlanetState()
         self.state.set('name', name)
         self.state.set('version', configure.version)
+        self.subscriptions = subscription.SubscriptionHub(self.state)
 
         self.plugs = {} # socket -> list of plugs
 
@@ -243,6 +250,7 @@ class Vishnu(log.Loggable):
         @returns: A deferred that will fire when the manager has shut
         down.
         """
+        self.startup.stop()
         if self.bouncer:
             return self.bouncer.stop()
         else:
@@ -621,6 +629,10 @@ class Vishnu(log.Loggable):
         """
         self.debug('loading configuration')
         conf = config.ManagerConfigParser(file)
+        if conf.manager and conf.manager.startupConcurrency:
+            self.startup.concurrency = conf.manager.startupConcurrency
+        if conf.manager and conf.manager.startupWaitForProducers:
+            self.startup.waitForProducers = True
         conf.parseBouncerAndPlugs()
         self._loadManagerPlugs(conf)
         self._loadManagerBouncer(conf)
@@ -918,8 +930,8 @@ class Vishnu(log.Loggable):
 
     def _workerCreateComponents(self, workerId, components):
         """
-        Create the list of components on the given worker, sequentially, but
-        in no specific order.
+        Schedule the creation of the list of components on the given
+        worker, in the order of the flow graph.
 
         @param workerId:   avatarId of the worker
         @type  workerId:   string
@@ -935,46 +947,34 @@ class Vishnu(log.Loggable):
                        'component start' % workerId)
             return defer.succeed(None)
 
-        workerAvatar = self.workerHeaven.avatars[workerId]
-
-        d = defer.Deferred()
-
         for c in components:
-            componentType = c.get('type')
-            conf = c.get('config')
-            self.debug('scheduling create of %s on %s'
-                       % (conf['avatarId'], workerId))
-            d.addCallback(self._workerCreateComponentDelayed,
-                workerAvatar, c, componentType, conf)
-
-        d.addCallback(lambda result: self.debug(
-            '_workerCreateComponents(): completed setting up create chain'))
-
-        # now trigger the chain
-        self.debug('_workerCreateComponents(): triggering create chain')
-        d.callback(None)
-        #reactor.callLater(0, d.callback, None)
-        return d
-
-    def _workerCreateComponentDelayed(self, result, workerAvatar,
-            componentState, componentType, conf):
-
+            # we set the moodPending to HAPPY, so this component only gets
+            # asked to start once
+            c.set('moodPending', moods.happy.value)
+        self.startup.schedule(workerId, components)
+        return defer.succeed(None)
+
+    def _workerCreateComponent(self, workerId, componentState):
+        # called by the startup scheduler when the component can be created
+        conf = componentState.get('config')
         avatarId = conf['avatarId']
         nice = conf.get('nice', 0)
 
-        # we set the moodPending to HAPPY, so this component only gets
-        # asked to start once
-        componentState.set('moodPending', moods.happy.value)
+        if not workerId in self.workerHeaven.avatars:
+            self.debug('worker %s logged out, not creating %s',
+                       workerId, avatarId)
+            componentState.set('moodPending', None)
+            return None
 
-        d = workerAvatar.createComponent(avatarId, componentType, nice,
-                                         conf)
+        workerAvatar = self.workerHeaven.avatars[workerId]
+        self.debug('creating %s on %s', avatarId, workerId)
+        d = workerAvatar.createComponent(avatarId, componentState.get('type'),
+                                         nice, conf)
         # FIXME: here we get the avatar Id of the component we wanted
         # started, so now attach it to the planetState's component state
         d.addCallback(self._createCallback, componentState)
         d.addErrback(self._createErrback, componentState)
-
-        # FIXME: shouldn't we return d here to make sure components
-        # wait on each other to be started ?
+        return d
 
     def _createCallback(self, result, componentState):
         self.debug('got avatarId %s for state %s' % (result, componentState))
@@ -1049,6 +1049,8 @@ class Vishnu(log.Loggable):
         self._componentMappers[m.id] = m
         self._componentMappers[m.avatar] = m
 
+        self.startup.componentLoggedIn(m.state, m.jobState)
+
     def unregisterComponent(self, componentAvatar):
         # called when the component is logging out
         # clear up jobState and avatar
@@ -1057,6 +1059,8 @@ class Vishnu(log.Loggable):
 
         m = self._componentMappers[componentAvatar]
 
+        self.startup.componentLoggedOut(m.state, m.jobState)
+
         # unmap jobstate
         try:
             del self._componentMappers[m.jobState]
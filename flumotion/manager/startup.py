@@ -0,0 +1,381 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_manager_startup -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""
+dependency-aware scheduling of component creation on the workers
+"""
+
+import time
+from collections import deque
+
+from twisted.internet import reactor
+
+from flumotion.common import common, dag, log
+from flumotion.common.planet import moods
+
+__version__ = "$Rev$"
+
+# number of components started at the same time on a worker, or None
+DEFAULT_CONCURRENCY = None
+# seconds a starting component can keep its slot on the worker
+DEFAULT_TIMEOUT = 60.0
+
+
+def _getFeeds(conf):
+    # full feed ids of the feeds, real or virtual, a component provides
+    flowName = conf['parent']
+    ret = [common.fullFeedId(flowName, conf['name'], feedName)
+           for feedName in conf.get('feed', [])]
+    for feedId in conf.get('virtual-feeds', {}).keys():
+        compName, feedName = common.parseFeedId(feedId)
+        ret.append(common.fullFeedId(flowName, compName, feedName))
+    return ret
+
+
+def _getEatenFeeds(conf):
+    # full feed ids of the feeds a component eats from
+    flowName = conf['parent']
+    ret = []
+    for pairs in conf.get('eater', {}).values():
+        for feedId, alias in pairs:
+            compName, feedName = common.parseFeedId(feedId)
+            ret.append(common.fullFeedId(flowName, compName, feedName))
+    return ret
+
+
+class StartupScheduler(log.Loggable):
+    """
+    I create components on their workers in the order of the flow graph:
+    producers first, then the components eating from them.
+
+    At most L{concurrency} components are starting on a worker at the
+    same time, all of them by default. A component stops taking a slot
+    when it becomes happy, hungry, sad or lost, or after L{timeout}
+    seconds. Consumers whose producers started are created before
+    anything else waiting for the same worker.
+
+    With L{waitForProducers}, components eating from a feed provided by
+    another component I still have to start are only created once that
+    component is started, that is happy or hungry for its own feeds.
+    This is off by default: each level of a flow then adds the time its
+    components take to start to the cold start, and a producer that never
+    starts delays its consumers by up to L{timeout} seconds.
+
+    The time each component took to become happy is logged and kept in
+    L{timeToHappy}.
+    """
+
+    logCategory = 'startup'
+
+    def __init__(self, create, concurrency=DEFAULT_CONCURRENCY,
+                 timeout=DEFAULT_TIMEOUT, waitForProducers=False):
+        """
+        @param create:      procedure called to create a component on a
+                            worker, returning a deferred firing when the
+                            worker spawned it, or None if it couldn't try
+        @type  create:      procedure(workerId, componentState) ->
+                            L{twisted.internet.defer.Deferred} or None
+        @param concurrency: number of components starting at the same time
+                            on a worker, or None for no limit
+        @type  concurrency: int
+        @param timeout:     seconds a starting component can keep its slot
+        @type  timeout:     float
+        @param waitForProducers: whether to create components only once
+                                 the components they eat from started
+        @type  waitForProducers: bool
+        """
+        self._create = create
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.waitForProducers = waitForProducers
+
+        # components scheduled but not settled yet, with the edges from
+        # producers to consumers
+        self._dag = dag.DAG()
+        self._workers = {} # componentState -> workerId
+        self._providers = {} # full feed id -> componentState
+        self._queues = {} # workerId -> deque of componentState ready
+
+        self._slots = {} # componentState -> timeout DelayedCall
+        self._running = {} # workerId -> number of slots taken
+
+        self._scheduled = {} # componentState -> time of schedule
+        self._created = {} # componentState -> time of create
+        self._jobStates = {} # jobState -> componentState
+        self._batchStart = None
+
+        # avatarId -> seconds between create and happy
+        self.timeToHappy = {}
+
+    ### public API
+
+    def schedule(self, workerId, componentStates):
+        """
+        Schedule the creation of components on a worker.
+
+        @type workerId:        str
+        @type componentStates: list of
+                               L{flumotion.common.planet.ManagerComponentState}
+        """
+        now = time.time()
+        if not self._workers:
+            self._batchStart = now
+        new = [s for s in componentStates if s not in self._workers]
+        for state in new:
+            self._workers[state] = workerId
+            self._scheduled[state] = now
+            self._dag.addNode(state)
+            for ffid in _getFeeds(state.get('config')):
+                self._providers.setdefault(ffid, state)
+
+        # components scheduled earlier may eat from the new ones too
+        edges = []
+        for consumer in self._workers:
+            if consumer in self._created:
+                continue
+            for ffid in _getEatenFeeds(consumer.get('config')):
+                producer = self._providers.get(ffid)
+                if producer is None or producer is consumer:
+                    continue
+                if consumer in self._dag.getChildren(producer):
+                    continue
+                self._dag.addEdge(producer, consumer)
+                edges.append((producer, consumer))
+
+        try:
+            self._dag.hasCycle()
+        except dag.CycleError:
+            self.warning('components eat from each other in a cycle, '
+                         'starting them in no particular order')
+            for producer, consumer in edges:
+                self._dag.removeEdge(producer, consumer)
+
+        # producers first, so their consumers can follow soon
+        if self.waitForProducers:
+            ready = [state for state in new
+                     if not self._dag.getParents(state)]
+        else:
+            ready = list(new)
+        depths = {}
+        ready.sort(key=lambda state: (self._getDepth(state, depths),
+                                      not self._dag.getChildren(state)))
+        self.debug('scheduling %d components on %s, %d ready',
+                   len(new), workerId, len(ready))
+        for state in ready:
+            self._queue(state)
+        self._createReady(workerId)
+
+    def stop(self):
+        """
+        Stop creating components, forgetting those still scheduled.
+        """
+        for call in self._slots.values():
+            if call.active():
+                call.cancel()
+        for jobState in self._jobStates.keys():
+            jobState.removeListener(self)
+        self._dag = dag.DAG()
+        self._workers = {}
+        self._providers = {}
+        self._queues = {}
+        self._slots = {}
+        self._running = {}
+        self._scheduled = {}
+        self._created = {}
+        self._jobStates = {}
+        self._batchStart = None
+
+    def componentLoggedIn(self, componentState, jobState):
+        """
+        Tell me a component logged in, so I can follow its mood.
+
+        @type componentState: L{flumotion.common.planet.ManagerComponentState}
+        @type jobState:       L{flumotion.common.planet.ManagerJobState}
+        """
+        if componentState not in self._created:
+            return
+        self._jobStates[jobState] = componentState
+        jobState.addListener(self, set_=self.stateSet)
+        self._moodChanged(componentState, jobState.get('mood'))
+
+    def componentLoggedOut(self, componentState, jobState):
+        """
+        Tell me a component logged out.
+
+        @type componentState: L{flumotion.common.planet.ManagerComponentState}
+        @type jobState:       L{flumotion.common.planet.ManagerJobState}
+        """
+        if jobState in self._jobStates:
+            del self._jobStates[jobState]
+            jobState.removeListener(self)
+        self._forget(componentState)
+        self._settle(componentState)
+
+    def getStarting(self, workerId):
+        """
+        @returns: the number of components starting on the worker
+        @rtype:   int
+        """
+        return self._running.get(workerId, 0)
+
+    def getQueued(self, workerId):
+        """
+        @returns: the number of components ready to be created on the
+                  worker once a slot is free
+        @rtype:   int
+        """
+        return len(self._queues.get(workerId, ()))
+
+    ### IStateListener methods
+
+    def stateSet(self, jobState, key, value):
+        if key == 'mood' and jobState in self._jobStates:
+            self._moodChanged(self._jobStates[jobState], value)
+
+    ### private methods
+
+    def _getDepth(self, state, depths):
+        # length of the longest chain of producers of the component
+        if state not in depths:
+            depths[state] = max([self._getDepth(parent, depths) + 1
+                                 for parent in self._dag.getParents(state)]
+                                or [0])
+        return depths[state]
+
+    def _isFull(self, workerId):
+        return (self.concurrency is not None
+                and self.getStarting(workerId) >= self.concurrency)
+
+    def _queue(self, state, first=False):
+        workerId = self._workers[state]
+        if workerId not in self._queues:
+            self._queues[workerId] = deque()
+        if first:
+            self._queues[workerId].appendleft(state)
+        else:
+            self._queues[workerId].append(state)
+
+    def _createReady(self, workerId):
+        queue = self._queues.get(workerId)
+        while queue and not self._isFull(workerId):
+            state = queue.popleft()
+            # it may have settled, or found a new producer, while queued
+            if state not in self._workers or state in self._created:
+                continue
+            if self.waitForProducers and self._dag.getParents(state):
+                continue
+            self._createComponent(workerId, state)
+        if not queue and workerId in self._queues:
+            del self._queues[workerId]
+
+    def _createComponent(self, workerId, state):
+        self.debug('creating %s on %s', state.get('name'), workerId)
+        self._running[workerId] = self.getStarting(workerId) + 1
+        self._slots[state] = reactor.callLater(self.timeout,
+                                               self._timedOut, state)
+        self._created[state] = time.time()
+
+        d = self._create(workerId, state)
+        if d is None:
+            self._forget(state)
+            self._settle(state)
+        else:
+            d.addCallback(self._createdCallback, state)
+
+    def _createdCallback(self, result, state):
+        # the create errback sets the mood when it failed
+        if state.get('mood') in (moods.sad.value, moods.lost.value):
+            self._forget(state)
+            self._settle(state)
+        return result
+
+    def _timedOut(self, state):
+        self.warning('%s did not start in %d seconds, starting the '
+                     'components waiting for it anyway',
+                     state.get('name'), self.timeout)
+        self._settle(state)
+
+    def _moodChanged(self, state, mood):
+        if mood == moods.happy.value:
+            if state in self._created:
+                self._reportHappy(state)
+            self._settle(state)
+        elif mood == moods.hungry.value:
+            # started, and waiting for its eaters to connect
+            self._settle(state)
+        elif mood in (moods.sad.value, moods.lost.value):
+            self._forget(state)
+            self._settle(state)
+
+    def _reportHappy(self, state):
+        now = time.time()
+        conf = state.get('config')
+        created = self._created[state]
+        scheduled = self._scheduled.get(state, created)
+        self.timeToHappy[conf['avatarId']] = now - created
+        self.info('%s happy %.3f seconds after being created, %.3f seconds '
+                  'after being scheduled', conf['avatarId'],
+                  now - created, now - scheduled)
+        self._forget(state)
+
+    def _forget(self, state):
+        # stop following the mood of the component
+        self._created.pop(state, None)
+        self._scheduled.pop(state, None)
+        for jobState, s in self._jobStates.items():
+            if s is state:
+                del self._jobStates[jobState]
+                jobState.removeListener(self)
+
+    def _settle(self, state):
+        # free the slot taken by the component on its worker, and create
+        # the components eating from it if they don't wait for others
+        if state not in self._workers:
+            return
+        workerId = self._workers.pop(state)
+        workerIds = {}
+        call = self._slots.pop(state, None)
+        if call is not None:
+            if call.active():
+                call.cancel()
+            self._running[workerId] -= 1
+            if not self._running[workerId]:
+                del self._running[workerId]
+            workerIds[workerId] = True
+        if state not in self._created:
+            self._scheduled.pop(state, None)
+        for ffid in _getFeeds(state.get('config')):
+            if self._providers.get(ffid) is state:
+                del self._providers[ffid]
+
+        consumers = self._dag.getChildren(state)
+        for consumer in consumers:
+            self._dag.removeEdge(state, consumer)
+        self._dag.removeNode(state)
+        for consumer in consumers:
+            if consumer in self._created:
+                continue
+            if not self._dag.getParents(consumer):
+                self._queue(consumer, first=True)
+                workerIds[self._workers[consumer]] = True
+        for workerId in workerIds:
+            self._createReady(workerId)
+
+        if not self._workers and self._batchStart is not None:
+            self.info('all scheduled components settled in %.3f seconds',
+                      time.time() - self._batchStart)
+            self._batchStart = None
@@ -0,0 +1,278 @@
+# -*- test-case-name: flumotion.test.test_manager_subscription -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""
+subscriptions of admin clients to parts of the planet state
+"""
+
+import fnmatch
+
+from flumotion.common import common, log
+
+__version__ = "$Rev$"
+
+# keys never sent to subscribers; their value is the flow state
+_skippedKeys = ('parent', )
+
+
+def _matches(patterns, name):
+    if patterns is None:
+        return True
+    for pattern in patterns:
+        if fnmatch.fnmatchcase(name, pattern):
+            return True
+    return False
+
+
+class Subscription(object):
+    """
+    I am the subscription of an admin client to some keys of some
+    component states.
+
+    Each of flows, components and keys is a list of shell-style patterns,
+    or None to match everything.
+
+    @ivar id:         the id of the subscription
+    @type id:         int
+    @ivar notify:     procedure called with the subscription id, the
+                      avatarId of the component, the event name and its
+                      arguments
+    @type notify:     procedure(int, str, str, tuple) -> None
+    @ivar flows:      patterns of the names of the flows, or 'atmosphere'
+    @type flows:      list of str or None
+    @ivar components: patterns of the avatarIds of the components
+    @type components: list of str or None
+    @ivar keys:       patterns of the keys of the component states
+    @type keys:       list of str or None
+    """
+
+    def __init__(self, subscriptionId, notify, flows=None, components=None,
+                 keys=None):
+        self.id = subscriptionId
+        self.notify = notify
+        self.flows = flows
+        self.components = components
+        self.keys = keys
+
+    def matchesComponent(self, flowName, avatarId):
+        return (_matches(self.flows, flowName)
+                and _matches(self.components, avatarId))
+
+    def matchesKey(self, key):
+        return key not in _skippedKeys and _matches(self.keys, key)
+
+    def getSnapshot(self, componentState):
+        """
+        @returns: the keys of the component state I match, and their value
+        @rtype:   dict of str -> object
+        """
+        return dict([(key, componentState.get(key))
+                     for key in componentState.keys()
+                     if self.matchesKey(key)])
+
+
+class SubscriptionHub(log.Loggable):
+    """
+    I tell admin clients about the changes of the parts of the component
+    states they subscribed to.
+
+    Unlike the observers of the whole planet state, subscribers only get
+    the changes they asked for, filtered here in the manager. The
+    components each subscription matches are computed when the
+    subscription is made or the component is added, so a change is only
+    compared to the keys of the subscriptions matching its component.
+
+    The planet state is only watched while there are subscriptions.
+
+    Subscribers are notified of these events:
+     - set, append, remove: arguments (key, value)
+     - setitem, delitem: arguments (key, subkey, value)
+     - added: a matching component was added; argument (snapshot, ), the
+       dict of the matching keys and their value
+     - removed: a matching component was removed; no arguments
+    """
+
+    logCategory = 'subscriptions'
+
+    def __init__(self, planetState):
+        """
+        @type planetState: L{flumotion.common.planet.ManagerPlanetState}
+        """
+        self._planet = planetState
+        self._subscriptions = {} # subscription id -> Subscription
+        self._nextId = 1
+        self._groups = [] # atmosphere and flow states watched
+        self._ids = {} # ManagerComponentState -> (flowName, avatarId)
+        # ManagerComponentState -> list of Subscription matching it
+        self._matching = {}
+
+    ### public API
+
+    def subscribe(self, notify, flows=None, components=None, keys=None):
+        """
+        Subscribe to some keys of some component states.
+
+        @param notify:     procedure called for each change, with the
+                           subscription id, the avatarId of the component,
+                           the event name and its arguments
+        @type  notify:     procedure(int, str, str, tuple) -> None
+        @param flows:      patterns of the names of the flows to watch,
+                           'atmosphere' included, or None for all
+        @type  flows:      list of str or None
+        @param components: patterns of the avatarIds of the components to
+                           watch, or None for all
+        @type  components: list of str or None
+        @param keys:       patterns of the keys to watch, or None for all
+        @type  keys:       list of str or None
+
+        @returns: the id of the subscription, and the snapshot of the
+                  matching keys of the matching components, by avatarId
+        @rtype:   tuple of (int, dict of str -> dict)
+        """
+        if not self._subscriptions:
+            self._startWatching()
+
+        subscription = Subscription(self._nextId, notify, flows, components,
+                                    keys)
+        self._nextId += 1
+        self._subscriptions[subscription.id] = subscription
+
+        snapshot = {}
+        for state, (flowName, avatarId) in self._ids.items():
+            if subscription.matchesComponent(flowName, avatarId):
+                self._matching[state].append(subscription)
+                snapshot[avatarId] = subscription.getSnapshot(state)
+        self.debug('subscription %d to flows %r, components %r, keys %r '
+                   'matches %d components', subscription.id, flows,
+                   components, keys, len(snapshot))
+        return subscription.id, snapshot
+
+    def unsubscribe(self, subscriptionId):
+        """
+        Cancel a subscription.
+
+        @type subscriptionId: int
+        """
+        subscription = self._subscriptions.pop(subscriptionId)
+        for subscriptions in self._matching.values():
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+        if not self._subscriptions:
+            self._stopWatching()
+
+    def getSubscriptionCount(self):
+        """
+        @rtype: int
+        """
+        return len(self._subscriptions)
+
+    ### private methods
+
+    def _startWatching(self):
+        self._planet.addWatcher(self, append=self._flowAppended,
+                                remove=self._flowRemoved)
+        self._addGroup(self._planet.get('atmosphere'))
+        for flow in self._planet.get('flows'):
+            self._addGroup(flow)
+
+    def _stopWatching(self):
+        self._planet.removeWatcher(self)
+        for group in self._groups:
+            group.removeWatcher(self)
+        for state in self._ids:
+            state.removeWatcher(self)
+        self._groups = []
+        self._ids = {}
+        self._matching = {}
+
+    def _addGroup(self, group, announce=False):
+        self._groups.append(group)
+        group.addWatcher(self, append=self._componentAppended,
+                         remove=self._componentRemoved)
+        for state in group.get('components'):
+            self._addComponent(group, state, announce)
+
+    def _removeGroup(self, group):
+        if group not in self._groups:
+            return
+        self._groups.remove(group)
+        group.removeWatcher(self)
+        for state in group.get('components'):
+            self._removeComponent(state)
+
+    def _addComponent(self, group, state, announce):
+        flowName = group.get('name')
+        avatarId = common.componentId(flowName, state.get('name'))
+        self._ids[state] = (flowName, avatarId)
+        self._matching[state] = [s for s in self._subscriptions.values()
+                                 if s.matchesComponent(flowName, avatarId)]
+        state.addWatcher(self, set_=self._proxy('set'),
+                         append=self._proxy('append'),
+                         remove=self._proxy('remove'),
+                         setitem=self._proxyItem('setitem'),
+                         delitem=self._proxyItem('delitem'))
+        if announce:
+            for subscription in self._matching[state]:
+                subscription.notify(subscription.id, avatarId, 'added',
+                                    (subscription.getSnapshot(state), ))
+
+    def _removeComponent(self, state):
+        if state not in self._ids:
+            return
+        state.removeWatcher(self)
+        flowName, avatarId = self._ids.pop(state)
+        for subscription in self._matching.pop(state):
+            subscription.notify(subscription.id, avatarId, 'removed', ())
+
+    def _dispatch(self, state, event, key, args):
+        subscriptions = self._matching.get(state)
+        if not subscriptions:
+            return
+        avatarId = self._ids[state][1]
+        for subscription in subscriptions[:]:
+            if subscription.matchesKey(key):
+                subscription.notify(subscription.id, avatarId, event, args)
+
+    def _proxy(self, event):
+
+        def proc(state, key, value):
+            self._dispatch(state, event, key, (key, value))
+        return proc
+
+    def _proxyItem(self, event):
+
+        def proc(state, key, subkey, value):
+            self._dispatch(state, event, key, (key, subkey, value))
+        return proc
+
+    ### watcher procedures
+
+    def _flowAppended(self, planet, key, value):
+        if key == 'flows':
+            self._addGroup(value, announce=True)
+
+    def _flowRemoved(self, planet, key, value):
+        if key == 'flows':
+            self._removeGroup(value)
+
+    def _componentAppended(self, group, key, value):
+        if key == 'components':
+            self._addComponent(group, value, announce=True)
+
+    def _componentRemoved(self, group, key, value):
+        if key == 'components':
+            self._removeComponent(value)
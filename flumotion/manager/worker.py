@@ -159,6 +159,17 @@ class WorkerAvatar(base.ManagerAvatar):
         self.debug('received message from component %s' % avatarId)
         self.vishnu.componentAddMessage(avatarId, message)
 
+    def perspective_checkStats(self, stats):
+        """
+        Called by the worker to report the statistics of its check result
+        cache, published in the worker heaven state.
+
+        @type stats: dict
+        """
+        state = self.heaven.getWorkerState(self.getName())
+        if state:
+            state.set('checks', stats)
+
 
 class WorkerHeaven(base.ManagerHeaven):
     """
@@ -176,6 +187,33 @@ class WorkerHeaven(base.ManagerHeaven):
 
     ### my methods
 
+    def getRoundTripTimes(self):
+        """
+        Get the round trip times to the logged in workers, as measured by
+        their heartbeats; for example to choose the worker to run a
+        component on.
+
+        @returns: worker name -> moving average of the round trip times
+                  in seconds, or None if not measured yet
+        @rtype:   dict of str -> float
+        """
+        ret = {}
+        for avatar in self.getAvatars():
+            stats = avatar.getHeartbeatStats()
+            ret[avatar.getName()] = stats and stats['rtt-average']
+        return ret
+
+    def getWorkerState(self, workerName):
+        """
+        @returns: the state of the given worker, or None if it is not
+                  logged in
+        @rtype:   L{flumotion.common.worker.ManagerWorkerState}
+        """
+        for state in self.state.get('workers'):
+            if state.get('name') == workerName:
+                return state
+        return None
+
     def workerAttached(self, workerAvatar):
         """
         Notify the heaven that the given worker has logged in.
@@ -53,16 +53,16 @@ class Mood(util.LogCommand):
         self.parentCommand.managerDeferred.addCallback(self._callback)
 
     def _callback(self, result):
-        d = self.parentCommand.adminModel.callRemote('getPlanetState')
+        d = self.parentCommand.adminModel.subscribe(
+            components=[self._component], keys=['mood'])
 
-        def gotPlanetStateCb(result):
-            self.debug('gotPlanetStateCb')
-            c = util.findComponent(result, self._component)
-            if not c:
+        def subscribedCb(subscription):
+            self.debug('subscribedCb')
+            if self._component not in subscription.components:
                 return util.unknown('Could not find component %s' %
                     self._component)
 
-            moodValue = c.get('mood')
+            moodValue = subscription.get(self._component, 'mood')
             moodName = planet.moods.get(moodValue).name
 
             if moodName in self._critical:
@@ -76,23 +76,25 @@ class Mood(util.LogCommand):
             return util.ok('Component %s is %s' % (self._component,
                 moodName))
 
-        d.addCallback(gotPlanetStateCb)
+        d.addCallback(subscribedCb)
         d.addCallback(lambda e: setattr(reactor, 'exitStatus', e))
         return d
 
 
 class FlipFlopDetector(object):
 
-    def __init__(self, timeout, flipflops, mood_a, mood_b, state):
+    def __init__(self, timeout, flipflops, mood_a, mood_b, subscription,
+                 avatarId):
         self.timeout = timeout
         self.flipflops = flipflops
         self.mood_a = mood_a
         self.mood_b = mood_b
-        self.state = state
+        self.subscription = subscription
+        self.avatarId = avatarId
 
         self.cancel = None
         self.flip_count = 0
-        if state.get('mood') == self.mood_a:
+        if subscription.get(avatarId, 'mood') == self.mood_a:
             self.current_state = self.mood_a
         else:
             self.current_state = None
@@ -102,12 +104,12 @@ class FlipFlopDetector(object):
         return self.waiting_d
 
     def start(self):
-        self.state.addListener(self, set_=self.state_set)
+        self.subscription.addListener(self, set_=self.state_set)
         self.cancel = reactor.callLater(self.timeout,
                                         self.success)
 
-    def state_set(self, cs, key, value):
-        if key != 'mood':
+    def state_set(self, avatarId, key, value):
+        if avatarId != self.avatarId or key != 'mood':
             return
 
         # the first time it goes to mood_a is not treated as a flip
@@ -125,7 +127,7 @@ class FlipFlopDetector(object):
             self.failure()
 
     def success(self):
-        self.state.removeListener(self)
+        self.subscription.removeListener(self)
         s = ''
         if self.flip_count != 1:
             s = 's'
@@ -133,7 +135,7 @@ class FlipFlopDetector(object):
                                 (self.flip_count, s))
 
     def failure(self):
-        self.state.removeListener(self)
+        self.subscription.removeListener(self)
         if self.cancel:
             self.cancel.cancel()
         s = ''
@@ -190,22 +192,22 @@ class FlipFlop(util.LogCommand):
         self.flipflops = options.flipflops
 
     def do(self, args):
-        self.parentCommand.managerDeferred.addCallback(self._get_planet_state)
-        self.parentCommand.managerDeferred.addCallback(self._got_planet_state)
+        self.parentCommand.managerDeferred.addCallback(self._subscribe)
+        self.parentCommand.managerDeferred.addCallback(self._subscribed)
 
-    def _get_planet_state(self, _):
-        return self.parentCommand.adminModel.callRemote('getPlanetState')
+    def _subscribe(self, _):
+        return self.parentCommand.adminModel.subscribe(
+            components=[self.component_id], keys=['mood'])
 
-    def _got_planet_state(self, planet_state):
-        c = util.findComponent(planet_state, self.component_id)
-        if not c:
+    def _subscribed(self, subscription):
+        if self.component_id not in subscription.components:
             return util.unknown('Could not find component %s' %
                                 self.component_id)
-        return self._detect_flipflops(c)
+        return self._detect_flipflops(subscription)
 
-    def _detect_flipflops(self, component_state):
+    def _detect_flipflops(self, subscription):
         f = FlipFlopDetector(self.timeout, self.flipflops, self.mood_a,
-                             self.mood_b, component_state)
+                             self.mood_b, subscription, self.component_id)
         f.start()
         d = f.wait()
         return d.addCallbacks(util.ok, lambda f:
@@ -160,7 +160,8 @@ class Manager(util.LogCommand):
             d = self.adminModel.connectToHost(connection.host,
                 connection.port, not connection.use_ssl)
         else:
-            d = self.adminModel.connectToManager(connection)
+            # the checks subscribe to the keys they need
+            d = self.adminModel.connectToManager(connection, fullState=False)
 
         d.addCallback(self._connectedCb)
         d.addErrback(self._connectedEb)
@@ -208,6 +208,7 @@ class TestMultiBouncerPlug(bouncertest.BouncerTestHelper,\
         comp = component.BaseComponent(componentProps)
         # mock method instead using HTTPStreamer
         comp.remove_client = callable
+        comp.remove_clients = callable
         http_auth = http.HTTPAuthentication(comp)
         bouncer = http_auth.plug
         self.keycard._fd = 100
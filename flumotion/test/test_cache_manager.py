@@ -58,6 +58,9 @@ class DummyStats:
     def onCleanup(self):
         self.oncleanup += 1
 
+    def onShardStatistics(self, shards):
+        self.shards = shards
+
 
 class TestCacheManager(testsuite.TestCase):
 
@@ -94,7 +97,7 @@ class TestCacheManager(testsuite.TestCase):
             raise
 
     def checkUsage(self, usage, m, size):
-        self.failIf(abs(m._cacheUsage - size) > MAX_PAGE_SIZE)
+        self.failIf(abs(m.getCacheUsage() - size) > MAX_PAGE_SIZE)
 
     def _releaseCacheSpace(self, tag, m):
         self.checkUsage(None, m, 100 * 1024)
@@ -238,6 +241,22 @@ class TestCacheManager(testsuite.TestCase):
 
         return d
 
+    def testCleanUpListsInThread(self):
+        m = cachemanager.CacheManager(self.stats, self.path,
+                                      CACHE_SIZE, True, 0.4, 0.2)
+        called = []
+        deferToThread = threads.deferToThread
+
+        def recordingDeferToThread(f, *args):
+            called.append(f)
+            return deferToThread(f, *args)
+        self.patch(threads, 'deferToThread', recordingDeferToThread)
+
+        d = m._cleanUp(m.getShards()[0])
+        # the cached files are listed out of the reactor thread
+        self.assertEquals(called, [cachemanager._listFiles])
+        return d
+
     def testConflict(self):
 
         def writeContent(f):
@@ -427,3 +446,95 @@ class TestCacheManager(testsuite.TestCase):
         dl.append(d)
 
         return defer.DeferredList(dl)
+
+
+class TestShardedCacheManager(testsuite.TestCase):
+
+    def setUp(self):
+        from twisted.python import threadpool
+        reactor.threadpool = threadpool.ThreadPool(0, 10)
+        reactor.threadpool.start()
+
+        self.path = tempfile.mkdtemp(suffix=".flumotion.test")
+        self.dirs = [os.path.join(self.path, str(i)) for i in range(3)]
+        self.stats = DummyStats()
+        self.manager = cachemanager.CacheManager(self.stats, self.dirs,
+                                                 CACHE_SIZE * 3, True,
+                                                 0.5, 0.3)
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+        reactor.threadpool.stop()
+        reactor.threadpool = None
+
+    def getShardDirs(self, paths):
+        return [self.manager.getShard(p).cacheDir for p in paths]
+
+    def testLayout(self):
+        m = self.manager
+        paths = ["/file%d" % i for i in range(300)]
+        dirs = self.getShardDirs(paths)
+        for d in self.dirs:
+            self.failUnless(dirs.count(d) > 30)
+
+        ident = m.getIdentifier("/file")
+        self.assertEquals(m.getCachePath("/file"),
+                          os.path.join(m.getShard("/file").cacheDir,
+                                       ident[:2], ident[2:4], ident))
+
+        d = m.newTempFile("/file", 7)
+
+        def completed(t):
+            t.write("content")
+            t.complete()
+            t.close()
+            self.failUnless(os.path.exists(m.getCachePath("/file")))
+            return m.openCacheFile("/file")
+
+        def opened(f):
+            self.assertEquals(f.read(), "content")
+            f.close()
+            stats = [s for s in m.getShardStatistics()
+                     if s['path'] == m.getShard("/file").cacheDir][0]
+            self.assertEquals(stats['hit-count'], 1)
+            self.assertEquals(stats['usage'], 7)
+            self.assertEquals(stats['size'], CACHE_SIZE)
+
+        d.addCallback(completed)
+        d.addCallback(opened)
+        return d
+
+    def testFailedShard(self):
+        m = self.manager
+        paths = ["/file%d" % i for i in range(300)]
+        before = self.getShardDirs(paths)
+        failed = m.getShard("/file").cacheDir
+
+        # The shard disk fails
+        shutil.rmtree(failed)
+        open(failed, "w").close()
+
+        d = m.newTempFile("/file", 1024)
+
+        def created(t):
+            self.assertEquals(t, None)
+            shard = [s for s in m.getShards() if s.cacheDir == failed][0]
+            self.failIf(shard.isAvailable())
+            # Only the files of the failed shard moved
+            after = self.getShardDirs(paths)
+            for b, a in zip(before, after):
+                if b == failed:
+                    self.failIfEquals(a, failed)
+                else:
+                    self.assertEquals(a, b)
+            return m.newTempFile("/file", 1024)
+
+        def createdAgain(t):
+            self.failIfEquals(t, None)
+            self.failIf(t.name.startswith(failed))
+            t.close()
+
+        d.addCallback(created)
+        d.addCallback(createdAgain)
+        return d
@@ -0,0 +1,122 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_common_callqueue -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+import threading
+
+from twisted.internet import defer, reactor
+
+from flumotion.common import callqueue
+from flumotion.common import testsuite
+
+
+class CountingReactor(object):
+    """
+    Wraps the reactor to count the wakeups done with callFromThread.
+    """
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.wakeups = 0
+
+    def callFromThread(self, f, *args, **kwargs):
+        self.wakeups += 1
+        return self.reactor.callFromThread(f, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.reactor, name)
+
+
+class TestThreadedCallQueue(testsuite.TestCase):
+
+    CALLS = 1000
+
+    def setUp(self):
+        self.reactor = CountingReactor(reactor)
+        callqueue.reactor = self.reactor
+        self.results = []
+
+    def tearDown(self):
+        callqueue.reactor = reactor
+
+    def produce(self, callFromThread):
+        # simulates a streaming thread updating the index on every keyframe
+        d = defer.Deferred()
+
+        def run():
+            for i in range(self.CALLS):
+                callFromThread(self.results.append, i)
+            self.reactor.callFromThread(d.callback, None)
+        threading.Thread(target=run).start()
+        return d
+
+    def testWakeupsPerCall(self):
+        # what happens when handing off every call to the reactor
+        d = self.produce(self.reactor.callFromThread)
+
+        def check(_):
+            self.assertEquals(self.results, range(self.CALLS))
+            self.assertEquals(self.reactor.wakeups, self.CALLS + 1)
+        d.addCallback(check)
+        return d
+
+    def testWakeupsBatched(self):
+        queue = callqueue.ThreadedCallQueue(10, 32)
+        queue.start()
+        d = self.produce(queue.callFromThread)
+
+        def check(_):
+            queue.stop()
+            self.assertEquals(self.results, range(self.CALLS))
+            self.assertEquals(queue.calls, self.CALLS)
+            # one wakeup per threshold at most, and the final callback
+            self.failUnless(queue.wakeups <= self.CALLS / 32)
+            self.assertEquals(self.reactor.wakeups, queue.wakeups + 1)
+        d.addCallback(check)
+        return d
+
+    def testThresholdNotReached(self):
+        queue = callqueue.ThreadedCallQueue(10, 32)
+        for i in range(31):
+            queue.callFromThread(self.results.append, i)
+        self.assertEquals(queue.wakeups, 0)
+        self.assertEquals(self.results, [])
+        queue.run()
+        self.assertEquals(self.results, range(31))
+
+    def testPeriodicRun(self):
+        queue = callqueue.ThreadedCallQueue(0.01, 32)
+        queue.start()
+        queue.callFromThread(self.results.append, 1)
+        d = defer.Deferred()
+        reactor.callLater(0.1, d.callback, None)
+
+        def check(_):
+            queue.stop()
+            self.assertEquals(self.results, [1])
+            self.assertEquals(queue.wakeups, 0)
+        d.addCallback(check)
+        return d
+
+    def testFailingCall(self):
+        queue = callqueue.ThreadedCallQueue(10, 32)
+
+        def fail():
+            raise ValueError()
+        queue.callFromThread(fail)
+        queue.callFromThread(self.results.append, 1)
+        queue.run()
+        self.assertEquals(self.results, [1])
@@ -941,6 +941,91 @@ class EventSetTestCase(testsuite.TestCase):
             end - start)
         self.assertEquals(len(p), 0)
 
+    def testTimelinePruned(self):
+        start = datetime(2007, 12, 22, 9, 0, 0, 0, UTC)
+        end = datetime(2007, 12, 22, 9, 4, 0, 0, UTC)
+        event = eventcalendar.Event('uid', start, end, 'content',
+            rrules=["FREQ=MINUTELY;INTERVAL=5", ],
+            exdates=[start + timedelta(days=30, minutes=10)])
+        set = eventcalendar.EventSet('uid')
+        set.addEvent(event)
+
+        # a month of 5 minute slots, most of them forgotten
+        when = start + timedelta(days=30, minutes=1)
+        active = set.getActiveEventInstances(when)
+        self.assertEquals(len(active), 1)
+        self.assertEquals(active[0].start, when - timedelta(minutes=1))
+        timeline = set._getTimeline()
+        self.failUnless(len(timeline._starts) <
+                        eventcalendar.PRUNE_THRESHOLD + 24 * 12 + 2)
+
+        self.failIf(set.getActiveEventInstances(when + timedelta(minutes=4)))
+        self.failIf(set.getActiveEventInstances(when + timedelta(minutes=10)))
+        # the slot at 10 minutes is an exception
+        p = set.getPoints(when, timedelta(minutes=15))
+        self.assertEquals([x.dt - when for x in p],
+                          [timedelta(minutes=m) for m in 0, 3, 4, 8, 14, 15])
+
+        # going back in time expands the recurrence again
+        active = set.getActiveEventInstances(start + timedelta(minutes=6))
+        self.assertEquals(active[0].start, start + timedelta(minutes=5))
+
+    def testTimelineInvalidated(self):
+        start = datetime(2007, 12, 22, 9, 0, 0, 0, UTC)
+        end = datetime(2007, 12, 22, 11, 0, 0, 0, UTC)
+        event = eventcalendar.Event('uid', start, end, 'content',
+            rrules=["FREQ=DAILY;WKST=MO", ])
+        set = eventcalendar.EventSet('uid')
+        set.addEvent(event)
+        when = start + timedelta(days=1, hours=1)
+        self.assertEquals(len(set.getActiveEventInstances(when)), 1)
+
+        override = eventcalendar.Event('uid', when, when + timedelta(hours=2),
+            'other', recurrenceid=start + timedelta(days=1))
+        set.addEvent(override)
+        self.failIf(set.getActiveEventInstances(when))
+        set.removeEvent(override)
+        self.assertEquals(len(set.getActiveEventInstances(when)), 1)
+
+    def testReuseEventSets(self):
+        start = datetime(2007, 12, 22, 9, 0, 0, 0, UTC)
+        end = datetime(2007, 12, 22, 11, 0, 0, 0, UTC)
+
+        def build(content):
+            calendar = Calendar()
+            calendar.addEvent(Event('uid1', start, end, 'content',
+                rrules=["FREQ=DAILY;WKST=MO", ]))
+            calendar.addEvent(Event('uid2', start, end, content))
+            return calendar
+        old = build('content')
+        new = build('changed')
+        new.reuseEventSets(old)
+        self.failUnless(new._eventSets['uid1'] is old._eventSets['uid1'])
+        self.failIf(new._eventSets['uid2'] is old._eventSets['uid2'])
+
+    def testReuseEventSetsMovedOverride(self):
+        start = datetime(2007, 12, 22, 9, 0, 0, 0, UTC)
+        end = datetime(2007, 12, 22, 11, 0, 0, 0, UTC)
+
+        def build(day):
+            calendar = Calendar()
+            calendar.addEvent(Event('uid1', start, end, 'content',
+                rrules=["FREQ=DAILY;WKST=MO", ]))
+            recurrenceid = datetime(2007, 12, day, 9, 0, 0, 0, UTC)
+            calendar.addEvent(Event('uid1', start + timedelta(days=3),
+                end + timedelta(days=3), 'moved',
+                recurrenceid=recurrenceid))
+            return calendar
+        old = build(23)
+        new = build(24)
+        new.reuseEventSets(old)
+        self.failIf(new._eventSets['uid1'] is old._eventSets['uid1'])
+
+        points = new.getPoints(start, timedelta(days=3))
+        starts = [p.dt for p in points if p.which == 'start']
+        self.failUnless(datetime(2007, 12, 23, 9, 0, 0, 0, UTC) in starts)
+        self.failIf(datetime(2007, 12, 24, 9, 0, 0, 0, UTC) in starts)
+
 
 class iCalTestCase(testsuite.TestCase):
 
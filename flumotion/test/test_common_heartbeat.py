@@ -0,0 +1,163 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_common_heartbeat -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+from twisted.internet import defer, task
+from twisted.spread import pb
+
+from flumotion.common import heartbeat, testsuite
+
+
+class FakeConnection:
+
+    def __init__(self):
+        self.pings = []
+        self.disconnected = False
+
+    def ping(self):
+        d = defer.Deferred()
+        self.pings.append(d)
+        return d
+
+    def disconnect(self):
+        self.disconnected = True
+
+
+class TestHeartbeatScheduler(testsuite.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.scheduler = heartbeat.getScheduler(self.clock)
+
+    def add(self, connection, interval=5, timeout=30):
+        return self.scheduler.add(connection.ping, connection.disconnect,
+                                  interval, timeout)
+
+    def testSharedScheduler(self):
+        self.assertIdentical(heartbeat.getScheduler(self.clock),
+                             self.scheduler)
+        self.failIfIdentical(heartbeat.getScheduler(task.Clock()),
+                             self.scheduler)
+
+    def testOneTimer(self):
+        connections = [FakeConnection() for i in range(100)]
+        heartbeats = []
+        for i, connection in enumerate(connections):
+            heartbeats.append(self.add(connection))
+            self.clock.advance(0.1)
+        self.assertEquals(self.scheduler.getCount(), 100)
+        self.assertEquals(len(self.clock.getDelayedCalls()), 1)
+
+        for h in heartbeats:
+            h.stop()
+        self.assertEquals(self.scheduler.getCount(), 0)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def testPingOnlyWhenIdle(self):
+        busy = FakeConnection()
+        idle = FakeConnection()
+        busyHeartbeat = self.add(busy)
+        self.add(idle)
+        # the round trip time is measured in the next slot
+        self.assertEquals(busy.pings, [])
+        self.clock.advance(1)
+        self.assertEquals(len(busy.pings), 1)
+        self.assertEquals(len(idle.pings), 1)
+        self.clock.advance(0.5)
+        busy.pings[0].callback(True)
+        idle.pings[0].callback(True)
+        self.assertEquals(busyHeartbeat.rtt, 0.5)
+
+        for i in range(20):
+            self.clock.advance(1)
+            busyHeartbeat.seen()
+            if len(idle.pings) == 2 and not idle.pings[1].called:
+                idle.pings[1].callback(True)
+        self.assertEquals(len(busy.pings), 1)
+        self.assertEquals(len(idle.pings), 3)
+
+        # a ping is not sent again while one is not answered
+        for i in range(35):
+            self.clock.advance(1)
+            busyHeartbeat.seen()
+        self.assertEquals(len(idle.pings), 3)
+        self.failUnless(idle.disconnected)
+        self.failIf(busy.disconnected)
+
+    def testRoundTripTime(self):
+        connection = FakeConnection()
+        h = self.add(connection)
+        self.clock.advance(1)
+        self.clock.advance(0.2)
+        connection.pings.pop().callback(True)
+        for i in range(int(heartbeat.RTT_INTERVAL)):
+            self.clock.advance(1)
+            h.seen()
+        # measured again even when busy
+        self.assertEquals(len(connection.pings), 1)
+        self.clock.advance(0.6)
+        # an error answer is an answer too
+        connection.pings.pop().errback(Exception('no remote_ping'))
+
+        stats = h.getStats()
+        self.assertApproximates(stats['rtt'], 0.6, 1e-9)
+        self.assertEquals(stats['rtt-count'], 2)
+        self.assertApproximates(stats['rtt-min'], 0.2, 1e-9)
+        self.assertApproximates(stats['rtt-max'], 0.6, 1e-9)
+        self.assertApproximates(stats['rtt-average'],
+                                0.2 + heartbeat.RTT_WEIGHT * 0.4, 1e-9)
+        self.assertEquals(stats['idle'], 0)
+
+    def testSendPing(self):
+        connection = FakeConnection()
+        h = self.add(connection)
+        h.sendPing()
+        h.sendPing()
+        self.assertEquals(len(connection.pings), 1)
+        # not pinged again in the next slot while not answered
+        self.clock.advance(1)
+        self.assertEquals(len(connection.pings), 1)
+
+    def testConnectionLost(self):
+        connection = FakeConnection()
+        h = self.add(connection)
+        self.clock.advance(1)
+        connection.pings.pop().errback(pb.PBConnectionLost())
+        self.assertEquals(h.rttCount, 0)
+        self.clock.advance(5)
+        self.assertEquals(len(connection.pings), 1)
+
+    def testDisconnect(self):
+        connections = [FakeConnection() for i in range(3)]
+        for connection in connections:
+            self.add(connection, timeout=10)
+        self.clock.advance(10)
+        self.failIf([c for c in connections if c.disconnected])
+        # checked again an interval later
+        self.clock.advance(5)
+        self.assertEquals([c.disconnected for c in connections],
+                          [True, True, True])
+        # not followed anymore once disconnected
+        self.assertEquals(self.scheduler.getCount(), 0)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def testCheckOnly(self):
+        connection = FakeConnection()
+        self.scheduler.add(None, connection.disconnect, 30, 30)
+        self.clock.advance(30)
+        self.failIf(connection.disconnected)
+        self.clock.advance(30)
+        self.failUnless(connection.disconnected)
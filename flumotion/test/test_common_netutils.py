@@ -15,6 +15,7 @@
 #
 # Headers in this file shall remain intact.
 
+import random
 import StringIO
 
 from twisted.internet import address
@@ -141,6 +142,88 @@ class TestRoutingTable(testsuite.TestCase):
         ar('192.168.1.1', 'bar')
         ar('192.168.2.1', 'baz')
 
+    def testNestedRouting(self):
+        net = RoutingTable()
+
+        def ar(ip, route):
+            self.assertEquals(net.route(ip), route)
+
+        net.addSubnet('a', '10.0.0.0', 8)
+        net.addSubnet('b', '10.1.0.0', 16)
+        net.addSubnet('c', '10.1.2.0', 24)
+        net.addSubnet('d', '10.1.3.0', 24)
+
+        ar('9.255.255.255', None)
+        ar('10.0.0.0', 'a')
+        ar('10.1.0.0', 'b')
+        ar('10.1.2.255', 'c')
+        ar('10.1.3.0', 'd')
+        ar('10.1.4.0', 'b')
+        ar('10.2.0.0', 'a')
+        ar('11.0.0.0', None)
+        ar(ipv4StringToInt('10.1.2.1'), 'c')
+
+        # the lookups follow the changes
+        net.removeSubnet('b', '10.1.0.0', 16)
+        ar('10.1.4.0', 'a')
+        net.addSubnet('e', '10.1.2.0', 24)
+        ar('10.1.2.1', 'e')
+        self.assertEquals(list(net.route_iter('10.1.2.1')),
+                          ['e', 'c', 'a', None])
+        self.assertRaises(ValueError, net.addSubnet, 'e', '10.1.2.0', 24)
+        self.assertRaises(ValueError, net.removeSubnet, 'f', '10.1.2.0', 24)
+
+    def testRandomRouting(self):
+        # compare with checking every subnet in order of preference
+        r = random.Random(42)
+        net = RoutingTable()
+        subnets = []
+        for i in range(300):
+            maskBits = r.randint(0, 32)
+            ip = r.getrandbits(32) & ~((1 << (32 - maskBits)) - 1)
+            route = r.choice('abcdef')
+            if (maskBits, ip, route) in subnets:
+                continue
+            subnets.append((maskBits, ip, route))
+            net.addSubnet(route, ipv4IntToString(ip), maskBits)
+        subnets.sort(reverse=True)
+
+        for i in range(1000):
+            ip = r.getrandbits(32)
+            if i % 2:
+                # an address close to a subnet
+                ip = r.choice(subnets)[1] ^ r.getrandbits(r.randint(1, 12))
+            expected = [route for maskBits, net_, route in subnets
+                        if ip & ~((1 << (32 - maskBits)) - 1) == net_]
+            self.assertEquals(net.route(ip), (expected + [None])[0])
+            self.assertEquals(list(net.route_iter(ip)), expected + [None])
+
+    def testIPv6Routing(self):
+        net = RoutingTable()
+
+        def ar(ip, route):
+            self.assertEquals(net.route(ip), route)
+
+        net.addSubnet('v4', '192.168.1.0', 24)
+        net.addSubnet('doc', '2001:db8::', 32)
+        net.addSubnet('host', '2001:db8::1')
+        self.assertRaises(ValueError, net.addSubnet, 'bad', '2001:db8::', 16)
+        self.assertRaises(ValueError, net.addSubnet, 'bad', '2001:db8::', 129)
+
+        ar('2001:db8::1', 'host')
+        ar('2001:db8:ffff::1', 'doc')
+        ar('2001:db9::1', None)
+        ar('::1', None)
+        # IPv4 addresses of dual-stack sockets
+        ar('::ffff:192.168.1.2', 'v4')
+        ar('192.168.1.2', 'v4')
+
+        self.assertEquals(len(net), 3)
+        self.assertEquals(list(net.iterHumanReadable()),
+                          [('v4', '192.168.1.0', 24),
+                           ('host', '2001:db8::1', 128),
+                           ('doc', '2001:db8::', 32)])
+
     def assertParseFailure(self, string, **kwargs):
         f = StringIO.StringIO(string)
         self.assertRaises(ValueError, RoutingTable.fromFile, f,
@@ -194,6 +277,10 @@ class TestRoutingTable(testsuite.TestCase):
                                '0.0.0.0/0 general',
                                [('foo', '192.168.1.1', 32),
                                 ('general', '0.0.0.0', 0)])
+        self.assertParseEquals('2001:db8::/32 doc\n'
+                               '::ffff:10.0.0.0/8 mapped',
+                               [('doc', '2001:db8::', 32),
+                                ('mapped', '10.0.0.0', 8)])
 
     def assertRouteNamesOrder(self, string, routeNames):
         f = StringIO.StringIO(string)
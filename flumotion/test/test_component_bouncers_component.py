@@ -37,6 +37,17 @@ class FakeBouncerMedium(component.BouncerMedium):
         return defer.succeed(None)
 
 
+class PendingBouncerMedium(component.BouncerMedium):
+
+    def __init__(self):
+        self.pending = []
+
+    def callRemote(self, method, requesterId, keycardIds):
+        d = defer.Deferred()
+        self.pending.append((d, requesterId, keycardIds))
+        return d
+
+
 class TrivialBouncerTest(testsuite.TestCase):
     obj = None
     medium = None
@@ -113,7 +124,8 @@ class TrivialBouncerTest(testsuite.TestCase):
 
         def checkCalls(res):
             self.assertEquals(self.medium.calls,
-                              [('expireKeycard', (k.requesterId, k.id), {})])
+                              [('expireKeycards', (k.requesterId, [k.id]),
+                                {})])
             return res
 
         k = keycards.KeycardGeneric()
@@ -159,3 +171,40 @@ class TrivialBouncerTest(testsuite.TestCase):
         d = self.obj.authenticate(k)
         d.addCallback(authenticated)
         return d
+
+    def testExpireKeycardIds(self):
+        medium = PendingBouncerMedium()
+        self.obj.setMedium(medium)
+        ids = []
+        for i in range(5 * component.EXPIRE_BLOCK_SIZE):
+            k = keycards.KeycardGeneric()
+            k.requesterId = ('a', 'b')[i % 2]
+            self.obj.addKeycard(k)
+            ids.append(k.id)
+        self.failUnless(isinstance(ids[0], (int, long)))
+        self.assertEquals(len(set(ids)), len(ids))
+
+        result = []
+        d = self.obj.expireKeycardIds(ids + [-1])
+        d.addCallback(result.append)
+
+        # blocks are sent to both requesters without waiting for answers
+        window = 2 * component.EXPIRE_WINDOW
+        self.assertEquals(len(medium.pending), window)
+        self.assertEquals(
+            [len(keycardIds) for _, _, keycardIds in medium.pending],
+            [component.EXPIRE_BLOCK_SIZE / 2] * window)
+        expired = 0
+        failed = False
+        while medium.pending:
+            pending, requesterId, keycardIds = medium.pending.pop(0)
+            if not failed:
+                failed = True
+                pending.errback(Exception('requester gone'))
+            else:
+                expired += len(keycardIds)
+                pending.callback(len(keycardIds))
+            self.failIf(len(medium.pending) > window)
+        self.assertEquals(result, [expired])
+        self.assertEquals(expired, len(ids) - component.EXPIRE_BLOCK_SIZE / 2)
+        self.failIf(self.obj._keycards)
@@ -15,12 +15,13 @@
 #
 # Headers in this file shall remain intact.
 
+import itertools
 import os
 import shutil
 import tempfile
 from StringIO import StringIO
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor, protocol
 from twisted.trial import unittest
 from twisted.web import client, server, http, error
 from twisted.web.resource import Resource
@@ -29,10 +30,13 @@ from twisted.web.static import Data
 from flumotion.common import log
 from flumotion.common import testsuite
 from flumotion.component.misc.httpserver import httpfile, httpserver
+from flumotion.component.misc.httpserver import flvindex
 from flumotion.component.misc.httpserver import localprovider
+from flumotion.component.misc.httpserver import recordingprovider
 from flumotion.component.plugs.base import ComponentPlug
 from flumotion.component.plugs.cortado import cortado
 from flumotion.test import test_http
+from flumotion.test import test_component_httpserver_flvindex as test_flvindex
 
 attr = testsuite.attr
 
@@ -176,6 +180,111 @@ class MountTest(testsuite.TestCase):
         return defer.DeferredList([d1, d2, d3], fireOnOneErrback=True)
 
 
+class Collector(protocol.Protocol):
+    """
+    I send requests and collect everything received until the server
+    closes the connection.
+    """
+
+    def __init__(self):
+        self.data = ''
+        self.closed = defer.Deferred()
+
+    def dataReceived(self, data):
+        self.data += data
+
+    def connectionLost(self, reason):
+        self.closed.callback(self.data)
+
+
+class KeepAliveTest(testsuite.TestCase):
+
+    slow = True
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(suffix=".flumotion.test")
+        open(os.path.join(self.path, 'A'), "w").write('test file A')
+        open(os.path.join(self.path, 'B'), "w").write('test file B')
+        self.component = None
+
+    def tearDown(self):
+        if self.component:
+            self.component.stop()
+        os.system('rm -r %s' % self.path)
+
+    def makeComponent(self, **properties):
+        properties.update({u'mount-point': '/',
+                           u'path': self.path,
+                           u'port': 0})
+        config = {
+            'feed': [],
+            'name': 'http-server',
+            'parent': 'default',
+            'avatarId': '/default/http-server',
+            'clock-master': None,
+            'type': 'http-server',
+            'plugs': {},
+            'properties': properties,
+        }
+        self.component = httpserver.HTTPFileStreamer(config)
+
+    def send(self, *requests):
+        creator = protocol.ClientCreator(reactor, Collector)
+        d = creator.connectTCP('localhost', self.component.port)
+
+        def connected(collector):
+            collector.transport.write(''.join(requests))
+            return collector.closed
+        d.addCallback(connected)
+        return d
+
+    def get(self, path, version='1.1'):
+        return 'GET %s HTTP/%s\r\nHost: localhost\r\n\r\n' % (path, version)
+
+    def testPipelined(self):
+        self.makeComponent(**{'keep-alive-max-requests': 3})
+        d = self.send(self.get('/A'), self.get('/B'), self.get('/A'))
+
+        def check(data):
+            responses = data.split('HTTP/1.1 200 OK')[1:]
+            self.assertEquals(len(responses), 3)
+            for response, body in zip(responses, ['A', 'B', 'A']):
+                self.failUnless(response.endswith('test file ' + body))
+            # The last one closes the connection
+            self.assertEquals(data.lower().count('connection: close'), 1)
+            self.failUnless('connection: close' in responses[2].lower())
+            stats = self.component.stats
+            self.assertEquals(stats.totalConnectionCount, 1)
+            self.assertEquals(stats.totalRequestCount, 3)
+            self.assertEquals(stats.keepAliveRequestCount, 2)
+            self.assertEquals(stats.meanRequestsPerConnection, 3.0)
+        d.addCallback(check)
+        return d
+
+    def testIdleTimeout(self):
+        self.makeComponent(**{'keep-alive-timeout': 0.1})
+        d = self.send(self.get('/A'))
+
+        def check(data):
+            self.failUnless(data.endswith('test file A'))
+            self.failIf('connection: close' in data.lower())
+            self.assertEquals(self.component.getConnections(), 0)
+        d.addCallback(check)
+        return d
+
+    def testNotPersistent(self):
+        self.makeComponent()
+        # HTTP/1.0 connections are closed after the first request
+        d = self.send(self.get('/A', '1.0'), self.get('/B', '1.0'))
+
+        def check(data):
+            self.assertEquals(data.count(' 200 OK'), 1)
+            self.failUnless(data.endswith('test file A'))
+            self.assertEquals(self.component.stats.keepAliveRequestCount, 0)
+        d.addCallback(check)
+        return d
+
+
 class _Resource(Resource):
 
     def __init__(self, path):
@@ -414,13 +523,13 @@ class TestTextFile(testsuite.TestCase):
             length)
         self.assertEquals(request.getHeader('content-type'),
             'application/octet-stream')
-        self.assertEquals(request.getHeader('Connection'), 'close')
+        # The connection is kept open or not by the channel
+        self.assertEquals(request.getHeader('Connection'), None)
 
     def finishPartialCallback(self, result, request, data, start, end):
         self.finishCallback(result, request, http.PARTIAL_CONTENT, data)
         self.assertEquals(request.getHeader('Content-Range'),
             "bytes %d-%d/%d" % (start, end, 11))
-        self.assertEquals(request.getHeader('Connection'), 'close')
 
     def testFull(self):
         fr = FakeRequest()
@@ -543,7 +652,7 @@ class TestNotFound(testsuite.TestCase):
         fr = FakeRequest()
         resource.render(fr)
         fr.finishDeferred.addCallback(lambda res:
-            self.assertEquals(fr.getHeader("Connection"), "close"))
+            self.assertEquals(fr.getHeader("Connection"), None))
         fr.finishDeferred.addCallback(lambda res:
             self.assertEquals(fr.response, http.NOT_FOUND))
         return fr.finishDeferred
@@ -575,10 +684,12 @@ class FakeSplitter(object):
     CHUNK_SIZE = 3
     HEADER = 'fake header'
     failure = None
+    instances = 0
 
     def __init__(self, t):
         self.t = t
         self.data = StringIO()
+        FakeSplitter.instances += 1
 
     def start(self, data_cb):
         self.data_cb = data_cb
@@ -617,6 +728,10 @@ class TestDirectory(testsuite.TestCase):
         fakemp4seek.async = Dummy()
         fakemp4seek.async.Splitter = FakeSplitter
         httpfile.mp4seek = fakemp4seek
+        self.indexCache = httpfile.MP4File.indexCache
+        httpfile.MP4File.indexCache = httpfile.MP4IndexCache()
+        self.flvIndexCache = httpfile.FLVFile.indexCache
+        httpfile.FLVFile.indexCache = flvindex.FLVIndexCache()
 
         self.component = FakeComponent(self.path)
         # a directory resource
@@ -625,7 +740,42 @@ class TestDirectory(testsuite.TestCase):
              'video/mp4': httpfile.MP4File})
 
     def tearDown(self):
-        os.system('rm -r %s' % self.path)
+        httpfile.MP4File.indexCache = self.indexCache
+        cache, httpfile.FLVFile.indexCache = (httpfile.FLVFile.indexCache,
+                                              self.flvIndexCache)
+        httpfile.FLVFile.startUnit = 'bytes'
+        d = cache.stop()
+        d.addCallback(lambda _: os.system('rm -r %s' % self.path))
+        return d
+
+    def writeFLV(self):
+        data, keyframes = test_flvindex.makeFLV()
+        path = os.path.join(self.path, 'index.flv')
+        h = open(path, 'wb')
+        h.write(data)
+        h.close()
+        provider = localprovider.LocalFile(path, 'video/x-flv')
+        child = self.component.getRoot().child('index.flv')
+        key = (str(child), provider.getmtime(), provider.getsize())
+        provider.close()
+        d = httpfile.FLVFile.indexCache.buildIndex(key, child)
+        d.addCallback(lambda index: (data, index))
+        return d
+
+    def requestFLV(self, _, **kwargs):
+        fr = FakeRequest(**kwargs)
+        self.resource.getChild('index.flv', fr).render(fr)
+        fr.finishDeferred.addCallback(lambda _: fr)
+        return fr.finishDeferred
+
+    def patchProviderStr(self):
+        # like the httpcached resources, every provider prints differently
+        serials = itertools.count()
+
+        def anonymousStr(provider):
+            serial = provider.__dict__.setdefault('_serial', serials.next())
+            return '<Resource %d>' % serial
+        self.patch(localprovider.LocalFile, '__str__', anonymousStr)
 
     def testGetChild(self):
         fr = FakeRequest()
@@ -712,6 +862,106 @@ class TestDirectory(testsuite.TestCase):
         fr.finishDeferred.addCallback(finish)
         return fr.finishDeferred
 
+    def testFLVStartKeyframe(self):
+        d = self.writeFLV()
+
+        def request(result):
+            self.data, self.index = result
+            index = self.index
+            # In the middle of the second keyframe
+            start = index.offsets[1] + 5
+            return self.requestFLV(None, args={'start': [str(start)]})
+
+        def check(fr):
+            expected = (httpfile.FLVFile.header
+                        + self.index.getMetadataTag()
+                        + self.data[self.index.offsets[1]:])
+            self.assertEquals(fr.data, expected)
+            self.assertEquals(fr.getHeader('Content-Length'),
+                              str(len(expected)))
+        d.addCallback(request)
+        d.addCallback(check)
+        return d
+
+    def testFLVStartSeconds(self):
+        httpfile.FLVFile.startUnit = 'seconds'
+        data, keyframes = test_flvindex.makeFLV()
+        h = open(os.path.join(self.path, 'index.flv'), 'wb')
+        h.write(data)
+        h.close()
+        # The request waits for the file to be indexed
+        d = self.requestFLV(None, args={'start': ['5.5']})
+
+        def check(fr):
+            index = test_flvindex.scanData(data)
+            expected = (httpfile.FLVFile.header + index.getMetadataTag()
+                        + data[keyframes[2]:])
+            self.assertEquals(fr.data, expected)
+            self.assertEquals(fr.getHeader('Content-Length'),
+                              str(len(expected)))
+        d.addCallback(check)
+        return d
+
+    def testFLVStartSecondsAddressKey(self):
+        self.patchProviderStr()
+        httpfile.FLVFile.startUnit = 'seconds'
+        data, keyframes = test_flvindex.makeFLV()
+        h = open(os.path.join(self.path, 'index.flv'), 'wb')
+        h.write(data)
+        h.close()
+        d = self.requestFLV(None, args={'start': ['5.5']})
+        # the second request uses the index built for the first one
+        d.addCallback(self.requestFLV, args={'start': ['5.5']})
+
+        def check(fr):
+            self.assertEquals(httpfile.FLVFile.indexCache.scanCount, 1)
+            self.assertEquals(fr.data[-len(data) + keyframes[2]:],
+                              data[keyframes[2]:])
+        d.addCallback(check)
+        return d
+
+    def testFLVKeyframesMetadata(self):
+        d = self.writeFLV()
+        d.addCallback(lambda result: self.requestFLV(
+            None, args={'start': [str(result[1].offsets[2])]}))
+
+        def check(fr):
+            index = test_flvindex.scanData(fr.data)
+            self.failUnless(index.hasKeyframesMetadata())
+            # The positions to start from in the original file
+            self.assertEquals(index.metadata['keyframes']['filepositions'],
+                              test_flvindex.makeFLV()[1])
+            self.assertEquals(fr.getHeader('Content-Length'),
+                              str(len(fr.data)))
+        d.addCallback(check)
+        return d
+
+    def testFLVIndexedWholeAndRange(self):
+        # Once indexed, whole files, ranges and HEAD requests still
+        # describe the same bytes
+        d = self.writeFLV()
+
+        def request(result):
+            self.data, index = result
+            return defer.gatherResults([
+                self.requestFLV(None),
+                self.requestFLV(None, headers={'range': 'bytes=100-'}),
+                self.requestFLV(None, method='HEAD')])
+
+        def check(results):
+            whole, partial, head = results
+            self.assertEquals(whole.data, self.data)
+            self.assertEquals(whole.getHeader('Content-Length'),
+                              str(len(self.data)))
+            self.assertEquals(partial.data, self.data[100:])
+            self.assertEquals(whole.data[100:], partial.data)
+            self.assertEquals(head.data, '')
+            self.assertEquals(head.getHeader('Content-Length'),
+                              str(len(self.data)))
+        d.addCallback(request)
+        d.addCallback(check)
+        return d
+
     def testMP4(self):
         fr = FakeRequest()
         self.assertEquals(self.resource.getChild('test.mp4', fr).render(fr),
@@ -809,6 +1059,178 @@ class TestDirectory(testsuite.TestCase):
         fr.finishDeferred.addCallback(finish)
         return fr.finishDeferred
 
+    def testMP4StartCached(self):
+        cache = httpfile.MP4File.indexCache
+        expected = 'fake header' + 'a fake MP4 file'[FakeSplitter.OFFSET:]
+
+        def request(_, start):
+            fr = FakeRequest(args={'start': [start]})
+            self.resource.getChild('test.mp4', fr).render(fr)
+            fr.finishDeferred.addCallback(lambda _: fr.data)
+            return fr.finishDeferred
+
+        def check(data, instances, readHits, splitHits):
+            self.assertEquals(data, expected)
+            self.assertEquals(FakeSplitter.instances - self.instances,
+                              instances)
+            self.assertEquals(cache.readHitCount, readHits)
+            self.assertEquals(cache.splitHitCount, splitHits)
+
+        self.instances = FakeSplitter.instances
+        d = request(None, 2)
+        d.addCallback(check, 1, 0, 0)
+        # The same start time reuses the rebuilt header
+        d.addCallback(request, 2)
+        d.addCallback(check, 1, 0, 1)
+        # Another one splits again with the data already read
+        d.addCallback(request, 3)
+        d.addCallback(check, 2, 1, 1)
+        return d
+
+    def testMP4StartCachedAddressKey(self):
+        self.patchProviderStr()
+        cache = httpfile.MP4File.indexCache
+
+        def request(_):
+            fr = FakeRequest(args={'start': [2]})
+            self.resource.getChild('test.mp4', fr).render(fr)
+            return fr.finishDeferred
+
+        d = request(None)
+        d.addCallback(request)
+        d.addCallback(lambda _: self.assertEquals(cache.splitHitCount, 1))
+        return d
+
+
+class TestMP4IndexCache(testsuite.TestCase):
+
+    def testLimits(self):
+        cache = httpfile.MP4IndexCache(maxSize=10, maxSplits=2)
+        cache.addRead('a', 0, 4, 'aaaa')
+        cache.addSplit('a', 1.0, 'h1', 4)
+        cache.addSplit('a', 2.0, 'h2', 8)
+        self.assertEquals(cache.getSplit('a', 1.0), ('h1', 4))
+        cache.addSplit('a', 3.0, 'h3', 12)
+        # The least recently used start time is forgotten
+        self.assertEquals(cache.getSplit('a', 2.0), None)
+        self.assertEquals(cache.getSplit('a', 3.0), ('h3', 12))
+        self.assertEquals(cache.size, 8)
+        cache.addRead('b', 0, 4, 'bbbb')
+        # And then the least recently used file
+        self.assertEquals(cache.getRead('a', 0, 4), None)
+        self.assertEquals(cache.getRead('b', 0, 4), 'bbbb')
+        self.assertEquals(cache.getRead('b', 0, 8), None)
+        self.assertEquals(cache.size, 4)
+        self.assertEquals(cache.readHitCount, 1)
+        self.assertEquals(cache.splitHitCount, 2)
+
+
+class PullingFakeRequest(FakeRequest):
+    """
+    A fake request asking its pull producer for more data after each write,
+    like a transport whose buffer drains right away.
+    """
+
+    producer = None
+
+    def write(self, data):
+        FakeRequest.write(self, data)
+        if self.producer:
+            reactor.callLater(0, self.producer.resumeProducing)
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+class TestRecording(testsuite.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        h = open(os.path.join(self.path, 'rec.ogg'), 'w')
+        h.write('HDRaaaabbbbcccc')
+        h.close()
+        h = open(os.path.join(self.path, 'rec.ogg.index'), 'w')
+        h.write('FLUIDX1 #Flumotion\n'
+                'CHK POS LEN TS DUR KF TDT TDUR\n'
+                '0 3 4 0 10 True 100 10\n'
+                '1 7 4 10 10 True 110 10\n'
+                '2 11 4 20 10 True 120 10\n')
+        h.close()
+
+        plugProps = {"properties": {"path": self.path,
+                                    "follow-timeout": 0}}
+        plug = recordingprovider.FileProviderRecordingPlug(plugProps)
+        self.component = FakeComponent(self.path)
+        self.resource = httpfile.File(plug.getRootPath(), self.component)
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def render(self, fr):
+        self.assertEquals(self.resource.getChild('rec.ogg', fr).render(fr),
+            server.NOT_DONE_YET)
+        return fr.finishDeferred
+
+    def testNoTime(self):
+        fr = FakeRequest()
+        d = self.render(fr)
+
+        def finish(result):
+            self.assertEquals(fr.data, 'HDRaaaabbbbcccc')
+            self.assertEquals(fr.getHeader('Content-Length'), '15')
+        d.addCallback(finish)
+        return d
+
+    def testStartEnd(self):
+        fr = FakeRequest(args={'start': ['112'], 'end': ['115']})
+        d = self.render(fr)
+
+        def finish(result):
+            self.assertEquals(fr.data, 'HDRbbbb')
+            self.assertEquals(fr.getHeader('Content-Length'), '7')
+        d.addCallback(finish)
+        return d
+
+    def testStartFollow(self):
+        fr = PullingFakeRequest(args={'start': ['105']})
+        d = self.render(fr)
+
+        def finish(result):
+            self.assertEquals(fr.data, 'HDRaaaabbbbcccc')
+            self.assertEquals(fr.getHeader('Content-Length'), None)
+        d.addCallback(finish)
+        return d
+
+    def testRangeTakesPrecedence(self):
+        fr = FakeRequest(headers={'range': 'bytes=3-6'},
+                         args={'start': ['112']})
+        d = self.render(fr)
+
+        def finish(result):
+            self.assertEquals(fr.data, 'aaaa')
+        d.addCallback(finish)
+        return d
+
+    def testOutsideIndex(self):
+        fr = FakeRequest(args={'start': ['80'], 'end': ['90']})
+        d = self.render(fr)
+
+        def finish(result):
+            self.assertEquals(fr.response,
+                              http.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.assertEquals(fr.data, '')
+        d.addCallback(finish)
+        return d
+
+    def testMalformed(self):
+        fr = FakeRequest(args={'start': ['w00t']})
+        d = self.render(fr)
+
+        def finish(result):
+            self.assertEquals(fr.response, http.BAD_REQUEST)
+        d.addCallback(finish)
+        return d
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,189 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+import threading
+from StringIO import StringIO
+
+from twisted.internet import defer
+
+from flumotion.common import testsuite
+from flumotion.component.misc.httpserver import diskio
+
+
+class Handle(StringIO):
+    """
+    File handle counting its reads.
+    """
+
+    def __init__(self, data):
+        StringIO.__init__(self, data)
+        self.reads = []
+
+    def read(self, size):
+        self.reads.append((self.tell(), size))
+        return StringIO.read(self, size)
+
+
+class Blocker:
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.event = threading.Event()
+
+    def __call__(self, result=None):
+        self.started.set()
+        self.event.wait()
+        return result
+
+    def release(self):
+        self.event.set()
+
+
+class TestDiskIOExecutor(testsuite.TestCase):
+
+    def setUp(self):
+        self.executor = diskio.DiskIOExecutor(4)
+        self.blockers = []
+
+    def tearDown(self):
+        for blocker in self.blockers:
+            blocker.release()
+        self.executor.stop()
+
+    def block(self, key):
+        blocker = Blocker()
+        self.blockers.append(blocker)
+        d = self.executor.call(key, blocker, key)
+        return blocker, d
+
+    def testQueuedByFile(self):
+        blocker, first = self.block('a')
+        order = []
+        first.addCallback(order.append)
+        second = self.executor.call('a', lambda: 'a2')
+        second.addCallback(order.append)
+        # Other files are not waiting
+        other = self.executor.call('b', lambda: 'b')
+        other.addCallback(order.append)
+
+        def released(_):
+            self.assertEquals(order, ['b'])
+            self.assertEquals(self.executor.getQueueLength('a'), 2)
+            blocker.release()
+            return second
+
+        def check(_):
+            self.assertEquals(order, ['b', 'a', 'a2'])
+            self.assertEquals(self.executor.getQueueLength('a'), 0)
+            stats = self.executor.getStats()
+            self.assertEquals(stats['operations'], 3)
+            self.assertEquals(stats['queue-depth'], 0)
+            self.assertEquals(stats['queue-depth-max'], 3)
+            self.failIf(stats['wait-time-average'] is None)
+            self.failUnless(stats['service-time-max']
+                            >= stats['service-time-average'])
+        other.addCallback(released)
+        other.addCallback(check)
+        return other
+
+    def testMergedReads(self):
+        handle = Handle("0123456789" * 4)
+        blocker, first = self.block('f')
+        queued = self.executor.read('f', handle, 0, 10)
+        # Covered by the read queued first
+        covered = self.executor.read('f', handle, 2, 5)
+        # Contiguous, extends the queued read
+        contiguous = self.executor.read('f', handle, 10, 10)
+        # Not touching the merged range
+        apart = self.executor.read('f', handle, 30, 10)
+        blocker.release()
+        d = defer.gatherResults([queued, covered, contiguous, apart])
+
+        def check(results):
+            self.assertEquals(results, ["0123456789", "23456",
+                                        "0123456789", "0123456789"])
+            self.assertEquals(handle.reads, [(0, 20), (30, 10)])
+            self.assertEquals(self.executor.getStats()['merged-reads'], 2)
+        d.addCallback(check)
+        return d
+
+    def testReadCoveredByRunningRead(self):
+        handle = Handle("0123456789")
+        blocker = Blocker()
+        self.blockers.append(blocker)
+
+        class BlockingHandle(Handle):
+
+            def read(self, size):
+                blocker()
+                return Handle.read(self, size)
+        blocking = BlockingHandle("0123456789")
+        running = self.executor.read('f', blocking, 0, 8)
+        blocker.started.wait()
+        # The running read can't be extended any more
+        covered = self.executor.read('f', handle, 4, 4)
+        after = self.executor.read('f', handle, 4, 6)
+        blocker.release()
+        d = defer.gatherResults([running, covered, after])
+
+        def check(results):
+            self.assertEquals(results, ["01234567", "4567", "456789"])
+            self.assertEquals(blocking.reads, [(0, 8)])
+            self.assertEquals(handle.reads, [(4, 6)])
+        d.addCallback(check)
+        return d
+
+    def testEndOfFile(self):
+        handle = Handle("0123456789")
+        blocker, first = self.block('f')
+        d1 = self.executor.read('f', handle, 6, 4)
+        d2 = self.executor.read('f', handle, 8, 4)
+        blocker.release()
+        d = defer.gatherResults([d1, d2])
+        d.addCallback(self.assertEquals, ["6789", "89"])
+        return d
+
+    def testFailure(self):
+
+        def fail():
+            raise IOError(5, "Input/output error")
+        d = self.executor.call('f', fail)
+        d = self.assertFailure(d, IOError)
+
+        def check(_):
+            self.assertEquals(self.executor.getStats()['failures'], 1)
+            # The queue goes on
+            return self.executor.call('f', lambda: 'ok')
+        d.addCallback(check)
+        d.addCallback(self.assertEquals, 'ok')
+        return d
+
+    def testStop(self):
+        blocker, first = self.block('f')
+        queued = self.executor.call('f', lambda: 'never')
+        blocker.started.wait()
+        blocker.release()
+        self.executor.stop()
+        self.assertEquals(self.executor.getStats()['queue-depth'], 1)
+        d = self.assertFailure(queued, diskio.DiskIOStopped)
+        # The running operation still delivers its result
+        d.addCallback(lambda _: first)
+        d.addCallback(self.assertEquals, 'f')
+        # And the executor restarts when used again
+        d.addCallback(lambda _: self.executor.call('f', lambda: 'again'))
+        d.addCallback(self.assertEquals, 'again')
+        return d
@@ -0,0 +1,220 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+import os
+import shutil
+import struct
+import tempfile
+
+from twisted.internet import defer
+
+from flumotion.common import testsuite
+from flumotion.component.misc.httpserver import flvindex
+from flumotion.component.misc.httpserver import localprovider
+
+HEADER = 'FLV\x01\x05' + struct.pack(">L", 9) + struct.pack(">L", 0)
+
+
+def makeTag(kind, stamp, data):
+    size = len(data)
+    return (struct.pack(">BBH", kind, size >> 16, size & 0xffff)
+            + struct.pack(">L", stamp)[1:] + chr(stamp >> 24) + "\x00" * 3
+            + data + struct.pack(">L", 11 + size))
+
+
+def makeFLV(metadata=None, seconds=10, video=True):
+    """
+    @return: an FLV file with a video frame every half a second,
+             a keyframe every 2 seconds, and an audio frame every
+             quarter of a second, and the offsets of the keyframes
+    """
+    data = HEADER
+    if metadata is not None:
+        data += makeTag(flvindex.TAG_SCRIPT, 0,
+                        flvindex.encodeScriptData('onMetaData', metadata))
+    keyframes = []
+    for stamp in range(0, seconds * 1000, 250):
+        if video and stamp % 500 == 0:
+            if stamp % 2000 == 0:
+                keyframes.append(len(data))
+                frame = '\x17' + 'k' * 100
+            else:
+                frame = '\x27' + 'i' * 20
+            data += makeTag(flvindex.TAG_VIDEO, stamp, frame)
+        data += makeTag(flvindex.TAG_AUDIO, stamp, '\xaf' + 'a' * 10)
+    return data, keyframes
+
+
+def scanData(data):
+    return flvindex.scan(lambda offset, size: data[offset:offset + size],
+                         len(data))
+
+
+class TestScriptData(testsuite.TestCase):
+
+    def testRoundTrip(self):
+        value = {'duration': 12.5, 'stereo': True, 'encoder': 'flumotion',
+                 'nothing': None, 'keyframes': {'times': [0.0, 2.0],
+                                                'filepositions': [13, 400]}}
+        data = flvindex.encodeScriptData('onMetaData', value)
+        self.assertEquals(flvindex.decodeScriptData(data),
+                          ('onMetaData', value))
+
+    def testTruncated(self):
+        data = flvindex.encodeScriptData('onMetaData', {'duration': 1})
+        self.assertRaises(flvindex.FLVError,
+                          flvindex.decodeScriptData, data[:-4])
+
+
+class TestScan(testsuite.TestCase):
+
+    def testKeyframes(self):
+        data, keyframes = makeFLV()
+        index = scanData(data)
+        self.assertEquals(index.header, HEADER)
+        self.assertEquals(index.metadata, None)
+        self.assertEquals(index.bodyOffset, len(HEADER))
+        self.assertEquals(index.times, [0.0, 2.0, 4.0, 6.0, 8.0])
+        self.assertEquals(index.offsets, keyframes)
+        self.assertEquals(index.duration, 9.75)
+        self.failIf(index.hasKeyframesMetadata())
+
+    def testFind(self):
+        data, keyframes = makeFLV()
+        index = scanData(data)
+        self.assertEquals(index.findTime(0), keyframes[0])
+        self.assertEquals(index.findTime(5.9), keyframes[2])
+        self.assertEquals(index.findTime(6), keyframes[3])
+        self.assertEquals(index.findTime(100), keyframes[-1])
+        self.assertEquals(index.findOffset(0), keyframes[0])
+        self.assertEquals(index.findOffset(keyframes[1] + 1), keyframes[1])
+        self.assertEquals(index.findOffset(keyframes[2] - 1), keyframes[1])
+
+    def testMetadata(self):
+        data, keyframes = makeFLV({'duration': 10.0, 'width': 320})
+        index = scanData(data)
+        self.assertEquals(index.metadata, {'duration': 10.0, 'width': 320})
+        self.assertEquals(index.bodyOffset, keyframes[0])
+        self.failIf(index.hasKeyframesMetadata())
+
+    def testMetadataTag(self):
+        data, keyframes = makeFLV({'width': 320})
+        index = scanData(data)
+        tag = index.getMetadataTag()
+        rewritten = index.header + tag + data[index.bodyOffset:]
+        rewrittenIndex = scanData(rewritten)
+        self.failUnless(rewrittenIndex.hasKeyframesMetadata())
+        metadata = rewrittenIndex.metadata
+        self.assertEquals(metadata['width'], 320)
+        self.assertEquals(metadata['duration'], 9.75)
+        # The positions are the ones in the original file
+        self.assertEquals(metadata['keyframes'],
+                          {'times': index.times,
+                           'filepositions': keyframes})
+
+    def testAudioOnly(self):
+        data, keyframes = makeFLV(video=False, seconds=3)
+        index = scanData(data)
+        self.assertEquals(index.times, [0.0, 1.0, 2.0])
+
+    def testTruncated(self):
+        data, keyframes = makeFLV()
+        # The last keyframe is cut
+        index = scanData(data[:keyframes[-1] + 20])
+        self.assertEquals(index.offsets, keyframes[:-1])
+
+    def testNotFLV(self):
+        self.assertRaises(flvindex.FLVError, scanData, 'a fake FLV file')
+
+
+class TestFLVIndexCache(testsuite.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.data, self.keyframes = makeFLV()
+        self.filePath = os.path.join(self.path, 'test.flv')
+        h = open(self.filePath, 'wb')
+        h.write(self.data)
+        h.close()
+        self.indexDir = os.path.join(self.path, 'index')
+        os.mkdir(self.indexDir)
+        self.key = (self.filePath, 1, len(self.data))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def testBuildIndex(self):
+        cache = flvindex.FLVIndexCache()
+        path = localprovider.LocalPath(self.filePath)
+        d = defer.gatherResults([cache.buildIndex(self.key, path),
+                                 cache.buildIndex(self.key, path)])
+
+        def check(indexes):
+            self.assertEquals(cache.scanCount, 1)
+            self.failUnless(indexes[0] is indexes[1])
+            self.assertEquals(indexes[0].offsets, self.keyframes)
+            self.failUnless(cache.hasIndex(self.key))
+            self.failUnless(cache.getIndex(self.key) is indexes[0])
+        d.addCallback(check)
+        return d
+
+    def testNotIndexable(self):
+        cache = flvindex.FLVIndexCache()
+        h = open(self.filePath, 'wb')
+        h.write('a fake FLV file')
+        h.close()
+        d = cache.buildIndex(self.key, localprovider.LocalPath(self.filePath))
+
+        def check(index):
+            self.assertEquals(index, None)
+            # The failure is remembered
+            self.failUnless(cache.hasIndex(self.key))
+            self.assertEquals(cache.getIndex(self.key), None)
+        d.addCallback(check)
+        return d
+
+    def testIndexDirectory(self):
+        cache = flvindex.FLVIndexCache(self.indexDir)
+        path = localprovider.LocalPath(self.filePath)
+        d = cache.buildIndex(self.key, path)
+
+        def buildAgain(_):
+            self.assertEquals(cache.scanCount, 1)
+            self.assertEquals(len(os.listdir(self.indexDir)), 1)
+            self.cache = flvindex.FLVIndexCache(self.indexDir)
+            return self.cache.buildIndex(self.key, path)
+
+        def check(index):
+            self.assertEquals(index.offsets, self.keyframes)
+            self.assertEquals(self.cache.scanCount, 0)
+            self.assertEquals(self.cache.loadCount, 1)
+        d.addCallback(buildAgain)
+        d.addCallback(check)
+        return d
+
+    def testMaxIndexes(self):
+        cache = flvindex.FLVIndexCache(maxIndexes=1)
+        path = localprovider.LocalPath(self.filePath)
+        other = ('other', 1, len(self.data))
+        d = cache.buildIndex(self.key, path)
+        d.addCallback(lambda _: cache.buildIndex(other, path))
+
+        def check(_):
+            self.failIf(cache.hasIndex(self.key))
+            self.failUnless(cache.hasIndex(other))
+        d.addCallback(check)
+        return d
@@ -0,0 +1,236 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+from twisted.internet import defer, protocol, reactor
+
+from flumotion.common.testsuite import TestCase
+from flumotion.component.misc.httpserver import cachestats
+from flumotion.component.misc.httpserver.httpcached import common
+from flumotion.component.misc.httpserver.httpcached import connection_pool
+from flumotion.component.misc.httpserver.httpcached import http_client
+from flumotion.component.misc.httpserver.httpcached import http_utils
+
+
+class CannedServerProtocol(protocol.Protocol):
+
+    def connectionMade(self):
+        self.factory.connections.append(self)
+        self.buffer = ""
+
+    def dataReceived(self, data):
+        self.buffer += data
+        while "\r\n\r\n" in self.buffer:
+            request, self.buffer = self.buffer.split("\r\n\r\n", 1)
+            self.factory.requests.append(request)
+            self.factory.respond(self, request)
+
+
+class CannedServerFactory(protocol.ServerFactory):
+    """
+    Answers every request with the body given by path, keeping the
+    connection open unless asked not to.
+    """
+
+    protocol = CannedServerProtocol
+
+    def __init__(self):
+        self.connections = []
+        self.requests = []
+        self.closeAfter = False
+        self.dropNextRequest = False
+        self.hold = False
+
+    def respond(self, proto, request):
+        if self.hold:
+            return
+        if self.dropNextRequest:
+            self.dropNextRequest = False
+            proto.transport.loseConnection()
+            return
+        path = request.split()[1]
+        if "If-Modified-Since" in request:
+            proto.transport.write("HTTP/1.1 304 Not Modified\r\n\r\n")
+            return
+        body = "x" * int(path[1:])
+        headers = ["HTTP/1.1 200 OK",
+                   "Content-Length: %d" % len(body)]
+        if self.closeAfter:
+            headers.append("Connection: close")
+        proto.transport.write("\r\n".join(headers) + "\r\n\r\n" + body)
+        if self.closeAfter:
+            proto.transport.loseConnection()
+
+
+class Consumer(common.StreamConsumer):
+
+    def __init__(self, cancelOnData=False):
+        self.cancelOnData = cancelOnData
+        self.data = []
+        self.result = None
+        self.deferred = defer.Deferred()
+
+    def _finish(self, result):
+        self.result = result
+        reactor.callLater(0, self.deferred.callback, result)
+
+    def serverError(self, getter, code, message):
+        self._finish(('error', code))
+
+    def conditionFail(self, getter, code, message):
+        self._finish(('condition', code))
+
+    def streamNotAvailable(self, getter, code, message):
+        self._finish(('not-available', code))
+
+    def onInfo(self, getter, info):
+        pass
+
+    def onData(self, getter, data):
+        self.data.append(data)
+        if self.cancelOnData:
+            getter.cancel()
+            self._finish(('canceled', None))
+
+    def streamDone(self, getter):
+        self._finish(('done', "".join(self.data)))
+
+
+class TestConnectionPool(TestCase):
+
+    def setUp(self):
+        self.server = CannedServerFactory()
+        self.port = reactor.listenTCP(0, self.server, interface="127.0.0.1")
+        self.stats = cachestats.CacheStatistics()
+        self.pool = connection_pool.ConnectionPool(self.stats)
+        self.client = http_client.StreamRequester(5, 5, self.pool)
+
+    def tearDown(self):
+        self.pool.close()
+        for proto in self.server.connections:
+            proto.transport.loseConnection()
+        return self.port.stopListening()
+
+    def fetch(self, size, **kwargs):
+        consumer = Consumer(kwargs.pop('cancelOnData', False))
+        url = http_utils.Url.fromString("http://127.0.0.1/%d" % size)
+        self.client.retrieve(consumer, url, proxyAddress="127.0.0.1",
+                             proxyPort=self.port.getHost().port, **kwargs)
+        return consumer.deferred
+
+    def assertPool(self, hits, misses):
+        self.assertEquals((self.stats.poolHitCount, self.stats.poolMissCount),
+                          (hits, misses))
+
+    def testReuse(self):
+        d = self.fetch(10)
+
+        def second(result):
+            self.assertEquals(result, ('done', "x" * 10))
+            self.assertEquals(self.pool.getIdleCount(
+                "127.0.0.1", self.port.getHost().port), 1)
+            return self.fetch(20)
+
+        def check(result):
+            self.assertEquals(result, ('done', "x" * 20))
+            self.assertEquals(len(self.server.connections), 1)
+            self.assertPool(1, 1)
+            self.assertEquals(self.stats.poolHitRatio, 0.5)
+        d.addCallback(second)
+        d.addCallback(check)
+        return d
+
+    def testConnectionClose(self):
+        self.server.closeAfter = True
+        d = self.fetch(10)
+        d.addCallback(lambda _: self.fetch(10))
+
+        def check(result):
+            self.assertEquals(result, ('done', "x" * 10))
+            self.assertEquals(len(self.server.connections), 2)
+            self.assertPool(0, 2)
+        d.addCallback(check)
+        return d
+
+    def testMaxConnections(self):
+        self.pool.maxConnections = 1
+        d = defer.gatherResults([self.fetch(10), self.fetch(20),
+                                 self.fetch(30)])
+
+        def check(results):
+            self.assertEquals([r[0] for r in results], ['done'] * 3)
+            self.assertEquals(len(self.server.connections), 1)
+            self.assertPool(2, 1)
+        d.addCallback(check)
+        return d
+
+    def testCanceledBigResponse(self):
+        size = connection_pool.DRAIN_MAX_SIZE * 4
+        d = self.fetch(size, cancelOnData=True)
+        d.addCallback(lambda _: self.fetch(10))
+
+        def check(result):
+            self.assertEquals(result, ('done', "x" * 10))
+            self.assertEquals(len(self.server.connections), 2)
+            self.assertPool(0, 2)
+        d.addCallback(check)
+        return d
+
+    def testNotModified(self):
+        d = self.fetch(10, ifModifiedSince=1000000000)
+
+        def check(result):
+            self.assertEquals(result,
+                              ('condition', common.STREAM_NOT_MODIFIED))
+            return self.fetch(10)
+
+        def checkReused(result):
+            self.assertEquals(result, ('done', "x" * 10))
+            self.assertPool(1, 1)
+        d.addCallback(check)
+        d.addCallback(checkReused)
+        return d
+
+    def testStaleConnection(self):
+        d = self.fetch(10)
+
+        def second(result):
+            # The server closes the connection instead of answering
+            self.server.dropNextRequest = True
+            return self.fetch(20)
+
+        def check(result):
+            self.assertEquals(result, ('done', "x" * 20))
+            self.assertEquals(len(self.server.connections), 2)
+            self.assertEquals(self.stats.meanConnectionRequests, 2)
+        d.addCallback(second)
+        d.addCallback(check)
+        return d
+
+    def testWaitTimeout(self):
+        self.pool.maxConnections = 1
+        self.pool.connTimeout = 0.1
+        # The only connection stays busy
+        self.server.hold = True
+        self.fetch(10)
+        d = self.fetch(20)
+
+        def check(result):
+            self.assertEquals(result, ('error', common.SERVER_TIMEOUT))
+            self.assertEquals(len(self.server.connections), 1)
+            self.assertEquals(self.pool._waiting, {})
+        d.addCallback(check)
+        return d
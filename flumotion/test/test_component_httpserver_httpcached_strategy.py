@@ -271,6 +271,113 @@ class TestBasicCachingStrategy(TestCase):
         d.callback(None)
         return d
 
+    def testNotCachedReadAhead(self):
+        data = os.urandom(BLOCK_SIZE*4 + EXTRA_DATA)
+        mtime = time.time()
+
+        d = defer.Deferred()
+
+        d.addCallback(self._setup, [], [ResDef("/dummy", data, mtime)],
+                      readAhead=2)
+
+        # Make the transfer slow for the caching session,
+        # so the data is read by block
+        d.addCallback(self._set, "reqmgr", "trans_delay", 0.2)
+
+        d.addCallback(self._getSource, "http://www.flumotion.net/dummy")
+        d.addCallback(self._gotSource, "source", "session")
+        d.addCallback(self._isInstance, strategy_base.RemoteSource)
+        d.addCallback(self._set, "reqmgr", "trans_delay", 0.01)
+        d.addCallback(self._readAllData)
+        d.addCallback(self._checkData, data)
+
+        def checkReadAhead(result):
+            readAhead = self.sources["source"].readAhead
+            self.assertEqual(readAhead.readCount, self._reqCountFor(data))
+            # The blocks following the first one were already retrieved
+            self.failUnless(readAhead.stallCount < readAhead.readCount)
+            return result
+
+        d.addCallback(checkReadAhead)
+        d.addCallback(self._closeSource, "source")
+        d.addCallback(self._checkBlockCaches, 0)
+
+        # Each block is requested only once, nothing after the end
+        fullBlocks = len(data) // BLOCK_SIZE
+        d.addCallback(self._checkReqCount, self._reqCountFor(data) + 1)
+        d.addCallback(self._checkReqsCode, [None] * (fullBlocks + 2))
+
+        d.callback(None)
+        return d
+
+    def testSharedReadAhead(self):
+        data = os.urandom(BLOCK_SIZE*4 + EXTRA_DATA)
+        mtime = time.time()
+
+        d = defer.Deferred()
+
+        d.addCallback(self._setup, [], [ResDef("/dummy", data, mtime)],
+                      readAhead=2)
+        d.addCallback(self._set, "reqmgr", "trans_delay", 0.2)
+
+        d.addCallback(self._getSource, "http://www.flumotion.net/dummy")
+        d.addCallback(self._gotSource, "source1")
+        d.addCallback(self._getSource, "http://www.flumotion.net/dummy")
+        d.addCallback(self._gotSource, "source2")
+        d.addCallback(self._set, "reqmgr", "trans_delay", 0.01)
+        d.addCallback(self._checkBlockCaches, 0)
+
+        def readBoth(_):
+            return defer.gatherResults(
+                [self._readAllData(self.sources["source1"]),
+                 self._readAllData(self.sources["source2"])])
+
+        d.addCallback(readBoth)
+        d.addCallback(self._checkData, [data, data])
+        d.addCallback(self._checkBlockCaches, 1)
+        d.addCallback(self._closeSource, "source1")
+        d.addCallback(self._checkBlockCaches, 1)
+        d.addCallback(self._closeSource, "source2")
+        d.addCallback(self._checkBlockCaches, 0)
+
+        # The readers shared the blocks
+        d.addCallback(self._checkReqCount, self._reqCountFor(data) + 1)
+
+        d.callback(None)
+        return d
+
+    def testReadAheadPaused(self):
+        data = os.urandom(BLOCK_SIZE*4)
+        mtime = time.time()
+        self.reqmgr = DummyReqMgr(ResDef("/dummy", data, mtime))
+        url = http_utils.Url.fromString("http://www.flumotion.net/dummy")
+        cache = strategy_base.BlockCache(self.reqmgr, url, len(data),
+                                         mtime, BLOCK_SIZE, 8)
+        readAhead = strategy_base.ReadAhead(cache, 2)
+
+        readAhead.pause()
+        d = readAhead.read(0, BLOCK_SIZE)
+        self._checkReqCount(None, 1)
+        readAhead.resume()
+        self._checkReqCount(None, 3)
+
+        d.addCallback(self._checkData, data[:BLOCK_SIZE])
+        # Wait for the prefetched blocks
+        d.addCallback(lambda _: cache.fetch(2))
+        d.addCallback(lambda _: readAhead.read(BLOCK_SIZE, BLOCK_SIZE*2))
+        d.addCallback(self._checkData, data[BLOCK_SIZE:BLOCK_SIZE*3])
+
+        def check(result):
+            self.assertEqual(readAhead.stallCount, 1)
+            self.assertEqual(readAhead.readCount, 2)
+            # The block after the window was requested, not further
+            self._checkReqCount(None, 4)
+            cache.close()
+            return result
+
+        d.addCallback(check)
+        return d
+
     def testNotCachedServerErrors(self):
         data = os.urandom(BLOCK_SIZE*4 + EXTRA_DATA)
         mtime = time.time()
@@ -485,6 +592,114 @@ class TestBasicCachingStrategy(TestCase):
         d.callback(None)
         return d
 
+    def testStaleWhileRevalidate(self):
+        data1 = os.urandom(BLOCK_SIZE*4 + EXTRA_DATA + 1)
+        mtime1 = time.time() - 200
+        data2 = os.urandom(BLOCK_SIZE*4 + EXTRA_DATA + 2)
+        mtime2 = time.time() - 100
+
+        cf = FileDef("/dummy", data1, mtime1)
+        res = ResDef("/dummy", data1, mtime1)
+
+        d = defer.Deferred()
+
+        d.addCallback(self._setup, [cf], [res], ttl=1, staleTTL=10)
+
+        # Without expiration time the first request checks for expiration
+        d.addCallback(self._getSource, "http://www.flumotion.net/dummy")
+        d.addCallback(self._gotSource, "source")
+        d.addCallback(self._isInstance, strategy_base.CachedSource)
+        d.addCallback(self._closeSource, "source")
+        d.addCallback(self._checkReqCount, 1)
+        d.addCallback(self._checkReqsCode, common.STREAM_NOT_MODIFIED)
+        d.addCallback(self._reset)
+
+        # When the TTL expired, the cached file is served right away
+        # and only one check is done in the background
+        d.addCallback(self._updateResource, res, data=data2, mtime=mtime2)
+        d.addCallback(wait, 1.2)
+
+        def getTwoSources(_):
+            return defer.gatherResults(
+                [self._getSource(None, "http://www.flumotion.net/dummy"),
+                 self._getSource(None, "http://www.flumotion.net/dummy")])
+
+        def gotTwoSources(sources):
+            for i, source in enumerate(sources):
+                self._gotSource(source, "stale%d" % i)
+                self._isInstance(source, strategy_base.CachedSource)
+            self._checkSessions(None, 1)
+            self.sessions["session"] = self.stgy.getSessions()[0]
+            return sources[0]
+
+        d.addCallback(getTwoSources)
+        d.addCallback(gotTwoSources)
+        d.addCallback(self._readAllData)
+        d.addCallback(self._checkData, data1)
+        d.addCallback(self._closeSource, "stale0")
+        d.addCallback(self._closeSource, "stale1")
+        d.addCallback(self._waitFinished, "session")
+        d.addCallback(self._checkReqCount, 1)
+        d.addCallback(self._checkReqsSize, len(data2))
+        d.addCallback(self._reset)
+
+        # The new version was cached in the background
+        d.addCallback(self._getSource, "http://www.flumotion.net/dummy")
+        d.addCallback(self._gotSource, "source2")
+        d.addCallback(self._isInstance, strategy_base.CachedSource)
+        d.addCallback(self._readAllData)
+        d.addCallback(self._checkData, data2)
+        d.addCallback(self._closeSource, "source2")
+        d.addCallback(self._checkReqCount, 0)
+        d.addCallback(self._reset)
+
+        # When the servers are down, the stale cached file is served
+        # and not checked again before the error TTL
+        d.addCallback(wait, 1.2)
+        d.addCallback(self._set, "reqmgr", "available", False)
+        d.addCallback(self._getSource, "http://www.flumotion.net/dummy")
+        d.addCallback(self._gotSource, "source3", "session3")
+        d.addCallback(self._isInstance, strategy_base.CachedSource)
+        d.addCallback(self._readAllData)
+        d.addCallback(self._checkData, data2)
+        d.addCallback(self._closeSource, "source3")
+        d.addCallback(wait, 0.1)
+        d.addCallback(self._checkSessions, 0)
+        d.addCallback(self._checkReqCount, 1)
+        d.addCallback(self._checkReqsCode, common.SERVER_UNAVAILABLE)
+        d.addCallback(self._reset)
+
+        d.addCallback(self._getSource, "http://www.flumotion.net/dummy")
+        d.addCallback(self._gotSource, "source4")
+        d.addCallback(self._isInstance, strategy_base.CachedSource)
+        d.addCallback(self._closeSource, "source4")
+        d.addCallback(self._checkReqCount, 0)
+
+        d.callback(None)
+        return d
+
+    def testExpirationTableCleanup(self):
+        d = defer.Deferred()
+        d.addCallback(self._setup, [], [])
+
+        def keepAlive(_):
+            self.stgy.keepCacheAlive("a", 0.1)
+            self.stgy.keepCacheAlive("b", 0.1)
+            self.stgy.keepCacheAlive("c", 10)
+            # Kept alive again, the first entry is outdated
+            self.stgy.keepCacheAlive("a", 10)
+
+        def cleanup(_):
+            self.stgy._cleanupExpirationTable()
+            self.assertEqual(sorted(self.stgy._etimes.keys()), ["a", "c"])
+            self.assertEqual(len(self.stgy._expirations), 2)
+
+        d.addCallback(keepAlive)
+        d.addCallback(wait, 0.2)
+        d.addCallback(cleanup)
+        d.callback(None)
+        return d
+
     def testErrorWhilePipelining(self):
         data = os.urandom(BLOCK_SIZE*4 + EXTRA_DATA)
         mtime = time.time()
@@ -1305,11 +1520,14 @@ class TestBasicCachingStrategy(TestCase):
         d.callback(None)
         return d
 
-    def _setup(self, _, files, resources, ttl=DEFAULT_TTL):
+    def _setup(self, _, files, resources, ttl=DEFAULT_TTL, readAhead=0,
+               staleTTL=0):
         self.cachemgr = DummyCacheMgr(*files)
         self.reqmgr = DummyReqMgr(*resources)
         self.stgy = strategy_basic.CachingStrategy(self.cachemgr,
-                                                   self.reqmgr, ttl)
+                                                   self.reqmgr, ttl,
+                                                   readAhead, BLOCK_SIZE,
+                                                   staleTTL)
         return self.stgy.setup()
 
     def _getSource(self, _, urlstr):
@@ -1422,6 +1640,10 @@ class TestBasicCachingStrategy(TestCase):
         self.failUnless(failure.check(expected))
         return
 
+    def _checkBlockCaches(self, result, count):
+        self.assertEqual(len(self.stgy._blockCaches), count)
+        return result
+
     def _checkSessions(self, result, count):
         self.assertEqual(len(self.stgy.getSessions()), count)
         return result
@@ -15,9 +15,12 @@
 #
 # Headers in this file shall remain intact.
 
+from twisted.internet import defer, reactor
 from twisted.trial import unittest
 
 from flumotion.common import testsuite
+from flumotion.component.common.streamer import burstcache
+from flumotion.component.common.streamer import multifdsinkstreamer
 from flumotion.component.consumers.httpstreamer import httpstreamer
 
 attr = testsuite.attr
@@ -38,6 +41,16 @@ CONFIG = {
 }
 
 
+class FakeSink:
+
+    def __init__(self, burstCache):
+        self.burstCache = burstCache
+        self.emitted = []
+
+    def emit(self, *args):
+        self.emitted.append(args)
+
+
 class StreamerTestCase(testsuite.TestCase):
 
     slow = True
@@ -95,5 +108,70 @@ class TestStreamDataPlug(StreamerTestCase):
     testGetStreamData.skip = 'See #1137'
 
 
+class TestClientRemovals(StreamerTestCase):
+
+    def testBatchedRemovals(self):
+        handled = []
+        self.component._client_removed_handler = \
+            lambda sink, fd, reason, stats: handled.append(fd)
+        self.component.update_ui_state = lambda: None
+
+        batch = multifdsinkstreamer.REMOVAL_BATCH_SIZE
+        count = batch * 2 + batch / 2
+        for fd in range(count):
+            self.component._pending_removals[fd] = (None, None)
+            self.component._client_fd_removed_cb(None, fd)
+        self.assertEquals(self.component.getRemovalBacklog(), count)
+
+        # a single reactor iteration only processes a batch
+        self.component._process_removals()
+        self.assertEquals(handled, range(batch))
+        self.assertEquals(self.component.getRemovalBacklog(), count - batch)
+
+        d = defer.Deferred()
+        reactor.callLater(0.1, d.callback, None)
+
+        def check(_):
+            self.assertEquals(handled, range(count))
+            self.assertEquals(self.component.getRemovalBacklog(), 0)
+        d.addCallback(check)
+        return d
+
+
+class TestSimpleBurst(StreamerTestCase):
+
+    properties = {'burst-on-connect': True}
+
+    def testBufferLimits(self):
+        # without a burst cache size, the sink keeps its buffer limits
+        sink = self.component.get_element('sink')
+        self.assertEquals(sink.get_property('sync-method').value_nick,
+                          'latest-keyframe')
+        self.assertEquals(sink.get_property('buffers-soft-max'), 250)
+        self.assertEquals(sink.get_property('buffers-max'), 500)
+        self.assertEquals(sink.burstCache, None)
+
+
+class TestSimpleBurstCacheSize(StreamerTestCase):
+
+    properties = {'burst-on-connect': True, 'burst-cache-size': 1024}
+
+    def testByteLimits(self):
+        sink = self.component.get_element('sink')
+        self.assertEquals(sink.get_property('units-max'), 1024 * 1024)
+        self.assertEquals(sink.get_property('units-soft-max'), 512 * 1024)
+        self.assertEquals(sink.burstCache.maxBytes, 1024 * 1024)
+
+    def testAddClient(self):
+        sink = FakeSink(burstcache.BurstCache(maxBytes=4096))
+        # no keyframe to start from yet, the sink picks where to start
+        self.component._add_client_to_sink(sink, 5)
+        sink.burstCache.addBuffer(1000, 0.0, True)
+        sink.burstCache.addBuffer(500, 0.1, False)
+        self.component._add_client_to_sink(sink, 6)
+        self.assertEquals(sink.emitted, [('add', 5),
+                                         ('add-full', 6, 4, 3, 1500, 3, 4096)])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -23,6 +23,7 @@ from twisted.web import client
 from flumotion.common import testsuite, netutils
 from flumotion.common import log
 from flumotion.common.planet import moods
+from flumotion.component.consumers.icystreamer import icymux
 from flumotion.component.consumers.icystreamer import icystreamer
 
 from flumotion.test import comptest
@@ -30,6 +31,47 @@ from flumotion.test import comptest
 attr = testsuite.attr
 
 
+class TestIcyMux(testsuite.TestCase):
+
+    def setUp(self):
+        self.buffers = []
+        self.mux = icymux.IcyMux()
+        self.mux.set_property('frame-size', 256)
+        self.mux.set_property('num-frames', 2)
+        self.sinkpad = gst.Pad('sink', gst.PAD_SINK)
+        self.sinkpad.set_chain_function(self._chain)
+        self.mux.get_pad('src').link(self.sinkpad)
+        self.sinkpad.set_active(True)
+        self.mux.set_state(gst.STATE_PAUSED)
+
+    def tearDown(self):
+        self.mux.set_state(gst.STATE_NULL)
+
+    def _chain(self, pad, buffer):
+        self.buffers.append(buffer)
+        return gst.FLOW_OK
+
+    def testFraming(self):
+        data = ''.join([chr(i % 256) for i in range(1000)])
+        pad = self.mux.get_pad('sink')
+        for start, end in ((0, 300), (300, 400), (400, 1000)):
+            self.mux.chainfunc(pad, gst.Buffer(data[start:end]))
+
+        sizes = [buf.size for buf in self.buffers]
+        self.assertEquals(sizes, [256, 256, 1, 256])
+        frames = [buf for buf in self.buffers if buf.size == 256]
+        self.assertEquals(''.join([str(buf) for buf in frames]), data[:768])
+        self.assertEquals(str(self.buffers[2]), icymux.EMPTY_METADATA)
+        self.failIf(frames[0].flag_is_set(gst.BUFFER_FLAG_DELTA_UNIT))
+        self.failUnless(frames[1].flag_is_set(gst.BUFFER_FLAG_DELTA_UNIT))
+        self.assertEquals(frames[0].caps[0]['metadata-interval'], 512)
+
+    def testEncodeMetadata(self):
+        self.assertEquals(icymux.encodeMetadata(), '\0')
+        block = icymux.encodeMetadata('title')
+        self.assertEquals(block, '\2' + "StreamTitle='title';" + '\0' * 12)
+
+
 class TestIcyStreamer(comptest.CompTestTestCase, log.Loggable):
 
     def setUp(self):
@@ -32,6 +32,7 @@ from flumotion.common import testsuite
 from flumotion.component.misc.httpserver import localpath
 from flumotion.component.misc.httpserver import localprovider
 from flumotion.component.misc.httpserver import cachedprovider
+from flumotion.component.misc.httpserver import recordingprovider
 from flumotion.component.misc.httpserver.fileprovider \
     import InsecureError, NotFoundError, CannotOpenError
 
@@ -188,6 +189,7 @@ class LocalPathCachedProvider(testsuite.TestCase):
     def testOpenNonExistingRemovesCachedFile(self):
         local = self.fileProviderPlug.getRootPath()
         child = local.child('foo')
+        self.fileProviderPlug.cache.makeCacheDirectory(child._path)
         cachedPath = self.fileProviderPlug.cache.getCachePath(child._path)
         open(cachedPath, 'w').write('')
         d = child.open()
@@ -239,6 +241,48 @@ class LocalPathLocalProvider(testsuite.TestCase):
         self.assertRaises(NotFoundError, child.open)
 
 
+class LocalProviderPlug(testsuite.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(suffix=".flumotion.test")
+        open(os.path.join(self.path, 'a'), "w").write('test file a')
+        plugProps = {"properties": {"path": self.path}}
+        self.plug = localprovider.FileProviderLocalPlug(plugProps)
+        self.executor = self.plug._executor
+
+    def tearDown(self):
+        self.plug.stop(None)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def testOpenNonExisting(self):
+        child = self.plug.getRootPath().child('foo')
+        return self.assertFailure(child.open(), NotFoundError)
+
+    def testSharedReads(self):
+        child = self.plug.getRootPath().child('a')
+        d = defer.gatherResults([child.open(), child.open()])
+
+        def read(files):
+            self.files = files
+            return defer.gatherResults([files[0].read(4), files[1].read(4)])
+
+        def check(results):
+            self.assertEquals(results, ['test', 'test'])
+            # The file was read once for both
+            self.assertEquals(self.executor.getStats()['merged-reads'], 1)
+            self.assertEquals(self.files[1].tell(), 4)
+            return self.files[1].read(100)
+
+        def checkNext(data):
+            self.assertEquals(data, ' file a')
+            for f in self.files:
+                f.close()
+        d.addCallback(read)
+        d.addCallback(check)
+        d.addCallback(checkNext)
+        return d
+
+
 class CachedProviderFileTest(testsuite.TestCase):
 
     skip = SKIP_MSG
@@ -277,6 +321,8 @@ class CachedProviderFileTest(testsuite.TestCase):
     @attr('slow')
     def testModifySrc(self):
         newData = "bar foo"
+        # The modification is seen when the source status expires
+        self.fileProviderPlug.sourceInfoTTL = 0
 
         d = self.openFile('a')
         d.addCallback(self.readFile, self.dataSize)
@@ -319,6 +365,68 @@ class CachedProviderFileTest(testsuite.TestCase):
                           self.failUnlessEqual(self.data, data))
         return d
 
+    def testConcurrentColdMisses(self):
+        opened = []
+
+        def open_stat(path, mode='rb'):
+            opened.append(path)
+            return orig_open_stat(path, mode)
+        orig_open_stat = cachedprovider.open_stat
+        self.patch(cachedprovider, 'open_stat', open_stat)
+
+        child = self.fileProviderPlug.getRootPath().child('a')
+        d = defer.gatherResults([child.open() for i in range(5)])
+
+        def read(files):
+            self.files = files
+            return defer.gatherResults([f.read(self.dataSize)
+                                        for f in files])
+
+        def check(results):
+            self.assertEquals(results, [self.data] * 5)
+            # The source file has been opened and copied only once
+            self.assertEquals(opened.count(self.testFileName), 1)
+            stats = self.fileProviderPlug.stats
+            self.assertEquals(stats.cacheMissCount, 1)
+            self.assertEquals(stats.tempHitCount, 4)
+            self.failUnless(stats.coalescedRequestCount >= 4)
+            sessions = [f._delegate._session for f in self.files]
+            self.assertEquals(sessions, sessions[:1] * 5)
+            for f in self.files:
+                f.close()
+        d.addCallback(read)
+        d.addCallback(check)
+        return d
+
+    def testSourceInfoKept(self):
+        statted = []
+
+        def stat_file(path):
+            statted.append(path)
+            return orig_stat_file(path)
+        orig_stat_file = cachedprovider.stat_file
+        self.patch(cachedprovider, 'stat_file', stat_file)
+
+        d = self.openFile('a')
+        d.addCallback(pass_through, self.close)
+        d.addCallback(lambda _: self.openFile('a'))
+        d.addCallback(pass_through, self.close)
+
+        def check(_):
+            self.assertEquals(statted, [self.testFileName])
+            self.assertEquals(
+                self.fileProviderPlug.stats.sourceInfoHitCount, 1)
+            self.fileProviderPlug.sourceInfoTTL = 0
+            self.fileProviderPlug.forgetSourceInfo(self.testFileName)
+            return self.openFile('a')
+
+        def checkExpired(_):
+            self.close()
+            self.assertEquals(statted, [self.testFileName] * 2)
+        d.addCallback(check)
+        d.addCallback(checkExpired)
+        return d
+
     def getCachePath(self, path):
         return self.fileProviderPlug.cache.getCachePath(path)
 
@@ -363,3 +471,98 @@ def delay(ret, t):
     d = defer.Deferred()
     reactor.callLater(t, d.callback, ret)
     return d
+
+
+class RecordingProviderTest(testsuite.TestCase):
+
+    HEADERS = 'HDR'
+    INDEX_HEADERS = 'FLUIDX1 #Flumotion\nCHK POS LEN TS DUR KF TDT TDUR\n'
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(suffix=".flumotion.test")
+        # three keyframe chunks of 4 bytes recorded at 100, 110 and 120
+        self.recording = os.path.join(self.path, 'rec.ogg')
+        open(self.recording, 'w').write(self.HEADERS + 'aaaabbbbcccc')
+        self.index = self.recording + '.index'
+        open(self.index, 'w').write(self.INDEX_HEADERS +
+                                    '0 3 4 0 10 True 100.5 10\n'
+                                    '1 7 4 10 10 True 110.5 10\n'
+                                    '2 11 4 20 10 True 120.5 10\n')
+        open(os.path.join(self.path, 'plain'), 'w').write('not indexed')
+        plugProps = {"properties": {"path": self.path,
+                                    "follow-timeout": 0}}
+        self.plug = recordingprovider.FileProviderRecordingPlug(plugProps)
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def open(self, name='rec.ogg'):
+        return self.plug.getRootPath().child(name).open()
+
+    def testOpenWithoutIndex(self):
+        f = self.open('plain')
+        self.failIf(isinstance(f, recordingprovider.RecordingFile))
+        f.close()
+
+    def testOpenWithIndex(self):
+        f = self.open()
+        self.failUnless(isinstance(f, recordingprovider.RecordingFile))
+        f.close()
+
+    def testHeaders(self):
+        f = self.open()
+        f.seek(5)
+        d = f.getHeaders()
+        d.addCallback(self.assertEquals, self.HEADERS)
+        d.addCallback(lambda _: self.assertEquals(f.tell(), 5))
+        d.addCallback(lambda _: f.close())
+        return d
+
+    def testSeekTime(self):
+        f = self.open()
+        self.assertEquals(f.seekTime(111, 115), (7, 10))
+        self.assertEquals(f.tell(), 7)
+        self.assertEquals(f.seekTime(None, 111), (3, 10))
+        self.assertEquals(f.seekTime(90, 101), (3, 6))
+        # the end of the last chunk is not indexed yet
+        self.assertEquals(f.seekTime(121, 125), (11, None))
+        self.assertEquals(f.seekTime(90, 100), None)
+        f.close()
+
+    def testReadUntilStop(self):
+        f = self.open()
+        f.seekTime(101, 111)
+        d = f.read(100)
+        d.addCallback(self.assertEquals, 'aaaabbbb')
+        d.addCallback(lambda _: f.read(100))
+        d.addCallback(self.assertEquals, '')
+        d.addCallback(lambda _: f.close())
+        return d
+
+    def testFollowGrowingRecording(self):
+        f = self.open()
+        f.seekTime(121, None)
+        d = f.read(100)
+        d.addCallback(self.assertEquals, 'cccc')
+
+        def append(_):
+            h = open(self.recording, 'a')
+            h.write('dddd')
+            h.close()
+            return f.read(100)
+        d.addCallback(append)
+        d.addCallback(self.assertEquals, 'dddd')
+        d.addCallback(lambda _: f.read(100))
+        # the recording didn't grow within the follow timeout
+        d.addCallback(self.assertEquals, '')
+        d.addCallback(lambda _: f.close())
+        return d
+
+    def testIndexRefresh(self):
+        f = self.open()
+        self.assertEquals(f.seekTime(121, 125), (11, None))
+        h = open(self.index, 'a')
+        h.write('3 15 4 30 10 True 130.5 10\n4 19 -1')
+        h.close()
+        self.assertEquals(f.seekTime(121, 125), (11, 14))
+        f.close()
@@ -0,0 +1,88 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+from flumotion.common import testsuite
+from flumotion.component.common.streamer import burstcache
+
+
+class TestBurstCache(testsuite.TestCase):
+
+    def feed(self, cache, gops, gopSize=10, bufferSize=1000, start=0.0):
+        # one second groups of pictures of gopSize buffers
+        for gop in range(gops):
+            for i in range(gopSize):
+                timestamp = start + gop + float(i) / gopSize
+                cache.addBuffer(bufferSize, timestamp, i == 0,
+                                now=timestamp)
+
+    def testBurstFromLatestKeyframe(self):
+        cache = burstcache.BurstCache()
+        self.feed(cache, 3)
+        self.assertEquals(cache.getKeyframeCount(), 3)
+        self.assertEquals(cache.getBurst(), 10000)
+
+    def testBurstSize(self):
+        cache = burstcache.BurstCache()
+        self.feed(cache, 5)
+        # the latest keyframe at least 15000 bytes before the end
+        self.assertEquals(cache.getBurst(burstSize=15000), 20000)
+        self.assertEquals(cache.getBurst(burstSize=20000), 20000)
+        # not enough data, start from the oldest keyframe
+        self.assertEquals(cache.getBurst(burstSize=100000), 50000)
+
+    def testBurstTime(self):
+        cache = burstcache.BurstCache()
+        self.feed(cache, 5)
+        # the last buffer is at 4.9, the keyframe at 2.0 is 2.9 seconds old
+        self.assertEquals(cache.getBurst(burstTime=2.5), 30000)
+        self.assertEquals(cache.getBurst(burstTime=0.5), 10000)
+
+    def testByteLimit(self):
+        cache = burstcache.BurstCache(maxBytes=25000)
+        self.feed(cache, 5)
+        self.assertEquals(cache.getKeyframeCount(), 2)
+        self.assertEquals(cache.getCachedBytes(), 20000)
+        self.assertEquals(cache.getBurst(burstSize=100000), 20000)
+
+    def testTimeLimit(self):
+        cache = burstcache.BurstCache(maxTime=2.5)
+        self.feed(cache, 5)
+        self.assertEquals(cache.getKeyframeCount(), 2)
+
+    def testKeyframeWait(self):
+        cache = burstcache.BurstCache()
+        self.assertEquals(cache.getBurst(now=1.0), None)
+        self.assertEquals(cache.getBurst(now=1.5), None)
+        self.assertEquals(cache.waitCount, 0)
+        cache.addBuffer(1000, 1.9, False, now=1.9)
+        self.assertEquals(cache.waitCount, 0)
+        cache.addBuffer(1000, 2.0, True, now=2.0)
+        self.assertEquals(cache.waitCount, 2)
+        self.assertAlmostEquals(cache.waitMax, 1.0)
+        self.assertAlmostEquals(cache.getAverageWait(), 0.75)
+
+        # a keyframe is cached now, no need to wait
+        self.assertEquals(cache.getBurst(), 1000)
+        self.assertEquals(cache.waitCount, 3)
+        self.assertAlmostEquals(cache.getAverageWait(), 0.5)
+
+    def testNoTimestamps(self):
+        cache = burstcache.BurstCache()
+        cache.addBuffer(1000, None, True)
+        cache.addBuffer(1000, None, False)
+        # without timestamps, the burst starts from the oldest keyframe
+        self.assertEquals(cache.getBurst(burstTime=1.0), 2000)
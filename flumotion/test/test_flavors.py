@@ -442,3 +442,33 @@ class TestState(testsuite.TestCase):
         self.assertEquals(c.get('adict'), {})
         self.assertRaises(KeyError, c.delitem, 'randomdictkey', 'value')
         self.assertRaises(KeyError, c.delitem, 'adict', 'akey')
+
+    def testStateWatcher(self):
+        c = flavors.StateCacheable()
+        c.addKey('akey')
+        c.addListKey('alist')
+        c.addDictKey('adict')
+
+        events = []
+        watcher = FakeObject()
+        c.addWatcher(watcher,
+                     set_=lambda *a: events.append(('set', ) + a),
+                     append=lambda *a: events.append(('append', ) + a),
+                     setitem=lambda *a: events.append(('setitem', ) + a))
+        self.assertRaises(KeyError, c.addWatcher, watcher,
+                          set_=lambda *a: None)
+        self.assertRaises(ValueError, c.addWatcher, FakeObject())
+
+        c.set('akey', 'avalue')
+        c.append('alist', 'avalue')
+        c.remove('alist', 'avalue')
+        c.setitem('adict', 'akey', 'avalue')
+        c.delitem('adict', 'akey')
+        self.assertEquals(events, [('set', c, 'akey', 'avalue'),
+                                   ('append', c, 'alist', 'avalue'),
+                                   ('setitem', c, 'adict', 'akey', 'avalue')])
+
+        c.removeWatcher(watcher)
+        c.set('akey', 'bvalue')
+        self.assertEquals(len(events), 3)
+        self.assertRaises(KeyError, c.removeWatcher, watcher)
@@ -41,6 +41,16 @@ class TestLogFilter(testsuite.TestCase):
         self.failIf(filter.isInRange("192.168.0.200"))
         self.failIf(filter.isInRange("127.0.0.2"))
 
+    def testIPv6Filter(self):
+        filter = http.LogFilter()
+        filter.addIPFilter("2001:db8::/32")
+        filter.addIPFilter("10.0.0.1/8")
+
+        self.failUnless(filter.isInRange("2001:db8::1"))
+        self.failIf(filter.isInRange("2001:db9::1"))
+        self.failUnless(filter.isInRange("10.1.2.3"))
+        self.failUnless(filter.isInRange("::ffff:10.1.2.3"))
+
     def testParseFailure(self):
         filter = http.LogFilter()
         self.assertRaises(errors.ConfigError, filter.addIPFilter, "192.12")
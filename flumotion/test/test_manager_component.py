@@ -646,3 +646,90 @@ class TestComponentHeaven(testsuite.TestCase):
                             (cA, [('default-prime', '/a/comp9:default',
                                    '127.0.0.1', 1032)], [])], *without(c9, cA))
         self.resetEatFeed(c9, cA)
+
+
+class TestFeedMap(testsuite.TestCase):
+
+    def setUp(self):
+        self.feedMap = component.FeedMap()
+
+    def detach(self, c):
+        # like ComponentAvatar.onShutdown, which drops the state of the
+        # component before the heaven hears about it
+
+        def stateGone(*args):
+            raise AttributeError("'NoneType' object has no attribute 'get'")
+        for name in ('getName', 'getParentName', 'getEaters', 'getFeeders',
+                     'getVirtualFeeds', 'getFeedId', 'getFullFeedId'):
+            setattr(c, name, stateGone)
+        return self.feedMap.componentDetached(c)
+
+    def assertEmpty(self):
+        self.assertEquals(self.feedMap.feedersForEaters, {})
+        self.assertEquals(self.feedMap.eatersForFeeders, {})
+        self.assertEquals(self.feedMap.feeds, {})
+        self.assertEquals(self.feedMap.feedDeps, {})
+
+    def testAttachBeforeFeeder(self):
+        c1 = fca('a', 'comp1')
+        c2 = fca('a', 'comp2',
+                 eaters={'default': [('comp1:default', 'default-prime')]})
+        self.feedMap.componentAttached(c2)
+        self.assertEquals(self.feedMap.getFeedersForEaters(c2), [])
+
+        self.feedMap.componentAttached(c1)
+        self.assertEquals(self.feedMap.getFeedersForEaters(c2),
+                          [('default-prime', c1, 'default')])
+        self.assertEquals(self.feedMap.getEatersForFeeders(c1),
+                          [('default', c2, 'default-prime')])
+        self.assertEquals(
+            self.feedMap.getFeedersForEater(c2, '/a/comp1:default'),
+            [('default-prime', c1, 'default')])
+
+    def testDetachAlternateFeeder(self):
+        c1 = fca('a', 'comp1', vfeeds=[('vcomp', 'vfeed', 'default')])
+        c2 = fca('a', 'comp2', vfeeds=[('vcomp', 'vfeed', 'default')])
+        c3 = fca('a', 'comp3',
+                 eaters={'default': [('vcomp:vfeed', 'default-prime')]})
+        c4 = fca('a', 'comp4',
+                 eaters={'default': [('vcomp:vfeed', 'default-prime')]})
+        for c in c1, c2, c3, c4:
+            self.feedMap.componentAttached(c)
+        self.assertEquals(self.feedMap.getFeedersForEaters(c3),
+                          [('default-prime', c1, 'default')])
+
+        deps = self.feedMap.componentDetached(c1)
+        self.assertEquals(len(deps), 2)
+        self.assertEquals(set(deps), set([(c3, '/a/vcomp:vfeed'),
+                                          (c4, '/a/vcomp:vfeed')]))
+        self.assertEquals(self.feedMap.getFeedersForEaters(c3),
+                          [('default-prime', c2, 'default')])
+        self.assertEquals(self.feedMap.getFeedersForEaters(c4),
+                          [('default-prime', c2, 'default')])
+        self.assertEquals(self.feedMap.getEatersForFeeders(c1), [])
+
+        self.assertEquals(self.detach(c3), [])
+        self.assertEquals(self.feedMap.getEatersForFeeders(c2),
+                          [('default', c4, 'default-prime')])
+
+        for c in c2, c4:
+            self.detach(c)
+        self.assertEmpty()
+
+    def testDetachAll(self):
+        comps = [fca('a', 'comp0')]
+        for i in range(1, 10):
+            comps.append(fca('a', 'comp%d' % i,
+                eaters={'default': [('comp%d:default' % (i - 1),
+                                     'default-prime')]}))
+        # attach every other component first
+        for c in comps[::2] + comps[1::2]:
+            self.feedMap.componentAttached(c)
+        for a, b in zip(comps, comps[1:]):
+            self.assertEquals(self.feedMap.getEatersForFeeders(a),
+                              [('default', b, 'default-prime')])
+
+        for c in comps[1::2] + comps[::2]:
+            self.detach(c)
+        self.assertEmpty()
+        self.assertEquals(self.feedMap.avatars, {})
@@ -53,7 +53,10 @@ class TestManagerConfigParser(testsuite.TestCase):
                            <port>999</port>
                            <transport>tcp</transport>
                            <certificate>manager.cert</certificate>
-                           <debug>true</debug>""",
+                           <debug>true</debug>
+                           <startup-concurrency>4</startup-concurrency>"""
+                               "<startup-wait-for-producers>True"
+                               "</startup-wait-for-producers>",
                         extra=' name="mname"')
         parser = ManagerConfigParser(f)
         self.failUnless(parser.manager)
@@ -65,6 +68,8 @@ class TestManagerConfigParser(testsuite.TestCase):
         self.assertEquals(manager.transport, 'tcp')
         self.assertEquals(manager.certificate, 'manager.cert')
         self.assertEquals(manager.fludebug, 'true')
+        self.assertEquals(manager.startupConcurrency, 4)
+        self.assertEquals(manager.startupWaitForProducers, True)
 
     def testParseManagerInvalid(self):
         f = self._buildManager('<transport>foo</transport>')
@@ -0,0 +1,174 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_manager_startup -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+from twisted.internet import defer, reactor, task
+
+from flumotion.common import common, planet, testsuite
+from flumotion.common.planet import moods
+from flumotion.manager import startup
+from flumotion.twisted import flavors
+
+
+def makeState(name, eaters=(), flowName='flow'):
+    state = planet.ManagerComponentState()
+    state.set('name', name)
+    state.set('mood', moods.sleeping.value)
+    eater = {}
+    if eaters:
+        eater['default'] = [(feedId, feedId) for feedId in eaters]
+    state.set('config', {'name': name,
+                         'parent': flowName,
+                         'avatarId': common.componentId(flowName, name),
+                         'feed': ['default'],
+                         'eater': eater})
+    return state
+
+
+class FakeJobState(flavors.StateRemoteCache):
+
+    def __init__(self):
+        flavors.StateRemoteCache.__init__(self)
+        self.setCopyableState({'mood': moods.waking.value})
+
+
+class TestStartupScheduler(testsuite.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        startup.reactor = self.clock
+        self.created = []
+        self.scheduler = startup.StartupScheduler(self.create,
+                                                  concurrency=2,
+                                                  timeout=10.0)
+
+    def tearDown(self):
+        self.scheduler.stop()
+        startup.reactor = reactor
+
+    def create(self, workerId, state):
+        self.created.append(state.get('name'))
+        return defer.succeed(None)
+
+    def setMood(self, state, mood):
+        if not hasattr(state, 'fakeJobState'):
+            state.fakeJobState = FakeJobState()
+            self.scheduler.componentLoggedIn(state, state.fakeJobState)
+        state.fakeJobState.observe_set('mood', mood.value)
+
+    def testConcurrency(self):
+        states = [makeState('comp%d' % i) for i in range(5)]
+        self.scheduler.schedule('worker', states)
+        self.assertEquals(self.created, ['comp0', 'comp1'])
+        self.assertEquals(self.scheduler.getStarting('worker'), 2)
+        self.assertEquals(self.scheduler.getQueued('worker'), 3)
+
+        self.setMood(states[0], moods.waking)
+        self.assertEquals(len(self.created), 2)
+        self.setMood(states[0], moods.happy)
+        self.assertEquals(len(self.created), 3)
+        self.setMood(states[1], moods.sad)
+        self.assertEquals(len(self.created), 4)
+
+        # the slots are per worker
+        self.scheduler.schedule('other', [makeState('comp5')])
+        self.assertEquals(len(self.created), 5)
+
+    def testProducersFirst(self):
+        producer = makeState('producer')
+        encoder = makeState('encoder', eaters=['producer:default'])
+        streamer = makeState('streamer', eaters=['encoder:default'])
+        others = [makeState('other%d' % i) for i in range(3)]
+        self.scheduler.concurrency = None
+
+        # all at once, producers first even when scheduled last
+        self.scheduler.schedule('worker',
+                                [streamer] + others + [encoder, producer])
+        self.assertEquals(self.created, ['producer', 'other0', 'other1',
+                                         'other2', 'encoder', 'streamer'])
+
+    def testConsumersWithoutWaiting(self):
+        producer = makeState('producer')
+        encoder = makeState('encoder', eaters=['producer:default'])
+        others = [makeState('other%d' % i) for i in range(2)]
+
+        self.scheduler.schedule('worker', [encoder, producer] + others)
+        self.assertEquals(self.created, ['producer', 'other0'])
+        # the encoder doesn't wait for the producer to start
+        self.setMood(others[0], moods.happy)
+        self.setMood(producer, moods.waking)
+        self.assertEquals(self.created[2:], ['other1'])
+        self.setMood(others[1], moods.happy)
+        self.assertEquals(self.created[3:], ['encoder'])
+
+    def testWaitForProducers(self):
+        self.scheduler.waitForProducers = True
+        producer = makeState('producer')
+        encoder = makeState('encoder', eaters=['producer:default'])
+        streamer = makeState('streamer', eaters=['encoder:default'])
+        others = [makeState('other%d' % i) for i in range(3)]
+
+        # producers go first, even when scheduled last
+        self.scheduler.schedule('worker',
+                                [streamer] + others + [encoder, producer])
+        self.assertEquals(self.created, ['producer', 'other0'])
+
+        # consumers go first once their producer is started
+        self.setMood(producer, moods.happy)
+        self.assertEquals(self.created[2:], ['encoder'])
+        self.setMood(encoder, moods.hungry)
+        self.assertEquals(self.created[3:], ['streamer'])
+        self.setMood(others[0], moods.happy)
+        self.assertEquals(self.created[4:], ['other1'])
+
+        # the consumers of a producer scheduled later can't wait for it
+        late = makeState('late', eaters=['missing:default'])
+        self.scheduler.schedule('other', [late])
+        self.assertEquals(self.created[5:], ['late'])
+
+    def testTimeToHappy(self):
+        state = makeState('comp')
+        self.scheduler.schedule('worker', [state])
+        self.setMood(state, moods.hungry)
+        self.setMood(state, moods.happy)
+        self.failUnless('/flow/comp' in self.scheduler.timeToHappy)
+        # not followed anymore once happy
+        self.failIf(state.fakeJobState._listeners)
+
+    def testTimeout(self):
+        self.scheduler.waitForProducers = True
+        producer = makeState('producer')
+        consumer = makeState('consumer', eaters=['producer:default'])
+        self.scheduler.schedule('worker', [producer, consumer])
+        self.assertEquals(self.created, ['producer'])
+        self.clock.advance(10.0)
+        self.assertEquals(self.created, ['producer', 'consumer'])
+        self.assertEquals(self.scheduler.getStarting('worker'), 1)
+
+    def testWorkerGone(self):
+        self.create = lambda workerId, state: None
+        self.scheduler._create = self.create
+        producer = makeState('producer')
+        consumer = makeState('consumer', eaters=['producer:default'])
+        self.scheduler.schedule('worker', [producer, consumer])
+        self.assertEquals(self.scheduler.getStarting('worker'), 0)
+        self.assertEquals(self.scheduler.getQueued('worker'), 0)
+
+    def testCycle(self):
+        a = makeState('a', eaters=['b:default'])
+        b = makeState('b', eaters=['a:default'])
+        self.scheduler.schedule('worker', [a, b])
+        self.assertEquals(len(self.created), 2)
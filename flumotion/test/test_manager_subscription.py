@@ -0,0 +1,123 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+from flumotion.common import planet, testsuite
+from flumotion.common.planet import moods
+from flumotion.manager import subscription
+
+
+def addComponent(parent, name):
+    state = planet.ManagerComponentState()
+    state.set('name', name)
+    state.set('mood', moods.sleeping.value)
+    state.set('parent', parent)
+    parent.append('components', state)
+    return state
+
+
+class TestSubscriptionHub(testsuite.TestCase):
+
+    def setUp(self):
+        self.planet = planet.ManagerPlanetState()
+        self.flow = planet.ManagerFlowState(name='default',
+                                            parent=self.planet)
+        self.planet.append('flows', self.flow)
+        self.producer = addComponent(self.flow, 'producer')
+        self.encoder = addComponent(self.flow, 'encoder')
+        self.porter = addComponent(self.planet.get('atmosphere'), 'porter')
+        self.hub = subscription.SubscriptionHub(self.planet)
+        self.events = []
+
+    def notify(self, subscriptionId, avatarId, event, args):
+        self.events.append((subscriptionId, avatarId, event, args))
+
+    def testSnapshot(self):
+        sid, snapshot = self.hub.subscribe(self.notify,
+                                           components=['/default/*'],
+                                           keys=['mood', 'name'])
+        self.assertEquals(snapshot, {
+            '/default/producer': {'mood': moods.sleeping.value,
+                                  'name': 'producer'},
+            '/default/encoder': {'mood': moods.sleeping.value,
+                                 'name': 'encoder'}})
+
+        # the parent is never sent
+        sid, snapshot = self.hub.subscribe(self.notify, flows=['atmosphere'])
+        self.assertEquals(snapshot.keys(), ['/atmosphere/porter'])
+        self.failIf('parent' in snapshot['/atmosphere/porter'])
+
+    def testFiltered(self):
+        sid, snapshot = self.hub.subscribe(self.notify,
+                                           components=['/default/producer'],
+                                           keys=['mood'])
+        self.encoder.set('mood', moods.happy.value)
+        self.producer.set('pid', 1234)
+        self.porter.set('mood', moods.happy.value)
+        self.failIf(self.events)
+
+        self.producer.set('mood', moods.happy.value)
+        self.producer.append('messages', 'message')
+        self.assertEquals(self.events, [
+            (sid, '/default/producer', 'set',
+             ('mood', moods.happy.value))])
+
+    def testComponentsAddedAndRemoved(self):
+        sid, snapshot = self.hub.subscribe(self.notify, flows=['default'],
+                                           keys=['name'])
+        streamer = addComponent(self.flow, 'streamer')
+        addComponent(self.planet.get('atmosphere'), 'other')
+        self.assertEquals(self.events, [
+            (sid, '/default/streamer', 'added', ({'name': 'streamer'}, ))])
+
+        del self.events[:]
+        self.flow.remove('components', streamer)
+        self.assertEquals(self.events,
+                          [(sid, '/default/streamer', 'removed', ())])
+        # not watched anymore
+        del self.events[:]
+        streamer.set('name', 'renamed')
+        self.failIf(self.events)
+
+        # new flows are watched too
+        flow = planet.ManagerFlowState(name='other', parent=self.planet)
+        addComponent(flow, 'producer')
+        self.planet.append('flows', flow)
+        sid2, snapshot = self.hub.subscribe(self.notify, flows=['other'])
+        self.assertEquals(snapshot.keys(), ['/other/producer'])
+        self.planet.remove('flows', flow)
+        self.assertEquals(self.events[-1],
+                          (sid2, '/other/producer', 'removed', ()))
+
+    def testUnsubscribe(self):
+        sid, snapshot = self.hub.subscribe(self.notify)
+        sid2, snapshot = self.hub.subscribe(self.notify, keys=['pid'])
+        self.failIfEquals(sid, sid2)
+        self.producer.set('pid', 1)
+        self.assertEquals(len(self.events), 2)
+
+        self.hub.unsubscribe(sid)
+        self.producer.set('pid', 2)
+        self.assertEquals(self.events[-1],
+                          (sid2, '/default/producer', 'set', ('pid', 2)))
+        self.assertEquals(len(self.events), 3)
+
+        # nothing is watched without subscriptions
+        self.hub.unsubscribe(sid2)
+        self.assertEquals(self.hub.getSubscriptionCount(), 0)
+        for state in [self.planet, self.flow, self.producer, self.encoder,
+                      self.porter, self.planet.get('atmosphere')]:
+            self.failIf(state._watchers)
@@ -52,6 +52,10 @@ class FakeMind(log.Loggable):
     def notifyOnDisconnect(self, proc):
         pass
 
+    def remote_ping(self):
+        # avatars ping their mind to measure the round trip time
+        return True
+
     def callRemote(self, name, *args, **kwargs):
         self.debug('callRemote(%s, %r, %r)' % (name, args, kwargs))
         #print "callRemote(%s, %r, %r)" % (name, args, kwargs)
@@ -22,6 +22,7 @@ import twisted
 
 from twisted.internet import defer, threads, reactor
 from flumotion.common import testsuite, errors
+from flumotion.component.misc.httpserver.httpcached import common
 from flumotion.component.misc.httpserver.httpcached import server_selection
 
 attr = testsuite.attr
@@ -135,6 +136,35 @@ class TestServerSelector(testsuite.TestCase):
         d.addCallback(self._testHas, ["127.0.0.1", "10.0.0.2"])
         return d
 
+    def testRefreshKeepsStatistics(self):
+        self.tearDown()
+        table = {"localhost": ["127.0.0.1", "10.0.0.1"]}
+        self.ss = server_selection.ServerSelector(None, DummySocketDNS(table))
+        self.ss.setup()
+
+        def report(_):
+            for s in self.ss.getServers():
+                s.reportSuccess(0.5)
+            self.ss._resolver.socket = DummySocketDNS(
+                {"localhost": ["127.0.0.1"]})
+            return self.ss.refreshServers()
+
+        def back(_):
+            self.ss._resolver.socket = DummySocketDNS(table)
+            return self.ss.refreshServers()
+
+        def check(_):
+            servers = list(self.ss.getServers())
+            self.assertEquals(len(servers), 2)
+            self.assertEquals([s.latency for s in servers], [0.5, 0.5])
+
+        d = self.ss.addServer("localhost", 80)
+        d.addCallback(report)
+        d.addCallback(self._testHas, ["127.0.0.1"])
+        d.addCallback(back)
+        d.addCallback(check)
+        return d
+
     def _testTimeout(self):
         self.tearDown()
         self.ss = server_selection.ServerSelector(None, TimeoutSocketDNS())
@@ -160,6 +190,90 @@ class TestServerSelector(testsuite.TestCase):
         return result
 
 
+class TestServerLoad(testsuite.TestCase):
+
+    def setUp(self):
+        self.ss = server_selection.ServerSelector(None)
+        self.fast = server_selection.Server("10.0.0.1", 80, 1.0)
+        self.slow = server_selection.Server("10.0.0.2", 80, 1.0)
+        self.backup = server_selection.Server("10.0.0.3", 80, 2.0)
+        self.ss.servers = {1.0: [self.fast, self.slow],
+                           2.0: [self.backup]}
+        self.fast.reportSuccess(0.01)
+        self.slow.reportSuccess(1.0)
+
+    def testLeastCost(self):
+        for i in range(10):
+            self.assertEquals(list(self.ss.getServers()),
+                              [self.fast, self.slow, self.backup])
+        # enough requests in progress make the fast one more expensive
+        for i in range(200):
+            self.fast.onRequestStarted()
+        self.assertEquals(list(self.ss.getServers())[0], self.slow)
+        for i in range(200):
+            self.fast.onRequestFinished()
+        self.assertEquals(self.fast.outstanding, 0)
+
+    def testErrorRate(self):
+        self.fast.latency = self.slow.latency = 0.5
+        self.fast.reportError(common.SERVER_TIMEOUT)
+        self.assertEquals(list(self.ss.getServers())[0], self.slow)
+        # errors not caused by the server don't count
+        self.slow.reportError(common.STREAM_NOTFOUND)
+        self.assertEquals(self.slow.errorRate, 0.0)
+
+    def testCircuitBreaker(self):
+        for i in range(server_selection.CIRCUIT_MAX_FAILURES):
+            self.failUnless(self.fast.isAvailable())
+            self.fast.reportError(common.SERVER_UNAVAILABLE)
+        self.failIf(self.fast.isAvailable())
+        # still tried, after all the others
+        self.assertEquals(list(self.ss.getServers()),
+                          [self.slow, self.backup, self.fast])
+
+        # one request at a time once the delay is over
+        delay = self.fast.retryDelay
+        now = self.fast.retryTime
+        self.failUnless(self.fast.isAvailable(now))
+        self.fast.onRequestStarted()
+        self.failIf(self.fast.isAvailable(now))
+        self.fast.onRequestFinished()
+        self.fast.reportError(common.SERVER_UNAVAILABLE, now)
+        self.assertEquals(self.fast.retryDelay, delay * 2)
+        self.failIf(self.fast.isAvailable(now))
+
+        self.fast.reportSuccess(0.01)
+        self.failUnless(self.fast.isAvailable())
+        self.assertEquals(self.fast.failures, 0)
+        # less used than its latency alone would tell
+        self.failUnless(self.fast.getCost() > 0.01)
+
+    def testCircuitBreakerInProgress(self):
+        started = time.time()
+        for i in range(server_selection.CIRCUIT_MAX_FAILURES):
+            self.fast.reportError(common.SERVER_TIMEOUT, started)
+        retryTime = self.fast.retryTime
+        delay = self.fast.retryDelay
+        # the other requests sent before don't make it back off further
+        for i in range(16):
+            self.fast.reportError(common.SERVER_TIMEOUT, started)
+        self.assertEquals(self.fast.retryTime, retryTime)
+        self.assertEquals(self.fast.retryDelay, delay)
+        # the request trying it again does
+        self.fast.reportError(common.SERVER_TIMEOUT, retryTime)
+        self.assertEquals(self.fast.retryDelay, delay * 2)
+
+    def testPruneKnown(self):
+        self.ss._getServer("10.0.0.1", 80, 1.0)
+        gone = self.ss._getServer("10.0.0.4", 80, 1.0)
+        self.ss._pruneKnown()
+        self.assertEquals(len(self.ss._known), 2)
+        # forgotten once not resolved for a while
+        gone.lastSeen -= server_selection.KNOWN_SERVER_TIMEOUT + 1
+        self.ss._pruneKnown()
+        self.assertEquals(self.ss._known.keys(), [("10.0.0.1", 80, 1.0)])
+
+
 class DummySocketDNS:
 
     def __init__(self, table):
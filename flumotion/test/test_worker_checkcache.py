@@ -0,0 +1,125 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_worker_checkcache -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+from twisted.internet import defer
+
+from flumotion.common import messages, testsuite
+from flumotion.common.i18n import N_, gettexter
+from flumotion.worker import checkcache
+
+T_ = gettexter()
+
+
+class FakeCheck:
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, *args):
+        d = defer.Deferred()
+        self.calls.append((args, d))
+        return d
+
+    def answer(self, result):
+        self.calls.pop(0)[1].callback(result)
+
+
+class TestCheckCache(testsuite.TestCase):
+
+    def setUp(self):
+        self.stamp = 1
+        self.cache = checkcache.CheckCache(getStamp=lambda: self.stamp)
+        self.check = FakeCheck()
+
+    def runCheck(self, *args):
+        results = []
+        key = checkcache.makeKey(*args)
+        d = self.cache.run(key, self.check, *args)
+        d.addCallback(results.append)
+        return results
+
+    def testMakeKey(self):
+        self.assertEquals(checkcache.makeKey(['a', 'b'], x={'y': [1]}),
+                          checkcache.makeKey(('a', 'b'), x={'y': (1, )}))
+        self.assertRaises(TypeError, checkcache.makeKey, set())
+
+    def testHit(self):
+        first = self.runCheck(['fakesrc'])
+        self.check.answer(['fakesrc'])
+        self.assertEquals(first, [['fakesrc']])
+        second = self.runCheck(['fakesrc'])
+        self.assertEquals(second, [['fakesrc']])
+        self.failIf(self.check.calls)
+
+        # other arguments are another check
+        self.runCheck(['fakesink'])
+        self.assertEquals(len(self.check.calls), 1)
+
+        stats = self.cache.getStats()
+        self.assertEquals(stats['hits'], 1)
+        self.assertEquals(stats['misses'], 2)
+        self.assertEquals(stats['entries'], 1)
+        self.assertEquals(stats['check-time-max'],
+                          stats['check-time-average'])
+
+    def testJoined(self):
+        first = self.runCheck('check')
+        second = self.runCheck('check')
+        self.assertEquals(len(self.check.calls), 1)
+        self.check.answer(True)
+        self.assertEquals(first, [True])
+        self.assertEquals(second, [True])
+        self.assertEquals(self.cache.getStats()['joined'], 1)
+
+    def testFailuresNotKept(self):
+        result = messages.Result()
+        result.add(messages.Error(T_(N_("Device busy."))))
+        self.runCheck('device')
+        self.check.answer(result)
+        self.runCheck('device')
+        self.assertEquals(len(self.check.calls), 1)
+
+        failures = []
+        d = self.cache.run(checkcache.makeKey('import'), self.check)
+        d.addErrback(failures.append)
+        self.check.calls.pop()[1].errback(ImportError())
+        self.assertEquals(len(failures), 1)
+        self.assertEquals(self.cache.getStats()['entries'], 0)
+
+    def testRegistryChanged(self):
+        self.runCheck('check')
+        self.check.answer(True)
+        self.stamp = 2
+        self.runCheck('check')
+        self.assertEquals(len(self.check.calls), 1)
+        self.assertEquals(self.cache.getStats()['invalidations'], 1)
+
+    def testExpiry(self):
+        self.cache.ttl = 0
+        self.runCheck('check')
+        self.check.answer(True)
+        self.runCheck('check')
+        self.assertEquals(len(self.check.calls), 1)
+
+    def testMaxEntries(self):
+        self.cache.maxEntries = 2
+        for i in range(3):
+            self.runCheck(i)
+            self.check.answer(i)
+        self.assertEquals(self.cache.getStats()['entries'], 2)
+        self.runCheck(0)
+        self.assertEquals(len(self.check.calls), 1)
@@ -105,6 +105,8 @@ class StateCacheable(pb.Cacheable):
     or list of objects.
     """
 
+    _watchers = None # watcher -> list of procedures, created when needed
+
     def __init__(self):
         self._observers = []
         self._hooks = []
@@ -174,6 +176,8 @@ class StateCacheable(pb.Cacheable):
             raise KeyError('%s in %r' % (key, self))
 
         self._dict[key] = value
+        if self._watchers:
+            self._notifyWatchers(0, key, value)
         dList = [o.callRemote('set', key, value) for o in self._observers]
         return defer.DeferredList(dList)
 
@@ -186,6 +190,8 @@ class StateCacheable(pb.Cacheable):
             raise KeyError('%s in %r' % (key, self))
 
         self._dict[key].append(value)
+        if self._watchers:
+            self._notifyWatchers(1, key, value)
         dList = [o.callRemote('append', key, value) for o in self._observers]
         return defer.DeferredList(dList)
 
@@ -202,6 +208,8 @@ class StateCacheable(pb.Cacheable):
         except ValueError:
             raise ValueError('value %r not in list %r for key %r' % (
                 value, self._dict[key], key))
+        if self._watchers:
+            self._notifyWatchers(2, key, value)
         dList = [o.callRemote('remove', key, value) for o in self._observers]
         dl = defer.DeferredList(dList)
         return dl
@@ -215,6 +223,8 @@ class StateCacheable(pb.Cacheable):
             raise KeyError('%s in %r' % (key, self))
 
         self._dict[key][subkey] = value
+        if self._watchers:
+            self._notifyWatchers(3, key, subkey, value)
         dList = [o.callRemote('setitem', key, subkey, value)
                 for o in self._observers]
         return defer.DeferredList(dList)
@@ -233,11 +243,66 @@ class StateCacheable(pb.Cacheable):
         except KeyError:
             raise KeyError('key %r not in dict %r for key %r' % (
                 subkey, self._dict[key], key))
+        if self._watchers:
+            self._notifyWatchers(4, key, subkey, value)
         dList = [o.callRemote('delitem', key, subkey, value) for o in
                 self._observers]
         dl = defer.DeferredList(dList)
         return dl
 
+    def addWatcher(self, watcher, set_=None, append=None, remove=None,
+                   setitem=None, delitem=None):
+        """
+        Adds a local watcher of the changes made to this state, in the
+        process owning it.
+
+        The watcher is called with the same arguments as the listeners
+        of a L{StateRemoteCache}, but synchronously, when the change is
+        made and before the remote observers are told about it.
+
+        Always call this method using keyword arguments for the functions.
+
+        @param watcher: object watching the changes
+        @param set_:    procedure to call when a value is set
+        @type  set_:    procedure(object, key, value) -> None
+        @param append:  procedure to call when a value is appended to a list
+        @type  append:  procedure(object, key, value) -> None
+        @param remove:  procedure to call when a value is removed from a list
+        @type  remove:  procedure(object, key, value) -> None
+        @param setitem: procedure to call when a value is set in a dict
+        @type  setitem: procedure(object, key, subkey, value) -> None
+        @param delitem: procedure to call when a value is removed from a dict
+        @type  delitem: procedure(object, key, subkey, value) -> None
+        """
+        if not (set_ or append or remove or setitem or delitem):
+            raise ValueError("At least one event handler has to be specified")
+        if self._watchers is None:
+            self._watchers = {}
+        if watcher in self._watchers:
+            raise KeyError("%r is already a watcher of %r" % (watcher, self))
+        self._watchers[watcher] = [set_, append, remove, setitem, delitem]
+
+    def removeWatcher(self, watcher):
+        """
+        Remove a watcher added with L{addWatcher}.
+        """
+        if not self._watchers or watcher not in self._watchers:
+            raise KeyError(watcher)
+        del self._watchers[watcher]
+
+    def _notifyWatchers(self, index, *args):
+        # compute the procedures first, so watchers can be added and
+        # removed during the calls
+        for proc in [procs[index] for procs in self._watchers.values()]:
+            if proc:
+                try:
+                    proc(self, *args)
+                except Exception, e:
+                    # These are all programming errors
+                    log.warning("statecacheable",
+                                'Exception in StateCacheable watcher: %s',
+                                log.getExceptionMessage(e))
+
     # pb.Cacheable methods
 
     def getStateToCacheAndObserveFor(self, perspective, observer):
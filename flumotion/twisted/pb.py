@@ -30,7 +30,7 @@ from twisted.spread.pb import PBClientFactory
 from zope.interface import implements
 
 from flumotion.configure import configure
-from flumotion.common import keycards, errors
+from flumotion.common import keycards, errors, heartbeat
 from flumotion.common import log as flog
 from flumotion.common.netutils import addressGetHost
 from flumotion.twisted import reflect as freflect
@@ -760,8 +760,10 @@ class Avatar(pb.Avatar, flog.Loggable):
 
 
 class PingableAvatar(Avatar):
+    _pingInterval = configure.heartbeatInterval
     _pingCheckInterval = (configure.heartbeatInterval *
                           configure.pingTimeoutMultiplier)
+    _heartbeat = None
 
     def __init__(self, avatarId, clock=reactor):
         self._clock = clock
@@ -769,7 +771,8 @@ class PingableAvatar(Avatar):
 
     def perspectiveMessageReceivedUnserialised(self, broker, message,
             args, kwargs):
-        self._lastPing = self._clock.seconds()
+        if self._heartbeat:
+            self._heartbeat.seen()
         return Avatar.perspectiveMessageReceivedUnserialised(
             self, broker, message, args, kwargs)
 
@@ -782,34 +785,38 @@ class PingableAvatar(Avatar):
                                          **kwargs)
 
         def cb(result):
-            self._lastPing = self._clock.seconds()
+            if self._heartbeat:
+                self._heartbeat.seen()
             return result
         d.addCallback(cb)
         return d
 
     def startPingChecking(self, disconnect):
-        self._lastPing = self._clock.seconds()
-        self._pingCheckDisconnect = disconnect
-        self._pingCheck()
-
-    def _pingCheck(self):
-        self._pingCheckDC = None
-        if self._clock.seconds() - self._lastPing > self._pingCheckInterval:
-            self.info('no ping in %f seconds, closing connection',
-                      self._pingCheckInterval)
-            self._pingCheckDisconnect()
-        else:
-            self._pingCheckDC = self._clock.callLater(self._pingCheckInterval,
-                                                      self._pingCheck)
+        # the client pings us when idle; we only ping it ourselves when it
+        # does not, and to measure the round trip time
+        scheduler = heartbeat.getScheduler(self._clock)
+        self._heartbeat = scheduler.add(self._ping, disconnect,
+                                        self._pingInterval,
+                                        self._pingCheckInterval)
+
+    def _ping(self):
+        return self.mindCallRemoteLogging(flog.LOG, 0, 'ping')
 
     def stopPingChecking(self):
-        if self._pingCheckDC:
-            self._pingCheckDC.cancel()
-        self._pingCheckDC = None
+        if self._heartbeat:
+            self._heartbeat.stop()
+        self._heartbeat = None
 
-        # release the disconnect function, too, to help break any
-        # potential cycles
-        self._pingCheckDisconnect = None
+    def getHeartbeatStats(self):
+        """
+        @returns: the round trip time statistics of the connection to the
+                  client, as returned by
+                  L{flumotion.common.heartbeat.Heartbeat.getStats}, or
+                  None when not connected
+        @rtype:   dict or None
+        """
+        if self._heartbeat:
+            return self._heartbeat.getStats()
 
     def setMind(self, mind):
         # chain up
@@ -0,0 +1,244 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_worker_checkcache -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""
+cache of the results of the checks run by the worker
+"""
+
+import glob
+import os
+import time
+
+from twisted.internet import defer
+from twisted.python import failure
+
+from flumotion.common import log, messages
+
+__version__ = "$Rev$"
+
+# seconds a check result is kept; devices can come and go without the
+# plugin registry changing
+DEFAULT_TTL = 600.0
+DEFAULT_MAX_ENTRIES = 1000
+# weight of a new check time in the moving average
+CHECK_TIME_WEIGHT = 0.25
+
+
+def getRegistryStamp():
+    """
+    Get a stamp of the GStreamer plugin registry used by the check jobs,
+    which changes when the registry is written again or plugins are added
+    to or removed from the plugin paths.
+
+    The worker process doesn't load GStreamer, so the registry files and
+    the plugin directories are looked at instead.
+
+    @rtype: tuple
+    """
+    if 'GST_REGISTRY' in os.environ:
+        paths = [os.environ['GST_REGISTRY']]
+    else:
+        paths = glob.glob(os.path.expanduser('~/.gstreamer-0.10/registry.*'))
+        paths.sort()
+    for var in ('GST_PLUGIN_PATH', 'GST_PLUGIN_SYSTEM_PATH'):
+        paths.extend([p for p in os.environ.get(var, '').split(os.pathsep)
+                      if p])
+
+    ret = []
+    for path in paths:
+        try:
+            s = os.stat(path)
+        except OSError:
+            continue
+        ret.append((path, s.st_mtime, s.st_size))
+    return tuple(ret)
+
+
+def makeKey(*args, **kwargs):
+    """
+    Make a cache key out of the arguments of a check, turning lists and
+    dicts into tuples.
+
+    @raises TypeError: when an argument can't be used as a key
+    """
+
+    def freeze(o):
+        if isinstance(o, (list, tuple)):
+            return tuple([freeze(x) for x in o])
+        if isinstance(o, dict):
+            items = [(k, freeze(v)) for k, v in o.items()]
+            items.sort()
+            return tuple(items)
+        hash(o)
+        return o
+    return freeze(args), freeze(kwargs)
+
+
+class CheckCache(log.Loggable):
+    """
+    I keep the results of the checks run in check jobs, so the same check
+    isn't run again until the GStreamer plugin registry changes or the
+    result is older than L{ttl} seconds.
+
+    Only successful results are kept: failures and results with error
+    messages, for example because a device is busy, are run again the
+    next time. Identical checks asked for while one is running wait for
+    its result instead of running too.
+    """
+
+    logCategory = 'checkcache'
+
+    def __init__(self, ttl=DEFAULT_TTL, maxEntries=DEFAULT_MAX_ENTRIES,
+                 getStamp=getRegistryStamp):
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self._getStamp = getStamp
+        self._stamp = getStamp()
+
+        self._entries = {} # key -> (result, expiry time)
+        self._running = {} # key -> list of deferreds waiting for it
+
+        self.hits = 0
+        self.misses = 0
+        self.joined = 0
+        self.invalidations = 0
+        self.checkTimeAverage = None
+        self.checkTimeMax = None
+
+    ### public API
+
+    def run(self, key, proc, *args, **kwargs):
+        """
+        Get the result of a check from the cache, or run it.
+
+        @param key:  the key of the check, from L{makeKey}, or None to run
+                     it without caching its result
+        @param proc: procedure running the check, returning a deferred
+        @type  proc: callable
+
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+        self._checkStamp()
+        if key is None:
+            self.misses += 1
+            return self._run(key, proc, args, kwargs)
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            result, expiry = entry
+            if expiry > time.time():
+                self.hits += 1
+                self.log('cache hit for %r', key)
+                return defer.succeed(result)
+            del self._entries[key]
+
+        if key in self._running:
+            self.joined += 1
+            self.log('waiting for the running check %r', key)
+            d = defer.Deferred()
+            self._running[key].append(d)
+            return d
+
+        self.misses += 1
+        self._running[key] = []
+        return self._run(key, proc, args, kwargs)
+
+    def invalidate(self):
+        """
+        Forget all the results kept.
+        """
+        self.invalidations += 1
+        self._entries = {}
+
+    def getStats(self):
+        """
+        @returns: the cache hits, misses and checks joined while running,
+                  the hit rate, the number of results kept and of
+                  invalidations, and the moving average and maximum of
+                  the seconds taken by the checks run
+        @rtype:   dict
+        """
+        asked = self.hits + self.misses + self.joined
+        hitRate = None
+        if asked:
+            hitRate = float(self.hits + self.joined) / asked
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'joined': self.joined,
+                'hit-rate': hitRate,
+                'entries': len(self._entries),
+                'invalidations': self.invalidations,
+                'check-time-average': self.checkTimeAverage,
+                'check-time-max': self.checkTimeMax}
+
+    ### private methods
+
+    def _checkStamp(self):
+        stamp = self._getStamp()
+        if stamp != self._stamp:
+            self.info('GStreamer plugin registry changed, forgetting %d '
+                      'check results', len(self._entries))
+            self._stamp = stamp
+            self.invalidate()
+
+    def _run(self, key, proc, args, kwargs):
+        d = defer.maybeDeferred(proc, *args, **kwargs)
+        d.addBoth(self._checkDone, key, time.time())
+        return d
+
+    def _checkDone(self, result, key, start):
+        elapsed = time.time() - start
+        if self.checkTimeAverage is None:
+            self.checkTimeAverage = self.checkTimeMax = elapsed
+        else:
+            self.checkTimeAverage += CHECK_TIME_WEIGHT * (
+                elapsed - self.checkTimeAverage)
+            self.checkTimeMax = max(self.checkTimeMax, elapsed)
+
+        if key is None:
+            return result
+
+        # the check job may have rebuilt the registry
+        self._checkStamp()
+        if self._isCacheable(result):
+            self._store(key, result)
+
+        for d in self._running.pop(key, []):
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        return result
+
+    def _isCacheable(self, result):
+        if isinstance(result, failure.Failure):
+            return False
+        if isinstance(result, messages.Result):
+            return not result.failed
+        return True
+
+    def _store(self, key, result):
+        now = time.time()
+        if len(self._entries) >= self.maxEntries:
+            for k, (r, expiry) in self._entries.items():
+                if expiry <= now:
+                    del self._entries[k]
+        if len(self._entries) >= self.maxEntries:
+            oldest = min([(expiry, k)
+                          for k, (r, expiry) in self._entries.items()])[1]
+            del self._entries[oldest]
+        self._entries[key] = (result, now + self.ttl)
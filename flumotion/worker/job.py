@@ -29,7 +29,7 @@ from flumotion.common import errors, log
 from flumotion.common import messages
 from flumotion.common.i18n import N_, gettexter
 from flumotion.configure import configure
-from flumotion.worker import base
+from flumotion.worker import base, checkcache
 
 __version__ = "$Rev$"
 T_ = gettexter()
@@ -268,6 +268,8 @@ class CheckJobHeaven(base.BaseJobHeaven):
 
     _checkCount = 0
     _timeout = 45
+    # seconds the cache statistics changes are gathered before sending them
+    _statsDelay = 5
 
     def __init__(self, brain):
         base.BaseJobHeaven.__init__(self, brain)
@@ -276,6 +278,15 @@ class CheckJobHeaven(base.BaseJobHeaven):
         # running checks)
         self.jobPool = []
 
+        self.checkCache = checkcache.CheckCache()
+        self._statsDC = None
+
+    def shutdown(self):
+        if self._statsDC is not None:
+            self._statsDC.cancel()
+            self._statsDC = None
+        return base.BaseJobHeaven.shutdown(self)
+
     def getCheckJobFromPool(self):
         if self.jobPool:
             job, expireDC = self.jobPool.pop(0)
@@ -314,6 +325,41 @@ class CheckJobHeaven(base.BaseJobHeaven):
         return d
 
     def runCheck(self, bundles, moduleName, methodName, *args, **kwargs):
+        """
+        Run a check in a check job, or get its result from the cache when
+        it was run with the same arguments and bundles already.
+
+        @param bundles: the bundles the check needs, as (name, path)
+                        tuples; the paths contain the md5 sums
+        @type  bundles: list of (str, str)
+        """
+        try:
+            key = checkcache.makeKey(bundles, moduleName, methodName,
+                                     *args, **kwargs)
+        except TypeError:
+            self.debug('not caching %s.%s, its arguments are not hashable',
+                       moduleName, methodName)
+            key = None
+
+        d = self.checkCache.run(key, self._runCheck, bundles, moduleName,
+                                methodName, *args, **kwargs)
+        self._statsChanged()
+        return d
+
+    def _statsChanged(self):
+        if self._statsDC is None:
+            self._statsDC = reactor.callLater(self._statsDelay,
+                                              self._sendStats)
+
+    def _sendStats(self):
+        self._statsDC = None
+        d = self.brain.callRemote('checkStats', self.checkCache.getStats())
+        # older managers don't know about them; not worth a warning
+        d.addErrback(lambda failure: self.debug(
+            'could not send check cache statistics: %s',
+            log.getFailureMessage(failure)))
+
+    def _runCheck(self, bundles, moduleName, methodName, *args, **kwargs):
 
         def haveJob(job):
 
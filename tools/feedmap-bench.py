@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+# Measures the time the manager's feed map takes to handle all the
+# components of a planet logging in at once, like after a manager restart,
+# and all of them logging out again.
+#
+# Usage: feedmap-bench.py [number of components...]
+
+import random
+import sys
+import time
+
+from flumotion.common import common
+from flumotion.manager import component
+
+COMPONENTS = (100, 1000, 5000)
+# producer -> encoder -> muxer -> two streamers
+FLOW_SIZE = 5
+
+
+class FakeAvatar:
+
+    def __init__(self, flowName, name, eaters=(), feeders=('default', )):
+        self.flowName = flowName
+        self.name = name
+        self.avatarId = common.componentId(flowName, name)
+        self.eaters = {}
+        for feedId in eaters:
+            self.eaters.setdefault('default', []).append(
+                (feedId, 'default-' + feedId.replace(':', '-')))
+        self.feeders = list(feeders)
+
+    def getEaters(self):
+        return self.eaters
+
+    def getFeeders(self):
+        return self.feeders
+
+    def getFeedId(self, feedName):
+        return common.feedId(self.name, feedName)
+
+    def getFullFeedId(self, feedName):
+        return common.fullFeedId(self.flowName, self.name, feedName)
+
+    def getVirtualFeeds(self):
+        return {}
+
+    def getParentName(self):
+        return self.flowName
+
+
+def makePlanet(count):
+    avatars = []
+    for i in range(count / FLOW_SIZE):
+        flowName = 'flow%d' % i
+        avatars.extend([
+            FakeAvatar(flowName, 'producer', feeders=('audio', 'video')),
+            FakeAvatar(flowName, 'encoder',
+                       eaters=('producer:audio', 'producer:video'),
+                       feeders=('audio', 'video')),
+            FakeAvatar(flowName, 'muxer',
+                       eaters=('encoder:audio', 'encoder:video')),
+            FakeAvatar(flowName, 'streamer1', eaters=('muxer:default', ),
+                       feeders=()),
+            FakeAvatar(flowName, 'streamer2', eaters=('muxer:default', ),
+                       feeders=())])
+    return avatars
+
+
+def storm(count):
+    avatars = makePlanet(count)
+    random.shuffle(avatars)
+    feedMap = component.FeedMap()
+
+    start = time.time()
+    for avatar in avatars:
+        feedMap.componentAttached(avatar)
+        # what the component heaven does to connect the new component
+        feedMap.getFeedersForEaters(avatar)
+        feedMap.getEatersForFeeders(avatar)
+    attach = time.time() - start
+
+    random.shuffle(avatars)
+    start = time.time()
+    for avatar in avatars:
+        for eater, ffid in feedMap.componentDetached(avatar):
+            feedMap.getFeedersForEater(eater, ffid)
+    detach = time.time() - start
+
+    print "%d components: attached in %.3f s (%.0f us each), " \
+          "detached in %.3f s" % (len(avatars), attach,
+                                  attach * 1e6 / len(avatars), detach)
+
+
+def main(args):
+    counts = COMPONENTS
+    if len(args) > 1:
+        counts = [int(arg) for arg in args[1:]]
+    random.seed(0)
+    for count in counts:
+        storm(count)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+# Measures the time to first byte and the stalls of a player reading
+# sequentially a file not cached yet by the http-server httpcached plug,
+# with block requests and with read-ahead windows of several sizes.
+# The origin server is a local stand-in with a fixed latency and bandwidth.
+#
+# Usage: httpcached-bench.py [read-ahead blocks...]
+
+import sys
+import time
+
+from twisted.internet import defer, reactor
+
+from flumotion.component.misc.httpserver.httpcached import http_utils
+from flumotion.component.misc.httpserver.httpcached import strategy_base
+
+READ_AHEAD = (0, 2, 4, 8)
+FILE_SIZE = 8 * 1024 * 1024
+BLOCK_SIZE = 256 * 1024
+# The player reads a block every PLAYER_PERIOD seconds (about 10 Mbit/s)
+PLAYER_PERIOD = 0.2
+ORIGIN_LATENCY = 0.05
+ORIGIN_BANDWIDTH = 40 * 1024 * 1024 # bytes per second
+ORIGIN_CHUNK = 16 * 1024
+
+
+class Info(object):
+
+    def __init__(self, size, start, length, mtime):
+        self.size = size
+        self.offset = start or 0
+        self.length = length
+        self.mtime = mtime
+        self.expires = None
+        self.mimeType = "application/octet-stream"
+
+
+class Request(object):
+
+    logName = "origin-request"
+
+    def __init__(self):
+        self.call = None
+
+    def cancel(self):
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+    def pause(self):
+        pass
+
+    def resume(self):
+        pass
+
+
+class OriginStandIn(object):
+    """
+    Request manager answering range requests for a file of FILE_SIZE bytes
+    after ORIGIN_LATENCY seconds, at ORIGIN_BANDWIDTH bytes per second.
+    """
+
+    def __init__(self):
+        self.data = "x" * FILE_SIZE
+        self.mtime = time.time()
+        self.requests = 0
+
+    def retrieve(self, consumer, url, start=None, size=None,
+                 ifModifiedSince=None, ifUnmodifiedSince=None):
+        self.requests += 1
+        start = start or 0
+        data = self.data[start:start + size]
+        request = Request()
+        request.call = reactor.callLater(ORIGIN_LATENCY, self._reply,
+                                         consumer, request, start, data)
+        return request
+
+    def _reply(self, consumer, request, start, data):
+        consumer.onInfo(request, Info(len(self.data), start, len(data),
+                                      self.mtime))
+        self._send(consumer, request, data)
+
+    def _send(self, consumer, request, data):
+        if not data:
+            request.call = None
+            consumer.streamDone(request)
+            return
+        chunk, data = data[:ORIGIN_CHUNK], data[ORIGIN_CHUNK:]
+        consumer.onData(request, chunk)
+        request.call = reactor.callLater(
+            float(len(chunk)) / ORIGIN_BANDWIDTH,
+            self._send, consumer, request, data)
+
+
+class Player(object):
+
+    def __init__(self, origin, readAhead):
+        self.origin = origin
+        self.url = http_utils.Url.fromString("http://origin/file")
+        self.window = None
+        if readAhead:
+            cache = strategy_base.BlockCache(origin, self.url, FILE_SIZE,
+                                             origin.mtime, BLOCK_SIZE,
+                                             readAhead * 2)
+            self.window = strategy_base.ReadAhead(cache, readAhead)
+        self.offset = 0
+        self.stalls = 0
+        self.stallTime = 0.0
+        self.firstByte = None
+        self.done = defer.Deferred()
+
+    def start(self):
+        self.started = time.time()
+        self._read()
+
+    def _read(self):
+        if self.offset >= FILE_SIZE:
+            if self.window is not None:
+                self.window.cache.close()
+            self.done.callback(self)
+            return
+        if self.window is not None:
+            result = self.window.read(self.offset, BLOCK_SIZE)
+        else:
+            requester = strategy_base.BlockRequester(self.origin, self.url,
+                                                     self.origin.mtime)
+            result = requester.retrieve(self.offset, BLOCK_SIZE)
+        if isinstance(result, defer.Deferred):
+            self.stalls += 1
+            result.addCallback(self._gotData, time.time())
+        else:
+            self._gotData(result, None)
+
+    def _gotData(self, data, stalledSince):
+        now = time.time()
+        if stalledSince is not None:
+            self.stallTime += now - stalledSince
+        if self.firstByte is None:
+            self.firstByte = now - self.started
+        self.offset += len(data)
+        reactor.callLater(PLAYER_PERIOD, self._read)
+
+
+def bench(readAhead):
+    origin = OriginStandIn()
+    player = Player(origin, readAhead)
+    player.start()
+    d = player.done
+    d.addCallback(report, readAhead, origin)
+    return d
+
+
+def report(player, readAhead, origin):
+    reads = FILE_SIZE / BLOCK_SIZE
+    print "read-ahead %2d: TTFB %6.1f ms, %3d/%d stalled reads, " \
+          "%6.1f ms stalled, %d requests" % (
+        readAhead, player.firstByte * 1000, player.stalls, reads,
+        player.stallTime * 1000, origin.requests)
+
+
+def main(args):
+    counts = [int(arg) for arg in args] or READ_AHEAD
+
+    def run(_):
+        d = defer.succeed(None)
+        for count in counts:
+            d.addCallback(lambda _, c=count: bench(c))
+        d.addBoth(lambda _: reactor.stop())
+
+    reactor.callWhenRunning(run, None)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+# Measures the latency of authenticating against the iCalendar bouncer,
+# for calendars made of 4 minute slots every 5 minutes that started
+# some years ago.
+#
+# Usage: icalbouncer-bench.py [years...]
+
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from flumotion.common import keycards, tz
+from flumotion.component.bouncers import icalbouncer
+
+YEARS = (1, 2, 5)
+AUTHENTICATIONS = 1000
+
+ICAL = """BEGIN:VCALENDAR
+PRODID:-//Flumotion Fake Calendar Creator//flumotion.com//
+VERSION:2.0
+BEGIN:VEVENT
+DTSTART:%(dtstart)s
+DTEND:%(dtend)s
+RRULE:FREQ=MINUTELY;INTERVAL=5
+SUMMARY:Slot
+UID:slots
+END:VEVENT
+END:VCALENDAR
+"""
+
+
+def makeBouncer(years):
+    # align the slots so that now is inside one
+    now = datetime.now(tz.UTC).replace(second=0, microsecond=0)
+    start = now - timedelta(days=365 * years, minutes=now.minute % 5)
+    end = start + timedelta(minutes=4)
+    f = tempfile.NamedTemporaryFile(suffix='.ics')
+    f.write(ICAL % {'dtstart': start.strftime('%Y%m%dT%H%M%SZ'),
+                    'dtend': end.strftime('%Y%m%dT%H%M%SZ')})
+    f.flush()
+    conf = {'name': 'bouncer',
+            'plugs': {},
+            'properties': {'file': f.name}}
+    return f, icalbouncer.IcalBouncer(conf)
+
+
+def bench(years):
+    f, bouncer = makeBouncer(years)
+    algorithm = bouncer.get_main_algorithm()
+
+    start = time.time()
+    keycard = algorithm.authenticate(keycards.KeycardGeneric())
+    first = time.time() - start
+    if not keycard:
+        print "%d years: authentication refused, slot just ended" % years
+    start = time.time()
+    for i in range(AUTHENTICATIONS):
+        algorithm.authenticate(keycards.KeycardGeneric())
+    elapsed = time.time() - start
+
+    bouncer.stop()
+    f.close()
+    print "%d years of 5 minute slots: first authentication %.1f ms, " \
+          "then %.3f ms each" % (years, first * 1000,
+                                 elapsed * 1000 / AUTHENTICATIONS)
+
+
+def main(args):
+    years = YEARS
+    if len(args) > 1:
+        years = [int(arg) for arg in args[1:]]
+    for y in years:
+        bench(y)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+# Measures the cost of log calls below the debug level, and the number of
+# requests per second the porter parses at FLU_DEBUG=0 and FLU_DEBUG=2.
+#
+# Usage: log-bench.py [iterations]
+
+import sys
+import time
+
+from flumotion.common import log
+from flumotion.component.misc.porter import porter
+
+
+class Tester(log.Loggable):
+    logCategory = 'logbench'
+
+
+class FakeTransport:
+
+    def fileno(self):
+        return -1
+
+    def write(self, data):
+        pass
+
+    def loseConnection(self):
+        pass
+
+
+class FakePorter:
+
+    def findDestination(self, identifier):
+        return None
+
+
+def timeDisabledCalls(iterations):
+    tester = Tester()
+    tester.debug('installing the no-op method')
+    start = time.time()
+    for i in xrange(iterations):
+        tester.debug('disabled %d', i)
+    shortcut = time.time() - start
+
+    # what every call cost before disabled levels were shortcut
+    start = time.time()
+    for i in xrange(iterations):
+        log.Loggable.debug(tester, 'disabled %d', i)
+    full = time.time() - start
+
+    print "disabled debug call: %.0f ns with no-op method, " \
+          "%.0f ns through the category level check" % (
+        shortcut * 1e9 / iterations, full * 1e9 / iterations)
+
+
+def timePorter(iterations):
+    request = 'GET /stream.ogg HTTP/1.0\r\nUser-Agent: bench\r\n\r\n'
+    chunks = [request[i:i + 8] for i in range(0, len(request), 8)]
+    fakePorter = FakePorter()
+    transport = FakeTransport()
+    start = time.time()
+    for i in xrange(iterations):
+        p = porter.HTTPPorterProtocol(fakePorter)
+        p.transport = transport
+        for chunk in chunks:
+            p.dataReceived(chunk)
+        p.connectionLost(None)
+    elapsed = time.time() - start
+    return iterations / elapsed
+
+
+def main(args):
+    iterations = 100000
+    if len(args) > 1:
+        iterations = int(args[1])
+
+    log.init()
+    log.setFluDebug('0')
+    timeDisabledCalls(iterations)
+    rates = []
+    for debug in ('0', '2'):
+        log.setFluDebug(debug)
+        rates.append(timePorter(iterations / 10))
+    print "porter: %.0f requests/s at FLU_DEBUG=0, " \
+          "%.0f requests/s at FLU_DEBUG=2" % tuple(rates)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
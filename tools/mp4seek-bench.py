@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+# Measures the time to first byte of MP4 seeks of the http-server component
+# with and without the MP4 index cache: the time to rebuild the header for
+# a start time, for seeks spread over the duration of a file.
+# Needs the mp4seek library and a (long) MP4 file.
+#
+# Usage: mp4seek-bench.py FILE DURATION [SEEKS]
+
+import os
+import sys
+import time
+
+from twisted.internet import defer, reactor
+
+from flumotion.component.misc.httpserver import httpfile
+from flumotion.component.misc.httpserver import localpath
+from flumotion.component.misc.httpserver import localprovider
+
+SEEKS = 50
+
+
+def bench(resource, path, starts, label):
+    times = []
+
+    def seek(_, start):
+        provider = localprovider.LocalFile(path, 'video/mp4')
+        began = time.time()
+        d = resource._split_file(provider, start)
+        d.addCallback(done, provider, began)
+        return d
+
+    def done(result, provider, began):
+        times.append(time.time() - began)
+        provider.close()
+
+    d = defer.succeed(None)
+    for start in starts:
+        d.addCallback(seek, start)
+    d.addCallback(report, times, label)
+    return d
+
+
+def report(_, times, label):
+    times.sort()
+    print "%-28s mean %7.2f ms, median %7.2f ms, max %7.2f ms" % (
+        label, sum(times) / len(times) * 1000,
+        times[len(times) // 2] * 1000, times[-1] * 1000)
+
+
+def main(args):
+    if len(args) < 2 or not httpfile.HAS_MP4SEEK:
+        print "Usage: mp4seek-bench.py FILE DURATION [SEEKS] (needs mp4seek)"
+        sys.exit(1)
+    path = os.path.abspath(args[0])
+    duration = float(args[1])
+    seeks = len(args) > 2 and int(args[2]) or SEEKS
+    starts = [duration * (i + 1) / (seeks + 1) for i in range(seeks)]
+    resource = httpfile.MP4File(localpath.LocalPath(path), None)
+
+    def run():
+        # Keeping nothing
+        httpfile.MP4File.indexCache = httpfile.MP4IndexCache(maxSize=0)
+        d = bench(resource, path, starts, "no cache:")
+        d.addCallback(lambda _: setattr(httpfile.MP4File, 'indexCache',
+                                        httpfile.MP4IndexCache()))
+        d.addCallback(lambda _: bench(resource, path, starts[:1],
+                                      "cache, first seek:"))
+        d.addCallback(lambda _: bench(resource, path, starts[1:],
+                                      "cache, other start times:"))
+        d.addCallback(lambda _: bench(resource, path, starts,
+                                      "cache, same start times:"))
+        d.addBoth(lambda _: reactor.stop())
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
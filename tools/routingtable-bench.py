@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+# Measures loading a GeoIP-like routing table from a file, and the number
+# of lookups per second in it, for IPv4 and IPv6 prefixes.
+#
+# Usage: routingtable-bench.py [prefixes]
+
+import random
+import StringIO
+import sys
+import time
+
+from flumotion.common import netutils
+
+LOOKUPS = 100000
+COUNTRIES = ['c%02d' % i for i in range(200)]
+
+
+def makeFile(count, family, r):
+    lines = []
+    seen = {}
+    if family == 'IPv4':
+        bits = 32
+        lengths = range(8, 33)
+    else:
+        bits = 128
+        lengths = range(19, 65)
+    while len(lines) < count:
+        maskBits = r.choice(lengths)
+        ip = r.getrandbits(bits) & ~((1 << (bits - maskBits)) - 1)
+        if (maskBits, ip) in seen:
+            continue
+        seen[maskBits, ip] = True
+        if family == 'IPv4':
+            ip = netutils.ipv4IntToString(ip)
+        else:
+            ip = netutils.formatAddress(netutils.socket.AF_INET6, ip)
+        lines.append('%s/%d %s\n' % (ip, maskBits, r.choice(COUNTRIES)))
+    return StringIO.StringIO(''.join(lines))
+
+
+def bench(count, family):
+    r = random.Random(0)
+    f = makeFile(count, family, r)
+
+    start = time.time()
+    table = netutils.RoutingTable.fromFile(f)
+    loaded = time.time() - start
+    # the first lookup builds the lookup array
+    start = time.time()
+    table.route('1.2.3.4')
+    table.route('2001:db8::1')
+    compiled = time.time() - start
+
+    if family == 'IPv4':
+        ips = [netutils.ipv4IntToString(r.getrandbits(32))
+               for i in xrange(LOOKUPS)]
+    else:
+        ips = [netutils.formatAddress(netutils.socket.AF_INET6,
+                                      r.getrandbits(128) >> 64 << 64)
+               for i in xrange(LOOKUPS)]
+    start = time.time()
+    for ip in ips:
+        table.route(ip)
+    elapsed = time.time() - start
+
+    print "%s, %d prefixes: loaded in %.2f s, lookup array built " \
+          "in %.2f s, %.0f lookups/s" % (family, count, loaded, compiled,
+                                         LOOKUPS / elapsed)
+
+
+def main(args):
+    count = 500000
+    if len(args) > 1:
+        count = int(args[1])
+    bench(count, 'IPv4')
+    bench(count, 'IPv6')
+
+
+if __name__ == '__main__':
+    main(sys.argv)